@@ -19,6 +19,9 @@ typedef unsigned char bool;
 typedef struct {
   PyObject_HEAD;
   tree_t *tree;
+  // the file the tree is mapped from, as long as it's not modified.  NULL
+  // otherwise.
+  PyObject *mapped_path;
 } fastmanifest;
 
 typedef struct {
@@ -121,6 +124,7 @@ static int fastmanifest_init(fastmanifest *self, PyObject *args) {
 
 static void fastmanifest_dealloc(fastmanifest *self) {
   destroy_tree(self->tree);
+  Py_XDECREF(self->mapped_path);
   PyObject_Del(self);
 }
 
@@ -187,7 +191,7 @@ static PyObject * fastmanifest_save(fastmanifest *self, PyObject *args){
   }
 }
 
-static PyObject *fastmanifest_load(PyObject *cls, PyObject *args) {
+static PyObject *fastmanifest_fromfile(PyObject *args, bool mapped) {
   PyObject *pydata = NULL;
   char *data;
   ssize_t len;
@@ -199,13 +203,24 @@ static PyObject *fastmanifest_load(PyObject *cls, PyObject *args) {
     PyErr_Format(PyExc_ValueError, "Illegal filepath");
     return NULL;
   }
-  read_from_file_result_t result = read_from_file(data, (size_t) len);
+  read_from_file_result_t result = mapped ?
+      map_from_file(data, (size_t) len) :
+      read_from_file(data, (size_t) len);
 
   switch (result.code) {
     case READ_FROM_FILE_OK: {
       fastmanifest *read_manifest = PyObject_New(
           fastmanifest, &fastmanifestType);
+      if (!read_manifest) {
+        destroy_tree(result.tree);
+        return PyErr_NoMemory();
+      }
       read_manifest->tree = result.tree;
+      read_manifest->mapped_path = NULL;
+      if (result.tree->mapping != NULL) {
+        Py_INCREF(pydata);
+        read_manifest->mapped_path = pydata;
+      }
       return (PyObject *) read_manifest;
     }
 
@@ -224,10 +239,35 @@ static PyObject *fastmanifest_load(PyObject *cls, PyObject *args) {
   }
 }
 
+static PyObject *fastmanifest_load(PyObject *cls, PyObject *args) {
+  return fastmanifest_fromfile(args, false);
+}
+
+static PyObject *fastmanifest_loadmapped(PyObject *cls, PyObject *args) {
+  return fastmanifest_fromfile(args, true);
+}
+
 static fastmanifest *fastmanifest_copy(fastmanifest *self) {
+  if (self->mapped_path) {
+    // the tree is still the file it's mapped from, map it again rather than
+    // copying it.
+    PyObject *args = PyTuple_Pack(1, self->mapped_path);
+    if (!args) {
+      return NULL;
+    }
+    fastmanifest *copy = (fastmanifest *) fastmanifest_fromfile(args, true);
+    Py_DECREF(args);
+    if (copy) {
+      return copy;
+    }
+    // the file is gone, copy the tree
+    PyErr_Clear();
+  }
+
   fastmanifest *copy = PyObject_New(fastmanifest, &fastmanifestType);
   if (copy) {
     copy->tree = copy_tree(self->tree);
+    copy->mapped_path = NULL;
   }
 
   if (!copy)
@@ -268,6 +308,8 @@ static fastmanifest *fastmanifest_filtercopy(
   fastmanifest *py_copy = PyObject_New(fastmanifest, &fastmanifestType);
   tree_t *copy = NULL;
   if (py_copy) {
+    py_copy->tree = NULL;
+    py_copy->mapped_path = NULL;
     filter_copy_context_t context;
 
     context.matchfn = matchfn;
@@ -551,6 +593,8 @@ static int fastmanifest_setitem(fastmanifest *self, PyObject *key,
   char *path, *hash, *flags;
   ssize_t plen, hlen, flen;
   int err;
+  // the tree no longer matches the file it's mapped from
+  Py_CLEAR(self->mapped_path);
   /* Decode path */
   if (!fastmanifest_is_valid_manifest_key(key)) {
     PyErr_Format(PyExc_TypeError, "Manifest keys must be strings.");
@@ -682,6 +726,9 @@ static PyMethodDef fastmanifest_methods[] = {
    "Save a fastmanifest to a file"},
   {"load", (PyCFunction)fastmanifest_load, METH_VARARGS | METH_CLASS,
    "Load a tree manifest from a file"},
+  {"loadmapped", (PyCFunction)fastmanifest_loadmapped,
+   METH_VARARGS | METH_CLASS,
+   "Map a tree manifest from a file, only copying what gets modified"},
   {"diff", (PyCFunction)fastmanifest_diff, METH_VARARGS | METH_KEYWORDS,
    "Compare this fastmanifest to another one."},
   {"text", (PyCFunction)fastmanifest_text, METH_NOARGS,
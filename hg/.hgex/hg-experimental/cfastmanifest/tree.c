@@ -113,7 +113,7 @@ void destroy_tree(tree_t *tree) {
   } else {
     free(tree->shadow_root);
   }
-  free(tree->arena);
+  release_arena(tree);
 
   free(tree);
 }
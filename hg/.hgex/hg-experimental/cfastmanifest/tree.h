@@ -42,6 +42,9 @@ typedef struct _tree_t {
   /* this is also a literal pointer. */
   size_t arena_sz;
   bool compacted;
+  /* if the arena is mapped from a file, the whole mapping.  NULL otherwise. */
+  void *mapping;
+  size_t mapping_sz;
 
 #if 0 // FIXME: (ttung) probably remove this
   allocation_mode_t mode;
@@ -99,6 +102,12 @@ extern bool contains_path(
 
 extern read_from_file_result_t read_from_file(char *fname, size_t fname_sz);
 
+/**
+ * Like read_from_file, but maps the file privately instead of reading it into
+ * a new arena.  Pages of the file are only copied once they're modified.
+ */
+extern read_from_file_result_t map_from_file(char *fname, size_t fname_sz);
+
 extern write_to_file_result_t write_to_file(
     tree_t *tree, char *fname, size_t fname_sz);
 
@@ -6,6 +6,10 @@
 // no-check-code
 
 #include <stdlib.h>
+#include <string.h>
+#if !defined(_WIN32)
+#include <sys/mman.h>
+#endif
 
 #include "node.h"
 #include "tree.h"
@@ -65,8 +69,17 @@ arena_alloc_node_result_t arena_alloc_node_helper(
           new_arena_sz = tree->arena_sz + ARENA_MAX_STORAGE_INCREMENT;
         }
 
-        // resize the arena so it's bigger.
-        void *new_arena = realloc(tree->arena, new_arena_sz);
+        // resize the arena so it's bigger.  a mapped arena can't be resized,
+        // so it's moved to the heap.
+        void *new_arena;
+        if (tree->mapping != NULL) {
+          new_arena = malloc(new_arena_sz);
+          if (new_arena != NULL) {
+            memcpy(new_arena, tree->arena, tree->arena_sz);
+          }
+        } else {
+          new_arena = realloc(tree->arena, new_arena_sz);
+        }
 
         if (new_arena == NULL) {
           return COMPOUND_LITERAL(arena_alloc_node_result_t) {
@@ -91,6 +104,9 @@ arena_alloc_node_result_t arena_alloc_node_helper(
           intptr_t new_arena_free_start = new_arena_start;
           new_arena_free_start += (arena_free_start - arena_start);
           tree->arena_free_start = (void *) new_arena_free_start;
+          if (tree->mapping != NULL) {
+            release_arena(tree);
+          }
           tree->arena = new_arena;
         }
         tree->arena_sz = new_arena_sz;
@@ -132,3 +148,16 @@ tree_t *alloc_tree_with_arena(size_t arena_sz) {
 
   return tree;
 }
+
+void release_arena(tree_t *tree) {
+  if (tree->mapping != NULL) {
+#if !defined(_WIN32)
+    munmap(tree->mapping, tree->mapping_sz);
+#endif
+    tree->mapping = NULL;
+    tree->mapping_sz = 0;
+  } else {
+    free(tree->arena);
+  }
+  tree->arena = NULL;
+}
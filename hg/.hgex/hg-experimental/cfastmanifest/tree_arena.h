@@ -80,4 +80,9 @@ static inline arena_alloc_node_result_t arena_alloc_node_strict(
  */
 extern tree_t *alloc_tree_with_arena(size_t arena_sz);
 
+/**
+ * Frees the arena of a tree, or unmaps it if it's mapped from a file.
+ */
+extern void release_arena(tree_t *tree);
+
 #endif /* #ifndef __FASTMANIFEST_TREE_ARENA_H__ */
@@ -5,10 +5,14 @@
 // no-check-code
 
 #include <errno.h>
+#include <fcntl.h>
 #include <memory.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <unistd.h>
 #include <arpa/inet.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 #include "checksum.h"
 #include "node.h"
@@ -110,6 +114,43 @@ static inline size_t read_noint(FILE *fh, void *_buf, size_t nbytes) {
       goto cleanup;                                          \
     }                                                        \
   }
+/**
+ * Checks that the header describes a tree this host can use.
+ */
+static read_from_file_code_t check_header(const v0_header_t *header) {
+  if (memcmp(header->magic, MAGIC, sizeof(MAGIC)) != 0) {
+    return READ_FROM_FILE_WTF;
+  }
+
+  // endianness
+  if (little_endian()) {
+    if (header->byte_order != BYTE_ORDER_LITTLE_ENDIAN) {
+      return READ_FROM_FILE_NOT_USABLE;
+    }
+  } else {
+    if (header->byte_order != BYTE_ORDER_BIG_ENDIAN) {
+      return READ_FROM_FILE_NOT_USABLE;
+    }
+  }
+
+  // host pointer size
+  if (header->address_size != host_pointer_size()) {
+    return READ_FROM_FILE_NOT_USABLE;
+  }
+
+  // file version.
+  if (header->file_version != FILE_VERSION) {
+    return READ_FROM_FILE_NOT_USABLE;
+  }
+
+  if (header->file_sz < header->header_sz ||
+      header->file_sz - header->header_sz > SIZE_MAX) {
+    return READ_FROM_FILE_WTF;
+  }
+
+  return READ_FROM_FILE_OK;
+}
+
 read_from_file_result_t read_from_file(char *fname, size_t fname_sz) {
   char *fname_dst = malloc(fname_sz + 1);
   if (fname_dst == NULL) {
@@ -130,57 +171,134 @@ read_from_file_result_t read_from_file(char *fname, size_t fname_sz) {
   v0_header_t header;
 
   CHECKED_READ(fh, &header, sizeof(v0_header_t));
-  if (memcmp(header.magic, MAGIC, sizeof(MAGIC)) != 0) {
-    result.code = READ_FROM_FILE_WTF;
+  result.code = check_header(&header);
+  if (result.code != READ_FROM_FILE_OK) {
     goto cleanup;
   }
 
-  // endianness
-  if (little_endian()) {
-    if (header.byte_order != BYTE_ORDER_LITTLE_ENDIAN) {
-      result.code = READ_FROM_FILE_NOT_USABLE;
-      goto cleanup;
-    }
-  } else {
-    if (header.byte_order != BYTE_ORDER_BIG_ENDIAN) {
-      result.code = READ_FROM_FILE_NOT_USABLE;
-      goto cleanup;
-    }
+  // at this point, the file offset should == header_sz
+  if (ftell(fh) != header.header_sz) {
+    result.code = READ_FROM_FILE_WTF;
+    goto cleanup;
   }
 
-  // host pointer size
-  if (header.address_size != host_pointer_size()) {
-    result.code = READ_FROM_FILE_NOT_USABLE;
+  size_t arena_sz = (size_t) (header.file_sz - header.header_sz);
+
+  // allocate the tree
+  result.tree = alloc_tree_with_arena(arena_sz);
+  if (result.tree == NULL) {
+    result.code = READ_FROM_FILE_OOM;
     goto cleanup;
   }
 
-  // file version.
-  if (header.file_version != FILE_VERSION) {
-    result.code = READ_FROM_FILE_NOT_USABLE;
+  // read the tree
+  CHECKED_READ(fh, result.tree->arena, arena_sz);
+
+  // find the real root and parent it to shadow root.
+  node_t *real_root = (node_t *) ( ((intptr_t) result.tree->arena) +
+                                   header.root_offset );
+  add_child(result.tree->shadow_root, real_root);
+
+  // write all the stats into place.
+  result.tree->arena_sz = arena_sz;
+  result.tree->arena_free_start = result.tree->arena + result.tree->arena_sz;
+  result.tree->compacted = true;
+  result.tree->consumed_memory = header.consumed_memory;
+  result.tree->num_leaf_nodes = header.num_leaf_nodes;
+
+  result.code = READ_FROM_FILE_OK;
+
+cleanup:
+  if (result.code != READ_FROM_FILE_OK && result.tree != NULL) {
+    destroy_tree(result.tree);
+  }
+  if (fh != NULL) {
+    fclose(fh);
+  }
+  free(fname_dst);
+  return result;
+
+}
+
+read_from_file_result_t map_from_file(char *fname, size_t fname_sz) {
+  char *fname_dst = malloc(fname_sz + 1);
+  if (fname_dst == NULL) {
+    return COMPOUND_LITERAL(read_from_file_result_t) {READ_FROM_FILE_OOM, 0, NULL};
+  }
+  memcpy(fname_dst, fname, fname_sz);
+  fname_dst[fname_sz] = '\x00';
+
+  read_from_file_result_t result = { 0 };
+  void *mapping = MAP_FAILED;
+  size_t mapping_sz = 0;
+
+  int fd = open(fname_dst, O_RDONLY);
+  struct stat st;
+  if (fd == -1 || fstat(fd, &st) == -1) {
+    result.err = errno;
+    result.code = READ_FROM_FILE_NOT_READABLE;
     goto cleanup;
   }
 
-  // at this point, the file offset should == header_sz
-  if (ftell(fh) != header.header_sz) {
+  if ((uint64_t) st.st_size < sizeof(v0_header_t) ||
+      (uint64_t) st.st_size > SIZE_MAX) {
     result.code = READ_FROM_FILE_WTF;
     goto cleanup;
   }
+  mapping_sz = (size_t) st.st_size;
+
+  // the mapping is private and writable: modifying the tree copies the pages
+  // it touches, and leaves the file alone.
+  mapping = mmap(NULL, mapping_sz, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+  if (mapping == MAP_FAILED) {
+    result.err = errno;
+    result.code = READ_FROM_FILE_NOT_READABLE;
+    goto cleanup;
+  }
+
+  v0_header_t header;
+  memcpy(&header, mapping, sizeof(v0_header_t));
+  result.code = check_header(&header);
+  if (result.code != READ_FROM_FILE_OK) {
+    goto cleanup;
+  }
 
-  if (header.file_sz - header.header_sz > SIZE_MAX) {
+  if (header.file_sz != mapping_sz ||
+      header.header_sz != sizeof(v0_header_t) ||
+      header.root_offset < 0 ||
+      (uint64_t) header.root_offset >= header.file_sz - header.header_sz) {
     result.code = READ_FROM_FILE_WTF;
     goto cleanup;
   }
+
+  // the nodes are read in place, so they have to be aligned.  that's the case
+  // as long as the header is, otherwise fall back to reading the file.
+  if (header.header_sz % sizeof(void *) != 0) {
+    munmap(mapping, mapping_sz);
+    mapping = MAP_FAILED;
+    result = read_from_file(fname, fname_sz);
+    goto cleanup;
+  }
   size_t arena_sz = (size_t) (header.file_sz - header.header_sz);
 
-  // allocate the tree
-  result.tree = alloc_tree_with_arena(arena_sz);
-  if (result.tree == NULL) {
+  // allocate the tree, without an arena.
+  result.tree = (tree_t *) calloc(1, sizeof(tree_t));
+  node_t *shadow_root = alloc_node("/", 1, 1);
+  if (result.tree == NULL || shadow_root == NULL) {
+    free(result.tree);
+    free(shadow_root);
+    result.tree = NULL;
     result.code = READ_FROM_FILE_OOM;
     goto cleanup;
   }
+  shadow_root->type = TYPE_ROOT;
+  result.tree->shadow_root = shadow_root;
 
-  // read the tree
-  CHECKED_READ(fh, result.tree->arena, arena_sz);
+  // the arena is the mapped file, past the header.
+  result.tree->mapping = mapping;
+  result.tree->mapping_sz = mapping_sz;
+  result.tree->arena = (char *) mapping + header.header_sz;
+  mapping = MAP_FAILED;
 
   // find the real root and parent it to shadow root.
   node_t *real_root = (node_t *) ( ((intptr_t) result.tree->arena) +
@@ -199,13 +317,16 @@ read_from_file_result_t read_from_file(char *fname, size_t fname_sz) {
 cleanup:
   if (result.code != READ_FROM_FILE_OK && result.tree != NULL) {
     destroy_tree(result.tree);
+    result.tree = NULL;
   }
-  if (fh != NULL) {
-    fclose(fh);
+  if (mapping != MAP_FAILED) {
+    munmap(mapping, mapping_sz);
+  }
+  if (fd != -1) {
+    close(fd);
   }
   free(fname_dst);
   return result;
-
 }
 
 static inline size_t write_noint(FILE *fh, void *_buf, size_t nbytes) {
@@ -92,9 +92,60 @@ static void save_load_small_tree() {
   ASSERT(diff_result == DIFF_OK);
 }
 
+static void save_map_small_tree() {
+  tree_t *tree = alloc_tree();
+
+  add_to_tree_t toadd[] = {
+      {STRPLUSLEN("abc"), 12345, 5},
+      {STRPLUSLEN("ab/cdef/gh"), 64342, 55},
+      {STRPLUSLEN("ab/cdef/ghi/jkl"), 51545, 57},
+      {STRPLUSLEN("a"), 577, 14},
+  };
+
+  add_to_tree(tree, toadd, sizeof(toadd) / sizeof(add_to_tree_t));
+
+  char *tempfile = get_tempfile();
+  write_to_file_result_t write_result = write_to_file_helper(
+      tree, STRPLUSLEN(tempfile), true);
+  ASSERT(write_result == WRITE_TO_FILE_OK);
+
+  read_from_file_result_t map_result = map_from_file(STRPLUSLEN(tempfile));
+
+  ASSERT(map_result.code == READ_FROM_FILE_OK);
+  ASSERT(map_result.tree->mapping != NULL);
+  diff_result_t diff_result = diff_trees(
+      tree, map_result.tree, false, never_called_callback, NULL);
+
+  ASSERT(diff_result == DIFF_OK);
+
+  // modifying the mapped tree leaves the file alone.
+  add_to_tree_t tomodify[] = {
+      {STRPLUSLEN("ab/cdef/ghi/jklm"), 54774, 12},
+      {STRPLUSLEN("abc"), 48477, 252},
+  };
+  add_to_tree(map_result.tree, tomodify,
+      sizeof(tomodify) / sizeof(add_to_tree_t));
+  ASSERT(remove_path(map_result.tree, STRPLUSLEN("a")) == REMOVE_PATH_OK);
+
+  read_from_file_result_t read_result = read_from_file(STRPLUSLEN(tempfile));
+
+  ASSERT(read_result.code == READ_FROM_FILE_OK);
+  diff_result = diff_trees(
+      tree, read_result.tree, false, never_called_callback, NULL);
+
+  ASSERT(diff_result == DIFF_OK);
+
+  destroy_tree(map_result.tree);
+  destroy_tree(read_result.tree);
+  destroy_tree(tree);
+  unlink(tempfile);
+  free(tempfile);
+}
+
 int main(int argc, char *argv[]) {
   save_load_empty_tree();
   save_load_small_tree();
+  save_map_small_tree();
 
   return 0;
 }
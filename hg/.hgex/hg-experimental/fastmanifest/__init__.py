@@ -35,9 +35,21 @@ cacheonchange = False
 # Make cacheonchange(see above) work in the background.
 cacheonchangebackground = True
 
+# How long the background worker waits after caching a manifest, in
+# milliseconds, so that it doesn't compete with the commands being run
+workerdelayms = 100
+
+# How many of the manifests a command missed in the cache are queued to be
+# cached, when cacheonchange is set
+maxqueuedmisses = 10
+
 # Maximum number of fastmanifest kept in volatile memory
 maxinmemoryentries = 10
 
+# Map the cached fastmanifests in memory instead of reading them, so only the
+# parts that are modified get copied
+mmapcache = True
+
 # Dump metrics after each command, see metrics.py
 debugmetrics = False
 
@@ -65,6 +77,11 @@ usecache=False
 # Enables the use of treemanifests (defaults to False)
 usetree=True
 
+# Maximum size in megabytes of the tree manifest nodes shared between
+# processes, so that they don't each read them from the datastore. 0 disables
+# sharing them.
+sharedtreecachemb = 64
+
 Description:
 
 `manifestaccesslogger` logs manifest accessed to a logfile specified with
@@ -72,12 +89,20 @@ the option fastmanifest.logfile
 
 `fastmanifesttocache` is a revset of relevant manifests to cache
 
+`workqueue` is the queue of the manifests to cache, most relevant first. The
+changes that make manifests relevant add them to the queue, and a single
+background worker drains it.
+
 `hybridmanifest` is a proxy class for flat and cached manifest that loads
 manifest from cache or from disk.
 It chooses what kind of manifest is relevant to create based on the operation,
 ideally the fastest.
 TODO instantiate fastmanifest when they are more suitable
 
+`sharedtreecache` keeps the tree manifest nodes commands read in files
+mapped in memory, so that the next commands build the same trees without
+reading them from the datastore.
+
 `manifestcache` is the class handling the interface with the cache, it supports
 caching flat and fast manifest and retrieving them.
 TODO logic for loading fastmanifest
@@ -97,14 +122,18 @@ and flat manifest, asynchronously and synchronously.
 import sys
 
 from mercurial import bookmarks, dispatch, error, extensions
-from mercurial import localrepo, manifest, registrar
+from mercurial import localrepo, manifest, registrar, util
 from mercurial import revset as revsetmod
 from mercurial.i18n import _
 
 import cachemanager
 from metrics import metricscollector
 import debug
-from implementation import manifestfactory, fastmanifestcache
+from implementation import (
+    fastmanifestcache,
+    manifestfactory,
+    treemanifestcache,
+)
 
 cmdtable = {}
 command = registrar.command(cmdtable)
@@ -158,7 +187,8 @@ def debugcachemanifest(ui, repo, *pats, **opts):
 @command('^cachemanifest', [],
     'hg cachemanifest')
 def cachemanifest(ui, repo, *pats, **opts):
-    cachemanager.cacher.cachemanifest(repo)
+    delay = ui.configint("fastmanifest", "workerdelayms", 100) / 1000.0
+    cachemanager.cacher.cachemanifest(repo, delay=delay)
 
 class uiproxy(object):
     """This is a proxy object that forwards all requests to a real ui object."""
@@ -182,6 +212,16 @@ class FastManifestExtension(object):
         metricscollector.get().logsamples(ui)
         return r
 
+    @staticmethod
+    def _flushonexit(orig, ui, repo, *args):
+        r = orig(ui, repo, *args)
+        # Share the tree nodes the command read with the next commands
+        if repo is not None:
+            opener = repo.store.opener
+            if util.safehasattr(opener, 'treemanifestcache'):
+                treemanifestcache.getinstance(opener, ui).flush()
+        return r
+
     @staticmethod
     def get_ui():
         return FastManifestExtension.uiproxy
@@ -239,6 +279,9 @@ class FastManifestExtension(object):
         extensions.wrapfunction(
             dispatch, 'runcommand',
             FastManifestExtension._logonexit)
+        extensions.wrapfunction(
+            dispatch, 'runcommand',
+            FastManifestExtension._flushonexit)
 
 def extsetup(ui):
     # always update the ui object.  this is probably a bogus ui object, but we
@@ -0,0 +1,245 @@
+# cacheindex.py
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+import heapq
+import os
+import string
+
+from mercurial import error, util
+
+import concurrency
+
+# The index lives in the cache directory, next to the entries
+INDEXFILE = "index"
+LOCKFILE = "index.lock"
+
+# How many more records than twice the number of entries the index can hold
+# before it's rewritten
+COMPACTSLACK = 1000
+
+# Translating hex nodes with this table reverses their sort order
+_reversehex = string.maketrans("0123456789abcdef", "fedcba9876543210")
+
+class cacheindex(object):
+    """The sizes and relevance of the entries of the on disk cache.
+
+    The index file is a journal, where each line records a change:
+
+      +<hexnode> <size> <time>  an entry was written
+      =<hexnode> <time>         an entry was accessed, or ranked
+      -<hexnode>                an entry was removed
+
+    An entry's time is what the cache ranks it by, most recent first, like
+    the mtimes of the entries used to. Records are appended with a single
+    write, so processes don't need a lock to add them. Each process reads
+    the index once and then only the records appended since, so the total
+    size of the cache and its least relevant entry are known without
+    listing and statting the directory.
+
+    The index is rewritten from the cache directory when it gets too long,
+    and when it's missing or corrupt, for example after a crash. Only one
+    process rewrites it at a time, under a looselock.
+    """
+    def __init__(self, vfs, cachepath, prefix):
+        self._vfs = vfs
+        self._cachepath = cachepath
+        self._prefix = prefix
+        self._path = os.path.join(cachepath, INDEXFILE)
+        self._lockname = os.path.relpath(os.path.join(cachepath, LOCKFILE),
+                                         vfs.join(None))
+        self._reset()
+
+    def _reset(self):
+        # hexnode -> (time, size)
+        self._entries = {}
+        # (time, reversed hexnode, hexnode), least relevant first. Entries
+        # whose time changed since they were pushed are stale.
+        self._heap = []
+        self._totalsize = 0
+        self._records = 0
+        # The index file read so far, and how much of it
+        self._ino = None
+        self._offset = 0
+
+    def refresh(self):
+        """Reads the records other processes appended to the index."""
+        try:
+            st = os.stat(self._path)
+        except EnvironmentError:
+            self._rebuild()
+            return
+
+        if st.st_ino != self._ino or st.st_size < self._offset:
+            # The index was rewritten
+            self._reset()
+            self._ino = st.st_ino
+        if st.st_size > self._offset:
+            try:
+                with open(self._path, "rb") as f:
+                    f.seek(self._offset)
+                    data = f.read(st.st_size - self._offset)
+            except EnvironmentError:
+                self._rebuild()
+                return
+
+            # A record may be in the middle of being appended
+            end = data.rfind("\n") + 1
+            try:
+                for line in data[:end].splitlines():
+                    self._apply(line)
+            except (ValueError, IndexError):
+                self._rebuild()
+                return
+            self._offset += end
+
+    def _apply(self, line):
+        op, fields = line[0], line[1:].split(" ")
+        hexnode = fields[0]
+        if op == "+":
+            self._set(hexnode, float(fields[2]), int(fields[1]))
+        elif op == "=":
+            entry = self._entries.get(hexnode)
+            if entry is not None:
+                self._set(hexnode, float(fields[1]), entry[1])
+        elif op == "-":
+            entry = self._entries.pop(hexnode, None)
+            if entry is not None:
+                self._totalsize -= entry[1]
+        else:
+            raise ValueError("unknown cache index record %r" % line)
+        self._records += 1
+
+    def _set(self, hexnode, time, size):
+        entry = self._entries.get(hexnode)
+        if entry is not None:
+            self._totalsize -= entry[1]
+        self._entries[hexnode] = (time, size)
+        self._totalsize += size
+        if entry is None or entry[0] != time:
+            heap = self._heap
+            if len(heap) > 2 * len(self._entries) + COMPACTSLACK:
+                heap[:] = [(t, h.translate(_reversehex), h)
+                           for h, (t, s) in self._entries.iteritems()]
+                heapq.heapify(heap)
+            else:
+                heapq.heappush(heap, (time, hexnode.translate(_reversehex),
+                                      hexnode))
+
+    def _append(self, line):
+        if self._records > 2 * len(self._entries) + COMPACTSLACK:
+            self._rebuild()
+        try:
+            with open(self._path, "ab") as f:
+                f.write(line)
+        except EnvironmentError:
+            # The cache isn't writable, see ondiskcache
+            pass
+
+    def _rebuild(self):
+        """Rewrites the index from the entries in the cache directory,
+        keeping the times of the entries the index already knows."""
+        known = self._entries
+        self._reset()
+        try:
+            names = os.listdir(self._cachepath)
+        except EnvironmentError:
+            names = []
+        for name in names:
+            if not name.startswith(self._prefix):
+                continue
+            hexnode = name[len(self._prefix):]
+            try:
+                st = os.stat(os.path.join(self._cachepath, name))
+            except EnvironmentError:
+                # Removed by another process
+                continue
+            time = known[hexnode][0] if hexnode in known else st.st_mtime
+            self._set(hexnode, time, st.st_size)
+
+        if not self._entries and not os.path.exists(self._path):
+            return
+        try:
+            with concurrency.looselock(self._vfs, self._lockname):
+                f = util.atomictempfile(self._path)
+                try:
+                    for hexnode, (time, size) in self._entries.iteritems():
+                        f.write("+%s %d %r\n" % (hexnode, size, time))
+                    self._offset = f.tell()
+                    f.close()
+                finally:
+                    f.discard()
+                self._ino = os.stat(self._path).st_ino
+                self._records = len(self._entries)
+        except (error.LockError, EnvironmentError):
+            # Another process is rewriting the index, or the cache isn't
+            # writable. Keep what was read, refresh will pick up the new
+            # index.
+            self._offset = 0
+            self._ino = None
+
+    def __contains__(self, hexnode):
+        self.refresh()
+        return hexnode in self._entries
+
+    def __len__(self):
+        self.refresh()
+        return len(self._entries)
+
+    def size(self, hexnode):
+        """Returns the size of an entry, or None if it isn't in the cache"""
+        self.refresh()
+        entry = self._entries.get(hexnode)
+        return entry[1] if entry is not None else None
+
+    def totalsize(self):
+        self.refresh()
+        return self._totalsize
+
+    def add(self, hexnode, size, time):
+        self.refresh()
+        self._set(hexnode, time, size)
+        self._append("+%s %d %r\n" % (hexnode, size, time))
+
+    def touch(self, hexnode, time):
+        self.refresh()
+        if hexnode in self._entries:
+            self._set(hexnode, time, self._entries[hexnode][1])
+            self._append("=%s %r\n" % (hexnode, time))
+
+    def remove(self, hexnode):
+        self.refresh()
+        entry = self._entries.pop(hexnode, None)
+        if entry is not None:
+            self._totalsize -= entry[1]
+            self._append("-%s\n" % hexnode)
+
+    def sorted(self):
+        """Returns the entries, from most relevant to least relevant"""
+        self.refresh()
+        entries = self._entries
+        return sorted(entries, key=lambda h: (-entries[h][0], h))
+
+    def leastrelevant(self, excluded=()):
+        """Returns the least relevant entry that isn't in excluded, or None
+        if there is none"""
+        self.refresh()
+        heap = self._heap
+        skipped = []
+        result = None
+        while heap:
+            time, reversedhex, hexnode = heap[0]
+            entry = self._entries.get(hexnode)
+            if entry is None or entry[0] != time:
+                heapq.heappop(heap)
+            elif hexnode in excluded:
+                skipped.append(heapq.heappop(heap))
+            else:
+                result = hexnode
+                break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return result
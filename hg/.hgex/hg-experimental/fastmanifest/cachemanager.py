@@ -7,14 +7,21 @@
 
 import os
 import errno
+import struct
+import time
 
 from mercurial import extensions, revlog, scmutil, util, error
 
 import cfastmanifest
 import concurrency
 import constants
+import workqueue
 from metrics import metricscollector
-from implementation import fastmanifestcache, CacheFullException
+from implementation import (
+    CacheFullException,
+    fastmanifestcache,
+    fastmanifestdict,
+)
 
 def _relevantremonamesrevs(repo):
     revs = set()
@@ -202,6 +209,143 @@ def cachemanifestlist(ui, repo):
                 l = h.replace("fast","")
                 ui.status("%s|%s\n" % (l, ",".join(revstoman.get(l,[]))))
 
+def _deltahunks(delta):
+    """Yields the (start, end, data) hunks of a binary delta, as produced by
+    mdiff.textdiff"""
+    pos = 0
+    while pos < len(delta):
+        start, end, length = struct.unpack(">lll", delta[pos:pos + 12])
+        pos += 12
+        yield start, end, delta[pos:pos + length]
+        pos += length
+
+def _derivefastmanifest(repo, cache, mannode):
+    """Returns the fastmanifest of mannode built from the cached manifest it
+    is stored as a delta of in the manifest revlog, or None if that one
+    isn't cached.
+
+    The delta is applied to a copy of the cached fastmanifest, so only the
+    entries that changed are parsed, instead of reading the whole manifest
+    from the revlog and parsing its text.
+    """
+    mfrevlog = repo.manifestlog._revlog
+    rev = mfrevlog.rev(revlog.bin(mannode))
+    baserev = mfrevlog.deltaparent(rev)
+    if baserev == revlog.nullrev:
+        return None
+    basenode = revlog.hex(mfrevlog.node(baserev))
+    if basenode not in cache:
+        return None
+    base = cache[basenode]
+    if base is None:
+        return None
+    if isinstance(base, fastmanifestdict):
+        base = base._fm
+
+    basetext = base.text()
+    removed = []
+    added = []
+    for start, end, data in _deltahunks(mfrevlog.revdiff(baserev, rev)):
+        removed.extend(basetext[start:end].splitlines())
+        added.extend(data.splitlines())
+
+    fastmanifest = base.copy()
+    for line in removed:
+        del fastmanifest[line[:line.index("\0")]]
+    for line in added:
+        path, value = line.split("\0")
+        fastmanifest[path] = (revlog.bin(value[:40]), value[40:])
+    # Copying compacts the tree, so its size is the one it takes on disk
+    return fastmanifest.copy()
+
+def _cachemanifests(ui, repo, cache, revs, mannodes, delay=0, rank=0,
+                    start=None):
+    """Cache the manifests `mannodes` of the revisions `revs`, sorted from most
+    relevant to least relevant, making room for them in the cache. When
+    `delay` is set, wait that many seconds after caching each manifest.
+
+    When the manifests are cached in batches, `rank` is how many more
+    relevant manifests the previous batches cached, and `start` when the
+    first batch started, so that the entries of a batch don't rank above
+    those of the previous ones.
+    """
+    repo.ui.log("fastmanifest", "FM: trying to cache %s\n" % str(revs))
+
+    # The manifests more relevant than the one being cached are not removed
+    # to make room for it
+    morerelevant = set(mannodes)
+    mostrelevant = {}
+    for offset, mannode in reversed(list(enumerate(mannodes))):
+        mostrelevant[mannode] = offset
+
+    # Cache the least relevant manifests first: those are the oldest ones,
+    # which the newer ones are stored as deltas of in the manifest revlog and
+    # can be derived from once cached.
+    revstomannodes = {}
+    for offset in reversed(range(len(revs))):
+        rev = revs[offset]
+        mannode = mannodes[offset]
+        if mostrelevant[mannode] == offset:
+            morerelevant.discard(mannode)
+        revstomannodes[rev] = mannode
+
+        if mannode in cache.ondiskcache:
+            ui.debug("[FM] skipped %s, already cached (fast path)\n"
+                     % (mannode,))
+            repo.ui.log("fastmanifest", "FM: skip(rev, man) %s->%s\n"
+                        % (rev, mannode))
+
+            # Account for the fact that we access this manifest
+            cache.ondiskcache.touch(mannode)
+            continue
+        fastmanifest = _derivefastmanifest(repo, cache, mannode)
+        if fastmanifest is None:
+            manifest = repo[rev].manifest()
+            fastmanifest = cfastmanifest.fastmanifest(manifest.text())
+
+        cache.makeroomfor(fastmanifest.bytes(), morerelevant)
+
+        try:
+            cache[mannode] = fastmanifest
+            repo.ui.log("fastmanifest", "FM: cached(rev,man) %s->%s\n"
+                        % (rev, mannode))
+        except CacheFullException:
+            # The more relevant manifests already fill the cache
+            repo.ui.log("fastmanifest", "FM: overflow\n")
+            del revstomannodes[rev]
+        if delay:
+            time.sleep(delay)
+
+    # Make the least relevant entries have an artificially older mtime than
+    # the more relevant ones. We use a resolution of 2 for time to work
+    # accross all platforms and ensure that the order is marked.
+    mtimemultiplier = 2
+    elapsed = time.time() - start if start is not None else 0
+    for offset, rev in enumerate(revs, rank):
+        if rev in revstomannodes:
+            hexnode = revstomannodes[rev]
+            cache.ondiskcache.touch(hexnode,
+                                    delay=elapsed + offset * mtimemultiplier)
+        else:
+            metricscollector.get().recordsample("cacheoverflow", hit=True)
+            pass # We didn't have enough space for that rev
+
+def _recordcachestats(cache):
+    total, numentries = cache.ondiskcache.totalsize()
+    if isinstance(cache.limit, _systemawarecachelimit):
+        free = cache.limit.free / 1024**2
+    else:
+        free = -1
+    metricscollector.get().recordsample("ondiskcachestats",
+                                        bytes=total,
+                                        numentries=numentries,
+                                        limit=(cache.limit.bytes() / 1024**2),
+                                        freespace=free)
+
+def _warnpermission(ui):
+    ui.warn(("warning: not using fastmanifest\n"))
+    ui.warn(("(make sure that .hg/store is writeable)\n"))
+
 def cachemanifestfillandtrim(ui, repo, revset):
     """Cache the manifests described by `revset`.  This priming is subject to
     limits imposed by the cache, and thus not all the entries may be written.
@@ -214,10 +358,10 @@ def cachemanifestfillandtrim(ui, repo, revset):
 
             computedrevs = scmutil.revrange(repo, revset)
             sortedrevs = sorted(computedrevs, key=lambda x:-x)
-            repo.ui.log("fastmanifest", "FM: trying to cache %s\n"
-                        % str(sortedrevs))
 
             if len(sortedrevs) == 0:
+                repo.ui.log("fastmanifest", "FM: trying to cache %s\n"
+                            % str(sortedrevs))
                 # normally, we prune as we make space for new revisions to add
                 # to the cache.  however, if we're not adding any new elements,
                 # we'll never check the disk cache size.  this is an explicit
@@ -232,82 +376,155 @@ def cachemanifestfillandtrim(ui, repo, revset):
                 else:
                     ui.log("fastmanifest", "FM: no entries removed\n")
             else:
-                revstomannodes = {}
-                mannodesprocessed = set()
-                for rev in sortedrevs:
-                    mannode = revlog.hex(
-                        repo.changelog.changelogrevision(rev).manifest)
-                    revstomannodes[rev] = mannode
-                    mannodesprocessed.add(mannode)
-
-                    if mannode in cache.ondiskcache:
-                        ui.debug("[FM] skipped %s, already cached "
-                                "(fast path)\n" % (mannode,))
-                        repo.ui.log("fastmanifest",
-                                "FM: skip(rev, man) %s->%s\n" %
-                                (rev, mannode))
-
-                        # Account for the fact that we access this manifest
-                        cache.ondiskcache.touch(mannode)
-                        continue
-                    manifest = repo[rev].manifest()
-                    fastmanifest = cfastmanifest.fastmanifest(manifest.text())
-
-                    cache.makeroomfor(fastmanifest.bytes(), mannodesprocessed)
-
-                    try:
-                        cache[mannode] = fastmanifest
-                        repo.ui.log("fastmanifest", "FM: cached(rev,man) "
-                                    "%s->%s\n" %
-                                    (rev, mannode))
-                    except CacheFullException:
-                        repo.ui.log("fastmanifest", "FM: overflow\n")
-                        break
-
-                # Make the least relevant entries have an artificially older
-                # mtime than the more relevant ones. We use a resolution of 2
-                # for time to work accross all platforms and ensure that the
-                # order is marked.
-                #
-                # Note that we use sortedrevs and not revs because here we
-                # don't care about the shuffling, we just want the most relevant
-                # revisions to have more recent mtime.
-                mtimemultiplier = 2
-                for offset, rev in enumerate(sortedrevs):
-                    if rev in revstomannodes:
-                        hexnode = revstomannodes[rev]
-                        cache.ondiskcache.touch(hexnode,
-                                delay=offset * mtimemultiplier)
-                    else:
-                        metricscollector.get().recordsample("cacheoverflow",
-                                hit=True)
-                        pass # We didn't have enough space for that rev
+                mannodes = [revlog.hex(
+                                repo.changelog.changelogrevision(rev).manifest)
+                            for rev in sortedrevs]
+                _cachemanifests(ui, repo, cache, sortedrevs, mannodes)
     except error.LockHeld:
         return
     except (OSError, IOError) as ex:
         if ex.errno == errno.EACCES:
             # permission issue
-            ui.warn(("warning: not using fastmanifest\n"))
-            ui.warn(("(make sure that .hg/store is writeable)\n"))
+            _warnpermission(ui)
             return
         raise
 
-    total, numentries = cache.ondiskcache.totalsize()
-    if isinstance(cache.limit, _systemawarecachelimit):
-        free = cache.limit.free / 1024**2
+    _recordcachestats(cache)
+
+def _relevantmanifests(repo, revs, now, parents=True):
+    """Returns the manifests of `revs`, and of their parents if `parents` is
+    set, as (hexnode, distance, time, rev) tuples to queue.
+
+    The distance of a manifest is how many parents away its revision is from
+    the closest head of those revisions, walking through them only. Its time
+    is `now`, when it's queued. The revisions older than
+    fastmanifest.cachecutoffdays are left out."""
+    cutoff = repo.ui.configint("fastmanifest", "cachecutoffdays", 60)
+    if cutoff == -1: # no cutoff
+        mindate = None
     else:
-        free = -1
-    metricscollector.get().recordsample("ondiskcachestats",
-                                        bytes=total,
-                                        numentries=numentries,
-                                        limit=(cache.limit.bytes() / 1024**2),
-                                        freespace=free)
+        mindate = time.time() - cutoff * 86400
+
+    changelog = repo.unfiltered().changelog
+    relevant = set(revs)
+    if parents:
+        for rev in revs:
+            relevant.update(changelog.parentrevs(rev))
+    relevant.discard(revlog.nullrev)
+
+    # Walk down from the heads, breadth first, so each revision gets its
+    # distance to the closest one
+    frontier = relevant.difference(*[changelog.parentrevs(rev)
+                                     for rev in relevant])
+    distances = dict.fromkeys(frontier, 0)
+    distance = 0
+    while frontier:
+        distance += 1
+        nextfrontier = set()
+        for rev in frontier:
+            for parent in changelog.parentrevs(rev):
+                if parent in relevant and parent not in distances:
+                    distances[parent] = distance
+                    nextfrontier.add(parent)
+        frontier = nextfrontier
+
+    entries = {}
+    for rev, distance in distances.iteritems():
+        c = changelog.changelogrevision(rev)
+        if mindate is not None and c.date[0] < mindate:
+            continue
+        mannode = revlog.hex(c.manifest)
+        # Revisions can share a manifest
+        entry = (distance, -rev)
+        entries[mannode] = min(entry, entries.get(mannode, entry))
+    return [(node, distance, now, -negrev)
+            for node, (distance, negrev) in entries.iteritems()]
+
+def _drainqueue(ui, repo, queue, lock, delay, done):
+    """Cache the queued manifests, most relevant first, until the queue is
+    empty. The manifests taken from the queue are added to `done`, so they
+    aren't taken again if the queue can't be written."""
+    cache = fastmanifestcache.getinstance(repo.store.opener, ui)
+    if not len(cache.ondiskcache.index):
+        # Nothing is cached yet, or anymore: queue all the revisions that are
+        # relevant, rather than only the ones that became relevant
+        revs = scmutil.revrange(repo, ["fastmanifesttocache()"])
+        queue.add(_relevantmanifests(repo, revs, time.time(),
+                                     parents=False))
+
+    # The revisions a manifest was queued for may have been hidden since
+    unfi = repo.unfiltered()
+    mfrevlog = unfi.manifestlog._revlog
+    start = time.time()
+    rank = 0
+    while True:
+        # Take the queue a batch at a time, so that the manifests that
+        # become relevant meanwhile are cached before the less relevant ones
+        queue.refresh()
+        pending = [mannode for mannode in queue.pending()
+                   if mannode not in done][:constants.WORKER_BATCH_SIZE]
+        if not pending:
+            break
+        done.update(pending)
+
+        revs = []
+        mannodes = []
+        for mannode in pending:
+            try:
+                rev = mfrevlog.rev(revlog.bin(mannode))
+            except (error.LookupError, TypeError):
+                # Stripped, or not a node
+                continue
+            revs.append(mfrevlog.linkrev(rev))
+            mannodes.append(mannode)
+        _cachemanifests(ui, unfi, cache, revs, mannodes, delay, rank, start)
+        rank += len(revs)
+        queue.remove(pending)
+        lock.refresh()
+
+    queue.compact()
+    _recordcachestats(cache)
 
 class cacher(object):
     @staticmethod
-    def cachemanifest(repo):
-        revset = ["fastmanifesttocache()"]
-        cachemanifestfillandtrim(repo.ui, repo, revset)
+    def cachemanifest(repo, delay=0):
+        """Cache the manifests of the work queue, most relevant first.
+
+        Triggers only queue the revisions that became relevant, the
+        revisions of fastmanifesttocache() are only queued when the cache is
+        empty. A single worker drains the queue: this returns right away if
+        another process is draining it.
+        """
+        ui = repo.ui
+        queue = workqueue.workqueue(repo.vfs)
+        done = set()
+        while True:
+            try:
+                with concurrency.looselock(repo.vfs,
+                        "fastmanifest",
+                        constants.WORKER_SPAWN_LOCK_STEAL_TIMEOUT) as lock:
+                    _drainqueue(ui, repo, queue, lock, delay, done)
+            except error.LockHeld:
+                # The worker holding the lock will drain the queue
+                return
+            except (OSError, IOError) as ex:
+                if ex.errno == errno.EACCES:
+                    # permission issue
+                    _warnpermission(ui)
+                    return
+                raise
+
+            # Manifests queued after the queue was last read, but before the
+            # lock was released, have no worker to cache them
+            queue.refresh()
+            if not set(queue.pending()) - done:
+                return
+
+    @staticmethod
+    def queue(repo, revs):
+        """Queue the manifests of `revs` and of their parents"""
+        workqueue.workqueue(repo.vfs).add(
+            _relevantmanifests(repo, revs, time.time()))
 
 class triggers(object):
     repos_to_update = set()
@@ -317,6 +534,12 @@ class triggers(object):
     def runcommandtrigger(orig, *args, **kwargs):
         result = orig(*args, **kwargs)
 
+        repo, cmd = args[1:3]
+        # The commands caching manifests miss the ones they cache
+        if repo is not None and cmd not in ("cachemanifest",
+                                            "debugcachemanifest"):
+            triggers.onaccess(repo)
+
         for repo in triggers.repos_to_update:
             repo.ui.log("fastmanifest", "FM: triggering caching for %s\n"
                         % repo.root)
@@ -325,6 +548,13 @@ class triggers(object):
                                     True)
 
             if bg:
+                lock = concurrency.looselock(repo.vfs, "fastmanifest",
+                    constants.WORKER_SPAWN_LOCK_STEAL_TIMEOUT)
+                if lock.islocked():
+                    # The worker that is running will cache what was queued
+                    repo.ui.log("fastmanifest", "FM: worker already running\n")
+                    continue
+
                 silent_worker = repo.ui.configbool(
                     "fastmanifest", "silentworker", True)
 
@@ -347,37 +577,81 @@ class triggers(object):
 
         return result
 
+    @staticmethod
+    def onaccess(repo):
+        """Queue the manifests the command missed in the cache"""
+        if not repo.local():
+            return
+        ui = repo.ui
+        if not ui.configbool("fastmanifest", "cacheonchange", False):
+            return
+
+        # Commands walking the history miss many manifests that won't be
+        # accessed again, only queue the first ones
+        maxqueued = ui.configint("fastmanifest", "maxqueuedmisses", 10)
+        mannodes = set()
+        for kind, sample in metricscollector.get().samples:
+            if len(mannodes) >= maxqueued:
+                break
+            if (kind == "cachehit" and not sample["hit"] and
+                sample["node"] is not None):
+                mannodes.add(sample["node"])
+        if not mannodes:
+            return
+
+        mfrevlog = repo.manifestlog._revlog
+        revs = []
+        for mannode in mannodes:
+            try:
+                revs.append(mfrevlog.linkrev(mfrevlog.rev(revlog.bin(mannode))))
+            except error.LookupError:
+                pass
+        if revs:
+            cacher.queue(repo, revs)
+            triggers.repos_to_update.add(repo)
+            metricscollector.get().recordsample("trigger", source="access")
+            ui.log("fastmanifest", "FM: caching trigger: access\n")
+
     @staticmethod
     def onbookmarkchange(orig, self, *args, **kwargs):
         repo = self._repo
         ui = repo.ui
+        result = orig(self, *args, **kwargs)
 
         if ui.configbool("fastmanifest", "cacheonchange", False):
+            changelog = repo.unfiltered().changelog
+            cacher.queue(repo, [changelog.rev(node)
+                                for node in self.itervalues()
+                                if node in changelog.nodemap])
             triggers.repos_to_update.add(repo)
             metricscollector.get().recordsample("trigger", source="bookmark")
             ui.log("fastmanifest", "FM: caching trigger: bookmark\n")
 
-        return orig(self, *args, **kwargs)
+        return result
 
     @staticmethod
     def oncommit(orig, self, *args, **kwargs):
         repo = self
         ui = repo.ui
+        node = orig(self, *args, **kwargs)
 
         if ui.configbool("fastmanifest", "cacheonchange", False):
+            cacher.queue(repo, [repo.unfiltered().changelog.rev(node)])
             triggers.repos_to_update.add(repo)
             metricscollector.get().recordsample("trigger", source="commit")
             ui.log("fastmanifest", "FM: caching trigger: commit\n")
 
-        return orig(self, *args, **kwargs)
+        return node
 
     @staticmethod
     def onremotenameschange(orig, repo, *args, **kwargs):
         ui = repo.ui
+        result = orig(repo, *args, **kwargs)
 
         if ui.configbool("fastmanifest", "cacheonchange", False):
+            cacher.queue(repo, _relevantremonamesrevs(repo))
             triggers.repos_to_update.add(repo)
             metricscollector.get().recordsample("trigger", source="remotenames")
             ui.log("fastmanifest", "FM: caching trigger: remotenames\n")
 
-        return orig(repo, *args, **kwargs)
+        return result
@@ -133,6 +133,24 @@ class looselock(object):
         return (self.stealcount != 0 or
                 self.refcount != 0)
 
+    def islocked(self):
+        """Returns whether the lock is held, by this or another process, and
+        too recent to be stolen."""
+        try:
+            fstat = self.vfs.lstat(self.lockname)
+        except OSError:
+            return False
+        return time.time() - fstat[stat.ST_MTIME] <= self.stealtime
+
+    def refresh(self):
+        """Touches the lockfile of a held lock, so that it isn't stolen while
+        its holder is still running."""
+        if self.held():
+            try:
+                self.vfs.utime(self.lockname)
+            except OSError:
+                pass
+
     def __enter__(self):
         return self.lock()
 
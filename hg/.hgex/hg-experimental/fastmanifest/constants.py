@@ -21,3 +21,10 @@ WORKER_SPAWN_LOCK_STEAL_TIMEOUT = 300
 
 # How many entries we keep in the in memory cache?
 DEFAULT_MAX_MEMORY_ENTRIES = 10
+
+# How many queued manifests the worker caches before reading the queue again
+WORKER_BATCH_SIZE = 20
+
+# How large the tree manifest nodes shared between processes can grow, see
+# sharedtreecache
+DEFAULT_MAX_SHARED_TREE_CACHE_MB = 64
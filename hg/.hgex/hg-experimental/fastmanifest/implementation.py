@@ -5,18 +5,20 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2 or any later version.
 
-import collections
 import os
 import time
 import heapq
 
 from mercurial import manifest, mdiff, revlog, util
+import cacheindex
 import cachemanager
 import cfastmanifest
+import sharedtreecache
 from metrics import metricscollector
 from constants import (
     CACHE_SUBDIR,
     DEFAULT_MAX_MEMORY_ENTRIES,
+    DEFAULT_MAX_SHARED_TREE_CACHE_MB,
 )
 
 try:
@@ -139,7 +141,7 @@ class hybridmanifest(object):
                 store = self.manifestlog.datastore
                 self.__treemanifest = cstore.treemanifest(store)
             else:
-                store = self.manifestlog.datastore
+                store = self.treecache.store(self.manifestlog.datastore)
                 try:
                     store.get('', self.node)
                     self.__treemanifest = cstore.treemanifest(store,
@@ -548,6 +550,12 @@ class ondiskcache(object):
         self.opener = opener
         self.ui = ui
         self.pathprefix = "fast"
+        # Entries are mapped rather than read, so that loading them and
+        # copying them into the in memory cache doesn't copy the whole tree
+        if ui.configbool("fastmanifest", "mmapcache", True):
+            self._load = cfastmanifest.fastmanifest.loadmapped
+        else:
+            self._load = cfastmanifest.fastmanifest.load
         base = opener.join(None)
         self.cachepath = os.path.join(base, CACHE_SUBDIR)
         if not os.path.exists(self.cachepath):
@@ -557,6 +565,10 @@ class ondiskcache(object):
                 # Likely permission issues, in that case, we won't be able to
                 # access the cache afterwards
                 pass
+        # The sizes and relevance of the entries, so that the cache doesn't
+        # need to be listed to be pruned
+        self.index = cacheindex.cacheindex(opener, self.cachepath,
+                                           self.pathprefix)
 
     def _pathfromnode(self, hexnode):
         return os.path.join(self.cachepath, self.pathprefix + hexnode)
@@ -566,29 +578,25 @@ class ondiskcache(object):
         path = self._pathfromnode(hexnode)
         try:
             self.debugf("[FM] refreshing %s with delay %d\n" %(hexnode, delay))
+            # The mtime is kept in sync, in case the index is rebuilt
             os.utime(path, (filetime, filetime))
         except EnvironmentError:
             pass
+        else:
+            self.index.touch(hexnode, filetime)
 
     def __contains__(self, hexnode):
-        path = self._pathfromnode(hexnode)
-        return os.path.exists(path)
+        return hexnode in self.index
 
     def items(self):
         """Return the entries in the cache, sorted from most relevant to least
         relevant"""
-        entries = []
-        for entry in os.listdir(self.cachepath):
-            try:
-                if entry.startswith(self.pathprefix):
-                    path = os.path.join(self.cachepath, entry)
-                    entries.append((entry,
-                                    os.path.getmtime(path),
-                                    os.path.getsize(path)))
-            except EnvironmentError:
-                pass
-        entries.sort(key=lambda x:(-x[1], x[0]))
-        return [x[0].replace(self.pathprefix, "") for x in entries]
+        return self.index.sorted()
+
+    def leastrelevant(self, excluded=()):
+        """Return the least relevant entry of the cache that isn't in
+        excluded, or None"""
+        return self.index.leastrelevant(excluded)
 
     def __iter__(self):
         return iter(self.items())
@@ -614,6 +622,7 @@ class ondiskcache(object):
         try:
             fm._save(tmpfpath)
             util.rename(tmpfpath, path)
+            self.index.add(hexnode, os.path.getsize(path), time.time())
             return True
         except EnvironmentError:
             return False
@@ -632,39 +641,36 @@ class ondiskcache(object):
             os.unlink(path)
         except EnvironmentError:
             pass
+        self.index.remove(hexnode)
 
     def __getitem__(self, hexnode):
         path = self._pathfromnode(hexnode)
         try:
-            fm = cfastmanifest.fastmanifest.load(path)
-            # touch on access to make this cache a LRU cache
-            os.utime(path, None)
+            fm = self._load(path)
         except EnvironmentError:
+            # Entry was deleted by another process
+            self.index.remove(hexnode)
             return None
+        # touch on access to make this cache a LRU cache
+        try:
+            os.utime(path, None)
+        except EnvironmentError:
+            pass
         else:
-            return fastmanifestdict(fm)
+            self.index.touch(hexnode, time.time())
+        return fastmanifestdict(fm)
 
     def entrysize(self, hexnode):
-        try:
-            return os.path.getsize(self._pathfromnode(hexnode))
-        except EnvironmentError:
-            return None
+        return self.index.size(hexnode)
 
     def totalsize(self, silent=True):
-        totalsize = 0
-        numentries = 0
-        for entry in self:
-            entrysize = self.entrysize(entry)
-            if entrysize == -1:
-                # Entry was deleted by another process
-                continue
-            totalsize += entrysize
-            numentries += 1
-            if not silent:
+        if not silent:
+            for entry in self:
+                entrysize = self.entrysize(entry)
                 msg = "%s (size %s)\n" % (self.pathprefix + entry,
                                           util.bytecount(entrysize))
                 self.ui.status(msg)
-        return totalsize, numentries
+        return self.index.totalsize(), len(self.index)
 
 class CacheFullException(Exception):
     pass
@@ -679,6 +685,27 @@ class treemanifestcache(object):
     def __init__(self, opener, ui):
         self.ui = ui
         self._cache = {}
+        # The tree nodes read by the other processes, so that they don't
+        # have to be read from the datastore again
+        self.shared = None
+        maxsize = ui.configint("fastmanifest", "sharedtreecachemb",
+                               DEFAULT_MAX_SHARED_TREE_CACHE_MB) * 1024 * 1024
+        if maxsize > 0:
+            cachepath = os.path.join(opener.join(None), CACHE_SUBDIR)
+            self.shared = sharedtreecache.sharedtreecache(opener, cachepath,
+                                                          maxsize)
+
+    def store(self, datastore):
+        """Returns the store to build treemanifests from"""
+        if self.shared is None:
+            return datastore
+        return self.shared.store(datastore)
+
+    def flush(self):
+        """Shares the tree nodes read since the last flush with the other
+        processes"""
+        if self.shared is not None:
+            self.shared.flush()
 
     def clear(self):
         self._cache.clear()
@@ -770,16 +797,13 @@ class fastmanifestcache(object):
         """Make room on disk for a cache entry of size `needed`.  Cache entries
         in `excluded` are not subjected to removal.
         """
-        cacheentries = collections.deque(self.ondiskcache.items())
         maxtotal = self.limit.bytes() - needed
 
-        while (len(cacheentries) > 0 and
-               self.ondiskcache.totalsize()[0] > maxtotal):
-            candidate = cacheentries.pop()
-
-            if candidate in excluded:
-                # it's immune, so skip it.
-                continue
+        while self.ondiskcache.totalsize()[0] > maxtotal:
+            # entries in excluded are immune
+            candidate = self.ondiskcache.leastrelevant(excluded)
+            if candidate is None:
+                break
 
             self.debug("[FM] removing cached manifest fast%s\n" % (candidate,))
             del self.ondiskcache[candidate]
@@ -1028,15 +1052,19 @@ class manifestfactory(object):
                         node, p1)
                 hpack = treemanifest.InterceptedMutableHistoryPack(
                         transaction.treehistpack, node, p1)
+                treecache = treemanifestcache.getinstance(opener, self.ui)
                 newtreeiter = newtree.finalize(tree)
                 for nname, nnode, ntext, np1text, np1, np2 in newtreeiter:
                     # Not using deltas, since there aren't any other trees in
                     # this pack it could delta against.
                     dpack.add(nname, nnode, revlog.nullid, ntext)
                     hpack.add(nname, nnode, np1, np2, revlog.nullid, '')
+                    if treecache.shared is not None:
+                        # The root is stored under the flat manifest node
+                        treecache.shared.add(node if nname == '' else nnode,
+                                             ntext)
 
-                treemanifestcache.getinstance(opener,
-                                              self.ui)[node] = newtree
+                treecache[node] = newtree
 
         return node
 
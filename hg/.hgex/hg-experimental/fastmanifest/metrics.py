@@ -39,7 +39,8 @@ FASTMANIFEST_METRICS = set([
     # => key is "size", a number
     "revsetsize",
     # trigger is what caused caching to trigger
-    # => keys is "source", one of ("commit", "remotenames", "bookmark")
+    # => keys is "source", one of ("commit", "remotenames", "bookmark",
+    # "access")
     "trigger",
     # cacheoverflow, logs cache overflow event: not enough space in the
     # cache to store revisions, it will inform us on how to resize the
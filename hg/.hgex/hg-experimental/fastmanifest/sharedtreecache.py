@@ -0,0 +1,277 @@
+# sharedtreecache.py
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+import mmap
+import os
+import struct
+
+from mercurial import error, util
+
+import concurrency
+
+# The shared cache lives in the fastmanifest cache directory
+DATAFILE = "trees"
+INDEXFILE = "trees.index"
+LOCKFILE = "trees.lock"
+
+# magic, generation
+_dataheader = struct.Struct(">4sI")
+# magic, generation, number of entries
+_indexheader = struct.Struct(">4sII")
+# node, offset of the text in the data file, length of the text
+_indexentry = struct.Struct(">20sQI")
+_DATAMAGIC = "HGTD"
+_INDEXMAGIC = "HGTI"
+
+class sharedtreecache(object):
+    """The texts of the tree manifest nodes, shared by the processes using
+    the repository.
+
+    Building a treemanifest reads its tree nodes from the datastore, which
+    resolves their delta chains across the packs every time. The texts the
+    processes read are kept here, in files they map in memory, so that the
+    trees of the same revisions, like the working copy parent or master, are
+    built without going to the datastore again.
+
+    The texts are appended to the data file, and the index file, sorted by
+    node, is rewritten next to it. The text of a tree node never changes,
+    so entries never become stale. When the data file would grow past
+    maxsize, both files are replaced by a new generation that only holds
+    the nodes the last process used. An index and a data file of different
+    generations are being replaced, and are not used.
+
+    Processes add the nodes they read with a single writer at a time, under
+    a looselock, at the end of their command. They map the files again when
+    the index was rewritten.
+    """
+    def __init__(self, vfs, cachepath, maxsize):
+        self._vfs = vfs
+        self._cachepath = cachepath
+        self._datapath = os.path.join(cachepath, DATAFILE)
+        self._indexpath = os.path.join(cachepath, INDEXFILE)
+        self._lockname = os.path.relpath(os.path.join(cachepath, LOCKFILE),
+                                         vfs.join(None))
+        self._maxsize = maxsize
+        self._index = None
+        self._data = None
+        self._identity = None
+        self.generation = 0
+        self._count = 0
+        # The nodes read from the datastore, and the nodes used, since the
+        # cache was last flushed
+        self._added = {}
+        self._addedsize = 0
+        self._used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _close(self):
+        for m in (self._index, self._data):
+            if m is not None:
+                m.close()
+        self._index = self._data = None
+        self._identity = None
+        self._count = 0
+
+    def refresh(self):
+        """Maps the latest index and data files, if they changed"""
+        try:
+            st = os.stat(self._indexpath)
+        except OSError:
+            self._close()
+            return
+        identity = (st.st_ino, st.st_size, st.st_mtime)
+        if identity == self._identity:
+            return
+
+        self._close()
+        try:
+            index = _map(self._indexpath)
+            data = _map(self._datapath)
+        except (EnvironmentError, ValueError):
+            # Missing, empty, or being replaced
+            return
+        try:
+            magic, generation, count = _indexheader.unpack_from(index, 0)
+            datamagic, datageneration = _dataheader.unpack_from(data, 0)
+        except struct.error:
+            magic = None
+        if (magic != _INDEXMAGIC or datamagic != _DATAMAGIC or
+            generation != datageneration or
+            len(index) < _indexheader.size + count * _indexentry.size):
+            index.close()
+            data.close()
+            return
+
+        self._index = index
+        self._data = data
+        self._identity = identity
+        self.generation = generation
+        self._count = count
+
+    def _find(self, node):
+        """Returns the position of node in the index, or of the first node
+        after it"""
+        index = self._index
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = _indexheader.size + mid * _indexentry.size
+            if index[pos:pos + 20] < node:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _entry(self, i):
+        return _indexentry.unpack_from(self._index,
+                                       _indexheader.size +
+                                       i * _indexentry.size)
+
+    def _lookup(self, node):
+        if self._index is None:
+            return None
+        i = self._find(node)
+        if i == self._count:
+            return None
+        entrynode, offset, length = self._entry(i)
+        if entrynode != node or offset + length > len(self._data):
+            return None
+        return self._data[offset:offset + length]
+
+    def __contains__(self, node):
+        return node in self._added or self._lookup(node) is not None
+
+    def get(self, name, node, datastore):
+        """Returns the text of a tree node, from the cache or datastore"""
+        text = self._added.get(node)
+        if text is None:
+            text = self._lookup(node)
+        if text is not None:
+            self.hits += 1
+            self._used.add(node)
+            return text
+
+        self.misses += 1
+        text = datastore.get(name, node)
+        self.add(node, text)
+        return text
+
+    def add(self, node, text):
+        """Adds a tree node, it is written on the next flush"""
+        self._used.add(node)
+        if (node not in self._added and
+            self._addedsize + len(text) <= self._maxsize):
+            self._added[node] = text
+            self._addedsize += len(text)
+
+    def store(self, datastore):
+        """Returns a store for cstore.treemanifest, reading the tree nodes
+        from the cache before datastore"""
+        self.refresh()
+        return _store(self, datastore)
+
+    def flush(self):
+        """Writes the nodes added since the last flush"""
+        added = self._added
+        used = self._used
+        self._added = {}
+        self._addedsize = 0
+        self._used = set()
+        if not added:
+            return
+
+        try:
+            if not os.path.exists(self._cachepath):
+                os.makedirs(self._cachepath)
+            with concurrency.looselock(self._vfs, self._lockname):
+                # Another process may have written a generation since
+                self.refresh()
+                new = sorted((node, text) for node, text in added.iteritems()
+                             if self._lookup(node) is None)
+                if not new:
+                    return
+                newsize = sum(len(text) for node, text in new)
+                if (self._index is not None and
+                    len(self._data) + newsize <= self._maxsize):
+                    self._append(new)
+                else:
+                    self._rewrite(new, used)
+        except (error.LockError, EnvironmentError):
+            # Another process is writing the cache, or it isn't writable
+            pass
+        self.refresh()
+
+    def _append(self, new):
+        """Appends the texts of new to the data file, and rewrites the
+        index with them"""
+        entries = []
+        with open(self._datapath, "ab") as f:
+            # Anything after the data that was mapped was left by a writer
+            # that didn't finish, and isn't indexed
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            for node, text in new:
+                f.write(text)
+                entries.append(_indexentry.pack(node, offset, len(text)))
+                offset += len(text)
+
+        # Merge the new entries into the sorted index
+        index = self._index
+        chunks = []
+        start = _indexheader.size
+        for (node, text), entry in zip(new, entries):
+            pos = _indexheader.size + self._find(node) * _indexentry.size
+            chunks.append(index[start:pos])
+            chunks.append(entry)
+            start = pos
+        chunks.append(index[start:_indexheader.size +
+                            self._count * _indexentry.size])
+        self._writeindex(self.generation, self._count + len(new), chunks)
+
+    def _rewrite(self, new, used):
+        """Writes a new generation, with the texts of new and of the nodes
+        in used that are in the cache"""
+        texts = dict(new)
+        for node in used:
+            if node not in texts:
+                text = self._lookup(node)
+                if text is not None:
+                    texts[node] = text
+
+        generation = self.generation + 1
+        entries = []
+        with util.atomictempfile(self._datapath) as f:
+            f.write(_dataheader.pack(_DATAMAGIC, generation))
+            offset = _dataheader.size
+            for node in sorted(texts):
+                text = texts[node]
+                if offset + len(text) > self._maxsize:
+                    continue
+                f.write(text)
+                entries.append(_indexentry.pack(node, offset, len(text)))
+                offset += len(text)
+        self._writeindex(generation, len(entries), entries)
+
+    def _writeindex(self, generation, count, chunks):
+        with util.atomictempfile(self._indexpath) as f:
+            f.write(_indexheader.pack(_INDEXMAGIC, generation, count))
+            for chunk in chunks:
+                f.write(chunk)
+
+class _store(object):
+    """A store for cstore.treemanifest, see sharedtreecache.store"""
+    def __init__(self, cache, datastore):
+        self._cache = cache
+        self._datastore = datastore
+
+    def get(self, name, node):
+        return self._cache.get(name, node, self._datastore)
+
+def _map(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
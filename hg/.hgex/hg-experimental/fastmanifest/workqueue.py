@@ -0,0 +1,125 @@
+# workqueue.py
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+
+from mercurial import util
+
+# The queue lives in .hg, next to the lock of the worker draining it
+QUEUEFILE = "fastmanifestqueue"
+
+# How many more records than queued manifests the queue can hold before the
+# worker rewrites it
+COMPACTSLACK = 100
+
+class workqueue(object):
+    """The manifests waiting to be cached, and how relevant they are.
+
+    The queue file is a journal, where each line records a change:
+
+      +<hexnode> <distance> <time> <rev>  a manifest became relevant
+      -<hexnode>                          a manifest was cached, or dropped
+
+    The distance of a manifest is how many parents away its revision is from
+    the closest revision of interest: a bookmark, a relevant remotename, a
+    new commit or a manifest a command missed in the cache. Its time is when
+    it was last queued or accessed. Manifests are cached closest first, then
+    most recent first, then newest revision first. A manifest queued several
+    times keeps its smallest distance and its latest time, so it's only
+    cached once.
+
+    Commands append records with a single write, without taking a lock.
+    Only the worker draining the queue rewrites it, under its lock. A record
+    appended while the queue is rewritten can be lost, the manifest is then
+    cached the next time it becomes relevant.
+    """
+    def __init__(self, vfs):
+        # The queue isn't written through the vfs, which expects the wlock
+        self._path = vfs.join(QUEUEFILE)
+        # hexnode -> (distance, time, rev)
+        self._entries = {}
+        self._records = 0
+
+    def refresh(self):
+        """Reads the queue"""
+        self._entries = {}
+        self._records = 0
+        try:
+            with open(self._path, "rb") as f:
+                data = f.read()
+        except EnvironmentError:
+            return
+
+        # A record may be in the middle of being appended
+        for line in data[:data.rfind("\n") + 1].splitlines():
+            try:
+                self._apply(line)
+            except (ValueError, IndexError):
+                # The queue only holds hints, skip what can't be read
+                pass
+
+    def _apply(self, line):
+        op, fields = line[0], line[1:].split(" ")
+        hexnode = fields[0]
+        if op == "+":
+            distance, time, rev = (int(fields[1]), float(fields[2]),
+                                   int(fields[3]))
+            entry = self._entries.get(hexnode)
+            if entry is not None:
+                distance = min(distance, entry[0])
+                time = max(time, entry[1])
+                rev = max(rev, entry[2])
+            self._entries[hexnode] = (distance, time, rev)
+        elif op == "-":
+            self._entries.pop(hexnode, None)
+        else:
+            raise ValueError("unknown work queue record %r" % line)
+        self._records += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pending(self):
+        """Returns the queued manifests, from most relevant to least
+        relevant"""
+        entries = self._entries
+        return sorted(entries,
+                      key=lambda h: (entries[h][0], -entries[h][1],
+                                     -entries[h][2], h))
+
+    def add(self, entries):
+        """Queues manifests, given as (hexnode, distance, time, rev) tuples"""
+        self._append("".join("+%s %d %r %d\n" % entry
+                             for entry in sorted(entries)))
+
+    def remove(self, hexnodes):
+        for hexnode in hexnodes:
+            self._entries.pop(hexnode, None)
+        self._append("".join("-%s\n" % hexnode for hexnode in hexnodes))
+
+    def _append(self, data):
+        if not data:
+            return
+        try:
+            with open(self._path, "ab") as f:
+                f.write(data)
+        except EnvironmentError:
+            # .hg isn't writable, nothing can be cached anyway
+            pass
+
+    def compact(self):
+        """Rewrites the queue with only the manifests still waiting to be
+        cached. Only the worker holding the lock can call this."""
+        self.refresh()
+        if self._records <= len(self._entries) + COMPACTSLACK:
+            return
+        try:
+            with util.atomictempfile(self._path) as f:
+                for hexnode, entry in self._entries.iteritems():
+                    f.write("+%s %d %r %d\n" % ((hexnode,) + entry))
+        except EnvironmentError:
+            return
+        self._records = len(self._entries)
@@ -10,21 +10,116 @@ only download them ondemand as needed.
 
 Configs:
 
+    ``packs.chaincost`` specifies how many bytes of pack size one more delta in
+      a chain is worth, in the repack cost model (default: 256B)
+    ``packs.costmodel`` makes repack try several delta bases for each revision
+      and keep the cheapest, according to pack size and chain length
     ``packs.maxchainlen`` specifies the maximum delta chain length in pack files
+    ``remotefilelog.ancestorcache`` keeps the ancestors of files with long
+      histories in a file next to the history packs, so they don't have to be
+      walked again by later commands. Only histories read entirely from the
+      shared packs are kept, and each is dropped when one of the packs it was
+      read from is removed.
+    ``remotefilelog.ancestorcache.maxentries`` specifies the maximum number of
+      ancestors kept in the ancestor cache (default: 1000000)
+    ``remotefilelog.ancestorcache.minentries`` specifies how many ancestors a
+      file revision needs to have for them to be cached (default: 100)
     ``remotefilelog.backgroundprefetch`` runs prefetch in background when True
     ``remotefilelog.bgprefetchrevs`` specifies revisions to fetch on commit and
       update, and on other commands that use them. Different from pullprefetch.
+    ``remotefilelog.connectionbroker`` borrows the ssh connections to the
+      server from a per-user connection broker process, which keeps them open
+      between commands, instead of opening one in every command
+    ``remotefilelog.connectionbroker.autostart`` starts a connection broker
+      in the background when none is running (default: True)
+    ``remotefilelog.connectionbroker.idletimeout`` specifies how many seconds
+      the connection broker keeps an unused connection open, and waits for
+      new clients before exiting (default: 600)
+    ``remotefilelog.connectionbroker.path`` specifies the socket of the
+      connection broker (default: connectionbroker.sock in the cache path)
+    ``remotefilelog.dedup`` stores the text of file revisions in the shared
+      cache once per content, hardlinked from every revision that has it, so
+      files copied to many paths only take space once. A
+      ``remotefilelog.cacheprocess`` used with it has to put the text back
+      into the deduplicated files it sends, like ``readblob`` in the example
+      cacheclient.py does
+    ``remotefilelog.dedupminsize`` specifies the minimum size of the file
+      revisions deduplicated by ``remotefilelog.dedup`` (default: 4KB)
+    ``remotefilelog.fetchconnections`` specifies how many connections a large
+      pipelined fetch may be spread across (default: 1)
+    ``remotefilelog.fetchpackdeltas`` makes ``remotefilelog.fetchpacks``
+      fetches ask the server for deltas against the revisions of the working
+      copy parent already in the cache, instead of full texts. The deltas are
+      applied as they're received, so the packs in the cache never depend on
+      each other
     ``remotefilelog.gcrepack`` does garbage collection during repack when True
+    ``remotefilelog.getpackcache`` makes the server keep the responses to
+      getpack requests on disk, and fill them in the background when
+      changesets are pushed
+    ``remotefilelog.getpackcachepath`` specifies where the getpack cache is
+      kept (default: .hg/getpackcache)
+    ``remotefilelog.getpackcachesize`` specifies the size the getpack cache is
+      trimmed to by hg gc and pushes, least recently used first (default: 1GB)
+    ``remotefilelog.linkrevindex`` keeps an index of the changesets
+      introducing each file revision, updated on pull, which is used to find
+      the linknode of a file revision without walking the changelog
+    ``remotefilelog.multipackindex`` maintains a combined index of all the pack
+      files in a pack directory, so lookups don't have to search every pack
     ``remotefilelog.nodettl`` specifies maximum TTL of a node in seconds before
       it is garbage collected
+    ``remotefilelog.parallelrepack`` repacks in partitions split by filename,
+      using one worker process per cpu (see ``worker.numcpus``)
+    ``remotefilelog.pipelinefetch`` requests cache misses from the server as
+      soon as the cache reports them, instead of waiting for the whole batch
+    ``remotefilelog.prefetchdaemon`` queues background prefetches for the
+      prefetch daemon instead of running ``hg prefetch`` for each of them
+    ``remotefilelog.prefetchdaemon.autostart`` starts a prefetch daemon when
+      a background prefetch is queued and none is running (default: True)
+    ``remotefilelog.prefetchdaemon.batchsize`` specifies how many queued
+      revisions a prefetch daemon worker fetches at once (default: 100)
+    ``remotefilelog.prefetchdaemon.idletimeout`` specifies how many seconds
+      the prefetch daemon waits for new work before exiting (default: 600)
+    ``remotefilelog.prefetchdaemon.interval`` specifies how often in seconds
+      the prefetch daemon checks the queue and the repository (default: 1)
+    ``remotefilelog.prefetchdaemon.revs`` specifies revisions the prefetch
+      daemon keeps prefetched as they move, on top of the default prefetch
+      revisions (default: bookmark())
+    ``remotefilelog.prefetchdaemon.workers`` specifies how many prefetches the
+      daemon runs at once (default: 2)
     ``remotefilelog.repackonhggc`` runs repack on hg gc when True
+    ``remotefilelog.repackpartitionsize`` specifies the maximum number of
+      entries in a parallel repack partition, which bounds the memory used by
+      each worker. A file with more revisions than that gets a partition of
+      its own (default: 100000)
+    ``remotefilelog.serverpackcache`` makes the server keep the blobs it sends
+      in append-only pack segments instead of one file per blob
+    ``remotefilelog.serverpackcache.segmentsize`` specifies the size at which
+      a server process seals its pack segment and starts a new one
+      (default: 512MB)
+    ``remotefilelog.serverpackcachepath`` specifies where the server pack
+      segments are kept (default: .hg/remotefilelogpacks)
+    ``remotefilelog.serverworkers`` specifies how many worker processes the
+      server builds and compresses the responses to getfiles and getpack
+      requests in, 0 to build them in the server process (default: 0)
+    ``remotefilelog.serverworkers.maxpending`` specifies how many requests
+      the server workers may work on ahead of the response being sent
+      (default: 4 per worker)
+    ``remotefilelog.serverworkers.minbatch`` specifies how many requests of a
+      getfiles or getpack command the server builds in its own process before
+      using the workers, which are forked once per server process (default:
+      16)
+    ``remotefilelog.textcachesize`` specifies the maximum size of the in-memory
+      cache of reconstructed file texts, 0 to disable (default: 64MB)
 """
 
 from . import fileserverclient, remotefilelog, remotefilectx, shallowstore
 import shallowbundle, debugcommands, remotefilelogserver, shallowverifier
 import shallowutil, shallowrepo
+import keepset, linkrevindex
+import bgprefetch
+import connectionbroker as connectionbrokermod
 import repack as repackmod
-from mercurial.node import hex
+from mercurial.node import hex, nullrev
 from mercurial.i18n import _
 from mercurial.extensions import wrapfunction
 from mercurial import (
@@ -56,7 +151,9 @@ from mercurial import (
     util,
 )
 
+import itertools
 import os
+import time
 import traceback
 
 # ensures debug commands are registered
@@ -230,6 +327,10 @@ def setupclient(ui, repo):
     shallowrepo.wraprepo(repo)
     repo.store = shallowstore.wrapstore(repo.store)
 
+    if ui.configbool('remotefilelog', 'linkrevindex'):
+        ui.setconfig('hooks', 'changegroup.linkrevindex',
+                     linkrevindex.updatehook)
+
 clientonetime = False
 def onetimeclientsetup(ui):
     global clientonetime
@@ -391,6 +492,11 @@ def onetimeclientsetup(ui):
             # - a norepo command like "help" is called
             if repo and shallowrepo.requirement in repo.requirements:
                 repo.fileservice.close()
+                repo.contentstore.logstats()
+                index = linkrevindex.getindex(repo)
+                if index is not None:
+                    index.logstats()
+                repo.metadatastore.flush()
     wrapfunction(dispatch, 'runcommand', runcommand)
 
     # disappointing hacks below
@@ -398,6 +504,7 @@ def onetimeclientsetup(ui):
     wrapfunction(revset, 'filelog', filelogrevset)
     revset.symbols['filelog'] = revset.filelog
     wrapfunction(cmdutil, 'walkfilerevs', walkfilerevs)
+    wrapfunction(revset, '_follow', followrevset)
 
     # prevent strip from stripping remotefilelogs
     def _collectbrokencsets(orig, repo, files, striprev):
@@ -529,6 +636,48 @@ def getrenamedfn(repo, endrev=None):
 
     return getrenamed
 
+class lazyfilerevs(object):
+    """The changelog revisions of the histories of some files, walked only
+    as far as the membership tests need.
+
+    Each history is an iterator of revisions in decreasing order, like
+    remotefilectx.walkancestors yields them. Testing for revisions in
+    decreasing order too, like walkchangerevs and hg log -f do, keeps the
+    walk lazy.
+    """
+    def __init__(self, histories):
+        # [iterator, lowest revision yielded so far]
+        self._histories = [[iter(h), None] for h in histories]
+        self._revs = set()
+
+    def _walk(self, rev):
+        """Walks the histories down to the first revision below rev."""
+        for history in self._histories:
+            it, low = history
+            while it is not None and (low is None or low >= rev):
+                low = next(it, None)
+                if low is None:
+                    it = None
+                else:
+                    self._revs.add(low)
+            history[:] = [it, low]
+
+    def __contains__(self, rev):
+        if rev not in self._revs:
+            self._walk(rev)
+        return rev in self._revs
+
+    def __iter__(self):
+        self._walk(nullrev)
+        return iter(sorted(self._revs))
+
+    def __len__(self):
+        self._walk(nullrev)
+        return len(self._revs)
+
+    def __sub__(self, other):
+        return set(self) - set(other)
+
 def walkfilerevs(orig, repo, match, follow, revs, fncache):
     if not shallowrepo.requirement in repo.requirements:
         return orig(repo, match, follow, revs, fncache)
@@ -538,28 +687,71 @@ def walkfilerevs(orig, repo, match, follow, revs, fncache):
     if not follow:
         raise cmdutil.FileWalkError("Cannot walk via filelog")
 
-    wanted = set()
     minrev, maxrev = min(revs), max(revs)
 
+    def filerevs(fctx):
+        # The ancestors come out by decreasing linkrev, but a linknode that
+        # points outside of the followed ancestry can give a revision a
+        # higher linkrev than its children, and put it behind ancestors
+        # below the range. So the walk only stops after a run of those.
+        below = 0
+        for ancestor in itertools.chain([fctx], fctx.ancestors()):
+            linkrev = ancestor.linkrev()
+            if linkrev < minrev:
+                below += 1
+                if below >= remotefilectx.READAHEAD:
+                    break
+                continue
+            below = 0
+            if linkrev <= maxrev:
+                fncache.setdefault(linkrev, []).append(ancestor.path())
+                yield linkrev
+
     pctx = repo['.']
+    histories = []
     for filename in match.files():
         if filename not in pctx:
             raise error.Abort(_('cannot follow file not in parent '
                                'revision: "%s"') % filename)
-        fctx = pctx[filename]
-
-        linkrev = fctx.linkrev()
-        if linkrev >= minrev and linkrev <= maxrev:
-            fncache.setdefault(linkrev, []).append(filename)
-            wanted.add(linkrev)
+        histories.append(filerevs(pctx[filename]))
 
-        for ancestor in fctx.ancestors():
-            linkrev = ancestor.linkrev()
-            if linkrev >= minrev and linkrev <= maxrev:
-                fncache.setdefault(linkrev, []).append(ancestor.path())
-                wanted.add(linkrev)
+    return lazyfilerevs(histories)
 
-    return wanted
+def followrevset(orig, repo, subset, x, name, followfirst=False):
+    """Replaces the pattern form of the ``follow()`` revset, to walk the
+    file histories lazily. ``hg log -f -l 10 FILE`` then reads as much of
+    the history as the 10 revisions need, not the whole of it.
+    """
+    if not shallowrepo.requirement in repo.requirements:
+        return orig(repo, subset, x, name, followfirst=followfirst)
+
+    l = revset.getargs(x, 0, 2, _("%s takes no arguments or a pattern "
+                                  "and an optional revset") % name)
+    if not l:
+        return orig(repo, subset, x, name, followfirst=followfirst)
+
+    c = repo['.']
+    pat = revset.getstring(l[0], _("%s expected a pattern") % name)
+    rev = None
+    if len(l) >= 2:
+        revs = revset.getset(repo, smartset.fullreposet(repo), l[1])
+        if len(revs) != 1:
+            raise error.RepoLookupError(
+                    _("%s expected one starting revision") % name)
+        rev = revs.last()
+        c = repo[rev]
+    m = match.match(repo.root, repo.getcwd(), [pat], ctx=repo[rev],
+                    default='path')
+
+    def filerevs(fctx):
+        # include the revision responsible for the most recent version
+        yield fctx.introrev()
+        for ancestor in fctx.walkancestors(lambda f: f.rev(), followfirst):
+            yield ancestor.rev()
+
+    s = lazyfilerevs(filerevs(c[f]) for f in c.manifest().walk(m))
+    return subset.filter(s.__contains__, condrepr=('<follow %r>', pat),
+                         cache=False)
 
 def filelogrevset(orig, repo, subset, x):
     """``filelog(pattern)``
@@ -649,8 +841,10 @@ def gcclient(ui, cachepath):
     reposfile.close()
 
     # build list of useful files
+    start = time.time()
     validrepos = []
-    keepkeys = set()
+    keepkeys = keepset.keepset()
+    keeprevs = 0
 
     _analyzing = _("analyzing repositories")
 
@@ -723,15 +917,13 @@ def gcclient(ui, cachepath):
             revs.append('(%s)' % prefetchrevs)
 
         keep = scmutil.revrange(repo, ['+'.join(revs)])
-        # TODO: Compute keepkeys more efficiently
-        for r in keep:
-            m = repo[r].manifest()
-            for filename, filenode in m.iteritems():
-                key = fileserverclient.getcachekey(reponame, filename,
-                    hex(filenode))
-                keepkeys.add(key)
+        keeprevs += len(keep)
+        keyfn = lambda filename, filenode: fileserverclient.getcachekey(
+            reponame, filename, hex(filenode))
+        keepset.addrevs(keepkeys, repo, keep, keyfn)
 
     ui.progress(_analyzing, None)
+    keepduration = time.time() - start
 
     # write list of valid repos back
     oldumask = os.umask(0o002)
@@ -748,6 +940,27 @@ def gcclient(ui, cachepath):
     elif not filesrepacked:
         ui.warn(_("warning: no valid repos in repofile\n"))
 
+    duration = time.time() - start
+    peakrss = shallowutil.peakrss()
+    ui.debug("keepset: %d keys from %d revisions in %0.2fs\n"
+             % (len(keepkeys), keeprevs, keepduration))
+    if peakrss:
+        ui.debug("gc: %0.2fs, peak RSS %s\n"
+                 % (duration, util.bytecount(peakrss)))
+        rssmsg = ', peak RSS %d bytes' % peakrss
+    else:
+        ui.debug("gc: %0.2fs\n" % duration)
+        rssmsg = ''
+    ui.log('remotefilelog',
+           'gc of %s: %d keep keys from %d revisions in %0.2fs, done in '
+           '%0.2fs%s\n',
+           cachepath, len(keepkeys), keeprevs, keepduration, duration,
+           rssmsg,
+           remotefilelogkeepkeys=len(keepkeys),
+           remotefilelogkeepsetduration=keepduration,
+           remotefilelogcachegcduration=duration,
+           remotefilelogcachegcpeakrss=peakrss)
+
 
 def log(orig, ui, repo, *pats, **opts):
     if shallowrepo.requirement not in repo.requirements:
@@ -893,16 +1106,34 @@ def debugdatapack(ui, path, **opts):
 def debughistorypack(ui, path, **opts):
     return debugcommands.debughistorypack(ui, path)
 
+@command('debugrepackbench', [
+    ], _('hg debugrepackbench'))
+def debugrepackbench(ui, repo, **opts):
+    return debugcommands.debugrepackbench(ui, repo, **opts)
+
 @command('debugwaitonrepack', [
     ], _('hg debugwaitonrepack'))
 def debugwaitonrepack(ui, repo, **opts):
     return debugcommands.debugwaitonrepack(repo)
 
+@command('debugwarmgetpackcache', [
+    ('r', 'rev', [], _('warm the cache for the specified revisions'),
+     _('REV')),
+    ], _('hg debugwarmgetpackcache -r REV'))
+def debugwarmgetpackcache(ui, repo, **opts):
+    revs = scmutil.revrange(repo, opts.get('rev'))
+    return remotefilelogserver.fillgetpackcache(ui, repo, revs)
+
 @command('debugwaitonprefetch', [
     ], _('hg debugwaitonprefetch'))
 def debugwaitonprefetch(ui, repo, **opts):
     return debugcommands.debugwaitonprefetch(repo)
 
+@command('debugprefetchqueue', [
+    ], _('hg debugprefetchqueue'))
+def debugprefetchqueue(ui, repo, **opts):
+    return debugcommands.debugprefetchqueue(ui, repo)
+
 @command('prefetch', [
     ('r', 'rev', [], _('prefetch the specified revisions'), _('REV')),
     ('', 'repack', False, _('run repack after prefetch')),
@@ -921,21 +1152,83 @@ def prefetch(ui, repo, *pats, **opts):
         raise error.Abort(_("repo is not shallow"))
 
     if not opts.get('rev'):
-        revset = ['.', 'draft()']
-
-        prefetchrevset = ui.config('remotefilelog', 'pullprefetch', None)
-        if prefetchrevset:
-            revset.append('(%s)' % prefetchrevset)
-        bgprefetchrevs = ui.config('remotefilelog', 'bgprefetchrevs', None)
-        if bgprefetchrevs:
-            revset.append('(%s)' % bgprefetchrevs)
-
-        opts['rev'] = ['+'.join(revset)]
+        opts['rev'] = [shallowutil.getprefetchrevset(ui)]
 
     revs = scmutil.revrange(repo, opts.get('rev'))
 
     repo.prefetch(revs, repack=opts.get('repack'), pats=pats, opts=opts)
 
+@command('prefetchdaemon', [
+    ('', 'background', None, _('run in a background process'), None),
+    ('', 'idle-timeout', '',
+     _('exit after being idle for this many seconds'), _('SECONDS')),
+    ], _('hg prefetchdaemon [OPTIONS]'))
+def prefetchdaemon(ui, repo, **opts):
+    """serve background prefetch requests for the repository
+
+    Prefetches the revisions queued by commands, and the working copy parent,
+    bookmarks, draft commits and the revisions configured in pullprefetch,
+    bgprefetchrevs and prefetchdaemon.revs whenever they move. The daemon
+    exits once it has been idle for prefetchdaemon.idletimeout seconds, or
+    immediately if another one is serving the repository.
+
+    Return 0 on success.
+    """
+    if not shallowrepo.requirement in repo.requirements:
+        raise error.Abort(_("repo is not shallow"))
+
+    if opts.get('background'):
+        bgprefetch.start(repo)
+        return
+
+    idletimeout = opts.get('idle_timeout')
+    if idletimeout:
+        try:
+            idletimeout = int(idletimeout)
+        except ValueError:
+            raise error.Abort(_("invalid idle timeout: %s") % idletimeout)
+    else:
+        idletimeout = None
+    if not bgprefetch.prefetchdaemon(repo, idletimeout).run():
+        ui.status(_("prefetch daemon already running\n"))
+
+@command('connectionbroker', [
+    ('', 'background', None, _('run in a background process'), None),
+    ('', 'idle-timeout', '',
+     _('exit after being idle for this many seconds'), _('SECONDS')),
+    ], _('hg connectionbroker [OPTIONS]'), norepo=True)
+def brokerconnections(ui, **opts):
+    """lend warm ssh connections to the hg commands of the user
+
+    Keeps the ssh connections to remotefilelog servers open between commands,
+    and lends them to the commands that fetch files when
+    remotefilelog.connectionbroker is set. Connections are closed once they
+    have been unused for connectionbroker.idletimeout seconds, and the broker
+    exits once it has been idle that long, or immediately if another one is
+    running.
+
+    Return 0 on success.
+    """
+    if not connectionbrokermod.supported():
+        raise error.Abort(_("connection broker is not supported on this "
+                            "platform"))
+
+    if opts.get('background'):
+        connectionbrokermod.start(ui)
+        return
+
+    idletimeout = opts.get('idle_timeout')
+    if idletimeout:
+        try:
+            idletimeout = int(idletimeout)
+        except ValueError:
+            raise error.Abort(_("invalid idle timeout: %s") % idletimeout)
+    else:
+        idletimeout = None
+    path = connectionbrokermod.socketpath(ui)
+    if not connectionbrokermod.connectionbroker(ui, path, idletimeout).run():
+        ui.status(_("connection broker already running\n"))
+
 @command('repack', [
      ('', 'background', None, _('run in a background process'), None),
      ('', 'incremental', None, _('do an incremental repack'), None),
@@ -0,0 +1,387 @@
+from __future__ import absolute_import
+
+import errno, hashlib, mmap, os, struct
+from mercurial import util
+from mercurial.node import bin, nullid
+from . import historypack
+
+# The ancestor cache version supported by this implementation.
+VERSION = 1
+
+# <version: 1 byte><key count: 4 byte><row count: 4 byte>
+# <string table size: 4 byte>
+HEADERFORMAT = '!BIII'
+HEADERLENGTH = struct.calcsize(HEADERFORMAT)
+
+# <key hash: 20 byte><first row: 4 byte><row count: 4 byte>
+# <packs string offset: 4 byte>
+KEYFORMAT = '!20sIII'
+KEYLENGTH = struct.calcsize(KEYFORMAT)
+
+NODELENGTH = 20
+# Each row holds a node, p1, p2, linknode and copyfrom string offset, each in
+# its own column.
+NODECOLUMNS = 4
+COPYFROMFORMAT = '!I'
+COPYFROMLENGTH = struct.calcsize(COPYFROMFORMAT)
+
+FILENAME = 'histpack.ancestors'
+
+# Maps added since the cache file was last rewritten are kept in a second file
+# in the same format, which is merged into the first once it holds at least
+# 1/MERGERATIO of its rows. So flushing a few new maps only rewrites the small
+# file, while the big one is rewritten about once per MERGERATIO-th of its size
+# added.
+NEWFILENAME = FILENAME + '.new'
+MERGERATIO = 8
+
+# The pack ids of an entry are kept as one string, whose length is stored in
+# 2 bytes.
+MAXPACKS = 0xffff // NODELENGTH
+
+def keyhash(name, node):
+    return hashlib.sha1('%s\0%s' % (name, node)).digest()
+
+def packid(path):
+    """Returns the 20 byte id of the history pack at path, which may or may
+    not end with the pack suffix."""
+    name = os.path.basename(path)
+    if name.endswith(historypack.PACKSUFFIX):
+        name = name[:-len(historypack.PACKSUFFIX)]
+    return bin(name)
+
+class cachefile(object):
+    """A read-only view of an ancestor cache file.
+
+    The file holds the full ancestor map of a set of (filename, node) keys, as
+    returned by unionmetadatastore.getancestors, so reading one back is a
+    bisect and one slice per column instead of a walk of the history graph.
+
+    It consists of a single file, with the following format. All bytes are in
+    network byte order (big endian).
+
+        cache = <version: 1 byte>
+                <key count: 4 byte unsigned int>
+                <row count: 4 byte unsigned int>
+                <string table size: 4 byte unsigned int>
+                <keyindex>
+                <nodes><p1s><p2s><linknodes>
+                <copyfroms>
+                <strings>
+        keyindex = [<key hash: 20 byte>
+                    <first row: 4 byte unsigned int>
+                    <row count: 4 byte unsigned int>
+                    <packs offset: 4 byte unsigned int>,...] (key count
+                                                              entries)
+        nodes, p1s, p2s, linknodes = [<node: 20 byte>,...] (row count entries)
+        copyfroms = [<string offset: 4 byte unsigned int>,...] (row count
+                                                                entries)
+        strings = [<string len: 2 byte unsigned int><string>,...]
+
+    The key index is sorted by key hash, which is the sha1 of the filename
+    and node separated by a null byte. The ancestors of a key are the rows
+    [first row, first row + row count). A copyfrom offset of 0 means the row
+    has no copyfrom, otherwise it's one past the string's offset in the
+    string table.
+
+    The packs offset of a key points to a string in the same way, holding
+    the 20 byte ids of the history packs its ancestors were read from. The
+    entry is only valid while all of those packs exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < HEADERLENGTH:
+                raise RuntimeError('truncated ancestor cache: %s' % path)
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (version, self.keycount, self.rowcount,
+         stringsize) = struct.unpack(HEADERFORMAT, self._data[:HEADERLENGTH])
+        if version != VERSION:
+            raise RuntimeError('unsupported ancestor cache version: %s' %
+                               version)
+
+        self._keystart = HEADERLENGTH
+        self._columnstart = self._keystart + self.keycount * KEYLENGTH
+        self._copyfromstart = (self._columnstart +
+                               NODECOLUMNS * self.rowcount * NODELENGTH)
+        self._stringstart = self._copyfromstart + self.rowcount * COPYFROMLENGTH
+        if size != self._stringstart + stringsize:
+            raise RuntimeError('corrupt ancestor cache: %s' % path)
+
+    def close(self):
+        self._data.close()
+
+    def __len__(self):
+        return self.keycount
+
+    def _findkey(self, hash):
+        start, end = 0, self.keycount
+        data = self._data
+        while start < end:
+            mid = (start + end) // 2
+            loc = self._keystart + mid * KEYLENGTH
+            midhash = data[loc:loc + NODELENGTH]
+            if midhash == hash:
+                return struct.unpack(KEYFORMAT, data[loc:loc + KEYLENGTH])[1:]
+            if midhash < hash:
+                start = mid + 1
+            else:
+                end = mid
+        return None
+
+    def _readstring(self, offset):
+        data = self._data
+        loc = self._stringstart + offset - 1
+        length = struct.unpack('!H', data[loc:loc + 2])[0]
+        return data[loc + 2:loc + 2 + length]
+
+    def _readpacks(self, offset):
+        raw = self._readstring(offset)
+        return frozenset(raw[i:i + NODELENGTH]
+                         for i in xrange(0, len(raw), NODELENGTH))
+
+    def _readrows(self, first, count):
+        data = self._data
+        columns = []
+        for column in xrange(NODECOLUMNS):
+            loc = (self._columnstart + column * self.rowcount * NODELENGTH +
+                   first * NODELENGTH)
+            raw = data[loc:loc + count * NODELENGTH]
+            columns.append([raw[i:i + NODELENGTH]
+                            for i in xrange(0, len(raw), NODELENGTH)])
+
+        loc = self._copyfromstart + first * COPYFROMLENGTH
+        offsets = struct.unpack('!%dI' % count,
+                                data[loc:loc + count * COPYFROMLENGTH])
+        copyfroms = [self._readstring(offset) if offset else None
+                     for offset in offsets]
+
+        nodes, p1s, p2s, linknodes = columns
+        return dict((nodes[i], (p1s[i], p2s[i], linknodes[i], copyfroms[i]))
+                    for i in xrange(count))
+
+    def get(self, name, node):
+        """Returns (pack ids, ancestor map) of name and node, or None if it
+        isn't cached."""
+        location = self._findkey(keyhash(name, node))
+        if location is None:
+            return None
+        first, count, packsoffset = location
+        return self._readpacks(packsoffset), self._readrows(first, count)
+
+    def iterentries(self):
+        """Yields (key hash, pack ids, ancestor map) for every key in the
+        cache, in key hash order."""
+        data = self._data
+        for i in xrange(self.keycount):
+            loc = self._keystart + i * KEYLENGTH
+            hash, first, count, packsoffset = struct.unpack(
+                KEYFORMAT, data[loc:loc + KEYLENGTH])
+            yield (hash, self._readpacks(packsoffset),
+                   self._readrows(first, count))
+
+def write(path, entries):
+    """Atomically writes an ancestor cache to path.
+
+    ``entries`` is an iterable of (key hash, pack ids, ancestor map), with at
+    most one entry per key hash.
+    """
+    keys = []
+    columns = [[] for i in xrange(NODECOLUMNS)]
+    copyfroms = []
+    strings = []
+    stringoffsets = {}
+    # A list so addstring can update it
+    stringsize = [0]
+    rowcount = 0
+
+    def addstring(value):
+        offset = stringoffsets.get(value)
+        if offset is None:
+            offset = stringsize[0] + 1
+            stringoffsets[value] = offset
+            strings.append(struct.pack('!H', len(value)) + value)
+            stringsize[0] += 2 + len(value)
+        return offset
+
+    for hash, packs, ancestors in sorted(entries):
+        packsoffset = addstring(''.join(sorted(packs)))
+        keys.append(struct.pack(KEYFORMAT, hash, rowcount, len(ancestors),
+                                packsoffset))
+        for node, (p1, p2, linknode, copyfrom) in sorted(ancestors.iteritems()):
+            for column, value in zip(columns, (node, p1, p2, linknode)):
+                column.append(value)
+            copyfroms.append(addstring(copyfrom) if copyfrom else 0)
+        rowcount += len(ancestors)
+
+    fp = util.atomictempfile(path, 'wb', checkambig=False)
+    try:
+        fp.write(struct.pack(HEADERFORMAT, VERSION, len(keys), rowcount,
+                             stringsize[0]))
+        fp.write(''.join(keys))
+        for column in columns:
+            fp.write(''.join(column))
+        fp.write(struct.pack('!%dI' % len(copyfroms), *copyfroms))
+        fp.write(''.join(strings))
+        fp.close()
+    finally:
+        fp.discard()
+
+def load(path):
+    """Returns the ancestor cache at path, or None if it does not exist or
+    cannot be read."""
+    try:
+        return cachefile(path)
+    except (IOError, OSError) as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+    except (RuntimeError, struct.error, ValueError):
+        # A corrupt or foreign cache is simply rebuilt.
+        pass
+    return None
+
+class ancestorcache(object):
+    """Caches the ancestor maps returned by unionmetadatastore.getancestors in
+    the shared pack directory, so the history of hot files doesn't have to be
+    walked on every command.
+
+    Only maps read entirely from ``store``, the shared historypackstore, are
+    cached, through its getpackancestors. Maps that use the repo-local or
+    loose stores would carry that repo's linknodes into every repo sharing
+    the cache.
+
+    The cache files are only read once they're needed. Maps with fewer than
+    ``minentries`` ancestors are cheap to walk and aren't cached. New maps are
+    kept in memory until flush() writes them out to the file of recent maps,
+    which is merged into the main one once it's big enough, keeping up to
+    ``maxentries`` ancestors in total.
+
+    Each map is stored with the ids of the packs it was read from, and is
+    dropped once one of them is removed, like by a repack. New packs don't
+    affect it: the ancestors of a node never change, and a complete map has
+    no history left for a new pack to add.
+    """
+    def __init__(self, ui, store, minentries=100, maxentries=1000000):
+        self.ui = ui
+        self.store = store
+        self.path = os.path.join(store.path, FILENAME)
+        self.newpath = os.path.join(store.path, NEWFILENAME)
+        self.minentries = minentries
+        self.maxentries = maxentries
+        self._pending = {}
+        self._loaded = False
+        self._cache = None
+        self._newcache = None
+        self._packs = None
+        self.hits = 0
+        self.misses = 0
+
+    def _listpacks(self):
+        """Returns the ids of the history packs in the pack directory."""
+        try:
+            files = os.listdir(self.store.path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            files = []
+        packs = set()
+        for f in files:
+            if f.endswith(historypack.PACKSUFFIX):
+                try:
+                    packs.add(packid(f))
+                except TypeError:
+                    # Not named after its hash, so not one of ours
+                    pass
+        return packs
+
+    def _load(self):
+        self._loaded = True
+        self._packs = self._listpacks()
+        self._cache = load(self.path)
+        self._newcache = load(self.newpath)
+
+    def get(self, name, node):
+        """Returns the cached ancestor map of name and node, or None."""
+        if not self._loaded:
+            self._load()
+
+        entry = self._pending.get(keyhash(name, node))
+        for cache in (self._newcache, self._cache):
+            if entry is not None:
+                break
+            if cache is not None:
+                entry = cache.get(name, node)
+                if entry is not None and not entry[0] <= self._packs:
+                    # One of its packs was removed
+                    entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # Callers may modify the map they get back.
+        return dict(entry[1])
+
+    def add(self, name, node, ancestors, packs):
+        """Adds the ancestor map of name and node, read from the packs whose
+        ids are in ``packs``."""
+        if len(ancestors) < self.minentries or node not in ancestors:
+            return
+        if nullid in ancestors or len(packs) > MAXPACKS:
+            return
+        self._pending[keyhash(name, node)] = (frozenset(packs),
+                                              dict(ancestors))
+
+    def flush(self):
+        """Writes the maps added since the cache was loaded to disk."""
+        if not self._pending:
+            return
+        if not self._loaded:
+            self._load()
+
+        # Only keep the maps whose packs are all still there. Otherwise the
+        # cache would outlive the history it was read from.
+        packs = self._listpacks()
+        entries = [(hash, entrypacks, ancestors)
+                   for hash, (entrypacks, ancestors) in self._pending.items()
+                   if entrypacks <= packs]
+        if entries:
+            seen = set(self._pending)
+            # A list so addentries can update it
+            total = [sum(len(ancestors) for hash, p, ancestors in entries)]
+
+            def addentries(cache):
+                for hash, entrypacks, ancestors in cache.iterentries():
+                    if hash in seen or not entrypacks <= packs:
+                        continue
+                    if total[0] + len(ancestors) > self.maxentries:
+                        continue
+                    seen.add(hash)
+                    entries.append((hash, entrypacks, ancestors))
+                    total[0] += len(ancestors)
+
+            if self._newcache is not None:
+                addentries(self._newcache)
+            cacherows = self._cache.rowcount if self._cache is not None else 0
+            try:
+                if total[0] * MERGERATIO < cacherows:
+                    write(self.newpath, entries)
+                else:
+                    if self._cache is not None:
+                        addentries(self._cache)
+                    write(self.path, entries)
+                    util.tryunlink(self.newpath)
+            except (IOError, OSError) as ex:
+                # The cache is an optimization; a read-only or full pack
+                # directory must not fail the command.
+                self.ui.debug('unable to write ancestor cache: %s\n' % ex)
+
+        self._pending = {}
+        for cache in (self._cache, self._newcache):
+            if cache is not None:
+                cache.close()
+        self._cache = None
+        self._newcache = None
+        self._loaded = False
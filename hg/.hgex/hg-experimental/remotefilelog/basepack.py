@@ -5,7 +5,7 @@ from mercurial import policy, util
 from mercurial.i18n import _
 from mercurial import vfs as vfsmod
 
-from . import shallowutil
+from . import multipackindex, shallowutil
 
 osutil = policy.importmod(r'osutil')
 
@@ -17,6 +17,8 @@ INDEXVERSIONSIZE = 2
 
 FANOUTSTART = INDEXVERSIONSIZE
 
+NODELENGTH = 20
+
 # Constant that indicates a fanout table entry hasn't been filled in. (This does
 # not get serialized)
 EMPTYFANOUT = -1
@@ -36,12 +38,25 @@ LARGEFANOUTPREFIX = 2
 # 10 step fanout scan = 2^16 / (2^16 / 8)  # fanout space divided by entries
 SMALLFANOUTCUTOFF = 2**16 / 8
 
+# Bisecting an index for one node costs about as much as unpacking this many of
+# its entries at once, so batches of at least (entries / BATCHSCANRATIO) nodes
+# are answered by scanning the whole index, and smaller ones by looking up each
+# node.
+BATCHSCANRATIO = 25
+
+# The number of index entries unpacked at once when scanning an index.
+SCANRANGESIZE = 4096
+
 # The amount of time to wait between checking for new packs. This prevents an
 # exception when data is moved to a new pack after the process has already
 # loaded the pack list.
 REFRESHRATE = 0.1
 
 class basepackstore(object):
+    # Whether finding a node in the multipack index is enough to know a key is
+    # present. This holds for stores whose packs are keyed by node alone.
+    MIDXEXACT = False
+
     def __init__(self, ui, path):
         self.path = path
         self.packs = []
@@ -66,6 +81,18 @@ class basepackstore(object):
                 continue
             self.packs.append(pack)
 
+        # The multipack index maps nodes to the packs that contain them, so a
+        # lookup costs one bisect instead of one per pack.
+        self._midx = None
+        self._midxpath = None
+        self._midxpacks = {}
+        self._unindexedpacks = self.packs
+        if ui.configbool('remotefilelog', 'multipackindex'):
+            self._midxpath = os.path.join(
+                path, self.PACKSUFFIX.lstrip('.') + multipackindex.SUFFIX)
+            self._midx = multipackindex.load(self._midxpath)
+            self.updatemultipackindex()
+
     def _getavailablepackfiles(self):
         suffixlen = len(self.INDEXSUFFIX)
 
@@ -92,6 +119,9 @@ class basepackstore(object):
         raise NotImplemented()
 
     def getmissing(self, keys):
+        if self._midx is not None:
+            return self._getmissingmidx(keys)
+
         missing = keys
         for pack in self.packs:
             missing = pack.getmissing(missing)
@@ -102,6 +132,93 @@ class basepackstore(object):
 
         return missing
 
+    def _getmissingmidx(self, keys):
+        missing = []
+        for key in keys:
+            name, node = key
+            for pack in self._packsfor(node):
+                if not self.MIDXEXACT or pack in self._unindexedpacks:
+                    if pack.getmissing([key]):
+                        continue
+                break
+            else:
+                missing.append(key)
+
+        if missing:
+            for pack in self.refresh():
+                missing = pack.getmissing(missing)
+
+        return missing
+
+    def _packsfor(self, node):
+        """Returns the loaded packs that may contain node. Without a multipack
+        index that is every pack."""
+        midx = self._midx
+        if midx is None:
+            return self.packs
+
+        midxpacks = self._midxpacks
+        packs = [midxpacks[name] for name in midx.getpacknames(node)
+                 if name in midxpacks]
+        if self._unindexedpacks:
+            packs.extend(self._unindexedpacks)
+        return packs
+
+    def updatemultipackindex(self):
+        """Brings the multipack index up to date with the loaded packs.
+
+        Entries for packs that are already indexed are copied from the existing
+        index, so only new packs have to be read. Entries for packs that no
+        longer exist are dropped. If the index can't be written (ex: a read-only
+        shared cache), the existing index is still used for the packs it covers
+        and the rest are searched one by one.
+        """
+        if self._midxpath is None:
+            return
+
+        packsbyname = {}
+        for pack in self.packs:
+            if multipackindex.indexable(pack):
+                packsbyname[os.path.basename(pack.path)] = pack
+
+        midx = self._midx
+        if midx is None or set(midx.packnames) != set(packsbyname):
+            packnames = sorted(packsbyname)
+            entries = []
+            indexed = set()
+            if midx is not None:
+                indexed = set(midx.packnames)
+                entries.extend((node, name) for node, name
+                               in midx.iterentries() if name in packsbyname)
+            for name in packnames:
+                if name not in indexed:
+                    entries.extend(
+                        multipackindex.packentries(packsbyname[name]))
+
+            try:
+                multipackindex.write(self._midxpath, packnames, entries)
+                newmidx = multipackindex.load(self._midxpath)
+            except EnvironmentError:
+                newmidx = None
+
+            if newmidx is not None:
+                if midx is not None:
+                    midx.close()
+                midx = newmidx
+
+        self._midx = midx
+        if midx is None:
+            self._midxpacks = {}
+            self._unindexedpacks = self.packs
+        else:
+            covered = set(midx.packnames)
+            self._midxpacks = dict((name, pack) for name, pack
+                                   in packsbyname.iteritems()
+                                   if name in covered)
+            indexed = set(self._midxpacks.itervalues())
+            self._unindexedpacks = [pack for pack in self.packs
+                                    if pack not in indexed]
+
     def markledger(self, ledger):
         for pack in self.packs:
             pack.markledger(ledger)
@@ -131,6 +248,9 @@ class basepackstore(object):
                 newpacks.append(self.getpack(filepath))
             self.packs.extend(newpacks)
 
+            if newpacks:
+                self.updatemultipackindex()
+
         return newpacks
 
 class versionmixin(object):
@@ -223,6 +343,28 @@ class basepack(versionmixin):
     def getmissing(self, keys):
         raise NotImplemented()
 
+    def _unpacknodes(self, start, end, entrylen):
+        """Returns the tuple of nodes in the index range [start, end), which
+        holds fixed size entries that start with a 20 byte node, unpacked
+        with a single struct call."""
+        count = (end - start) // entrylen
+        fmt = ('%ds%dx' % (NODELENGTH, entrylen - NODELENGTH)) * count
+        self._pagedin += end - start
+        return struct.unpack_from(fmt, self._index, start)
+
+    def _scannodes(self, start, end, entrylen):
+        """Yields the nodes of the index range [start, end), which holds fixed
+        size entries that start with a 20 byte node, in tuples of up to
+        SCANRANGESIZE nodes.
+
+        This reads the whole range, so it's only worth it for batches that are
+        dense relative to the range. See BATCHSCANRATIO.
+        """
+        rangesize = SCANRANGESIZE * entrylen
+        for offset in xrange(start, end, rangesize):
+            yield self._unpacknodes(offset, min(offset + rangesize, end),
+                                    entrylen)
+
     def markledger(self, ledger):
         raise NotImplemented()
 
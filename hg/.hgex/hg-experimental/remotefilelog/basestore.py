@@ -3,10 +3,11 @@ from __future__ import absolute_import
 import errno, hashlib, heapq, os, shutil, time
 
 from . import (
+    constants,
     shallowutil,
 )
 
-from mercurial import error
+from mercurial import error, util
 from mercurial.i18n import _
 from mercurial.node import bin, hex
 
@@ -37,6 +38,13 @@ class basestore(object):
         if self._validatecache == 'off':
             self._validatecache = False
 
+        # Store the text of large blobs once per content hash, so files
+        # copied to many paths only take space once.
+        self._dedup = (shared and util.safehasattr(os, 'link') and
+                       self.ui.configbool('remotefilelog', 'dedup'))
+        self._dedupminsize = max(1, self.ui.configbytes('remotefilelog',
+                                                        'dedupminsize', '4KB'))
+
         if shared:
             shallowutil.mkstickygroupdir(self.ui, path)
 
@@ -80,8 +88,10 @@ class basestore(object):
                     # If the file is already gone, no big deal
                     if ex.errno != errno.ENOENT:
                         raise
+                util.tryunlink(path + constants.DEDUPSUFFIX)
             count += 1
         ui.progress(_("cleaning up"), None)
+        self._sweepcontent()
 
         # Clean up directories
         cachepath = shallowutil.getcachepath(ui)
@@ -183,15 +193,20 @@ class basestore(object):
 
         return os.path.join(self._path, key)
 
+    def _getcontentpath(self, text):
+        sha = hashlib.sha1(text).hexdigest()
+        return os.path.join(self._path, constants.DEDUPDIR, sha[:2], sha[2:])
+
     def _getdata(self, name, node):
         filepath = self._getfilepath(name, node)
         try:
-            data = shallowutil.readfile(filepath)
+            data = shallowutil.readfileblob(filepath)
             if self._validatecache and not self._validatedata(data, filepath):
                 if self._validatecachelog:
                     with open(self._validatecachelog, 'a+') as f:
                         f.write("corrupt %s during read\n" % filepath)
                 os.rename(filepath, filepath + ".corrupt")
+                util.tryunlink(filepath + constants.DEDUPSUFFIX)
                 raise KeyError("corrupt local cache file %s" % filepath)
         except IOError:
             raise KeyError("no file found at %s for %s:%s" % (filepath, name,
@@ -199,6 +214,37 @@ class basestore(object):
 
         return data
 
+    def _dedupdata(self, filepath, data):
+        """Links the text of the blob from the content-addressed store next
+        to filepath, and returns what should be written to filepath."""
+        linkpath = filepath + constants.DEDUPSUFFIX
+        offset, size, flags = shallowutil.parsesizeflags(data)
+        if size < self._dedupminsize:
+            util.tryunlink(linkpath)
+            return data
+
+        stub, text = shallowutil.splitdedupblob(data)
+        contentpath = self._getcontentpath(text)
+        templink = '%s-tmp%d' % (linkpath, os.getpid())
+        # The text may be collected by gc between the two steps, in which
+        # case it just has to be written again.
+        for attempt in (0, 1):
+            if not os.path.exists(contentpath):
+                shallowutil.mkstickygroupdir(self.ui,
+                                             os.path.dirname(contentpath))
+                shallowutil.writefile(contentpath, text, readonly=True)
+            util.tryunlink(templink)
+            try:
+                os.link(contentpath, templink)
+                break
+            except OSError as ex:
+                if ex.errno != errno.ENOENT or attempt:
+                    raise
+        # Replace any existing link atomically, since readers may be looking
+        # at the old stub.
+        shallowutil.renamefile(templink, linkpath)
+        return stub
+
     def addremotefilelognode(self, name, node, data):
         filepath = self._getfilepath(name, node)
 
@@ -213,8 +259,17 @@ class basestore(object):
                 if os.path.exists(newfilename):
                     shallowutil.unlinkfile(newfilename)
                 shutil.copy(filepath, newfilename)
+                # keep the text of a deduplicated version too
+                linkpath = filepath + constants.DEDUPSUFFIX
+                util.tryunlink(newfilename + constants.DEDUPSUFFIX)
+                if os.path.exists(linkpath):
+                    os.link(linkpath, newfilename + constants.DEDUPSUFFIX)
 
             shallowutil.mkstickygroupdir(self.ui, os.path.dirname(filepath))
+            if self._dedup:
+                data = self._dedupdata(filepath, data)
+            elif self._shared:
+                util.tryunlink(filepath + constants.DEDUPSUFFIX)
             shallowutil.writefile(filepath, data, readonly=True)
 
             if self._validatecache:
@@ -239,8 +294,11 @@ class basestore(object):
             os.chmod(repospath, 0o0664)
 
     def _validatekey(self, path, action):
-        with open(path, 'rb') as f:
-            data = f.read()
+        try:
+            data = shallowutil.readfileblob(path)
+        except IOError:
+            # the deduplicated text is missing
+            data = ''
 
         if self._validatedata(data, path):
             return True
@@ -250,8 +308,38 @@ class basestore(object):
                 f.write("corrupt %s during %s\n" % (path, action))
 
         os.rename(path, path + ".corrupt")
+        util.tryunlink(path + constants.DEDUPSUFFIX)
         return False
 
+    def _iterdedupcontent(self):
+        """Yields (path, stat) for every text in the content-addressed
+        store."""
+        for root, dirs, files in os.walk(os.path.join(self._path,
+                                                      constants.DEDUPDIR)):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    yield path, os.lstat(path)
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+
+    def _sweepcontent(self):
+        """Removes the deduplicated texts that no cache file links to
+        anymore, and returns how many bytes were freed."""
+        freed = 0
+        for path, st in self._iterdedupcontent():
+            # every cache file using a text holds a hardlink to it
+            if st.st_nlink > 1:
+                continue
+            try:
+                shallowutil.unlinkfile(path)
+                freed += st.st_size
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+        return freed
+
     def _validatedata(self, data, path):
         try:
             if len(data) > 0:
@@ -292,8 +380,17 @@ class basestore(object):
         # keep files newer than a day even if they aren't needed
         limit = time.time() - (60 * 60 * 24)
 
+        # Deduplicated texts are only removed once no cache file links to
+        # them, and are accounted for separately.
+        dedupdir = os.path.join(cachepath, constants.DEDUPDIR)
+        contentsize = sum(st.st_size for path, st in self._iterdedupcontent())
+        originalsize += contentsize
+
         ui.progress(_removing, count, unit="files")
         for root, dirs, files in os.walk(cachepath):
+            if root == dedupdir:
+                dirs[:] = []
+                continue
             for file in files:
                 if file == 'repos':
                     continue
@@ -302,6 +399,12 @@ class basestore(object):
                 if '/packs/' in root:
                     continue
 
+                if file.endswith(constants.DEDUPSUFFIX):
+                    path = os.path.join(root, file)
+                    if not os.path.exists(path[:-len(constants.DEDUPSUFFIX)]):
+                        util.tryunlink(path)
+                    continue
+
                 ui.progress(_removing, count, unit="files")
                 path = os.path.join(root, file)
                 key = os.path.relpath(path, cachepath)
@@ -332,9 +435,12 @@ class basestore(object):
                                 "process\n")
                         ui.warn(msg % path)
                         continue
+                    util.tryunlink(path + constants.DEDUPSUFFIX)
                     removed += 1
         ui.progress(_removing, None)
 
+        size += contentsize - self._sweepcontent()
+
         # remove oldest files until under limit
         limit = ui.configbytes("remotefilelog", "cachelimit", "1000 GB")
         if size > limit:
@@ -344,6 +450,7 @@ class basestore(object):
                 ui.progress(_truncating, removedexcess, unit="bytes",
                             total=excess)
                 atime, oldpath, oldpathstat = queue.get()
+                freed = oldpathstat.st_size
                 try:
                     shallowutil.unlinkfile(oldpath)
                 except OSError as e:
@@ -352,10 +459,21 @@ class basestore(object):
                         raise
                     msg = _("warning: file %s was removed by another process\n")
                     ui.warn(msg % oldpath)
-                size -= oldpathstat.st_size
+                linkpath = oldpath + constants.DEDUPSUFFIX
+                try:
+                    linkstat = os.stat(linkpath)
+                    # the text is freed along with its last link
+                    if linkstat.st_nlink <= 2:
+                        freed += linkstat.st_size
+                    shallowutil.unlinkfile(linkpath)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                size -= freed
                 removed += 1
-                removedexcess += oldpathstat.st_size
+                removedexcess += freed
         ui.progress(_truncating, None)
+        self._sweepcontent()
 
         ui.status(_("finished: removed %s of %s files (%0.2f GB to %0.2f GB)\n")
                   % (removed, count,
@@ -0,0 +1,407 @@
+# bgprefetch.py - long-lived background prefetching for remotefilelog
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+"""background prefetch service
+
+The prefetch daemon owns all background prefetching for a repository.
+Commands don't prefetch themselves, they drop the revisions they want into a
+queue directory and leave. The daemon watches the queue and the repository
+(working copy parent, bookmarks, remotenames, sparse profile and changelog),
+and prefetches the files and trees of new revisions with a bounded pool of
+``hg prefetch`` processes.
+
+The queue is a directory in the store with one file per revision, named by
+its hex node. Requests are written to a temporary file and renamed into
+place, so any number of processes can enqueue without locking, and
+enqueuing a revision that is already queued is a no-op. The daemon claims
+requests by renaming them to ``<node>.<pid>``, and deletes them once they are
+prefetched.
+"""
+from __future__ import absolute_import
+
+import errno, os, subprocess, tempfile, time
+
+from hgext3rd.extutil import runbgcommand
+from mercurial import error, extensions, hg, scmutil, util
+from mercurial.i18n import _
+from mercurial.node import bin, hex, nullid
+
+from . import shallowutil
+
+QUEUEDIR = 'prefetchqueue'
+LOCKNAME = 'prefetchdaemonlock'
+STATSFILE = 'stats'
+
+# Files in the store that change when something the daemon prefetches for
+# moves.
+_WATCHEDSTOREFILES = ['00changelog.i', 'phaseroots']
+_WATCHEDFILES = ['dirstate', 'bookmarks', 'remotenames', 'sparse']
+
+def _isnode(name):
+    if len(name) != 40:
+        return False
+    try:
+        bin(name)
+    except TypeError:
+        return False
+    return True
+
+def _claimpid(name):
+    node, sep, pid = name.partition('.')
+    if not sep or not _isnode(node) or not pid.isdigit():
+        return None
+    return int(pid)
+
+def _queuepath(repo):
+    return repo.svfs.join(QUEUEDIR)
+
+def enqueue(repo, nodes, repack=False):
+    """Queues the given changelog nodes for the prefetch daemon."""
+    path = _queuepath(repo)
+    util.makedirs(path)
+    content = 'repack\n' if repack else ''
+    for node in nodes:
+        if node == nullid:
+            continue
+        fd, temp = tempfile.mkstemp(prefix='.', dir=path)
+        try:
+            os.write(fd, content)
+        finally:
+            os.close(fd)
+        # Renaming is atomic, so concurrent requests for the same revision
+        # simply replace each other.
+        os.rename(temp, os.path.join(path, hex(node)))
+
+def readqueue(repo):
+    """Returns (queued, claimed) lists of the queue entries."""
+    try:
+        files = os.listdir(_queuepath(repo))
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return [], []
+    queued = [f for f in files if _isnode(f)]
+    claimed = [f for f in files if _claimpid(f) is not None]
+    return queued, claimed
+
+def readstats(repo):
+    """Returns the statistics written by the last daemon, as a dict of
+    floats."""
+    path = os.path.join(_queuepath(repo), STATSFILE)
+    try:
+        lines = util.readfile(path).splitlines()
+    except IOError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        lines = []
+    stats = {}
+    for line in lines:
+        key, sep, value = line.partition(' ')
+        try:
+            stats[key] = float(value)
+        except ValueError:
+            pass
+    return stats
+
+def daemonpid(repo):
+    """Returns the pid of the running prefetch daemon, or None."""
+    try:
+        locker = repo.svfs.readlock(LOCKNAME)
+    except (IOError, OSError) as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return None
+    host, sep, pid = locker.rpartition(':')
+    if not pid.isdigit() or not util.testpid(int(pid)):
+        return None
+    return int(pid)
+
+def start(repo):
+    """Starts a prefetch daemon in the background, unless one is running."""
+    if daemonpid(repo) is not None:
+        return
+    cmd = util.hgcmd() + ['-R', repo.origroot, 'prefetchdaemon']
+    runbgcommand(cmd, os.environ)
+
+def wait(repo, interval=0.1):
+    """Waits until the running daemon, if any, has emptied the queue."""
+    while True:
+        pid = daemonpid(repo)
+        if pid is None:
+            return
+        queued, claimed = readqueue(repo)
+        if not queued and not claimed:
+            return
+        time.sleep(interval)
+
+class prefetchdaemon(object):
+    """Serves the prefetch queue of a repository. Only one daemon runs per
+    repository at a time."""
+    def __init__(self, repo, idletimeout=None):
+        self.ui = repo.ui
+        self.baseui = repo.baseui
+        self.root = repo.root
+        self.repo = repo.unfiltered()
+        self.queuepath = _queuepath(repo)
+        ui = self.ui
+        self.workers = max(1, ui.configint('remotefilelog',
+                                           'prefetchdaemon.workers', 2))
+        self.batchsize = max(1, ui.configint('remotefilelog',
+                                             'prefetchdaemon.batchsize', 100))
+        self.interval = float(ui.config('remotefilelog',
+                                        'prefetchdaemon.interval', 1.0))
+        if idletimeout is None:
+            idletimeout = ui.configint('remotefilelog',
+                                       'prefetchdaemon.idletimeout', 600)
+        self.idletimeout = idletimeout
+        self.watchrevs = ui.config('remotefilelog', 'prefetchdaemon.revs',
+                                   'bookmark()')
+
+        self._jobs = []
+        self._signature = None
+        self._sparse = None
+        # Revisions prefetched by this daemon, so the watcher doesn't queue
+        # them again every time the repository changes.
+        self._done = set()
+
+        self._stats = {
+            'started': time.time(),
+            'revisions': 0,
+            'batches': 0,
+            'failures': 0,
+            'busytime': 0,
+        }
+        self._busysince = None
+
+    def run(self):
+        """Serves the queue until it has been idle for idletimeout seconds.
+        Returns False if another daemon is already running."""
+        try:
+            lock = self.repo._lock(self.repo.svfs, LOCKNAME, False, None,
+                                   None, _('prefetch daemon in %s') %
+                                   self.repo.origroot)
+        except error.LockHeld:
+            return False
+
+        try:
+            util.makedirs(self.queuepath)
+            self._requeuestale()
+            lastactive = time.time()
+            while True:
+                self._watch()
+                self._reap()
+                self._dispatch()
+                self._writestats()
+
+                now = time.time()
+                queued, claimed = readqueue(self.repo)
+                if self._jobs or queued:
+                    lastactive = now
+                elif now - lastactive >= self.idletimeout:
+                    break
+
+                time.sleep(0.05 if self._jobs else self.interval)
+        finally:
+            while self._jobs:
+                for job in self._jobs:
+                    job['proc'].wait()
+                self._reap()
+            self._writestats()
+            lock.release()
+        return True
+
+    def _requeuestale(self):
+        """Puts the requests claimed by daemons that died back in the
+        queue."""
+        queued, claimed = readqueue(self.repo)
+        for name in claimed:
+            if util.testpid(_claimpid(name)):
+                continue
+            node = name.partition('.')[0]
+            try:
+                os.rename(os.path.join(self.queuepath, name),
+                          os.path.join(self.queuepath, node))
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+    def _getsignature(self):
+        signature = []
+        for vfs, files in ((self.repo.svfs, _WATCHEDSTOREFILES),
+                           (self.repo.vfs, _WATCHEDFILES)):
+            for f in files:
+                try:
+                    st = vfs.stat(f)
+                    signature.append((st.st_mtime, st.st_size))
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    signature.append(None)
+        return signature
+
+    def _watch(self):
+        """Reloads the repository and queues the watched revisions if
+        anything they depend on changed."""
+        signature = self._getsignature()
+        if signature == self._signature:
+            return
+        if self._signature is not None:
+            self.repo = hg.repository(self.baseui, self.root).unfiltered()
+        self._signature = signature
+
+        # prefetch only fetches the files in the sparse profile, so a new
+        # profile means everything has to be fetched again.
+        sparse = self.repo.vfs.tryread('sparse')
+        if sparse != self._sparse:
+            self._sparse = sparse
+            self._done.clear()
+
+        revset = shallowutil.getprefetchrevset(self.ui)
+        if self.watchrevs:
+            revset += '+(%s)' % self.watchrevs
+        try:
+            revs = scmutil.revrange(self.repo, [revset])
+        except (error.ParseError, error.RepoLookupError) as ex:
+            self.ui.warn(_('unable to resolve revisions to prefetch: %s\n') %
+                         ex)
+            return
+        cl = self.repo.changelog
+        nodes = [cl.node(r) for r in revs]
+        enqueue(self.repo, [n for n in nodes if n not in self._done])
+
+    def _claim(self):
+        """Claims up to batchsize queued revisions, oldest first. Returns a
+        list of (node, repack) tuples."""
+        queued, claimed = readqueue(self.repo)
+        def mtime(name):
+            try:
+                return os.stat(os.path.join(self.queuepath, name)).st_mtime
+            except OSError:
+                return 0
+        queued.sort(key=mtime)
+
+        nodemap = self.repo.changelog.nodemap
+        pid = os.getpid()
+        batch = []
+        for name in queued:
+            if len(batch) >= self.batchsize:
+                break
+            path = os.path.join(self.queuepath, name)
+            claimedpath = '%s.%d' % (path, pid)
+            try:
+                os.rename(path, claimedpath)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                continue
+            node = bin(name)
+            repack = util.readfile(claimedpath).startswith('repack')
+            if node not in nodemap:
+                # Stripped or otherwise unknown revision.
+                os.unlink(claimedpath)
+                continue
+            batch.append((node, repack))
+        return batch
+
+    def _treecommand(self, nodes):
+        """Returns the command prefetching the trees of nodes, or None if the
+        repository doesn't use tree manifests or already has them."""
+        try:
+            extensions.find('treemanifest')
+        except KeyError:
+            return None
+        mfl = self.repo.manifestlog
+        if (self.ui.configbool('treemanifest', 'server') or
+            not util.safehasattr(mfl, 'datastore')):
+            return None
+        mfnodes = dict((self.repo[n].manifestnode(), n) for n in nodes)
+        missing = mfl.datastore.getmissing(('', mf) for mf in mfnodes)
+        if not missing:
+            return None
+        revs = [hex(mfnodes[mf]) for name, mf in missing]
+        return ['prefetchtrees', '-r', '+'.join(revs)]
+
+    def _dispatch(self):
+        while len(self._jobs) < self.workers:
+            batch = self._claim()
+            if not batch:
+                return
+            nodes = [n for n, repack in batch]
+            cmd = ['prefetch', '-r', '+'.join(hex(n) for n in nodes)]
+            if any(repack for n, repack in batch):
+                cmd.append('--repack')
+            commands = [cmd]
+            treecmd = self._treecommand(nodes)
+            if treecmd:
+                commands.append(treecmd)
+
+            if self._busysince is None:
+                self._busysince = time.time()
+            # The commands of a batch run one after the other, so a batch
+            # only ever takes one worker.
+            job = {'nodes': nodes, 'commands': commands, 'failed': False}
+            self._spawn(job)
+            self._jobs.append(job)
+
+    def _spawn(self, job):
+        cmd = util.hgcmd() + ['-R', self.root, '-q'] + job['commands'].pop(0)
+        self.ui.debug('prefetch daemon running: %s\n' % ' '.join(cmd))
+        with open(os.devnull, 'w') as devnull:
+            job['proc'] = subprocess.Popen(cmd, close_fds=util.closefds,
+                                           stdin=devnull, stdout=devnull,
+                                           stderr=devnull)
+        job['cmd'] = cmd
+
+    def _reap(self):
+        pid = os.getpid()
+        running = []
+        for job in self._jobs:
+            proc = job['proc']
+            if proc.poll() is None:
+                running.append(job)
+                continue
+            if proc.returncode:
+                job['failed'] = True
+                self.ui.warn(_('prefetch daemon: %s exited with status %d\n')
+                             % (' '.join(job['cmd']), proc.returncode))
+            if job['commands']:
+                self._spawn(job)
+                running.append(job)
+                continue
+
+            nodes = job['nodes']
+            self._stats['batches'] += 1
+            self._stats['revisions'] += len(nodes)
+            if job['failed']:
+                self._stats['failures'] += 1
+            # Waiters consider the batch done once its claims are gone, so the
+            # statistics have to be written first.
+            self._writestats()
+            for node in nodes:
+                # Failed revisions are only retried once the repository
+                # changes.
+                self._done.add(node)
+                util.tryunlink(os.path.join(self.queuepath,
+                                            '%s.%d' % (hex(node), pid)))
+        self._jobs = running
+
+        if not self._jobs and self._busysince is not None:
+            self._stats['busytime'] += time.time() - self._busysince
+            self._busysince = None
+
+    def _writestats(self):
+        stats = dict(self._stats)
+        stats['pid'] = os.getpid()
+        stats['updated'] = time.time()
+        if self._busysince is not None:
+            stats['busytime'] += time.time() - self._busysince
+        try:
+            with util.atomictempfile(os.path.join(self.queuepath, STATSFILE),
+                                     'w') as fp:
+                for key in sorted(stats):
+                    fp.write('%s %r\n' % (key, stats[key]))
+        except (IOError, OSError) as ex:
+            self.ui.debug('unable to write prefetch daemon stats: %s\n' % ex)
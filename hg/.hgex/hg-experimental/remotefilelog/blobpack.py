@@ -0,0 +1,521 @@
+# blobpack.py - append-only pack store for the server blob cache
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+from __future__ import absolute_import
+
+import errno, hashlib, mmap, os, struct, time
+from mercurial import util
+from mercurial.i18n import _
+
+try:
+    import fcntl
+    fcntl.flock
+except ImportError:
+    fcntl = None
+
+PACKSUFFIX = '.blobpack'
+INDEXSUFFIX = '.blobidx'
+
+# The first byte of an index tells whether it's the append-only log of a
+# segment that is still being written, or the sorted index of a sealed one.
+LOGINDEX = 0
+SORTEDINDEX = 1
+
+# <key hash: 20 byte><blob offset: 8 byte><blob size: 4 byte>
+INDEXFORMAT = '!20sQI'
+INDEXENTRYLENGTH = struct.calcsize(INDEXFORMAT)
+
+# Sorted indexes are addressed by the first byte of the key hash.
+FANOUTCOUNT = 256
+FANOUTFORMAT = '!%dI' % FANOUTCOUNT
+FANOUTSIZE = struct.calcsize(FANOUTFORMAT)
+SORTEDSTART = 1 + FANOUTSIZE
+
+# The minimum time between two refreshes of the segment list, so a burst of
+# requests for blobs the store doesn't have doesn't list the directory for
+# each of them.
+REFRESHRATE = 0.1
+
+def keyhash(path, node):
+    return hashlib.sha1('%s\0%s' % (path, node)).digest()
+
+def getstore(repo):
+    """Returns the blob pack store of a server repo, or None if the server
+    keeps its blobs as loose files."""
+    ui = repo.ui
+    if not ui.configbool('remotefilelog', 'serverpackcache'):
+        return None
+    store = getattr(repo, '_blobpackstore', None)
+    if store is None:
+        path = ui.config('remotefilelog', 'serverpackcachepath')
+        if not path:
+            path = repo.vfs.join('remotefilelogpacks')
+        segmentsize = ui.configbytes('remotefilelog',
+                                     'serverpackcache.segmentsize', '512MB')
+        store = blobpackstore(ui, path, segmentsize)
+        repo._blobpackstore = store
+    return store
+
+class segment(object):
+    """A read-only view of one segment of a blob pack store.
+
+    A segment is a pair of files. Both are only ever appended to until the
+    segment is sealed, so readers never see data move.
+
+    .blobpack
+        The blobs, one after the other, with nothing in between.
+
+    .blobidx
+        Either the append-only log of a segment that is being written:
+
+            logindex = <0: 1 byte>[<indexentry>,...]
+
+        or, once the segment is sealed, a sorted index with a fanout table,
+        which replaces the log atomically:
+
+            sortedindex = <1: 1 byte><fanout>[<indexentry>,...]
+            fanout = [<entry count: 4 byte unsigned int>,...] (256 entries)
+
+        indexentry = <key hash: 20 byte>
+                     <blob offset: 8 byte unsigned int>
+                     <blob size: 4 byte unsigned int>
+
+        The key hash is the sha1 of the file path and node. Fanout entry N is
+        the number of index entries whose key hash starts with a byte lower
+        than N. An index entry is appended to the log only once its blob is
+        entirely written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sealed = False
+        self._logsize = 0
+        self._log = {}
+        self._index = None
+        self._fanout = None
+        self._packfp = None
+        self._stat = None
+
+    def refresh(self):
+        """Picks up the entries appended, or the sealing, since the last
+        refresh."""
+        if self.sealed:
+            return
+        indexpath = self.path + INDEXSUFFIX
+        try:
+            st = os.stat(indexpath)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return
+        if (self._stat is not None and st.st_ino == self._stat.st_ino and
+            st.st_size == self._stat.st_size):
+            return
+
+        with open(indexpath, 'rb') as fp:
+            kind = fp.read(1)
+            if not kind:
+                return
+            if ord(kind) == SORTEDINDEX:
+                self._loadsorted(fp)
+                self._log = {}
+            else:
+                fp.seek(max(1, self._logsize))
+                raw = fp.read()
+                usable = len(raw) - len(raw) % INDEXENTRYLENGTH
+                for offset in xrange(0, usable, INDEXENTRYLENGTH):
+                    hash, blobstart, size = struct.unpack_from(INDEXFORMAT,
+                                                               raw, offset)
+                    self._log[hash] = (blobstart, size)
+                self._logsize = max(1, self._logsize) + usable
+        self._stat = st
+
+    def _loadsorted(self, fp):
+        size = os.fstat(fp.fileno()).st_size
+        self._index = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        self._fanout = struct.unpack(FANOUTFORMAT,
+                                     self._index[1:SORTEDSTART])
+        self.sealed = True
+
+    def _findsorted(self, hash):
+        prefix = ord(hash[0])
+        start = self._fanout[prefix]
+        if prefix + 1 < FANOUTCOUNT:
+            end = self._fanout[prefix + 1]
+        else:
+            end = (len(self._index) - SORTEDSTART) // INDEXENTRYLENGTH
+        index = self._index
+        while start < end:
+            mid = (start + end) // 2
+            offset = SORTEDSTART + mid * INDEXENTRYLENGTH
+            midhash = index[offset:offset + 20]
+            if midhash < hash:
+                start = mid + 1
+            elif midhash > hash:
+                end = mid
+            else:
+                return struct.unpack_from(INDEXFORMAT, index, offset)[1:]
+        return None
+
+    def addlogged(self, hash, location):
+        """Records an entry this process just appended to the log."""
+        self._log[hash] = location
+
+    def find(self, hash):
+        if self.sealed:
+            return self._findsorted(hash)
+        return self._log.get(hash)
+
+    def read(self, location):
+        blobstart, size = location
+        if self._packfp is None:
+            self._packfp = open(self.path + PACKSUFFIX, 'rb')
+        self._packfp.seek(blobstart)
+        data = self._packfp.read(size)
+        if len(data) != size:
+            return None
+        return data
+
+    def close(self):
+        if self._packfp is not None:
+            self._packfp.close()
+            self._packfp = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+class blobpackstore(object):
+    """A cache of compressed file blobs, kept in append-only segments
+    instead of one file per blob. The server keeps the blobs it sends in one,
+    and the local cache process (see localcacheclient.py) uses one as a
+    machine wide cache.
+
+    Every process appends to a segment of its own, so any number of
+    processes can fill the store at once. A segment is locked by the process
+    appending to it, and is reused by the next process once its writer is
+    done with it. When a segment reaches ``segmentsize`` bytes, its writer
+    seals it by replacing its log with a sorted index, and starts a new one.
+
+    Segments are expired or trimmed as a whole, so garbage collection only
+    has to look at the segment files instead of walking a tree of millions
+    of blobs.
+    """
+    def __init__(self, ui, path, segmentsize):
+        self.ui = ui
+        self.path = path
+        self.segmentsize = segmentsize
+        self._segments = {}
+        self._lastrefresh = 0
+
+        # The segment this process appends to
+        self._writer = None
+        self._writerpath = None
+        self._writerpid = None
+
+    def _listsegments(self):
+        try:
+            files = os.listdir(self.path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return []
+        return [os.path.join(self.path, f[:-len(INDEXSUFFIX)])
+                for f in files if f.endswith(INDEXSUFFIX)]
+
+    def refresh(self):
+        current = set(self._listsegments())
+        for path in set(self._segments) - current:
+            self._segments.pop(path).close()
+        for path in current:
+            if path not in self._segments:
+                self._segments[path] = segment(path)
+            self._segments[path].refresh()
+        self._lastrefresh = time.time()
+
+    def _find(self, path, node):
+        hash = keyhash(path, node)
+        for seg in self._segments.itervalues():
+            location = seg.find(hash)
+            if location is not None:
+                return seg, location
+        return None, None
+
+    def _findorrefresh(self, path, node):
+        seg, location = self._find(path, node)
+        if seg is None and time.time() - self._lastrefresh > REFRESHRATE:
+            # Another process may have added it since the last refresh
+            self.refresh()
+            seg, location = self._find(path, node)
+        return seg, location
+
+    def get(self, path, node):
+        """Returns the compressed blob of the given file revision, or None
+        if the store doesn't have it."""
+        seg, location = self._findorrefresh(path, node)
+        if seg is None:
+            return None
+        try:
+            return seg.read(location)
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            # The segment was expired
+            return None
+
+    def getmany(self, keys):
+        """Yields (path, node, blob) for each of the given (path, node) keys,
+        with a blob of None for the ones the store doesn't have.
+
+        The blobs are read segment by segment in the order they are stored,
+        instead of in the order of the keys, so a large batch of lookups
+        reads each segment sequentially.
+        """
+        found = []
+        for path, node in keys:
+            seg, location = self._findorrefresh(path, node)
+            if seg is None:
+                yield path, node, None
+            else:
+                found.append((seg.path, location, seg, path, node))
+        found.sort(key=lambda x: x[:2])
+
+        for segpath, location, seg, path, node in found:
+            try:
+                blob = seg.read(location)
+            except IOError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                # The segment was expired
+                blob = None
+            yield path, node, blob
+
+    def contains(self, path, node):
+        return self._findorrefresh(path, node)[0] is not None
+
+    def add(self, path, node, blob):
+        """Appends a compressed blob to the segment of this process."""
+        try:
+            writer = self._getwriter()
+            packfp, indexfp = writer
+            blobstart = packfp.tell()
+            packfp.write(blob)
+            packfp.flush()
+            hash = keyhash(path, node)
+            indexfp.write(struct.pack(INDEXFORMAT, hash, blobstart,
+                                      len(blob)))
+            indexfp.flush()
+
+            seg = self._segments.get(self._writerpath)
+            if seg is None:
+                seg = self._segments[self._writerpath] = segment(
+                    self._writerpath)
+            seg.addlogged(hash, (blobstart, len(blob)))
+
+            if packfp.tell() >= self.segmentsize:
+                self._writer = None
+                self._seal(self._writerpath, writer)
+        except (IOError, OSError) as ex:
+            # Don't fail the request if the user only has permission to read
+            # the cache.
+            self.ui.debug('unable to write to server blob pack: %s\n' % ex)
+
+    def _getwriter(self):
+        if self._writer is not None and self._writerpid == os.getpid():
+            return self._writer
+
+        # Workers forked from the server must not append to its segment
+        self._writer = None
+        oldumask = os.umask(0o002)
+        try:
+            util.makedirs(self.path)
+            segpath, writer = self._reusesegment()
+            if writer is None:
+                suffix = hashlib.sha1(os.urandom(20)).hexdigest()[:8]
+                name = '%d-%d-%s' % (int(time.time()), os.getpid(), suffix)
+                segpath = os.path.join(self.path, name)
+                packfp = open(segpath + PACKSUFFIX, 'ab')
+                indexfp = open(segpath + INDEXSUFFIX, 'a+b')
+                if fcntl is not None:
+                    # Another process may briefly hold it, to find it isn't
+                    # ready to be reused yet.
+                    fcntl.flock(indexfp, fcntl.LOCK_EX)
+                indexfp.write(chr(LOGINDEX))
+                indexfp.flush()
+                writer = (packfp, indexfp)
+        finally:
+            os.umask(oldumask)
+
+        self._writer = writer
+        self._writerpath = segpath
+        self._writerpid = os.getpid()
+        return self._writer
+
+    def _reusesegment(self):
+        """Returns the path and the open files of a segment that isn't sealed
+        and that no other process is appending to, so short lived processes,
+        like cache processes, don't each leave a small segment behind.
+
+        The segment is locked for as long as the files stay open. Returns
+        (None, None) if there is no such segment, or segments can't be
+        locked on this platform.
+        """
+        if fcntl is None:
+            return None, None
+        for segpath in self._listsegments():
+            indexpath = segpath + INDEXSUFFIX
+            try:
+                indexfp = open(indexpath, 'a+b')
+            except IOError:
+                continue
+            try:
+                fcntl.flock(indexfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # The segment may have been sealed or expired before we got
+                # the lock, in which case we hold the lock of a stale file.
+                st = os.fstat(indexfp.fileno())
+                if st.st_ino != os.stat(indexpath).st_ino:
+                    raise IOError(errno.ENOENT, 'segment was replaced')
+                indexfp.seek(0)
+                if indexfp.read(1) != chr(LOGINDEX):
+                    raise IOError(errno.EEXIST, 'segment is sealed')
+
+                # Drop the partial entry a crashed writer may have left, so
+                # the log stays aligned.
+                size = st.st_size
+                usable = 1 + (size - 1) // INDEXENTRYLENGTH * INDEXENTRYLENGTH
+                if size != usable:
+                    indexfp.truncate(usable)
+
+                packfp = open(segpath + PACKSUFFIX, 'ab')
+                packfp.seek(0, os.SEEK_END)
+                if packfp.tell() >= self.segmentsize:
+                    # The last writer didn't get to seal it
+                    self._seal(segpath, (packfp, indexfp))
+                    continue
+                return segpath, (packfp, indexfp)
+            except (IOError, OSError):
+                indexfp.close()
+        return None, None
+
+    def _seal(self, segpath, writer):
+        """Replaces the log of a segment with a sorted index, and closes its
+        files, so the next blob starts a new segment."""
+        seg = segment(segpath)
+        seg.refresh()
+        entries = sorted(seg._log.iteritems())
+        seg.close()
+
+        fanout = [0] * FANOUTCOUNT
+        for hash, location in entries:
+            fanout[ord(hash[0])] += 1
+        total = 0
+        for i in xrange(FANOUTCOUNT):
+            total, fanout[i] = total + fanout[i], total
+
+        # The lock is held until the sorted index replaced the log, so no
+        # other process starts appending to it in between.
+        with util.atomictempfile(segpath + INDEXSUFFIX, 'wb') as fp:
+            fp.write(chr(SORTEDINDEX))
+            fp.write(struct.pack(FANOUTFORMAT, *fanout))
+            for hash, (blobstart, size) in entries:
+                fp.write(struct.pack(INDEXFORMAT, hash, blobstart, size))
+
+        for fp in writer:
+            fp.close()
+
+    def close(self):
+        if self._writer is not None and self._writerpid == os.getpid():
+            for fp in self._writer:
+                fp.close()
+        self._writer = None
+        for seg in self._segments.itervalues():
+            seg.close()
+        self._segments = {}
+
+    def _removesegment(self, segpath):
+        """Removes a segment, unless a process is still appending to it.
+        Returns whether it was removed.
+
+        The segment is locked like _reusesegment does while its files are
+        unlinked, so no writer keeps appending to files that are gone, and
+        no process starts reusing it in between.
+        """
+        indexpath = segpath + INDEXSUFFIX
+        try:
+            indexfp = open(indexpath, 'rb')
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            # Another process removed it first
+            return False
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(indexfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    # The segment may have been sealed or removed before we
+                    # got the lock, in which case we hold the lock of a stale
+                    # file.
+                    st = os.fstat(indexfp.fileno())
+                    if st.st_ino != os.stat(indexpath).st_ino:
+                        return False
+                except (IOError, OSError):
+                    return False
+
+            # Remove the index first, so readers stop finding the blobs
+            util.tryunlink(indexpath)
+            util.tryunlink(segpath + PACKSUFFIX)
+            return True
+        finally:
+            indexfp.close()
+
+    def _segmentstats(self):
+        stats = []
+        for segpath in self._listsegments():
+            try:
+                st = os.stat(segpath + PACKSUFFIX)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                st = None
+            stats.append((segpath, st))
+        return stats
+
+    def expire(self, before):
+        """Removes the segments that haven't been written to since the given
+        time, except the ones a process is still appending to. Returns the
+        number of bytes freed."""
+        freed = 0
+        _removing = _("removing old server blob packs")
+        segments = self._segmentstats()
+        for i, (segpath, st) in enumerate(segments):
+            self.ui.progress(_removing, i, unit="packs", total=len(segments))
+            if st is not None and st.st_mtime >= before:
+                continue
+            if self._removesegment(segpath) and st is not None:
+                freed += st.st_size
+        self.ui.progress(_removing, None)
+
+        self.refresh()
+        return freed
+
+    def trim(self, maxsize):
+        """Removes the least recently written segments until the store is at
+        most maxsize bytes, except the ones a process, this one included,
+        is still appending to. Returns the number of bytes freed."""
+        segments = sorted((st.st_mtime, st.st_size, segpath)
+                          for segpath, st in self._segmentstats()
+                          if st is not None)
+        size = sum(segsize for mtime, segsize, segpath in segments)
+        freed = 0
+        for mtime, segsize, segpath in segments:
+            if size - freed <= maxsize:
+                break
+            if self._writer is not None and segpath == self._writerpath:
+                continue
+            if self._removesegment(segpath):
+                freed += segsize
+
+        if freed:
+            self.refresh()
+        return freed
@@ -12,7 +12,6 @@
 # A better implementation would make all of the requests non-blocking.
 
 import os, sys
-import memcache
 
 stdin = sys.stdin
 stdout = sys.stdout
@@ -35,6 +34,18 @@ def readfile(path):
     finally:
         f.close()
 
+def readblob(path):
+    """Reads a file from the remotefilelog cache. The text of deduplicated
+    files is stored in a separate file next to them (see
+    remotefilelog.basestore), and has to be put back before the file is
+    shared with other machines."""
+    value = readfile(path)
+    if value.startswith('dedup\n'):
+        value = value[len('dedup\n'):]
+        index = value.index('\0') + 1
+        value = value[:index] + readfile(path + '.content') + value[index:]
+    return value
+
 def writefile(path, content):
     dirname = os.path.dirname(path)
     if not os.path.exists(dirname):
@@ -120,7 +131,7 @@ def setKeys():
         id = stdin.readline()[:-1]
         path = os.path.join(cachepath, id)
 
-        value = readfile(path)
+        value = readblob(path)
         value = compress(value)
 
         key = generateKey(id)
@@ -192,6 +203,8 @@ def main(argv=None):
     keyprefix = argv[2]
     cachepath = argv[3]
 
+    # Imported here so the helpers above can be used without memcache
+    import memcache
     mc = memcache.Client([ip], debug=0)
 
     while True:
@@ -0,0 +1,454 @@
+# connectionbroker.py - per-user broker of warm ssh connections
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+"""per-user connection broker
+
+Every hg process that fetches files opens its own ssh connection to the
+server, and pays for the ssh handshake and the ``hg serve --stdio`` startup.
+The connection broker is a long-lived process per user that keeps those
+connections open between commands, and lends them to the hg processes of the
+user over a unix socket.
+
+A client connects to the socket and sends the key of the connection it wants,
+as ``<length>\\n<path>\\0<ssh command>\\0<remote command>``. The broker replies
+``ok <length>\\n<capabilities>`` and lends the client an idle connection for
+that key, opening one if there is none, or replies
+``error <length>\\n<message>``.
+
+From then on the broker relays the client's requests to the server, and the
+server's responses back. The wire protocol can't tell where a request ends,
+so the client sends its requests in frames of ``<length>\\n<data>``, and an
+empty frame when it is done and has read every response it waited for. Only
+connections that were given back that way are lent again; if the client goes
+away without doing so, the connection is closed.
+
+Requests are multiplexed over the broker's connections one client at a time:
+the stdio protocol has no way to interleave the requests of several clients
+on one connection, so concurrent clients get a connection each.
+"""
+from __future__ import absolute_import
+
+import collections, errno, os, select, socket, threading, time
+
+from hgext3rd.extutil import runbgcommand
+from mercurial import error, hg, sshpeer, util
+from mercurial.i18n import _
+
+from . import shallowutil
+
+try:
+    import fcntl
+    fcntl.flock
+except ImportError:
+    fcntl = None
+
+SOCKETNAME = 'connectionbroker.sock'
+
+# Size of the reads and writes relayed between clients and connections
+CHUNKSIZE = 65536
+
+# How much data the broker buffers for a client or a connection before it
+# stops reading from the other side
+MAXBUFFERED = 4 * 1024 * 1024
+
+def supported():
+    return fcntl is not None and util.safehasattr(socket, 'AF_UNIX')
+
+def enabled(ui):
+    return ui.configbool('remotefilelog', 'connectionbroker') and supported()
+
+def socketpath(ui):
+    path = ui.config('remotefilelog', 'connectionbroker.path')
+    if path:
+        return util.expandpath(path)
+    return os.path.join(shallowutil.getcachepath(ui), SOCKETNAME)
+
+def start(ui):
+    """Starts a connection broker in the background. It exits right away if
+    one is already running."""
+    # The broker doesn't run in a repository, so it can't read the socket
+    # path from the configuration of one
+    cmd = util.hgcmd() + ['connectionbroker', '--config',
+                          'remotefilelog.connectionbroker.path=%s' %
+                          socketpath(ui)]
+    runbgcommand(cmd, os.environ)
+
+def _sendreply(sock, status, message):
+    sock.sendall('%s %d\n%s' % (status, len(message), message))
+
+def _readexact(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise error.ResponseError(_('unexpected response from connection '
+                                    'broker:'), data)
+    return data
+
+def connect(ui, path):
+    """Returns a peer to path lent by the connection broker, or None if
+    there is no broker or it couldn't connect. A broker is started in the
+    background if none is running, for the next commands to use."""
+    u = util.url(path, parsequery=False, parsefragment=False)
+    if u.scheme != 'ssh':
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketpath(ui))
+    except socket.error as ex:
+        sock.close()
+        if (ex.errno in (errno.ENOENT, errno.ECONNREFUSED) and
+            ui.configbool('remotefilelog', 'connectionbroker.autostart',
+                          True)):
+            start(ui)
+        return None
+
+    try:
+        key = '\0'.join([path, ui.config('ui', 'ssh'),
+                         ui.config('ui', 'remotecmd')])
+        sock.sendall('%d\n%s' % (len(key), key))
+        fp = sock.makefile('rb')
+        status, size = fp.readline().split()
+        message = _readexact(fp, int(size))
+    except (socket.error, error.ResponseError, ValueError) as ex:
+        ui.debug('connection broker failed: %s\n' % ex)
+        sock.close()
+        return None
+
+    if status != 'ok':
+        ui.debug('connection broker failed: %s\n' % message)
+        sock.close()
+        return None
+
+    ui.debug('using connection broker for %s\n' % util.hidepassword(path))
+    peer = brokerpeer(ui, path, sock, fp, set(message.split()))
+    # Set the peer up like hg.peer does
+    for f in hg.wirepeersetupfuncs:
+        f(ui, peer)
+    return peer
+
+class _framewriter(object):
+    """Buffers the writes to the broker, and sends them as one frame when
+    flushed."""
+    def __init__(self, sock):
+        self._sock = sock
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= CHUNKSIZE:
+            self.flush()
+
+    def flush(self):
+        if self._size:
+            data = ''.join(self._chunks)
+            self._chunks = []
+            self._size = 0
+            self._sock.sendall('%d\n%s' % (len(data), data))
+
+    def close(self):
+        self._chunks = []
+        self._size = 0
+
+class brokerpeer(sshpeer.sshpeer):
+    """An ssh peer lent by the connection broker.
+
+    Requests are relayed by the broker to one of its connections. release()
+    gives the connection back to the broker, and cleanup() drops it, so it's
+    not lent again in an unknown state.
+    """
+    def __init__(self, ui, path, sock, fp, caps):
+        # sshpeer.__init__ starts ssh, which is the broker's job
+        self._url = path
+        self.ui = ui
+        u = util.url(path, parsequery=False, parsefragment=False)
+        self.user = u.user
+        self.host = u.host
+        self.port = u.port
+        self.path = u.path or "."
+
+        self._sock = sock
+        self.pipeo = _framewriter(sock)
+        self.pipei = fp
+        self._caps = caps
+
+    def readerr(self):
+        # The broker drains the remote output, there is nothing to forward
+        pass
+
+    def release(self):
+        if self._sock is None:
+            return
+        try:
+            self.pipeo.flush()
+            self._sock.sendall('0\n')
+        except socket.error:
+            pass
+        self.cleanup()
+
+    def cleanup(self):
+        if self._sock is None:
+            return
+        self.pipeo.close()
+        self.pipei.close()
+        self._sock.close()
+        self._sock = None
+
+    __del__ = cleanup
+
+class _buffer(object):
+    """Bytes waiting to be written to a non-blocking file descriptor."""
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        for i in xrange(0, len(data), CHUNKSIZE):
+            self._chunks.append(data[i:i + CHUNKSIZE])
+        self._size += len(data)
+
+    def writeto(self, write):
+        chunk = self._chunks[0]
+        try:
+            written = write(chunk)
+        except (OSError, socket.error) as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+            return
+        if written == len(chunk):
+            self._chunks.popleft()
+        else:
+            self._chunks[0] = chunk[written:]
+        self._size -= written
+
+def _readable(fd):
+    return bool(select.select([fd], [], [], 0)[0])
+
+def _relay(sock, proc):
+    """Relays the frames sent by a client to the stdin of a connection, and
+    the stdout of the connection back to the client, until the client is
+    done with it. Returns True if the connection was given back in a state
+    it can be lent again in."""
+    client = sock.fileno()
+    stdin = proc.stdin.fileno()
+    stdout = proc.stdout.fileno()
+    stderr = proc.stderr.fileno()
+    sock.setblocking(False)
+    flags = fcntl.fcntl(stdin, fcntl.F_GETFL)
+    fcntl.fcntl(stdin, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    toserver = _buffer()
+    toclient = _buffer()
+    pending = ''
+    remaining = 0
+    released = False
+    while True:
+        if released and not toserver:
+            # A client only gives the connection back once it has received
+            # every response it waited for, so anything left is unexpected.
+            return not toclient and not _readable(stdout)
+
+        rlist = [stderr]
+        wlist = []
+        if not released and len(toserver) < MAXBUFFERED:
+            rlist.append(client)
+        if len(toclient) < MAXBUFFERED:
+            rlist.append(stdout)
+        if toserver:
+            wlist.append(stdin)
+        if toclient:
+            wlist.append(client)
+        r, w, x = select.select(rlist, wlist, [])
+
+        if client in r:
+            data = sock.recv(CHUNKSIZE)
+            if not data:
+                return False
+            pending += data
+            while pending and not released:
+                if remaining:
+                    chunk = pending[:remaining]
+                    toserver.append(chunk)
+                    remaining -= len(chunk)
+                    pending = pending[len(chunk):]
+                    continue
+                header, sep, rest = pending.partition('\n')
+                if not sep:
+                    break
+                remaining = int(header)
+                pending = rest
+                if not remaining:
+                    released = True
+
+        if stdout in r:
+            data = os.read(stdout, CHUNKSIZE)
+            if not data:
+                return False
+            toclient.append(data)
+
+        if stderr in r:
+            # The client has no way to show the remote output
+            if not os.read(stderr, CHUNKSIZE):
+                return False
+
+        if stdin in w:
+            toserver.writeto(lambda data: os.write(stdin, data))
+        if client in w:
+            toclient.writeto(sock.send)
+
+class connectionbroker(object):
+    """Lends warm ssh connections to the hg processes of a user. Only one
+    broker runs per socket at a time."""
+    def __init__(self, ui, path, idletimeout=None):
+        self.ui = ui
+        self.path = path
+        if idletimeout is None:
+            idletimeout = ui.configint('remotefilelog',
+                                       'connectionbroker.idletimeout', 600)
+        self.idletimeout = idletimeout
+
+        self._lock = threading.Lock()
+        # key -> list of (lasttime, peer) of the idle connections
+        self._idle = {}
+        self._sessions = 0
+        self._lastactive = time.time()
+        self._stats = {
+            'sessions': 0,
+            'opened': 0,
+            'reused': 0,
+        }
+
+    def run(self):
+        """Serves clients until no connection has been lent for
+        idletimeout seconds. Returns False if another broker is already
+        running."""
+        util.makedirs(os.path.dirname(self.path))
+        lockfp = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as ex:
+            lockfp.close()
+            if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # The socket of a broker that died is left behind
+            util.tryunlink(self.path)
+            # Only the user may connect
+            oldumask = os.umask(0o077)
+            try:
+                listener.bind(self.path)
+            finally:
+                os.umask(oldumask)
+            listener.listen(64)
+
+            while True:
+                r, w, x = select.select([listener], [], [], 1.0)
+                if r:
+                    sock, addr = listener.accept()
+                    with self._lock:
+                        self._sessions += 1
+                    thread = threading.Thread(target=self._serve,
+                                              args=(sock,))
+                    thread.daemon = True
+                    thread.start()
+
+                now = time.time()
+                self._closeidle(now - self.idletimeout)
+                with self._lock:
+                    if (not self._sessions and
+                        now - self._lastactive >= self.idletimeout):
+                        break
+        finally:
+            util.tryunlink(self.path)
+            listener.close()
+            self._closeidle(None)
+            lockfp.close()
+            self.ui.debug('connection broker: %d sessions, %d connections '
+                          'opened, %d reused\n' %
+                          (self._stats['sessions'], self._stats['opened'],
+                           self._stats['reused']))
+        return True
+
+    def _closeidle(self, before):
+        """Closes the idle connections last used before the given time, or
+        all of them if it's None."""
+        closing = []
+        with self._lock:
+            for key, peers in self._idle.items():
+                keep = []
+                for lasttime, peer in peers:
+                    if before is not None and lasttime >= before:
+                        keep.append((lasttime, peer))
+                    else:
+                        closing.append(peer)
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for peer in closing:
+            peer.cleanup()
+
+    def _checkout(self, key):
+        with self._lock:
+            peers = self._idle.get(key, [])
+            while peers:
+                lasttime, peer = peers.pop()
+                if peer.subprocess.poll() is None:
+                    self._stats['reused'] += 1
+                    return peer
+                peer.cleanup()
+
+        path, sshcmd, remotecmd = key
+        peer = hg.peer(self.ui, {'ssh': sshcmd, 'remotecmd': remotecmd}, path)
+        if not util.safehasattr(peer, 'subprocess'):
+            peer.close()
+            raise error.RepoError(_('%s is not an ssh repository') %
+                                  util.hidepassword(path))
+        with self._lock:
+            self._stats['opened'] += 1
+        return peer
+
+    def _checkin(self, key, peer):
+        with self._lock:
+            self._idle.setdefault(key, []).append((time.time(), peer))
+
+    def _serve(self, sock):
+        key = peer = None
+        released = False
+        try:
+            fp = sock.makefile('rb', 0)
+            size = int(fp.readline())
+            key = tuple(_readexact(fp, size).split('\0'))
+            if len(key) != 3:
+                raise ValueError('invalid connection key')
+            try:
+                peer = self._checkout(key)
+            except Exception as ex:
+                _sendreply(sock, 'error', str(ex))
+                return
+            _sendreply(sock, 'ok', ' '.join(sorted(peer._capabilities())))
+            released = _relay(sock, peer.subprocess)
+        except (error.ResponseError, select.error, socket.error, IOError,
+                OSError, ValueError) as ex:
+            self.ui.debug('connection broker session failed: %s\n' % ex)
+        finally:
+            sock.close()
+            if peer is not None:
+                if released and peer.subprocess.poll() is None:
+                    self._checkin(key, peer)
+                else:
+                    peer.cleanup()
+            with self._lock:
+                self._sessions -= 1
+                self._stats['sessions'] += 1
+                self._lastactive = time.time()
@@ -12,6 +12,8 @@ from mercurial import (
     util,
 )
 
+from . import connectionbroker
+
 class connectionpool(object):
     def __init__(self, repo):
         self._repo = repo
@@ -30,11 +32,17 @@ class connectionpool(object):
                 peer = conn.peer
                 # If the connection has died, drop it
                 if (isinstance(peer, sshpeer.sshpeer) and
+                    util.safehasattr(peer, 'subprocess') and
                     peer.subprocess.poll() is not None):
                     conn = None
             except IndexError:
                 pass
 
+        if conn is None and connectionbroker.enabled(self._repo.ui):
+            peer = connectionbroker.connect(self._repo.ui, path)
+            if peer is not None:
+                conn = connection(pathpool, peer)
+
         if conn is None:
             def _cleanup(orig):
                 # close pipee first so peer.cleanup reading it won't deadlock,
@@ -55,7 +63,7 @@ class connectionpool(object):
     def close(self):
         for pathpool in self._pool.itervalues():
             for conn in pathpool:
-                conn.close()
+                conn.release()
             del pathpool[:]
 
 class connection(object):
@@ -75,6 +83,14 @@ class connection(object):
         else:
             self.close()
 
+    def release(self):
+        """Closes a connection that is in a reusable state, which lets a
+        connection broker lend it again."""
+        if util.safehasattr(self.peer, 'release'):
+            self.peer.release()
+        else:
+            self.close()
+
     def close(self):
         if util.safehasattr(self.peer, 'cleanup'):
             self.peer.cleanup()
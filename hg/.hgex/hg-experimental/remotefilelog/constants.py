@@ -23,6 +23,13 @@ TREEPACK_CATEGORY="manifests"
 METAKEYFLAG = 'f'  # revlog flag
 METAKEYSIZE = 's'  # full rawtext size
 
+# Loose cache files whose text lives in the content-addressed store start with
+# DEDUPMARKER, and their text is hardlinked next to them with DEDUPSUFFIX. See
+# basestore.addremotefilelognode.
+DEDUPMARKER = 'dedup\n'
+DEDUPSUFFIX = '.content'
+DEDUPDIR = '.dedup'
+
 def getunits(category):
     if category == FILEPACK_CATEGORY:
         return _("files")
@@ -9,6 +9,8 @@ from . import (
 from mercurial import mdiff, revlog, util
 from mercurial.node import hex, nullid
 
+import collections
+
 class ChainIndicies(object):
     """A static class for easy reference to the delta chain indicies.
     """
@@ -26,6 +28,54 @@ class ChainIndicies(object):
     # The actual delta or full text data.
     DATA = 4
 
+class textcache(object):
+    """A least recently used cache of full texts, keyed by (name, node), that
+    holds at most ``maxsize`` bytes of text.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self._cache = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key):
+        text = self._cache.pop(key, None)
+        if text is None:
+            self.misses += 1
+            return None
+
+        # Re-insert to mark it as the most recently used entry.
+        self._cache[key] = text
+        self.hits += 1
+        return text
+
+    def set(self, key, text):
+        if len(text) > self.maxsize:
+            return
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._cache[key] = text
+        self.size += len(text)
+
+        while self.size > self.maxsize:
+            key, old = self._cache.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    def clear(self):
+        self._cache.clear()
+        self.size = 0
+
 class unioncontentstore(object):
     def __init__(self, *args, **kwargs):
         self.stores = args
@@ -36,6 +86,19 @@ class unioncontentstore(object):
         # deltachain can't be found.
         self.allowincomplete = kwargs.get('allowincomplete', False)
 
+        # If textcachesize is set, full texts built by get() are kept in
+        # memory, so delta chains of hot files are only walked once.
+        self.ui = kwargs.get('ui')
+        self._textcache = None
+        textcachesize = kwargs.get('textcachesize')
+        if textcachesize:
+            self._textcache = textcache(textcachesize)
+
+        # Number of texts built by get(), and the bytes of text and deltas
+        # they materialized, reported by logstats().
+        self.gets = 0
+        self.bytescopied = 0
+
     def get(self, name, node):
         """Fetches the full text revision contents of the given name+node pair.
         If the full text doesn't exist, throws a KeyError.
@@ -43,22 +106,98 @@ class unioncontentstore(object):
         Under the hood, this uses getdeltachain() across all the stores to build
         up a full chain to produce the full text.
         """
-        chain = self.getdeltachain(name, node)
-
-        if chain[-1][ChainIndicies.BASENODE] != nullid:
-            # If we didn't receive a full chain, throw
-            raise KeyError((name, hex(node)))
+        cache = self._textcache
+        if cache is None:
+            chain = self.getdeltachain(name, node)
+            if chain[-1][ChainIndicies.BASENODE] != nullid:
+                # If we didn't receive a full chain, throw
+                raise KeyError((name, hex(node)))
+
+            # The last entry in the chain is a full text, so we start our delta
+            # applies with that.
+            text = chain.pop()[ChainIndicies.DATA]
+            self.bytescopied += len(text)
+        else:
+            text = cache.get((name, node))
+            if text is not None:
+                return text
+
+            chain, text = self._getcachedchain(name, node)
+            if text is None:
+                # The chain ends in a full text, which is worth keeping since
+                # every other revision in the chain is built from it.
+                base = chain.pop()
+                text = base[ChainIndicies.DATA]
+                self.bytescopied += len(text)
+                if chain:
+                    cache.set((base[ChainIndicies.NAME],
+                               base[ChainIndicies.NODE]), text)
+
+        # Apply the whole chain at once: mpatch folds the deltas together and
+        # writes the result into a single buffer, instead of building every
+        # intermediate text.
+        self.gets += 1
+        if chain:
+            deltas = [entry[ChainIndicies.DATA] for entry in reversed(chain)]
+            text = mdiff.patches(text, deltas)
+            self.bytescopied += sum(len(delta) for delta in deltas) + len(text)
+
+        if cache is not None:
+            cache.set((name, node), text)
 
-        # The last entry in the chain is a full text, so we start our delta
-        # applies with that.
-        fulltext = chain.pop()[ChainIndicies.DATA]
+        return text
 
-        text = fulltext
-        while chain:
-            delta = chain.pop()[ChainIndicies.DATA]
-            text = mdiff.patches(text, [delta])
+    def _getcachedchain(self, name, node):
+        """Like getdeltachain(), but stops at the first revision whose full text
+        is in the text cache.
 
-        return text
+        Returns (chain, text), where text is the cached full text the chain
+        applies to, or None if the chain ends in a full text.
+        """
+        cache = self._textcache
+        chain = self._getpartialchain(name, node)
+        i = 0
+        while True:
+            x, x, deltabasename, deltabasenode, x = chain[i]
+            if deltabasenode == nullid:
+                return chain[:i + 1], None
+
+            basekey = (deltabasename, deltabasenode)
+            if basekey in cache:
+                return chain[:i + 1], cache.get(basekey)
+
+            i += 1
+            if i == len(chain):
+                # If we didn't receive a full chain, _getpartialchain throws
+                chain.extend(self._getpartialchain(deltabasename,
+                                                   deltabasenode))
+
+    def logstats(self):
+        """Reports the text cache and copy statistics through ui.log."""
+        if self.ui is None:
+            return
+        if self.gets:
+            self.ui.log('remotefilelog',
+                        'content store: %d texts built, %d bytes copied '
+                        '(%d per text)\n',
+                        self.gets, self.bytescopied,
+                        self.bytescopied // self.gets,
+                        remotefilelogtextsbuilt=self.gets,
+                        remotefilelogbytescopied=self.bytescopied)
+            self.gets = self.bytescopied = 0
+
+        cache = self._textcache
+        if cache is None:
+            return
+        if not cache.hits and not cache.misses:
+            return
+        self.ui.log('remotefilelog',
+                    'text cache: %d hits, %d misses, %d evictions\n',
+                    cache.hits, cache.misses, cache.evictions,
+                    remotefilelogtextcachehits=cache.hits,
+                    remotefilelogtextcachemisses=cache.misses,
+                    remotefilelogtextcacheevictions=cache.evictions,
+                    remotefilelogtextcachesize=cache.size)
 
     def getdeltachain(self, name, node):
         """Returns the deltachain for the given name/node pair.
@@ -27,6 +27,7 @@ PACKSUFFIX = '.datapack'
 class datapackstore(basepack.basepackstore):
     INDEXSUFFIX = INDEXSUFFIX
     PACKSUFFIX = PACKSUFFIX
+    MIDXEXACT = True
 
     def __init__(self, ui, path, usecdatapack=False):
         self.usecdatapack = usecdatapack
@@ -42,7 +43,7 @@ class datapackstore(basepack.basepackstore):
         raise RuntimeError("must use getdeltachain with datapackstore")
 
     def getmeta(self, name, node):
-        for pack in self.packs:
+        for pack in self._packsfor(node):
             try:
                 return pack.getmeta(name, node)
             except KeyError:
@@ -57,7 +58,7 @@ class datapackstore(basepack.basepackstore):
         raise KeyError((name, hex(node)))
 
     def getdeltachain(self, name, node):
-        for pack in self.packs:
+        for pack in self._packsfor(node):
             try:
                 return pack.getdeltachain(name, node)
             except KeyError:
@@ -86,6 +87,24 @@ class datapack(basepack.basepack):
     SUPPORTED_VERSIONS = [0, 1]
 
     def getmissing(self, keys):
+        # Callers may pass a generator, and the keys are walked twice.
+        keys = list(keys)
+        params = self.params
+        entrylen = self.INDEXENTRYLENGTH
+        if (len(keys) * basepack.BATCHSCANRATIO >=
+            (self._indexend - params.indexstart) / entrylen):
+            # Large batch, so resolve every key with one pass over the index.
+            nodes = set(node for name, node in keys)
+            found = set()
+            for indexnodes in self._scannodes(params.indexstart,
+                                              self._indexend, entrylen):
+                found.update(nodes.intersection(indexnodes))
+            missing = [key for key in keys if key[1] not in found]
+
+            # If we've read a lot of data from the mmap, free some memory.
+            self.freememory()
+            return missing
+
         missing = []
         for name, node in keys:
             value = self._find(node)
@@ -142,30 +161,31 @@ class datapack(basepack.basepack):
             deltabaseoffset = value[1]
             chain.append(value)
 
-        # Read chain data
+        # Read chain data. Headers are unpacked straight from the mmap, and
+        # the deltas are decompressed from buffers over it, so the raw entries
+        # are never copied out of the pack.
+        data = self._data
         deltachain = []
         for node, deltabaseoffset, offset, size in chain:
-            rawentry = self._data[offset:offset + size]
-            self._pagedin += len(rawentry)
+            self._pagedin += size
 
             # <2 byte len> + <filename>
             lengthsize = 2
-            filenamelen = struct.unpack('!H', rawentry[:2])[0]
-            filename = rawentry[lengthsize:lengthsize + filenamelen]
+            filenamelen = struct.unpack_from('!H', data, offset)[0]
+            filestart = offset + lengthsize
+            filename = data[filestart:filestart + filenamelen]
 
             # <20 byte node> + <20 byte deltabase>
-            nodestart = lengthsize + filenamelen
+            nodestart = filestart + filenamelen
             deltabasestart = nodestart + NODELENGTH
-            node = rawentry[nodestart:deltabasestart]
-            deltabasenode = rawentry[deltabasestart:deltabasestart + NODELENGTH]
+            node = data[nodestart:deltabasestart]
+            deltabasenode = data[deltabasestart:deltabasestart + NODELENGTH]
 
             # <8 byte len> + <delta>
             deltastart = deltabasestart + NODELENGTH
-            rawdeltalen = rawentry[deltastart:deltastart + 8]
-            deltalen = struct.unpack('!Q', rawdeltalen)[0]
+            deltalen = struct.unpack_from('!Q', data, deltastart)[0]
 
-            delta = rawentry[deltastart + 8:deltastart + 8 + deltalen]
-            delta = lz4decompress(delta)
+            delta = lz4decompress(buffer(data, deltastart + 8, deltalen))
 
             deltachain.append((filename, node, filename, deltabasenode, delta))
 
@@ -287,6 +307,41 @@ class datapack(basepack.basepack):
             if self.freememory():
                 data = self._data
 
+    def iterrawentries(self):
+        """Yields (filename, node, deltabase, rawentry) for every revision in
+        pack order, where rawentry is the revision exactly as it is serialized
+        in the pack. See mutabledatapack.addraw.
+        """
+        # Start at 1 to skip the header
+        offset = 1
+        data = self._data
+        while offset < self.datasize:
+            start = offset
+
+            filenamelen = struct.unpack('!H', data[offset:offset + 2])[0]
+            offset += 2
+            filename = data[offset:offset + filenamelen]
+            offset += filenamelen
+
+            node = data[offset:offset + constants.NODESIZE]
+            offset += constants.NODESIZE
+            deltabase = data[offset:offset + constants.NODESIZE]
+            offset += constants.NODESIZE
+
+            deltalen = struct.unpack('!Q', data[offset:offset + 8])[0]
+            offset += 8 + deltalen
+
+            if self.VERSION == 1:
+                metalen = struct.unpack_from('!I', data, offset)[0]
+                offset += 4 + metalen
+
+            yield (filename, node, deltabase, data[start:offset])
+
+            # If we've read a lot of data from the mmap, free some memory.
+            self._pagedin += offset - start
+            if self.freememory():
+                data = self._data
+
 class fastdatapack(basepack.basepack):
     INDEXSUFFIX = INDEXSUFFIX
     PACKSUFFIX = PACKSUFFIX
@@ -465,6 +520,18 @@ class mutabledatapack(basepack.mutablebasepack):
 
         self.writeraw(rawdata)
 
+    def addraw(self, node, deltabasenode, rawentry):
+        """Adds a revision that is already serialized in this pack's format,
+        as yielded by datapack.iterrawentries, without recompressing it.
+        """
+        if node in self.entries:
+            # The revision has already been added
+            return
+
+        offset = self.packfp.tell()
+        self.entries[node] = (deltabasenode, offset, len(rawentry))
+        self.writeraw(rawentry)
+
     def createindex(self, nodelocations, indexoffset):
         entries = sorted((n, db, o, s) for n, (db, o, s)
                          in self.entries.iteritems())
@@ -6,18 +6,23 @@
 # GNU General Public License version 2 or any later version.
 from __future__ import absolute_import
 
-from mercurial import error, filelog, revlog
+from mercurial import error, filelog, revlog, util
 from mercurial.node import bin, hex, nullid, short
 from mercurial.i18n import _
 from . import (
+    bgprefetch,
+    constants,
+    contentstore,
     datapack,
     fileserverclient,
     historypack,
+    metadatastore,
     shallowrepo,
     shallowutil,
 )
 from .lz4wrapper import lz4decompress
-import hashlib, os
+from .repack import repacker, repackledger
+import hashlib, os, shutil, tempfile, time
 
 def debugremotefilelog(ui, path, **opts):
     decompress = opts.get('decompress')
@@ -149,8 +154,10 @@ def verifyremotefilelog(ui, path, **opts):
     decompress = opts.get('decompress')
 
     for root, dirs, files in os.walk(path):
+        if constants.DEDUPDIR in dirs:
+            dirs.remove(constants.DEDUPDIR)
         for file in files:
-            if file == "repos":
+            if file == "repos" or file.endswith(constants.DEDUPSUFFIX):
                 continue
             filepath = os.path.join(root, file)
             size, firstnode, mapping = parsefileblob(filepath, decompress)
@@ -173,6 +180,10 @@ def parsefileblob(path, decompress):
     if decompress:
         raw = lz4decompress(raw)
 
+    if raw.startswith(constants.DEDUPMARKER):
+        raw = shallowutil.joindedupblob(
+            raw, shallowutil.readfile(path + constants.DEDUPSUFFIX))
+
     offset, size, flags = shallowutil.parsesizeflags(raw)
     start = offset + size
 
@@ -277,3 +288,94 @@ def debugwaitonprefetch(repo):
     with repo._lock(repo.svfs, "prefetchlock", True, None,
                          None, _('prefetching in %s') % repo.origroot):
         pass
+    bgprefetch.wait(repo)
+
+def debugprefetchqueue(ui, repo):
+    pid = bgprefetch.daemonpid(repo)
+    if pid is None:
+        ui.write(_("daemon: not running\n"))
+    else:
+        ui.write(_("daemon: running (pid %d)\n") % pid)
+
+    queued, claimed = bgprefetch.readqueue(repo)
+    ui.write(_("queued: %d\n") % len(queued))
+    ui.write(_("in progress: %d\n") % len(claimed))
+
+    stats = bgprefetch.readstats(repo)
+    if not stats:
+        return
+    ui.write(_("prefetched: %d revisions in %d batches (%d failed)\n") %
+             (stats.get('revisions', 0), stats.get('batches', 0),
+              stats.get('failures', 0)))
+    busytime = stats.get('busytime', 0)
+    if busytime:
+        ui.write(_("throughput: %0.1f revisions/sec\n") %
+                 (stats.get('revisions', 0) / busytime))
+
+def _getlatencies(ui, packpath, ledger):
+    """Reads back every data entry repacked into packpath, and returns the
+    sorted read times in seconds."""
+    store = contentstore.unioncontentstore(
+        datapack.datapackstore(ui, packpath))
+    latencies = []
+    for entry in ledger.entries.itervalues():
+        if entry.datarepacked:
+            start = time.time()
+            store.get(entry.filename, entry.node)
+            latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies
+
+def debugrepackbench(ui, repo, **opts):
+    """Repacks the shared file packs into a temporary directory, and reports
+    the throughput and peak memory of the configured repack engine, and the
+    size of the resulting data pack and how fast it can be read. The
+    repository's packs are not modified.
+    """
+    if not util.safehasattr(repo, 'shareddatastores'):
+        raise error.Abort(_("repo is not shallow"))
+
+    datasource = contentstore.unioncontentstore(*repo.shareddatastores)
+    historysource = metadatastore.unionmetadatastore(
+        *repo.sharedhistorystores,
+        allowincomplete=True)
+
+    # Garbage collection would need linkrev lookups for every old entry,
+    # which isn't what this is measuring.
+    overrides = {('remotefilelog', 'gcrepack'): False}
+    with ui.configoverride(overrides, 'debugrepackbench'):
+        packer = repacker(repo, datasource, historysource,
+                          constants.FILEPACK_CATEGORY)
+
+        ledger = repackledger()
+        datasource.markledger(ledger)
+        historysource.markledger(ledger)
+
+        # internal config: remotefilelog.datapackversion
+        dv = ui.configint('remotefilelog', 'datapackversion', 0)
+        tempdir = tempfile.mkdtemp(prefix='repackbench-')
+        try:
+            start = time.time()
+            with datapack.mutabledatapack(ui, tempdir, version=dv) as dpack:
+                with historypack.mutablehistorypack(ui, tempdir) as hpack:
+                    packer.repack(ledger, dpack, hpack)
+            elapsed = time.time() - start
+
+            datasize = sum(os.path.getsize(os.path.join(tempdir, f))
+                           for f in os.listdir(tempdir)
+                           if f.endswith(datapack.PACKSUFFIX))
+            latencies = _getlatencies(ui, tempdir, ledger) or [0]
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    count = len(ledger.entries)
+    ui.write(_("repacked %d entries in %0.2f seconds (%d entries/sec)\n") %
+             (count, elapsed, count / max(elapsed, 0.001)))
+    ui.write(_("peak RSS: %s, workers: %s\n") %
+             (util.bytecount(shallowutil.peakrss()),
+              util.bytecount(shallowutil.peakrss(children=True))))
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+    ui.write(_("data pack size: %s\n") % util.bytecount(datasize))
+    ui.write(_("get latency: p50 %0.3f ms, p99 %0.3f ms\n") %
+             (p50 * 1000, p99 * 1000))
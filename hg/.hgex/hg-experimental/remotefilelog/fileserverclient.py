@@ -9,7 +9,7 @@ from mercurial.i18n import _
 from mercurial.node import hex, bin, nullid
 from mercurial import util, sshpeer, error, util, wireproto, httppeer
 import hashlib, os, time, io, struct
-import itertools
+import itertools, Queue, sys, threading
 
 from . import (
     connectionpool,
@@ -18,6 +18,7 @@ from . import (
     wirepack,
 )
 from .contentstore import unioncontentstore
+from .datapack import datapackstore
 from .metadatastore import unionmetadatastore
 from lz4wrapper import lz4decompress
 
@@ -236,6 +237,155 @@ def _getfiles(
     remote.pipeo.write('\n')
     remote.pipeo.flush()
 
+def _readblob(pipe):
+    """Reads one getfiles response from pipe and returns the compressed
+    blob."""
+    line = pipe.readline()[:-1]
+    if not line:
+        raise error.ResponseError(_("error downloading file contents:"),
+                                  _("connection closed early"))
+    size = int(line)
+    data = pipe.read(size)
+    if len(data) != size:
+        raise error.ResponseError(_("error downloading file contents:"),
+                                  _("only received %s of %s bytes")
+                                  % (len(data), size))
+    return data
+
+class _getfilesstream(object):
+    """A getfiles command running on one pooled connection, with a thread
+    that receives the responses in the order the requests were sent."""
+    def __init__(self, conn, received):
+        self.conn = conn
+        self.remote = conn.peer
+        self.pending = Queue.Queue()
+        self.unflushed = 0
+        self._received = received
+
+        self.remote._callstream("getfiles")
+        self.thread = threading.Thread(target=self._receive)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, missingid, file):
+        self.pending.put((missingid, file))
+        self.remote.pipeo.write("%s%s\n" % (missingid[-40:], file))
+        self.unflushed += 1
+
+    def flush(self):
+        if self.unflushed:
+            self.remote.pipeo.flush()
+            self.unflushed = 0
+
+    def end(self):
+        """Ends the getfiles command. Responses for the requests already
+        sent are still received."""
+        self.pending.put(None)
+        self.remote.pipeo.write('\n')
+        self.remote.pipeo.flush()
+
+    def _receive(self):
+        pipe = self.remote.pipei
+        try:
+            while True:
+                request = self.pending.get()
+                if request is None:
+                    break
+                missingid, file = request
+                self._received.put((missingid, file, _readblob(pipe)))
+        except Exception:
+            self._received.put((None, None, sys.exc_info()))
+            return
+        self._received.put((None, self, None))
+
+class pipelinedfetch(object):
+    """Fetches cache misses from the server as soon as the cache process
+    reports them, instead of waiting for the cache to report every miss.
+
+    Misses are sent in chunks of ``step`` over up to ``maxconnections``
+    getfiles streams taken from the connection pool, so a large miss set is
+    spread over several ssh connections. Responses are received on background
+    threads, while the blobs are written to the store on the calling thread,
+    so writes overlap with the rest of the download.
+    """
+    def __init__(self, client, step, maxconnections):
+        self._client = client
+        self._step = step
+        self._maxconnections = max(1, maxconnections)
+        self._streams = []
+        self._received = Queue.Queue()
+        self._sent = 0
+        self._done = 0
+        self.fetched = []
+
+    def start(self):
+        """Opens the first stream. Returns False if the server doesn't
+        support getfiles, in which case the caller should fall back to the
+        sequential fetch."""
+        conn = self._client._connect()
+        remote = conn.peer
+        if (not remote.capable("remotefilelog") or
+            not isinstance(remote, sshpeer.sshpeer)):
+            conn.__exit__(None, None, None)
+            return False
+        self._streams.append(_getfilesstream(conn, self._received))
+        return True
+
+    def request(self, missingid, file):
+        streams = self._streams
+        chunk = self._sent // self._step
+        if chunk >= len(streams) and len(streams) < self._maxconnections:
+            streams.append(_getfilesstream(self._client._connect(),
+                                           self._received))
+        stream = streams[chunk % len(streams)]
+        stream.request(missingid, file)
+        self._sent += 1
+        if stream.unflushed >= self._step:
+            stream.flush()
+
+    def flush(self):
+        for stream in self._streams:
+            stream.flush()
+
+    def writereceived(self, progresstick, block=False):
+        """Writes the blobs received so far to the store. If block is True,
+        waits until every stream has finished."""
+        while self._done < len(self._streams):
+            try:
+                missingid, file, data = self._received.get(block)
+            except Queue.Empty:
+                return
+            if missingid is None:
+                if data is not None:
+                    # A receive thread failed; re-raise its exception.
+                    raise data[0], data[1], data[2]
+                self._done += 1
+                continue
+            self._client.writemissing(file, missingid[-40:], data)
+            self.fetched.append(missingid)
+            progresstick()
+
+    def finish(self, progresstick):
+        try:
+            for stream in self._streams:
+                stream.end()
+            self.writereceived(progresstick, block=True)
+        except Exception:
+            self.abort()
+            raise
+
+        for stream in self._streams:
+            stream.thread.join()
+            stream.conn.__exit__(None, None, None)
+        self._streams = []
+
+    def abort(self):
+        # The streams may be half way through a response, so they can't be
+        # reused.
+        for stream in self._streams:
+            stream.conn.close()
+        self._streams = []
+
 class fileserverclient(object):
     """A client for requesting files from the remote file server.
     """
@@ -299,29 +449,17 @@ class fileserverclient(object):
         total = count
         self.ui.progress(_downloading, 0, total=count)
 
-        missed = []
-        count = 0
-        while True:
-            missingid = cache.receiveline()
-            if not missingid:
-                missedset = set(missed)
-                for missingid in idmap.iterkeys():
-                    if not missingid in missedset:
-                        missed.append(missingid)
-                self.ui.warn(_("warning: cache connection closed early - " +
-                    "falling back to server\n"))
-                break
-            if missingid == "0":
-                break
-            if missingid.startswith("_hits_"):
-                # receive progress reports
-                parts = missingid.split("_")
-                count += int(parts[2])
-                self.ui.progress(_downloading, count, total=total)
-                continue
+        if self.ui.configbool('remotefilelog', 'pipelinefetch'):
+            self._requestpipelined(cache, writedata, idmap, total)
+            return
 
-            missed.append(missingid)
+        missed = [m for m in self._receivecachemisses(cache, idmap, total)
+                  if m is not None]
+        self._fetchmissed(cache, writedata, idmap, total, missed)
 
+    def _fetchmissed(self, cache, writedata, idmap, total, missed):
+        """Fetches the keys the cache process reported as missing from the
+        server, one batch at a time over a single connection."""
         global fetchmisses
         fetchmisses += len(missed)
 
@@ -396,18 +534,123 @@ class fileserverclient(object):
 
         return
 
+    def _receivecachemisses(self, cache, idmap, total, hits=None):
+        """Yields the keys the cache process reports as misses, as soon as it
+        reports them. None is yielded for each progress report, which is a
+        good time to flush requests that are waiting on more misses.
+
+        If the cache connection closes early, every key that wasn't reported
+        yet is yielded as a miss. If ``hits`` is given, its first element is
+        kept up to date with the number of hits reported so far.
+        """
+        missed = set()
+        count = 0
+        while True:
+            missingid = cache.receiveline()
+            if not missingid:
+                self.ui.warn(_("warning: cache connection closed early - " +
+                    "falling back to server\n"))
+                for missingid in idmap.iterkeys():
+                    if not missingid in missed:
+                        yield missingid
+                break
+            if missingid == "0":
+                break
+            if missingid.startswith("_hits_"):
+                # receive progress reports
+                parts = missingid.split("_")
+                count += int(parts[2])
+                if hits is not None:
+                    hits[0] = count
+                self.ui.progress(_downloading, count, total=total)
+                yield None
+                continue
+
+            missed.add(missingid)
+            yield missingid
+
+    def _requestpipelined(self, cache, writedata, idmap, total):
+        """Like request(), but sends each miss to the server as soon as the
+        cache process reports it, instead of waiting for every miss first.
+        See pipelinedfetch.
+        """
+        step = self.ui.configint('remotefilelog', 'getfilesstep', 10000)
+        connections = self.ui.configint('remotefilelog', 'fetchconnections', 1)
+        pipeline = pipelinedfetch(self, step, connections)
+
+        hits = [0]
+        def progresstick():
+            self.ui.progress(_downloading, hits[0] + len(pipeline.fetched),
+                             total=total)
+
+        missed = []
+        started = False
+        oldumask = os.umask(0o002)
+        # When verbose is true, sshpeer prints 'running ssh...' to stdout,
+        # which can interfere with some command outputs
+        verbose = self.ui.verbose
+        self.ui.verbose = False
+        try:
+            misses = self._receivecachemisses(cache, idmap, total, hits=hits)
+            for missingid in misses:
+                if missingid is None:
+                    if started:
+                        pipeline.flush()
+                    continue
+
+                missed.append(missingid)
+                if not started:
+                    if not pipeline.start():
+                        # The server doesn't support getfiles, so collect the
+                        # rest of the misses and fetch them the old way.
+                        missed.extend(m for m in misses if m is not None)
+                        break
+                    started = True
+                pipeline.request(missingid, idmap[missingid])
+                pipeline.writereceived(progresstick)
+
+            if started:
+                hits[0] = total - len(missed)
+                pipeline.finish(progresstick)
+        except Exception:
+            pipeline.abort()
+            if started:
+                self.ui.log("remotefilefetchlog",
+                            "Fail",
+                            fetched_files = len(pipeline.fetched),
+                            total_to_fetch = len(missed))
+            raise
+        finally:
+            self.ui.verbose = verbose
+            os.umask(oldumask)
+
+        if not started:
+            self._fetchmissed(cache, writedata, idmap, total, missed)
+            return
+
+        global fetchmisses
+        fetchmisses += len(missed)
+        self.ui.log("remotefilelog", "remote cache hit rate is %r of %r ",
+                    total - len(missed), total, hit=total - len(missed),
+                    total=total)
+        self.ui.log("remotefilefetchlog",
+                    "Success",
+                    fetched_files = len(pipeline.fetched),
+                    total_to_fetch = len(missed))
+
+        # send to memcache
+        request = "set\n%d\n%s\n" % (len(missed), "\n".join(missed))
+        cache.request(request)
+
+        self.ui.progress(_downloading, None)
+
+        # mark ourselves as a user of this cache
+        writedata.markrepo(self.repo.path)
+
     def receivemissing(self, pipe, filename, node):
-        line = pipe.readline()[:-1]
-        if not line:
-            raise error.ResponseError(_("error downloading file contents:"),
-                                      _("connection closed early"))
-        size = int(line)
-        data = pipe.read(size)
-        if len(data) != size:
-            raise error.ResponseError(_("error downloading file contents:"),
-                                      _("only received %s of %s bytes")
-                                      % (len(data), size))
+        self.writemissing(filename, node, _readblob(pipe))
 
+    def writemissing(self, filename, node, data):
         self.writedata.addremotefilelognode(filename, bin(node),
                                              lz4decompress(data))
 
@@ -422,16 +665,27 @@ class fileserverclient(object):
                 rcvd = 0
 
                 remote = conn.peer
-                remote._callstream("getpackv1")
-
-                self._sendpackrequest(remote, fileids)
+                basestore = None
+                if (self.ui.configbool('remotefilelog', 'fetchpackdeltas')
+                    and remote.capable('getpackv2')):
+                    basestore = self._getpackbasestore()
+                    remote._callstream("getpackv2")
+                    self._sendpackrequest(remote, fileids, basestore)
+                else:
+                    remote._callstream("getpackv1")
+                    self._sendpackrequest(remote, fileids)
 
                 packpath = shallowutil.getcachepackpath(
                     self.repo, constants.FILEPACK_CATEGORY)
                 receiveddata, receivedhistory = wirepack.receivepack(
-                    self.repo.ui, remote.pipei, packpath)
+                    self.repo.ui, remote.pipei, packpath, basestore=basestore)
                 rcvd = len(receiveddata)
 
+            # The stores may have looked for new packs too recently to see
+            # the ones just received
+            self.datastore.markforrefresh()
+            self.historystore.markforrefresh()
+
             self.ui.log("remotefilefetchlog",
                         "Success(pack)" if (rcvd==total) else "Fail(pack)",
                         fetched_files = rcvd,
@@ -443,27 +697,72 @@ class fileserverclient(object):
                         total_to_fetch = total)
             raise
 
-    def _sendpackrequest(self, remote, fileids):
+    def _sendpackrequest(self, remote, fileids, basestore=None):
         """Formats and writes the given fileids to the remote as part of a
-        getpackv1 call.
+        getpackv1 or getpackv2 call. getpackv2 requests offer the revisions
+        of ``basestore`` the server can send deltas against.
         """
         # Sort the requests by name, so we receive requests in batches by name
         grouped = {}
         for filename, node in fileids:
-            grouped.setdefault(filename, set()).add(node)
+            grouped.setdefault(filename, set()).add(bin(node))
+
+        bases = {}
+        if basestore is not None:
+            bases = self._getpackbases(grouped, basestore)
 
         # Issue request
         for filename, nodes in grouped.iteritems():
             filenamelen = struct.pack(constants.FILENAMESTRUCT, len(filename))
             countlen = struct.pack(constants.PACKREQUESTCOUNTSTRUCT, len(nodes))
-            rawnodes = ''.join(bin(n) for n in nodes)
-
-            remote.pipeo.write('%s%s%s%s' % (filenamelen, filename, countlen,
-                                             rawnodes))
+            rawnodes = ''.join(nodes)
+            request = '%s%s%s%s' % (filenamelen, filename, countlen, rawnodes)
+            if basestore is not None:
+                filebases = bases.get(filename, ())
+                request += struct.pack(constants.PACKREQUESTCOUNTSTRUCT,
+                                       len(filebases))
+                request += ''.join(filebases)
+
+            remote.pipeo.write(request)
             remote.pipeo.flush()
         remote.pipeo.write(struct.pack(constants.FILENAMESTRUCT, 0))
         remote.pipeo.flush()
 
+    def _getpackbasestore(self):
+        """Returns the store the bases of getpackv2 deltas are read from: the
+        shared packs, so a delta never depends on a single repository's local
+        store."""
+        return unioncontentstore(*[store for store
+                                   in self.repo.shareddatastores
+                                   if isinstance(store, datapackstore)])
+
+    def _getpackbases(self, grouped, store):
+        """Returns the revisions of the requested files the server can send
+        deltas against, as a dict of filename to nodes.
+
+        Those are the revisions of the working copy parent that are in
+        ``store``, which the received deltas are applied to. The loose files
+        of the shared cache aren't offered, since reading them back is more
+        likely to miss: gc can remove them at any time.
+        """
+        repo = self.repo
+        mf = repo['.'].manifest()
+        keys = []
+        for filename, nodes in grouped.iteritems():
+            node = mf.get(filename)
+            if node is not None and node not in nodes:
+                keys.append((filename, node))
+
+        if not keys:
+            return {}
+
+        missing = set(store.getmissing(keys))
+        bases = {}
+        for filename, node in keys:
+            if (filename, node) not in missing:
+                bases.setdefault(filename, []).append(node)
+        return bases
+
     def connect(self):
         if self.cacheprocess:
             cmd = "%s %s" % (self.cacheprocess, self.writedata._path)
@@ -0,0 +1,236 @@
+# getpackcache.py - server cache of getpack responses
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+from __future__ import absolute_import
+
+import errno, hashlib, mmap, os
+from mercurial import util
+from mercurial.i18n import _
+
+# Size of the chunks cached parts are sent in.
+CHUNKSIZE = 1024 * 1024
+
+# The files kept next to the entries, see getpackcache.
+EPOCHFILE = 'epoch'
+SIZEFILE = 'size'
+
+def getcache(repo):
+    """Returns the getpack cache of a server repo, or None if it's disabled."""
+    ui = repo.ui
+    if not ui.configbool('remotefilelog', 'getpackcache'):
+        return None
+    path = ui.config('remotefilelog', 'getpackcachepath')
+    if not path:
+        path = repo.vfs.join('getpackcache')
+    maxsize = ui.configbytes('remotefilelog', 'getpackcachesize', '1GB')
+    return getpackcache(ui, path, maxsize)
+
+class getpackcache(object):
+    """A cache of the serialized wirepack parts served by getpack.
+
+    Every part answers a request for a set of nodes of one file, and is stored
+    as is in its own file, named after the hash of the file name, the nodes
+    and the cache epoch. It can be sent back to the client straight from the
+    mmap. Parts hold full texts, so the bases getpackv2 clients send don't
+    split the entries: the server turns the cached texts into deltas against
+    them.
+
+    The history in a part holds the linknodes of the file revisions, which a
+    strip can change: the linkrevs then point to other changesets. A strip
+    calls invalidate(), which starts a new epoch, so the entries written
+    before it are never read again, and are eventually evicted.
+
+    Entries are written to a temporary file and renamed into place, so any
+    number of server processes can read and fill the cache at the same time.
+    Reading an entry bumps its mtime, and evict() removes the entries that
+    were read the longest ago until the cache fits in its size budget.
+
+    The size of each entry written is appended to the size file, so evict()
+    only walks the cache once the entries written since the last walk may
+    have taken it over budget. Entries written during a walk may be missed,
+    until the next one.
+    """
+    def __init__(self, ui, path, maxsize):
+        self.ui = ui
+        self.path = path
+        self.maxsize = maxsize
+        self._epoch = None
+
+        self.hits = 0
+        self.misses = 0
+        self.bytesserved = 0
+
+    @property
+    def epoch(self):
+        if self._epoch is None:
+            try:
+                with open(os.path.join(self.path, EPOCHFILE), 'rb') as f:
+                    self._epoch = f.read()
+            except IOError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                self._epoch = ''
+        return self._epoch
+
+    def invalidate(self):
+        """Starts a new epoch, so none of the existing entries are used."""
+        epoch = os.urandom(20).encode('hex')
+        oldumask = os.umask(0o002)
+        try:
+            util.makedirs(self.path)
+            with util.atomictempfile(os.path.join(self.path, EPOCHFILE),
+                                     'wb') as f:
+                f.write(epoch)
+        finally:
+            os.umask(oldumask)
+        self._epoch = epoch
+
+    def _entrypath(self, filename, nodes):
+        key = hashlib.sha1(self.epoch)
+        key.update(filename)
+        for node in sorted(nodes):
+            key.update(node)
+        key = key.hexdigest()
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def contains(self, filename, nodes):
+        return os.path.exists(self._entrypath(filename, nodes))
+
+    def get(self, filename, nodes):
+        """Returns the chunks of the cached part for the given nodes of
+        filename, or None if it's not cached."""
+        path = self._entrypath(filename, nodes)
+        try:
+            fp = open(path, 'rb')
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return None
+
+        with fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size == 0:
+                self.misses += 1
+                return None
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        self.bytesserved += size
+        return self._iterchunks(data, size)
+
+    def _iterchunks(self, data, size):
+        try:
+            for offset in xrange(0, size, CHUNKSIZE):
+                yield data[offset:offset + CHUNKSIZE]
+        finally:
+            data.close()
+
+    def set(self, filename, nodes, chunks):
+        """Stores the part made of the given chunks, and returns them."""
+        chunks = list(chunks)
+        path = self._entrypath(filename, nodes)
+
+        # everything should be user & group read/writable
+        oldumask = os.umask(0o002)
+        try:
+            util.makedirs(os.path.dirname(path))
+            with util.atomictempfile(path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            # A single small append, so concurrent writers don't interleave
+            with open(os.path.join(self.path, SIZEFILE), 'ab') as f:
+                f.write('%d\n' % sum(len(chunk) for chunk in chunks))
+        except (IOError, OSError) as ex:
+            # Don't fail the request if the user only has permission to read
+            # the cache.
+            self.ui.debug('unable to write getpack cache entry: %s\n' % ex)
+        finally:
+            os.umask(oldumask)
+
+        return chunks
+
+    def _trackedsize(self):
+        """Returns the size of the cache according to the size file, which
+        holds the size found by the last walk, followed by the size of each
+        entry written since. Returns None if the cache needs to be walked to
+        know its size."""
+        try:
+            with open(os.path.join(self.path, SIZEFILE), 'rb') as f:
+                return sum(int(line) for line in f if line.strip())
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            # Corrupt
+            return None
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in
+        its size budget. Returns the number of bytes freed."""
+        trackedsize = self._trackedsize()
+        if trackedsize is not None and trackedsize <= self.maxsize:
+            return 0
+
+        entries = []
+        size = 0
+        for root, dirs, files in os.walk(self.path):
+            if root == self.path:
+                # The epoch and size files
+                continue
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                size += st.st_size
+
+        freed = 0
+        _removing = _("evicting getpack cache")
+        entries.sort()
+        for mtime, entrysize, path in entries:
+            if size - freed <= self.maxsize:
+                break
+            self.ui.progress(_removing, freed, unit="bytes",
+                             total=size - self.maxsize)
+            util.tryunlink(path)
+            freed += entrysize
+        self.ui.progress(_removing, None)
+
+        try:
+            with util.atomictempfile(os.path.join(self.path, SIZEFILE),
+                                     'wb') as f:
+                f.write('%d\n' % (size - freed))
+        except (IOError, OSError) as ex:
+            self.ui.debug('unable to write getpack cache size: %s\n' % ex)
+
+        return freed
+
+    def logstats(self):
+        """Reports the cache statistics through ui.log."""
+        requests = self.hits + self.misses
+        if not requests:
+            return
+        self.ui.log('remotefilelog',
+                    'getpack cache: %d hits, %d misses (%0.2f%% hit ratio), '
+                    '%d bytes served from cache\n',
+                    self.hits, self.misses, 100.0 * self.hits / requests,
+                    self.bytesserved,
+                    remotefilelogpackcachehits=self.hits,
+                    remotefilelogpackcachemisses=self.misses,
+                    remotefilelogpackcachebytes=self.bytesserved)
+        self.hits = self.misses = self.bytesserved = 0
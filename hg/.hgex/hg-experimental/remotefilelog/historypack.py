@@ -40,22 +40,27 @@ class historypackstore(basepack.basepackstore):
         return historypack(path)
 
     def getancestors(self, name, node, known=None):
-        for pack in self.packs:
+        return self.getpackancestors(name, node, known=known)[1]
+
+    def getpackancestors(self, name, node, known=None):
+        """Returns the pack the ancestors of name and node were read from,
+        along with the ancestors getancestors returns."""
+        for pack in self._packsfor(node):
             try:
-                return pack.getancestors(name, node, known=known)
+                return pack, pack.getancestors(name, node, known=known)
             except KeyError:
                 pass
 
         for pack in self.refresh():
             try:
-                return pack.getancestors(name, node, known=known)
+                return pack, pack.getancestors(name, node, known=known)
             except KeyError:
                 pass
 
         raise KeyError((name, node))
 
     def getnodeinfo(self, name, node):
-        for pack in self.packs:
+        for pack in self._packsfor(node):
             try:
                 return pack.getnodeinfo(name, node)
             except KeyError:
@@ -90,12 +95,22 @@ class historypack(basepack.basepack):
             self.INDEXENTRYLENGTH = INDEXENTRYLENGTH1
 
     def getmissing(self, keys):
-        missing = []
+        # Callers may pass a generator, and the keys are walked twice.
+        keys = list(keys)
+
+        # Group the keys by file, so each file section is only looked up once.
+        filenodes = {}
         for name, node in keys:
-            try:
-                self._findnode(name, node)
-            except KeyError:
-                missing.append((name, node))
+            filenodes.setdefault(name, set()).add(node)
+
+        found = set()
+        for name, nodes in filenodes.iteritems():
+            found.update((name, node) for node in self._findnodes(name, nodes))
+
+        missing = [key for key in keys if key not in found]
+
+        # If we've read a lot of data from the mmap, free some memory.
+        self.freememory()
 
         return missing
 
@@ -186,6 +201,41 @@ class historypack(basepack.basepack):
 
         raise KeyError("unable to find history for %s:%s" % (name, hex(node)))
 
+    def _findnodes(self, name, nodes):
+        """Batch version of _findnode that only checks for existence. Returns
+        the subset of the ``nodes`` set that is present in the section for
+        ``name``."""
+        try:
+            section = self._findsection(name)
+        except KeyError:
+            return []
+
+        if self.VERSION == 0:
+            # Version 0 has no node index, so walk the section once.
+            filename, offset, size = section[:3]
+            present = set()
+            o = 0
+            while o < size:
+                entry, copyfrom = self._readentry(offset + o)
+                o += PACKENTRYLENGTH
+                if copyfrom:
+                    o += len(copyfrom)
+                present.add(entry[ANC_NODE])
+            self._pagedin += size
+            return nodes.intersection(present)
+
+        nodeindexoffset, nodeindexsize = section[3:]
+        nodeindexend = nodeindexoffset + nodeindexsize
+        if (len(nodes) * basepack.BATCHSCANRATIO >=
+            nodeindexsize / NODEINDEXENTRYLENGTH):
+            return nodes.intersection(self._unpacknodes(nodeindexoffset,
+                                                        nodeindexend,
+                                                        NODEINDEXENTRYLENGTH))
+
+        return [node for node in nodes
+                if self._bisect(node, nodeindexoffset, nodeindexend,
+                                NODEINDEXENTRYLENGTH) is not None]
+
     def _findsection(self, name):
         params = self.params
         namehash = hashlib.sha1(name).digest()
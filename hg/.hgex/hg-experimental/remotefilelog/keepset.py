@@ -0,0 +1,130 @@
+# keepset.py - compact set of the cache keys garbage collection keeps
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+from __future__ import absolute_import
+
+import hashlib, itertools, struct
+
+# The most keys held as Python strings at once, while adding keys or merging
+# them into the sorted runs.
+PENDINGLIMIT = 100000
+
+def _bisect(data, hash, lo=0, hi=None):
+    """Returns the index of the first entry of the sorted concatenation of
+    20 byte hashes that isn't lower than hash, which may be a prefix."""
+    if hi is None:
+        hi = len(data) // 20
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if data[mid * 20:mid * 20 + 20] < hash:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _mergeruns(runs):
+    """Merges sorted concatenations of hashes into one, without duplicates.
+
+    The key space is split on the first two bytes of the hashes into ranges
+    of about PENDINGLIMIT entries, which are merged one at a time, so only
+    the hashes of one range exist as strings at once.
+    """
+    total = sum(len(run) for run in runs) // 20
+    rangecount = min(65536, total // PENDINGLIMIT + 1)
+    starts = [0] * len(runs)
+    merged = []
+    for i in xrange(1, rangecount + 1):
+        if i < rangecount:
+            prefix = struct.pack('!H', i * 65536 // rangecount)
+            ends = [_bisect(run, prefix, start)
+                    for run, start in zip(runs, starts)]
+        else:
+            ends = [len(run) // 20 for run in runs]
+        entries = []
+        for run, start, end in zip(runs, starts, ends):
+            entries.extend([run[j:j + 20]
+                            for j in xrange(start * 20, end * 20, 20)])
+        # The runs are sorted already, which sort() takes advantage of
+        entries.sort()
+        merged.append(''.join([entry for entry, previous
+                               in itertools.izip(entries, [None] + entries)
+                               if entry != previous]))
+        starts = ends
+    return ''.join(merged)
+
+class keepset(object):
+    """A set of keys, kept as sorted concatenations of their 20 byte sha1
+    instead of as Python strings, so a keepset covering tens of millions of
+    file revisions still fits in memory.
+
+    Keys are added to a pending list. Every PENDINGLIMIT keys, it's sorted
+    into a new run, which is merged with the previous ones as long as those
+    aren't larger, so each key is merged a logarithmic number of times.
+    Queries first merge everything into a single run. A hash collision only
+    means a file is kept when it could have been removed.
+    """
+    def __init__(self):
+        self._runs = []
+        self._pending = []
+
+    def add(self, key):
+        self._pending.append(hashlib.sha1(key).digest())
+        if len(self._pending) >= PENDINGLIMIT:
+            self._flush()
+
+    def _flush(self):
+        run = ''.join(sorted(set(self._pending)))
+        self._pending = []
+        while self._runs and len(self._runs[-1]) <= len(run):
+            run = _mergeruns([self._runs.pop(), run])
+        self._runs.append(run)
+
+    def _compact(self):
+        if self._pending:
+            self._flush()
+        if len(self._runs) > 1:
+            self._runs = [_mergeruns(self._runs)]
+        return self._runs[0] if self._runs else ''
+
+    def __len__(self):
+        return len(self._compact()) // 20
+
+    def __contains__(self, key):
+        data = self._compact()
+        hash = hashlib.sha1(key).digest()
+        index = _bisect(data, hash)
+        return data[index * 20:index * 20 + 20] == hash
+
+def addrevs(keep, repo, revs, keyfn):
+    """Adds keyfn(path, filenode) to keep for every file in the manifests of
+    the given revisions.
+
+    Only the first manifest is read in full. Each following one is diffed
+    against its parent's if that was already added, or else against the
+    previous one, and only the entries that differ are added. Keep revisions
+    are mostly close to each other, so the diffs are small.
+    """
+    added = set()
+    prevrev = prevmf = None
+    for rev in sorted(revs):
+        ctx = repo[rev]
+        mf = ctx.manifest()
+        p1 = ctx.p1().rev()
+        if p1 in added and p1 != prevrev:
+            basemf = repo[p1].manifest()
+        else:
+            basemf = prevmf
+
+        if basemf is None:
+            for path, fnode in mf.iteritems():
+                keep.add(keyfn(path, fnode))
+        else:
+            for path, ((fnode, flag), other) in mf.diff(basemf).iteritems():
+                if fnode is not None:
+                    keep.add(keyfn(path, fnode))
+
+        added.add(rev)
+        prevrev, prevmf = rev, mf
@@ -0,0 +1,262 @@
+# linkrevindex.py - index of the changesets introducing file revisions
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+from __future__ import absolute_import
+
+import errno, hashlib, mmap, os
+from mercurial.i18n import _
+from mercurial.node import bin, hex
+from mercurial import util
+
+# <key hash: 20 byte><linknode: 20 byte>
+ENTRYLENGTH = 40
+
+# Once the log has that many entries, it's merged into the sorted index, so
+# readers don't have to load a large log into memory.
+MAXLOGENTRIES = 50000
+
+def keyhash(path, fnode):
+    return hashlib.sha1('%s\0%s' % (path, fnode)).digest()
+
+def getindex(repo):
+    """Returns the linkrev index of a shallow repo, or None if it's not
+    enabled."""
+    if not repo.ui.configbool('remotefilelog', 'linkrevindex'):
+        return None
+    index = getattr(repo, '_linkrevindex', None)
+    if index is None:
+        index = linkrevindex(repo.ui, repo.vfs.join('cache/linkrevindex'))
+        repo._linkrevindex = index
+    return index
+
+def updatehook(ui, repo, node=None, **kwargs):
+    """changegroup hook that indexes the incoming changesets, and the local
+    ones committed since the last pull."""
+    index = getindex(repo)
+    if index is None or node is None:
+        return
+    with repo.lock():
+        index.update(repo, repo.unfiltered()[node].rev())
+
+class linkrevindex(object):
+    """A persistent map from (path, file node) to the changesets introducing
+    that file revision, so _adjustlinknode doesn't have to walk the changelog
+    and read manifests to find the one that is an ancestor of a given
+    changeset.
+
+    The index covers a contiguous range of changelog revisions, recorded in
+    the ``.state`` file along with the node of the last one, so it's ignored
+    if history was stripped. It's kept in two files:
+
+    linkrevindex
+        The sorted index, made of entries of <key hash><linknode>, where the
+        key hash is the sha1 of the path and the file node. It is looked up
+        through a binary search, without being loaded.
+
+    linkrevindex.log
+        The entries appended since the sorted index was last rewritten, in
+        the same format, loaded in memory.
+
+    The index is updated under the repo lock. Readers never need a lock,
+    since the state is only written once its entries are, and the sorted
+    index is replaced atomically.
+    """
+    def __init__(self, ui, path):
+        self.ui = ui
+        self.path = path
+
+        # Reported by logstats()
+        self.lookups = 0
+        self.hits = 0
+        self.slowwalks = 0
+
+        self._statestat = None
+        self._coverage = None
+        self._sorted = None
+        self._log = None
+
+    def _readstate(self):
+        try:
+            with open(self.path + '.state', 'rb') as fp:
+                start, end, lastnode = fp.read().split('\n')[:3]
+            return int(start), int(end), bin(lastnode)
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return None
+        except (ValueError, TypeError):
+            # A corrupt state just makes the index unusable until the next
+            # update.
+            return None
+
+    def _load(self):
+        try:
+            st = os.stat(self.path + '.state')
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            st = None
+        if st is not None and self._statestat is not None:
+            if (st.st_ino == self._statestat.st_ino and
+                st.st_mtime == self._statestat.st_mtime and
+                st.st_size == self._statestat.st_size):
+                return
+        self._close()
+        self._statestat = st
+        if st is None:
+            return
+
+        self._coverage = self._readstate()
+        try:
+            with open(self.path, 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size:
+                    self._sorted = mmap.mmap(fp.fileno(), size,
+                                             access=mmap.ACCESS_READ)
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        self._log = {}
+        for hash, linknode in self._readlog():
+            self._log.setdefault(hash, []).append(linknode)
+
+    def _readlog(self):
+        try:
+            with open(self.path + '.log', 'rb') as fp:
+                raw = fp.read()
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            return []
+        usable = len(raw) - len(raw) % ENTRYLENGTH
+        return [(raw[i:i + 20], raw[i + 20:i + ENTRYLENGTH])
+                for i in xrange(0, usable, ENTRYLENGTH)]
+
+    def _close(self):
+        if self._sorted is not None:
+            self._sorted.close()
+        self._sorted = None
+        self._log = None
+        self._coverage = None
+        self._statestat = None
+
+    def coverage(self, cl):
+        """Returns the (start, end) range of changelog revisions the index
+        covers, or None if it doesn't match the changelog."""
+        self._load()
+        if self._coverage is None:
+            return None
+        start, end, lastnode = self._coverage
+        if end > len(cl) or end <= start or cl.node(end - 1) != lastnode:
+            return None
+        return start, end
+
+    def get(self, path, fnode):
+        """Returns the set of nodes of the indexed changesets introducing the
+        given file revision."""
+        self._load()
+        hash = keyhash(path, fnode)
+        linknodes = set(self._log.get(hash, ()) if self._log else ())
+
+        index = self._sorted
+        if index is not None:
+            lo = 0
+            hi = len(index) // ENTRYLENGTH
+            while lo < hi:
+                mid = (lo + hi) // 2
+                offset = mid * ENTRYLENGTH
+                if index[offset:offset + 20] < hash:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            offset = lo * ENTRYLENGTH
+            while index[offset:offset + 20] == hash:
+                linknodes.add(index[offset + 20:offset + ENTRYLENGTH])
+                offset += ENTRYLENGTH
+        return linknodes
+
+    def update(self, repo, startrev):
+        """Indexes the changesets added since the last update. ``startrev``
+        is where the index starts if it doesn't cover anything yet, or no
+        longer matches the changelog. Must be called with the repo lock."""
+        repo = repo.unfiltered()
+        cl = repo.changelog
+        mfl = repo.manifestlog
+
+        coverage = self.coverage(cl)
+        if coverage is None:
+            start = end = startrev
+            self._close()
+            util.tryunlink(self.path)
+            util.tryunlink(self.path + '.log')
+        else:
+            start, end = coverage
+        if end >= len(cl):
+            return
+
+        shallowmatch = getattr(repo, 'shallowmatch', None)
+        entries = []
+        _indexing = _("indexing linkrevs")
+        for rev in xrange(end, len(cl)):
+            self.ui.progress(_indexing, rev - end, unit="changesets",
+                             total=len(cl) - end)
+            clr = cl.changelogrevision(rev)
+            md = mfl[clr.manifest].readfast()
+            linknode = cl.node(rev)
+            for path in clr.files:
+                if shallowmatch is not None and not shallowmatch(path):
+                    continue
+                fnode = md.get(path)
+                if fnode is not None:
+                    entries.append(keyhash(path, fnode) + linknode)
+        self.ui.progress(_indexing, None)
+
+        util.makedirs(os.path.dirname(self.path))
+        with open(self.path + '.log', 'ab') as fp:
+            fp.write(''.join(entries))
+            logsize = fp.tell()
+        if logsize // ENTRYLENGTH >= MAXLOGENTRIES:
+            self._compact()
+
+        # The state is written last, so readers only ever trust entries that
+        # are in the index.
+        end = len(cl)
+        with util.atomictempfile(self.path + '.state', 'wb') as fp:
+            fp.write('%d\n%d\n%s\n' % (start, end, hex(cl.node(end - 1))))
+        self._close()
+
+    def _compact(self):
+        """Merges the log into the sorted index."""
+        self._close()
+        entries = set(h + n for h, n in self._readlog())
+        try:
+            with open(self.path, 'rb') as fp:
+                raw = fp.read()
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            raw = ''
+        entries.update(raw[i:i + ENTRYLENGTH]
+                       for i in xrange(0, len(raw), ENTRYLENGTH))
+
+        with util.atomictempfile(self.path, 'wb') as fp:
+            fp.write(''.join(sorted(entries)))
+        util.tryunlink(self.path + '.log')
+
+    def logstats(self):
+        """Reports how often linknodes were resolved through the index, and
+        how often the slow changelog walk was still needed, through
+        ui.log."""
+        if not self.lookups:
+            return
+        self.ui.log('remotefilelog',
+                    'linkrev index: %d lookups, %d resolved by the index, '
+                    '%d slow walks\n',
+                    self.lookups, self.hits, self.slowwalks,
+                    remotefilelogindexlookups=self.lookups,
+                    remotefilelogindexhits=self.hits,
+                    remotefilelogslowwalks=self.slowwalks)
+        self.lookups = self.hits = self.slowwalks = 0
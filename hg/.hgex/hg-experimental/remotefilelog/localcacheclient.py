@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# localcacheclient.py - machine local cache process
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+# A cache process implementation (see cacheclient.py for the protocol) that
+# keeps the file blobs in an append-only blob pack store on the local
+# machine, so the repos of a machine can share a second level cache without
+# a memcache server. Blobs are stored LZ4 compressed, and the store is kept
+# under a size limit by dropping its least recently written segments.
+
+import os, sys
+
+import blobpack, cacheclient
+from lz4wrapper import lzcompresshc, lz4decompress
+from mercurial import ui as uimod, util
+
+stdin = sys.stdin
+stdout = sys.stdout
+stderr = sys.stderr
+
+# Number of keys looked up between two progress reports
+batchsize = 1000
+
+# Size at which a segment of the store is sealed
+segmentsize = 64 * 1024 * 1024
+
+def splitid(id):
+    """Returns the cache id of a requested key, and the (path, node) it is
+    stored under."""
+    if '\0' in id:
+        # cacheprocess.includepath sends <file path>\0<id>
+        id = id.split('\0', 1)[1]
+    return id, os.path.split(id)
+
+def readids():
+    raw = stdin.readline()[:-1]
+    keycount = int(raw)
+    return [splitid(stdin.readline()[:-1]) for i in xrange(keycount)]
+
+def getKeys(store, cachepath):
+    ids = readids()
+
+    for start in xrange(0, len(ids), batchsize):
+        batch = ids[start:start + batchsize]
+        # The client adds the reports up, so each one only counts the hits
+        # of its own batch
+        hits = 0
+        idmap = dict((key, id) for id, key in batch)
+        for path, node, value in store.getmany(key for id, key in batch):
+            id = idmap[(path, node)]
+            if value is None:
+                # On miss, report to caller
+                stdout.write(id + "\n")
+                continue
+            cacheclient.writefile(os.path.join(cachepath, id),
+                                  lz4decompress(value))
+            hits += 1
+
+        stdout.write("_hits_%s_\n" % hits)
+        stdout.flush()
+
+    # done signal
+    stdout.write("0\n")
+    stdout.flush()
+
+def setKeys(store, cachepath, maxsize):
+    ids = readids()
+
+    for id, (path, node) in ids:
+        if store.contains(path, node):
+            continue
+        try:
+            value = cacheclient.readblob(os.path.join(cachepath, id))
+        except IOError:
+            # The file was removed from the local cache since
+            continue
+        store.add(path, node, lzcompresshc(value))
+
+    if maxsize:
+        store.trim(maxsize)
+
+def main(argv=None):
+    """
+    remotefilelog uses this cache process by setting it in the config:
+
+    [remotefilelog]
+    cacheprocess = localcacheclient <store path> <max size>
+
+    The store is created at <store path> if it doesn't exist, and is shared
+    by every repo using the same path. <max size> is a byte count, like 10GB,
+    or 0 for no limit.
+
+    remotefilelog executes it with the path of the cache to write hits to as
+    the last argument:
+
+    localcacheclient <store path> <max size> <cachepath>
+    """
+    if argv is None:
+        argv = sys.argv
+
+    storepath = argv[1]
+    maxsize = util.sizetoint(argv[2])
+    cachepath = argv[3]
+
+    store = blobpack.blobpackstore(uimod.ui(), storepath, segmentsize)
+    try:
+        while True:
+            cmd = stdin.readline()[:-1]
+            if cmd == "get":
+                getKeys(store, cachepath)
+            elif cmd == "set":
+                setKeys(store, cachepath, maxsize)
+            elif cmd == "exit":
+                return 0
+            else:
+                stderr.write("Invalid Command %s\n" % cmd)
+                return 1
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,6 @@
-import basestore, shallowutil
+import ancestorcache, basestore, revgraph, shallowutil
 from mercurial.node import hex, nullid
+from mercurial import util
 
 class unionmetadatastore(object):
     def __init__(self, *args, **kwargs):
@@ -11,6 +12,12 @@ class unionmetadatastore(object):
         # history can't be found.
         self.allowincomplete = kwargs.get('allowincomplete', False)
 
+        # A persistent cache of complete ancestor maps, see ancestorcache.py.
+        self._ancestorcache = kwargs.get('ancestorcache')
+
+        # The revision graphs built by getrevgraph, by file name
+        self._revgraphs = util.lrucachedict(revgraph.CACHESIZE)
+
     def getancestors(self, name, node, known=None):
         """Returns as many ancestors as we're aware of.
 
@@ -24,7 +31,18 @@ class unionmetadatastore(object):
         if node in known:
             return []
 
+        # Only full ancestor maps are cached, since a partial one depends on
+        # what the caller already knows.
+        cache = self._ancestorcache if not known else None
+        packs = None
+        if cache is not None:
+            ancestors = cache.get(name, node)
+            if ancestors is not None:
+                return ancestors
+            packs = set()
+
         ancestors = {}
+        complete = True
         def traverse(curname, curnode):
             # TODO: this algorithm has the potential to traverse parts of
             # history twice. Ex: with A->B->C->F and A->B->D->F, both D and C
@@ -53,7 +71,8 @@ class unionmetadatastore(object):
             curname, curnode = missing.pop()
             try:
                 ancestors.update(self._getpartialancestors(curname, curnode,
-                                                           known=known))
+                                                           known=known,
+                                                           packs=packs))
                 newmissing = traverse(curname, curnode)
                 missing.extend(newmissing)
             except KeyError:
@@ -63,14 +82,52 @@ class unionmetadatastore(object):
                 # If the requested name+node doesn't exist, always throw.
                 if (curname, curnode) == (name, node):
                     raise
+                complete = False
+
+        if cache is not None and complete and None not in packs:
+            cache.add(name, node, ancestors, packs)
 
         # TODO: ancestors should probably be (name, node) -> (value)
         return ancestors
 
-    def _getpartialancestors(self, name, node, known=None):
+    def getrevgraph(self, name, nodes):
+        """Returns the revgraph of name, holding nodes and their ancestors.
+
+        The graph of a file is kept by the store and extended as other nodes
+        are asked for, so only the history it doesn't have yet is read.
+        """
+        graph = self._revgraphs.get(name)
+        if graph is None:
+            graph = revgraph.revgraph()
+            # An incomplete history would stay incomplete in the graph
+            if not self.allowincomplete:
+                self._revgraphs[name] = graph
+        for node in nodes:
+            if node not in graph:
+                ancestors = self.getancestors(name, node,
+                                              known=graph.nodemap)
+                graph.add(node, ancestors)
+        return graph
+
+    def _getpartialancestors(self, name, node, known=None, packs=None):
+        """Returns the ancestors of name and node found in the first store
+        that has them.
+
+        If ``packs`` is given, the id of the shared history pack they were
+        read from is added to it, or None if another store had them.
+        """
+        cachestore = self._ancestorcache.store if packs is not None else None
         for store in self.stores:
             try:
-                return store.getancestors(name, node, known=known)
+                if store is cachestore:
+                    pack, ancestors = store.getpackancestors(name, node,
+                                                             known=known)
+                    packs.add(ancestorcache.packid(pack.path))
+                    return ancestors
+                ancestors = store.getancestors(name, node, known=known)
+                if packs is not None:
+                    packs.add(None)
+                return ancestors
             except KeyError:
                 pass
 
@@ -85,6 +142,26 @@ class unionmetadatastore(object):
 
         raise KeyError((name, hex(node)))
 
+    def getnodehistory(self, name, node):
+        """Returns the history of node, and as much of its ancestors' as
+        comes with it for free: loose files hold the whole ancestor map of a
+        node, while packs are read one entry at a time.
+
+        return value: {
+           node: (p1, p2, linknode, copyfrom),
+           ...
+        }
+        """
+        for store in self.stores:
+            try:
+                if util.safehasattr(store, 'getnodehistory'):
+                    return store.getnodehistory(name, node)
+                return {node: store.getnodeinfo(name, node)}
+            except KeyError:
+                pass
+
+        raise KeyError((name, hex(node)))
+
     def add(self, name, node, data):
         raise RuntimeError("cannot add content only to remotefilelog "
                            "contentstore")
@@ -100,6 +177,88 @@ class unionmetadatastore(object):
         for store in self.stores:
             store.markledger(ledger)
 
+    def markforrefresh(self):
+        for store in self.stores:
+            if util.safehasattr(store, 'markforrefresh'):
+                store.markforrefresh()
+
+    def flush(self):
+        """Writes out the ancestor maps cached by this command, and reports
+        the ancestor cache statistics through ui.log."""
+        cache = self._ancestorcache
+        if cache is None:
+            return
+        cache.flush()
+        if cache.hits or cache.misses:
+            cache.ui.log('remotefilelog',
+                         'ancestor cache: %d hits, %d misses\n',
+                         cache.hits, cache.misses,
+                         remotefilelogancestorcachehits=cache.hits,
+                         remotefilelogancestorcachemisses=cache.misses)
+            cache.hits = cache.misses = 0
+
+class lazyancestormap(dict):
+    """An ancestor map of a file revision, that reads the history of its
+    ancestors as they're looked up rather than all at once like
+    unionmetadatastore.getancestors.
+
+    Lookups of nodes that weren't loaded yet go to the store, so the map can
+    be handed to remotefilectx like a complete one. load() reads several
+    nodes at a time, fetching the missing ones from the server together.
+    """
+    def __init__(self, store, name, node, prefetch=None):
+        super(lazyancestormap, self).__init__()
+        self._store = store
+        self._prefetch = prefetch
+        # The file names of the nodes that can be looked up. They're only
+        # known once a descendant is loaded, because of renames.
+        self._names = {node: name}
+
+    def __missing__(self, node):
+        self.load([node])
+        if node not in self:
+            raise KeyError(node)
+        return dict.__getitem__(self, node)
+
+    def get(self, node, default=None):
+        try:
+            return self[node]
+        except KeyError:
+            return default
+
+    def load(self, nodes):
+        """Reads the history of the given nodes that isn't loaded yet. The
+        nodes the local stores don't have are fetched in a single request.
+        """
+        keys = [(self._names[node], node) for node in nodes
+                if node not in self and node in self._names]
+        if not keys:
+            return
+        if self._prefetch is not None:
+            missing = self._store.getmissing(keys)
+            if missing:
+                self._prefetch(missing)
+
+        for name, node in keys:
+            if node not in self:
+                self._add(name, node, self._store.getnodehistory(name, node))
+
+    def _add(self, name, node, history):
+        names = self._names
+        stack = [(name, node)]
+        while stack:
+            name, node = stack.pop()
+            if node in self or node not in history:
+                continue
+            p1, p2, linknode, copyfrom = history[node]
+            self[node] = history[node]
+            if p1 != nullid:
+                names[p1] = copyfrom or name
+                stack.append((names[p1], p1))
+            if p2 != nullid:
+                names[p2] = name
+                stack.append((name, p2))
+
 class remotefilelogmetadatastore(basestore.basestore):
     def getancestors(self, name, node, known=None):
         """Returns as many ancestors as we're aware of.
@@ -116,6 +275,10 @@ class remotefilelogmetadatastore(basestore.basestore):
     def getnodeinfo(self, name, node):
         return self.getancestors(name, node)[node]
 
+    def getnodehistory(self, name, node):
+        # The blob of a node holds the whole ancestor map anyway
+        return self.getancestors(name, node)
+
     def add(self, name, node, parents, linknode):
         raise RuntimeError("cannot add metadata only to remotefilelog "
                            "metadatastore")
@@ -0,0 +1,200 @@
+from __future__ import absolute_import
+
+import errno, mmap, os, struct
+from mercurial import util
+
+# The multipack index version supported by this implementation.
+VERSION = 0
+
+# Index header is <version: 1 byte><pack count: 4 byte unsigned int>
+HEADERFORMAT = '!BI'
+HEADERLENGTH = struct.calcsize(HEADERFORMAT)
+
+# Packs are named by the hex sha1 of their contents.
+PACKNAMELENGTH = 40
+
+# The fanout table has one entry per leading node byte.
+FANOUTCOUNT = 2**8
+FANOUTENTRYFORMAT = '!I'
+FANOUTENTRYLENGTH = struct.calcsize(FANOUTENTRYFORMAT)
+
+# <node: 20 byte><pack id: 4 byte unsigned int>
+ENTRYFORMAT = '!20sI'
+ENTRYLENGTH = struct.calcsize(ENTRYFORMAT)
+NODELENGTH = 20
+
+SUFFIX = '.midx'
+
+class multipackindex(object):
+    """A read-only view of a multipack index file.
+
+    A multipack index covers every pack of a given kind in a directory, so a
+    node can be resolved to the packs containing it with a single bisect,
+    instead of one fanout lookup and bisect per pack.
+
+    It consists of a single file, with the following format. All bytes are in
+    network byte order (big endian).
+
+        midx = <version: 1 byte>
+               <pack count: 4 byte unsigned int>
+               <packtable>
+               <fanouttable>
+               <index>
+        packtable = [<pack name: 40 byte hex sha1>,...] (pack count entries)
+        fanouttable = [<index end: 4 byte unsigned int>,...] (2^8 entries)
+        index = [<index entry>,...]
+        indexentry = <node: 20 byte>
+                     <pack id: 4 byte unsigned int>
+
+    The index is sorted by node, then by pack id. A node may appear once per
+    pack that contains it. The pack id is the position of the pack's name in
+    the pack table. Fanout slot N holds the number of index entries whose node
+    starts with a byte less than or equal to N.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < HEADERLENGTH:
+                raise RuntimeError('truncated multipack index: %s' % path)
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        version, packcount = struct.unpack(HEADERFORMAT,
+                                           self._data[:HEADERLENGTH])
+        if version != VERSION:
+            raise RuntimeError('unsupported multipack index version: %s' %
+                               version)
+
+        offset = HEADERLENGTH
+        self.packnames = []
+        for i in xrange(packcount):
+            self.packnames.append(self._data[offset:offset + PACKNAMELENGTH])
+            offset += PACKNAMELENGTH
+
+        fanoutsize = FANOUTCOUNT * FANOUTENTRYLENGTH
+        rawfanout = self._data[offset:offset + fanoutsize]
+        self._fanout = struct.unpack('!%dI' % FANOUTCOUNT, rawfanout)
+        offset += fanoutsize
+
+        self._indexstart = offset
+        self.entrycount = self._fanout[-1] if self._fanout else 0
+        if size != offset + self.entrycount * ENTRYLENGTH:
+            raise RuntimeError('corrupt multipack index: %s' % path)
+
+    def close(self):
+        self._data.close()
+
+    def __len__(self):
+        return self.entrycount
+
+    def _node(self, i):
+        loc = self._indexstart + i * ENTRYLENGTH
+        return self._data[loc:loc + NODELENGTH]
+
+    def _range(self, node):
+        """Returns the [start, end) range of index positions that may contain
+        node, based on the fanout table."""
+        key = ord(node[0])
+        start = self._fanout[key - 1] if key > 0 else 0
+        return start, self._fanout[key]
+
+    def __contains__(self, node):
+        start, end = self._range(node)
+        while start < end:
+            mid = (start + end) // 2
+            midnode = self._node(mid)
+            if midnode == node:
+                return True
+            if midnode < node:
+                start = mid + 1
+            else:
+                end = mid
+        return False
+
+    def getpackids(self, node):
+        """Returns the ids of every pack containing node, in pack id order."""
+        start, end = self._range(node)
+        # Find the first entry for node.
+        while start < end:
+            mid = (start + end) // 2
+            if self._node(mid) < node:
+                start = mid + 1
+            else:
+                end = mid
+
+        packids = []
+        data = self._data
+        loc = self._indexstart + start * ENTRYLENGTH
+        indexend = self._indexstart + self.entrycount * ENTRYLENGTH
+        while loc < indexend and data[loc:loc + NODELENGTH] == node:
+            packids.append(struct.unpack(ENTRYFORMAT,
+                                         data[loc:loc + ENTRYLENGTH])[1])
+            loc += ENTRYLENGTH
+        return packids
+
+    def getpacknames(self, node):
+        packnames = self.packnames
+        return [packnames[i] for i in self.getpackids(node)]
+
+    def iterentries(self):
+        """Yields (node, pack name) for every entry in the index."""
+        data = self._data
+        packnames = self.packnames
+        loc = self._indexstart
+        for i in xrange(self.entrycount):
+            node, packid = struct.unpack(ENTRYFORMAT,
+                                         data[loc:loc + ENTRYLENGTH])
+            yield node, packnames[packid]
+            loc += ENTRYLENGTH
+
+def write(path, packnames, entries):
+    """Atomically writes a multipack index to path.
+
+    ``packnames`` is the list of pack names covered by the index, and
+    ``entries`` is an iterable of (node, pack name) for every node in those
+    packs.
+    """
+    packids = dict((name, i) for i, name in enumerate(packnames))
+    index = sorted((node, packids[name]) for node, name in entries)
+
+    fanout = [0] * FANOUTCOUNT
+    for node, packid in index:
+        fanout[ord(node[0])] += 1
+    total = 0
+    for i in xrange(FANOUTCOUNT):
+        total += fanout[i]
+        fanout[i] = total
+
+    fp = util.atomictempfile(path, 'wb', checkambig=False)
+    try:
+        fp.write(struct.pack(HEADERFORMAT, VERSION, len(packnames)))
+        fp.write(''.join(packnames))
+        fp.write(struct.pack('!%dI' % FANOUTCOUNT, *fanout))
+        fp.write(''.join(struct.pack(ENTRYFORMAT, node, packid)
+                         for node, packid in index))
+        fp.close()
+    finally:
+        fp.discard()
+
+def packentries(pack):
+    """Yields (node, pack name) for every node in ``pack``."""
+    name = os.path.basename(pack.path)
+    for filename, node in pack:
+        yield node, name
+
+def indexable(pack):
+    """Returns True if ``pack`` can be referenced from a multipack index."""
+    return len(os.path.basename(pack.path)) == PACKNAMELENGTH
+
+def load(path):
+    """Returns the multipack index at path, or None if it does not exist or
+    cannot be read."""
+    try:
+        return multipackindex(path)
+    except (IOError, OSError) as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+    except (RuntimeError, struct.error, ValueError):
+        # A corrupt or foreign index is simply rebuilt.
+        pass
+    return None
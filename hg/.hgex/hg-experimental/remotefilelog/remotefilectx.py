@@ -5,13 +5,18 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2 or any later version.
 
-import collections
+import collections, heapq
 from mercurial.i18n import _
 from mercurial.node import bin, hex, nullid, nullrev
 from mercurial import context, util, error, ancestor, phases
+from . import linkrevindex, metadatastore
 
 propertycache = util.propertycache
 
+# How many revisions at the front of an ancestors() walk get their parents'
+# history read, and fetched, together
+READAHEAD = 100
+
 class remotefilectx(context.filectx):
     def __init__(self, repo, path, changeid=None, fileid=None,
                  filelog=None, changectx=None, ancestormap=None):
@@ -132,6 +137,22 @@ class remotefilectx(context.filectx):
 
         return self._ancestormap
 
+    def lazyancestormap(self):
+        """Like ancestormap, but reads the history of the ancestors as they
+        are looked up. See metadatastore.lazyancestormap."""
+        if not self._ancestormap:
+            repo = self._repo
+            def prefetch(keys):
+                repo.fileservice.prefetch(
+                    [(name, hex(node)) for name, node in keys],
+                    fetchdata=False, fetchhistory=True)
+            ancestormap = metadatastore.lazyancestormap(repo.metadatastore,
+                self._path, self._filenode, prefetch=prefetch)
+            ancestormap.load([self._filenode])
+            self._ancestormap = ancestormap
+
+        return self._ancestormap
+
     def parents(self):
         repo = self._repo
         ancestormap = self.ancestormap()
@@ -197,6 +218,16 @@ class remotefilectx(context.filectx):
         if self._verifylinknode(revs, linknode):
             return linknode
 
+        index = linkrevindex.getindex(repo)
+        if index is not None:
+            index.lookups += 1
+            indexed = self._indexedlinknode(index, path, fnode, revs,
+                                            inclusive)
+            if indexed is not None:
+                index.hits += 1
+                return indexed
+            index.slowwalks += 1
+
         pc = repo._phasecache
         seenpublic = False
         iteranc = cl.ancestors(revs, inclusive=inclusive)
@@ -272,6 +303,41 @@ class remotefilectx(context.filectx):
 
         return linknode
 
+    def _indexedlinknode(self, index, path, fnode, revs, inclusive):
+        """Returns the first ancestor of revs introducing fnode according to
+        the linkrev index, or None if the index can't tell."""
+        repo = self._repo
+        cl = repo.unfiltered().changelog
+        coverage = index.coverage(cl)
+        if coverage is None:
+            return None
+        start, end = coverage
+
+        # The changesets added since the index was last updated are the
+        # closest ancestors, so they are checked first.
+        mfl = repo.manifestlog
+        for ancrev in cl.ancestors(revs, stoprev=end, inclusive=inclusive):
+            ancctx = cl.read(ancrev)
+            manifestnode, files = ancctx[0], ancctx[3]
+            if path in files:
+                if fnode == mfl[manifestnode].readfast().get(path):
+                    return cl.node(ancrev)
+
+        # Any indexed changeset that is an ancestor is closer than the ones
+        # the index doesn't cover.
+        best = None
+        for linknode in index.get(path, fnode):
+            rev = cl.nodemap.get(linknode)
+            if rev is None or (best is not None and rev <= best):
+                continue
+            if not inclusive and rev in revs:
+                continue
+            if self._verifylinknode(revs, linknode):
+                best = rev
+        if best is None:
+            return None
+        return cl.node(best)
+
     def _verifylinknode(self, revs, linknode):
         """
         Check if a linknode is correct one for the current history.
@@ -298,33 +364,54 @@ class remotefilectx(context.filectx):
             return False
 
     def ancestors(self, followfirst=False):
-        ancestors = []
-        queue = collections.deque((self,))
-        seen = set()
-        while queue:
-            current = queue.pop()
-            if current.filenode() in seen:
-                continue
-            seen.add(current.filenode())
+        """Yields the ancestors of this file revision, latest linkrev first.
+
+        The copy tracing algorithm depends on these coming out in order.
+        """
+        return self.walkancestors(lambda fctx: fctx.linkrev(), followfirst)
 
-            ancestors.append(current)
+    def walkancestors(self, key, followfirst=False):
+        """Yields the ancestors of this file revision by decreasing key.
 
+        The history is read as the walk reaches it, so the first ancestors
+        come out without reading the whole history of the file. The key
+        of a revision has to be lower than its children's, like revision
+        numbers, for the ancestors to come out in order.
+        """
+        ancestormap = self.lazyancestormap()
+        lazy = util.safehasattr(ancestormap, 'load')
+
+        def readahead(current, heap):
+            """Reads the parents of current if they're missing, together with
+            those of the next READAHEAD revisions of the walk, so the history
+            is read in batches rather than a revision at a time."""
+            p1, p2, linknode, copyfrom = ancestormap[current.filenode()]
+            if all(p == nullid or p in ancestormap for p in (p1, p2)):
+                return
+            nodes = [p1, p2]
+            for k, node, fctx in heap[:READAHEAD]:
+                if node in ancestormap:
+                    nodes.extend(ancestormap[node][:2])
+            ancestormap.load(nodes)
+
+        heap = []
+        seen = set([self.filenode()])
+        current = self
+        while True:
+            if lazy:
+                readahead(current, heap)
             parents = current.parents()
-            first = True
+            if followfirst:
+                parents = parents[:1]
             for p in parents:
-                if first or not followfirst:
-                    queue.append(p)
-                first = False
+                if p.filenode() not in seen:
+                    seen.add(p.filenode())
+                    heapq.heappush(heap, (-key(p), p.filenode(), p))
 
-        # Remove self
-        ancestors.pop(0)
-
-        # Sort by linkrev
-        # The copy tracing algorithm depends on these coming out in order
-        ancestors = sorted(ancestors, reverse=True, key=lambda x:x.linkrev())
-
-        for ancestor in ancestors:
-            yield ancestor
+            if not heap:
+                break
+            current = heapq.heappop(heap)[2]
+            yield current
 
     def ancestor(self, fc2, actx):
         # the easy case: no (relevant) renames
@@ -409,6 +496,9 @@ class remoteworkingfilectx(context.workingfilectx, remotefilectx):
     def parents(self):
         return remotefilectx.parents(self)
 
+    def lazyancestormap(self):
+        return self.ancestormap()
+
     def ancestormap(self):
         if not self._ancestormap:
             path = self._path
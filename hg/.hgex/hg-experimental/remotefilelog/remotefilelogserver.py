@@ -7,18 +7,22 @@
 from __future__ import absolute_import
 
 from mercurial import wireproto, changegroup, match, util, changelog, context
-from mercurial import exchange, sshserver, store, error
+from mercurial import exchange, sshserver, store, error, mdiff, repair
 from mercurial.extensions import wrapfunction
 from mercurial.hgweb import protocol as httpprotocol
 from mercurial.node import bin, hex, nullid, nullrev
 from mercurial.i18n import _
 from .  import (
+    blobpack,
     constants,
+    getpackcache,
     lz4wrapper,
     shallowrepo,
     shallowutil,
     wirepack,
+    workerpool,
 )
+from hgext3rd.extutil import runbgcommand
 import errno, stat, os, time
 
 try:
@@ -56,6 +60,9 @@ def setupserver(ui, repo):
 
     wrapfunction(changegroup.cg1packer, 'generatefiles', generatefiles)
 
+    if ui.configbool('remotefilelog', 'getpackcache'):
+        ui.setconfig('hooks', 'changegroup.getpackcache', warmgetpackcache)
+
 onetime = False
 def onetimesetup(ui):
     """Configures the wireprotocol for both clients and servers.
@@ -70,6 +77,7 @@ def onetimesetup(ui):
     wireproto.commands['getfiles'] = (getfiles, '')
     wireproto.commands['getfile'] = (getfile, 'file node')
     wireproto.commands['getpackv1'] = (getpack, '*')
+    wireproto.commands['getpackv2'] = (getpackv2, '*')
 
     class streamstate(object):
         match = None
@@ -190,6 +198,7 @@ def onetimesetup(ui):
             if isinstance(proto, sshserver.sshserver):
                 # legacy getfiles method which only works over ssh
                 caps.append(shallowrepo.requirement)
+                caps.append('getpackv2')
             caps.append('getflogheads')
             caps.append('getfile')
         return caps
@@ -212,16 +221,29 @@ def onetimesetup(ui):
 
     wrapfunction(httpprotocol, 'iscmd', _iscmd)
 
+    def _strip(orig, ui, repo, *args, **kwargs):
+        # The linknodes in the getpack cache point to the stripped changesets
+        cache = getpackcache.getcache(repo)
+        try:
+            return orig(ui, repo, *args, **kwargs)
+        finally:
+            if cache is not None:
+                cache.invalidate()
+
+    wrapfunction(repair, 'strip', _strip)
+
 def _loadfileblob(repo, cachepath, path, node):
+    store = blobpack.getstore(repo)
+    if store is not None:
+        text = store.get(path, node)
+        if text is None:
+            text = _buildcompressedblob(repo, path, node)
+            store.add(path, node, text)
+        return text
+
     filecachepath = os.path.join(cachepath, path, hex(node))
     if not os.path.exists(filecachepath) or os.path.getsize(filecachepath) == 0:
-        filectx = repo.filectx(path, fileid=node)
-        if filectx.node() == nullid:
-            repo.changelog = changelog.changelog(repo.svfs)
-            filectx = repo.filectx(path, fileid=node)
-
-        text = createfileblob(filectx)
-        text = lz4wrapper.lzcompresshc(text)
+        text = _buildcompressedblob(repo, path, node)
 
         # everything should be user & group read/writable
         oldumask = os.umask(0o002)
@@ -252,6 +274,21 @@ def _loadfileblob(repo, cachepath, path, node):
             text = f.read()
     return text
 
+def _buildcompressedblob(repo, path, node):
+    filectx = repo.filectx(path, fileid=node)
+    if filectx.node() == nullid:
+        repo.changelog = changelog.changelog(repo.svfs)
+        filectx = repo.filectx(path, fileid=node)
+
+    text = createfileblob(filectx)
+    return lz4wrapper.lzcompresshc(text)
+
+def _iscachedblob(repo, cachepath, path, node):
+    store = blobpack.getstore(repo)
+    if store is not None:
+        return store.contains(path, node)
+    return os.path.exists(os.path.join(cachepath, path, hex(node)))
+
 def getflogheads(repo, proto, path):
     """A server api for requesting a filelog's heads
     """
@@ -293,26 +330,64 @@ def getfiles(repo, proto):
         if not cachepath:
             cachepath = os.path.join(repo.path, "remotefilelogcache")
 
-        while True:
-            request = fin.readline()[:-1]
-            if not request:
-                break
+        pool = workerpool.getpool(repo)
+        if pool is None:
+            for node, path in _readfilesrequests(fin):
+                if node == nullid:
+                    yield '0\n'
+                    continue
 
-            node = bin(request[:40])
+                text = _loadfileblob(repo, cachepath, path, node)
+
+                yield '%d\n%s' % (len(text), text)
+
+                # it would be better to only flush after processing a whole
+                # batch but currently we don't know if there are more requests
+                # coming
+                proto.fout.flush()
+            return
+
+        # The requests arrive one at a time, so the first ones are built in
+        # this process until there are enough of them for the workers to pay
+        # off.
+        submitted = [0]
+        def submit(request):
+            node, path = request
+            if node == nullid:
+                return workerpool.done('')
+            if _iscachedblob(repo, cachepath, path, node):
+                # Reading the cached blob is cheaper than sending it back
+                # from a worker
+                return workerpool.done(_loadfileblob(repo, cachepath, path,
+                                                     node))
+            submitted[0] += 1
+            if submitted[0] <= pool.minbatch:
+                return pool.run(_buildfileblob, cachepath, path, node)
+            return pool.submit(_buildfileblob, cachepath, path, node)
+
+        requests = _readfilesrequests(fin)
+        for (node, path), text in pool.pipeline(requests, submit):
             if node == nullid:
                 yield '0\n'
-                continue
+            else:
+                yield '%d\n%s' % (len(text), text)
+            proto.fout.flush()
 
-            path = request[40:]
+    return wireproto.streamres(streamer())
 
-            text = _loadfileblob(repo, cachepath, path, node)
+def _readfilesrequests(fin):
+    """Yields the (node, path) requests of a getfiles command, until the
+    client ends it with an empty line."""
+    while True:
+        request = fin.readline()[:-1]
+        if not request:
+            break
 
-            yield '%d\n%s' % (len(text), text)
+        yield bin(request[:40]), request[40:]
 
-            # it would be better to only flush after processing a whole batch
-            # but currently we don't know if there are more requests coming
-            proto.fout.flush()
-    return wireproto.streamres(streamer())
+def _buildfileblob(state, cachepath, path, node):
+    """Builds a getfiles blob in a worker process."""
+    return _loadfileblob(state['repo'], cachepath, path, node)
 
 def createfileblob(filectx):
     """
@@ -407,9 +482,27 @@ def gcserver(ui, repo):
 
     ui.progress(_removing, None)
 
+    store = blobpack.getstore(repo)
+    if store is not None:
+        store.expire(expiration)
+
+    cache = getpackcache.getcache(repo)
+    if cache is not None:
+        cache.evict()
+
 def getpack(repo, proto, args):
     """A server api for requesting a pack of file information.
     """
+    return _getpack(repo, proto, 1)
+
+def getpackv2(repo, proto, args):
+    """Like getpack, but the client also sends, for each file, the nodes it
+    already has, and the server sends deltas against them instead of full
+    texts where it can.
+    """
+    return _getpack(repo, proto, 2)
+
+def _getpack(repo, proto, version):
     if shallowrepo.requirement in repo.requirements:
         raise error.Abort(_('cannot fetch remote files from shallow repo'))
     if not isinstance(proto, sshserver.sshserver):
@@ -420,7 +513,8 @@ def getpack(repo, proto, args):
 
         [<filerequest>,...]\0\0
         filerequest = <filename len: 2 byte><filename><count: 4 byte>
-                      [<node: 20 byte>,...]
+                      [<node: 20 byte>,...]<bases>
+        bases = <count: 4 byte>[<node: 20 byte>,...] (version 2 only)
 
         Response format:
         [<fileresponse>,...]<10 null bytes>
@@ -431,42 +525,170 @@ def getpack(repo, proto, args):
         deltas = <count: 4 byte>[<delta entry>,...]
         deltaentry = <node: 20 byte><deltabase: 20 byte>
                      <delta len: 8 byte><delta>
+
+        The deltabase of a delta entry is either the nullid, for full texts,
+        or one of the bases the client sent.
+
+        The cache holds the parts with full texts only, whatever the bases,
+        so every client hits the same entries, and the deltas against the
+        bases of a request are computed from the cached texts.
         """
-        files = _receivepackrequest(proto.fin)
+        files = _receivepackrequest(proto.fin, version)
+        cache = getpackcache.getcache(repo)
+        pool = workerpool.getpool(repo)
 
         # Sort the files by name, so we provide deterministic results
-        for filename, nodes in sorted(files.iteritems()):
-            fl = repo.file(filename)
-
-            # Compute history
-            history = []
-            for rev in fl.ancestors(list(fl.rev(n) for n in nodes),
-                                    inclusive=True):
-                x, x, x, x, linkrev, p1, p2, node = fl.index[rev]
-                copyfrom = ''
-                p1node = fl.node(p1)
-                p2node = fl.node(p2)
-                linknode = repo.changelog.node(linkrev)
-                if p1node == nullid:
-                    copydata = fl.renamed(node)
-                    if copydata:
-                        copyfrom, copynode = copydata
-                        p1node = copynode
-
-                history.append((node, p1node, p2node, linknode, copyfrom))
-
-            # Scan and send deltas
-            chain = _getdeltachain(fl, nodes, -1)
-
-            for chunk in wirepack.sendpackpart(filename, history, chain):
-                yield chunk
+        requests = sorted(files.iteritems())
+
+        if pool is None:
+            for filename, (nodes, bases) in requests:
+                if cache is not None:
+                    chunks = cache.get(filename, nodes)
+                    if chunks is None:
+                        chunks = cache.set(filename, nodes,
+                                           _getpackpart(repo, filename, nodes))
+                    if bases:
+                        chunks = _rebasepackpart(repo, chunks, bases)
+                else:
+                    chunks = _getpackpart(repo, filename, nodes, bases)
+
+                for chunk in chunks:
+                    yield chunk
+        else:
+            # Like getfiles, the first parts are built in this process
+            submitted = [0]
+            def build(func, *args):
+                submitted[0] += 1
+                if submitted[0] <= pool.minbatch:
+                    return pool.run(func, *args)
+                return pool.submit(func, *args)
+
+            def submit(request):
+                filename, (nodes, bases) = request
+                if cache is not None:
+                    chunks = cache.get(filename, nodes)
+                    if chunks is not None:
+                        if bases:
+                            return build(_buildrebasedpart, ''.join(chunks),
+                                         bases)
+                        return workerpool.done((None, chunks))
+                return build(_buildpackpart, filename, nodes, bases,
+                             cache is not None)
+
+            for request, (part, chunks) in pool.pipeline(requests, submit):
+                filename, (nodes, bases) = request
+                if part is not None:
+                    cache.set(filename, nodes, [part])
+                for chunk in chunks:
+                    yield chunk
 
         yield wirepack.closepart()
         proto.fout.flush()
 
+        if cache is not None:
+            cache.logstats()
+
     return wireproto.streamres(streamer())
 
-def _receivepackrequest(stream):
+def _getpackpart(repo, filename, nodes, bases=()):
+    """Produces the wirepack part holding the history and contents of the
+    given nodes of filename. The contents are deltas against the given bases
+    where possible, and full texts otherwise."""
+    fl = repo.file(filename)
+
+    # Compute history
+    history = []
+    for rev in fl.ancestors(list(fl.rev(n) for n in nodes),
+                            inclusive=True):
+        x, x, x, x, linkrev, p1, p2, node = fl.index[rev]
+        copyfrom = ''
+        p1node = fl.node(p1)
+        p2node = fl.node(p2)
+        linknode = repo.changelog.node(linkrev)
+        if p1node == nullid:
+            copydata = fl.renamed(node)
+            if copydata:
+                copyfrom, copynode = copydata
+                p1node = copynode
+
+        history.append((node, p1node, p2node, linknode, copyfrom))
+
+    # Scan and send deltas
+    if bases:
+        chain = _getbaseddeltas(fl, [(n, fl.read(n)) for n in nodes],
+                                bases)
+    else:
+        chain = _getdeltachain(fl, nodes, -1)
+
+    return wirepack.sendpackpart(filename, history, chain)
+
+def _rebasepackpart(repo, chunks, bases):
+    """Produces the getpack part made of the given chunks, which holds full
+    texts, with its contents turned into deltas against the given bases where
+    possible."""
+    stream = util.stringio(''.join(chunks))
+    filename = shallowutil.readpath(stream)
+    history = list(wirepack.readhistory(stream))
+    texts = [(node, text) for node, deltabase, text
+             in wirepack.readdeltas(stream)]
+
+    chain = _getbaseddeltas(repo.file(filename), texts, bases)
+    return wirepack.sendpackpart(filename, history, chain)
+
+def _buildpackpart(state, filename, nodes, bases, cacheable):
+    """Builds a getpack part in a worker process. Returns the part with full
+    texts to store in the cache, or None if it isn't cached, and the chunks
+    to send."""
+    repo = state['repo']
+    if not cacheable:
+        return None, [''.join(_getpackpart(repo, filename, nodes, bases))]
+    part = ''.join(_getpackpart(repo, filename, nodes))
+    if not bases:
+        return part, [part]
+    return part, [''.join(_rebasepackpart(repo, [part], bases))]
+
+def _buildrebasedpart(state, part, bases):
+    """Turns the texts of a cached getpack part into deltas against the
+    given bases, in a worker process."""
+    return None, [''.join(_rebasepackpart(state['repo'], [part], bases))]
+
+def warmgetpackcache(ui, repo, node=None, **kwargs):
+    """changegroup hook that fills the getpack cache with the file revisions
+    introduced by the incoming changesets, which clients are about to fetch.
+
+    The cache is filled by a background process, so the push doesn't wait
+    for it.
+    """
+    if node is None or getpackcache.getcache(repo) is None:
+        return
+
+    cmd = util.hgcmd() + ['-R', repo.origroot, 'debugwarmgetpackcache',
+                          '-r', '%s:' % node]
+    runbgcommand(cmd, os.environ)
+
+def fillgetpackcache(ui, repo, revs):
+    """Fills the getpack cache with the file revisions introduced by revs,
+    then trims the cache to its size budget."""
+    cache = getpackcache.getcache(repo)
+    if cache is None:
+        return
+
+    _warming = _("warming getpack cache")
+    ui.progress(_warming, 0, unit="changesets", total=len(revs))
+    for i, rev in enumerate(revs):
+        ctx = repo[rev]
+        for filename in ctx.files():
+            if filename not in ctx:
+                continue
+            nodes = set([ctx.filenode(filename)])
+            if not cache.contains(filename, nodes):
+                cache.set(filename, nodes, _getpackpart(repo, filename, nodes))
+        ui.progress(_warming, i + 1, unit="changesets", total=len(revs))
+    ui.progress(_warming, None)
+
+    cache.evict()
+
+def _receivepackrequest(stream, version=1):
     files = {}
     while True:
         filenamelen = shallowutil.readunpack(stream,
@@ -475,18 +697,57 @@ def _receivepackrequest(stream):
             break
 
         filename = shallowutil.readexactly(stream, filenamelen)
+        nodes = _receivenodes(stream)
+        bases = set()
+        if version >= 2:
+            bases = _receivenodes(stream)
 
-        nodecount = shallowutil.readunpack(stream,
-                                           constants.PACKREQUESTCOUNTSTRUCT)[0]
+        files[filename] = (nodes, bases)
 
-        # Read N nodes
-        nodes = shallowutil.readexactly(stream, constants.NODESIZE * nodecount)
-        nodes = set(nodes[i:i + constants.NODESIZE] for i in
-                    xrange(0, len(nodes), constants.NODESIZE))
+    return files
 
-        files[filename] = nodes
+def _receivenodes(stream):
+    nodecount = shallowutil.readunpack(stream,
+                                       constants.PACKREQUESTCOUNTSTRUCT)[0]
 
-    return files
+    # Read N nodes
+    nodes = shallowutil.readexactly(stream, constants.NODESIZE * nodecount)
+    return set(nodes[i:i + constants.NODESIZE] for i in
+               xrange(0, len(nodes), constants.NODESIZE))
+
+def _getbaseddeltas(fl, texts, bases):
+    """Produces a delta for each of the given (node, text), against the
+    closest of the given base nodes the filelog has, or a full text if it has
+    none.
+
+    Deltas are computed between the texts returned by fl.read(), without the
+    copy metadata, since those are the texts the client stores.
+    """
+    baserevs = []
+    for base in bases:
+        try:
+            baserevs.append(fl.rev(base))
+        except error.LookupError:
+            # The client may have the file from a commit we don't know about
+            pass
+
+    chain = []
+    for node, text in sorted(texts, key=lambda x: fl.rev(x[0])):
+        rev = fl.rev(node)
+        candidates = [b for b in baserevs if b != rev]
+        if candidates:
+            # Revisions close to each other in the filelog are usually close
+            # to each other in contents as well.
+            baserev = min(candidates, key=lambda b: (abs(rev - b), b))
+            basenode = fl.node(baserev)
+            delta = mdiff.textdiff(fl.read(baserev), text)
+            if len(delta) < len(text):
+                chain.append((node, basenode, delta))
+                continue
+
+        chain.append((node, nullid, text))
+
+    return chain
 
 def _getdeltachain(fl, nodes, stophint):
     """Produces a chain of deltas that includes each of the given nodes.
@@ -1,6 +1,11 @@
 from __future__ import absolute_import
 
+import hashlib
+import heapq
 import os
+import shutil
+import struct
+import tempfile
 from collections import defaultdict
 from hgext3rd.extutil import runshellcommand
 from mercurial import (
@@ -10,6 +15,7 @@ from mercurial import (
     policy,
     scmutil,
     util,
+    worker,
 )
 from mercurial.node import nullid
 from mercurial.i18n import _
@@ -18,6 +24,7 @@ from . import (
     contentstore,
     datapack,
     historypack,
+    keepset,
     metadatastore,
     shallowutil,
 )
@@ -288,6 +295,116 @@ def _runrepack(repo, data, history, packpath, category):
                 raise error.Abort(_("skipping repack - another repack is "
                                     "already running"))
 
+    if repo.ui.configbool('remotefilelog', 'multipackindex'):
+        # The repack replaced packs on disk, so bring the multipack indexes up
+        # to date now rather than on the next lookup miss.
+        for storetype in (datapack.datapackstore,
+                          historypack.historypackstore):
+            storetype(repo.ui, packpath).updatemultipackindex()
+
+# The cost per partition given to the worker module. Partitions are large, so
+# always use the workers when there is more than one cpu.
+WORKERCOST = 100000.0
+
+def _partition(filename, count):
+    """Returns the partition of a parallel repack that filename belongs
+    to."""
+    return struct.unpack('!I', hashlib.sha1(filename).digest()[:4])[0] % count
+
+def _partitionkeys(keys, count, size):
+    """Splits the (filename, node) keys into at least ``count`` partitions,
+    and returns the list of keys of each partition.
+
+    All the revisions of a file are in the same partition, which is picked by
+    _partition when it has room. The files that would make it hold more than
+    ``size`` keys go to extra partitions instead, so a partition only holds
+    more than ``size`` keys when a single file does.
+    """
+    files = {}
+    for key in keys:
+        files.setdefault(key[0], []).append(key)
+
+    partitions = [[] for i in xrange(count)]
+    overflow = None
+    for filename, filekeys in files.iteritems():
+        i = _partition(filename, count)
+        if partitions[i] and len(partitions[i]) + len(filekeys) > size:
+            i = overflow
+            if (i is None or
+                partitions[i] and len(partitions[i]) + len(filekeys) > size):
+                i = overflow = len(partitions)
+                partitions.append([])
+        partitions[i].extend(filekeys)
+    return partitions
+
+class deltabasechooser(object):
+    """Chooses the delta base of each revision of a file being repacked, with
+    a cost model that trades pack size against read latency.
+
+    Revisions are written children first, so only revisions that were
+    already written can be delta bases. The candidates for a revision are its
+    children (the reverse delta equivalent of its parents), the revision
+    written just before it, and a full text. A candidate costs the size of
+    its delta, plus ``chaincost`` bytes for every delta that has to be
+    applied to read the revision back. Chains never get longer than
+    ``maxchainlen``, so a full text is written at least that often.
+    """
+    def __init__(self, data, filename, maxchainlen, chaincost, textcachesize):
+        self.data = data
+        self.filename = filename
+        self.maxchainlen = maxchainlen
+        self.chaincost = chaincost
+        self._chainlens = {}
+        self._children = defaultdict(list)
+        self._previous = None
+        self._texts = contentstore.textcache(textcachesize)
+
+    def _gettext(self, node):
+        text = self._texts.get(node)
+        if text is None:
+            text = self.data.get(self.filename, node)
+            self._texts.set(node, text)
+        return text
+
+    def choose(self, node, ancestorinfo):
+        """Returns (deltabase, delta) for node, which must be written before
+        any of its ancestors. ancestorinfo is node's (p1, p2, linknode,
+        copyfrom), or None if its history is unknown."""
+        text = self._gettext(node)
+
+        candidates = list(self._children[node])
+        if self._previous is not None and self._previous not in candidates:
+            candidates.append(self._previous)
+
+        bestcost, deltabase, delta = len(text), nullid, text
+        chainlen = 0
+        for base in candidates:
+            basechainlen = self._chainlens[base] + 1
+            if basechainlen > self.maxchainlen:
+                continue
+            basedelta = mdiff.textdiff(self._gettext(base), text)
+            cost = len(basedelta) + self.chaincost * basechainlen
+            if cost < bestcost:
+                bestcost, deltabase, delta = cost, base, basedelta
+                chainlen = basechainlen
+
+        self._chainlens[node] = chainlen
+        self._previous = node
+        if ancestorinfo:
+            p1, p2, linknode, copyfrom = ancestorinfo
+            # Don't delta against revisions of the file this one was copied
+            # from.
+            if copyfrom:
+                p1 = nullid
+            for parent in (p1, p2):
+                if parent != nullid:
+                    self._children[parent].append(node)
+
+        return deltabase, delta
+
+def _keepkey(filename, node):
+    return '%s\0%s' % (filename, node)
+
 class repacker(object):
     """Class for orchestrating the repack of data and history information into a
     new format.
@@ -320,10 +437,8 @@ class repacker(object):
             revs.append('(%s)' % prefetchrevs)
 
         keep = scmutil.revrange(repo, ['+'.join(revs)])
-        keepkeys = set()
-        for r in keep:
-            m = repo[r].manifest()
-            keepkeys.update(m.iteritems())
+        keepkeys = keepset.keepset()
+        keepset.addrevs(keepkeys, repo, keep, _keepkey)
 
         return keepkeys
 
@@ -339,16 +454,23 @@ class repacker(object):
             self.history.markledger(ledger)
 
             # Run repack
-            self.repackdata(ledger, targetdata)
-            self.repackhistory(ledger, targethistory)
+            self.repack(ledger, targetdata, targethistory)
 
             # Call cleanup on each source
             for source in ledger.sources:
                 source.cleanup(ledger)
 
+    def repack(self, ledger, targetdata, targethistory):
+        """Repacks every entry in the ledger into the target packs, and
+        closes them."""
+        if self.repo.ui.configbool('remotefilelog', 'parallelrepack'):
+            self.repackpartitioned(ledger, targetdata, targethistory)
+        else:
+            self.repackdata(ledger, targetdata)
+            self.repackhistory(ledger, targethistory)
+
     def repackdata(self, ledger, target):
         ui = self.repo.ui
-        maxchainlen = ui.configint('packs', 'maxchainlen', 1000)
 
         byfile = {}
         for entry in ledger.entries.itervalues():
@@ -359,54 +481,81 @@ class repacker(object):
         for filename, entries in sorted(byfile.iteritems()):
             ui.progress(_("repacking data"), count, unit=self.unit,
                         total=len(byfile))
+            self._repackfiledata(filename, entries, target)
+            count += 1
 
-            ancestors = {}
-            nodes = list(node for node in entries.iterkeys())
-            nohistory = []
-            for i, node in enumerate(nodes):
-                if node in ancestors:
-                    continue
-                ui.progress(_("building history"), i, unit='nodes',
-                            total=len(nodes))
-                try:
-                    ancestors.update(self.history.getancestors(filename, node,
-                                                               known=ancestors))
-                except KeyError:
-                    # Since we're packing data entries, we may not have the
-                    # corresponding history entries for them. It's not a big
-                    # deal, but the entries won't be delta'd perfectly.
-                    nohistory.append(node)
-            ui.progress(_("building history"), None)
-
-            # Order the nodes children first, so we can produce reverse deltas
-            orderednodes = list(reversed(self._toposort(ancestors)))
-            orderednodes.extend(sorted(nohistory))
-
-            # Compute deltas and write to the pack
-            deltabases = defaultdict(lambda: (nullid, 0))
-            nodes = set(nodes)
-            for i, node in enumerate(orderednodes):
-                # orderednodes is all ancestors, but we only want to serialize
-                # the files we have.
-                if node not in nodes:
-                    continue
+        ui.progress(_("repacking data"), None)
+        target.close(ledger=ledger)
 
-                if self.garbagecollect:
-                    # If the node is old and is not in the keepset
-                    # we skip it and mark as garbage collected
-                    if ((filename, node) not in self.keepkeys and
-                                        self.isold(self.repo, filename, node)):
-                        entries[node].gced = True
-                        continue
+    def _repackfiledata(self, filename, entries, target, progress=True):
+        """Writes the data entries of one file to the target pack, as deltas
+        against their children. ``entries`` maps node to repackentry."""
+        ui = self.repo.ui
+        maxchainlen = ui.configint('packs', 'maxchainlen', 1000)
+        uiprogress = ui.progress
+        if not progress:
+            # Partitions are repacked in worker processes, which must not
+            # draw over the parent's progress bar.
+            uiprogress = lambda *args, **kwargs: None
+
+        ancestors = {}
+        nodes = list(node for node in entries.iterkeys())
+        nohistory = []
+        for i, node in enumerate(nodes):
+            if node in ancestors:
+                continue
+            uiprogress(_("building history"), i, unit='nodes',
+                       total=len(nodes))
+            try:
+                ancestors.update(self.history.getancestors(filename, node,
+                                                           known=ancestors))
+            except KeyError:
+                # Since we're packing data entries, we may not have the
+                # corresponding history entries for them. It's not a big
+                # deal, but the entries won't be delta'd perfectly.
+                nohistory.append(node)
+        uiprogress(_("building history"), None)
+
+        # Order the nodes children first, so we can produce reverse deltas
+        orderednodes = list(reversed(self._toposort(ancestors)))
+        orderednodes.extend(sorted(nohistory))
+
+        chooser = None
+        if ui.configbool('packs', 'costmodel'):
+            chooser = deltabasechooser(
+                self.data, filename, maxchainlen,
+                ui.configbytes('packs', 'chaincost', '256B'),
+                ui.configbytes('remotefilelog', 'textcachesize', '64MB'))
+
+        # Compute deltas and write to the pack
+        deltabases = defaultdict(lambda: (nullid, 0))
+        nodes = set(nodes)
+        for i, node in enumerate(orderednodes):
+            # orderednodes is all ancestors, but we only want to serialize
+            # the files we have.
+            if node not in nodes:
+                continue
+
+            if self.garbagecollect:
+                # If the node is old and is not in the keepset
+                # we skip it and mark as garbage collected
+                if (_keepkey(filename, node) not in self.keepkeys and
+                                    self.isold(self.repo, filename, node)):
+                    entries[node].gced = True
+                    continue
 
-                ui.progress(_("processing nodes"), i, unit='nodes',
-                            total=len(orderednodes))
+            uiprogress(_("processing nodes"), i, unit='nodes',
+                       total=len(orderednodes))
+            if chooser:
+                deltabase, delta = chooser.choose(node, ancestors.get(node))
+            else:
                 # Find delta base
                 # TODO: allow delta'ing against most recent descendant instead
                 # of immediate child
                 deltabase, chainlen = deltabases[node]
 
-                # Use available ancestor information to inform our delta choices
+                # Use available ancestor information to inform our delta
+                # choices
                 ancestorinfo = ancestors.get(node)
                 if ancestorinfo:
                     p1, p2, linknode, copyfrom = ancestorinfo
@@ -442,16 +591,13 @@ class repacker(object):
 
                 # TODO: don't use the delta if it's larger than the fulltext
                 # TODO: don't use the delta if the chain is already long
-                meta = self.data.getmeta(filename, node)
-                target.add(filename, node, deltabase, delta, meta)
 
-                entries[node].datarepacked = True
+            meta = self.data.getmeta(filename, node)
+            target.add(filename, node, deltabase, delta, meta)
 
-            ui.progress(_("processing nodes"), None)
-            count += 1
+            entries[node].datarepacked = True
 
-        ui.progress(_("repacking data"), None)
-        target.close(ledger=ledger)
+        uiprogress(_("processing nodes"), None)
 
     def repackhistory(self, ledger, target):
         ui = self.repo.ui
@@ -463,53 +609,186 @@ class repacker(object):
 
         count = 0
         for filename, entries in sorted(byfile.iteritems()):
-            ancestors = {}
-            nodes = list(node for node in entries.iterkeys())
+            self._repackfilehistory(filename, entries, target)
+            count += 1
+            ui.progress(_("repacking history"), count, unit=self.unit,
+                        total=len(byfile))
 
-            for node in nodes:
-                if node in ancestors:
-                    continue
-                ancestors.update(self.history.getancestors(filename, node,
-                                                           known=ancestors))
+        ui.progress(_("repacking history"), None)
+        target.close(ledger=ledger)
 
-            # Order the nodes children first
-            orderednodes = reversed(self._toposort(ancestors))
-
-            # Write to the pack
-            dontprocess = set()
-            for node in orderednodes:
-                p1, p2, linknode, copyfrom = ancestors[node]
-
-                # If the node is marked dontprocess, but it's also in the
-                # explicit entries set, that means the node exists both in this
-                # file and in another file that was copied to this file.
-                # Usually this happens if the file was copied to another file,
-                # then the copy was deleted, then reintroduced without copy
-                # metadata. The original add and the new add have the same hash
-                # since the content is identical and the parents are null.
-                if node in dontprocess and node not in entries:
-                    # If copyfrom == filename, it means the copy history
-                    # went to come other file, then came back to this one, so we
-                    # should continue processing it.
-                    if p1 != nullid and copyfrom != filename:
-                        dontprocess.add(p1)
-                    if p2 != nullid:
-                        dontprocess.add(p2)
-                    continue
+    def _repackfilehistory(self, filename, entries, target):
+        """Writes the history of one file to the target pack. ``entries``
+        maps node to repackentry."""
+        ancestors = {}
+        nodes = list(node for node in entries.iterkeys())
+
+        for node in nodes:
+            if node in ancestors:
+                continue
+            ancestors.update(self.history.getancestors(filename, node,
+                                                       known=ancestors))
 
-                if copyfrom:
+        # Order the nodes children first
+        orderednodes = reversed(self._toposort(ancestors))
+
+        # Write to the pack
+        dontprocess = set()
+        for node in orderednodes:
+            p1, p2, linknode, copyfrom = ancestors[node]
+
+            # If the node is marked dontprocess, but it's also in the
+            # explicit entries set, that means the node exists both in this
+            # file and in another file that was copied to this file.
+            # Usually this happens if the file was copied to another file,
+            # then the copy was deleted, then reintroduced without copy
+            # metadata. The original add and the new add have the same hash
+            # since the content is identical and the parents are null.
+            if node in dontprocess and node not in entries:
+                # If copyfrom == filename, it means the copy history
+                # went to come other file, then came back to this one, so we
+                # should continue processing it.
+                if p1 != nullid and copyfrom != filename:
                     dontprocess.add(p1)
+                if p2 != nullid:
+                    dontprocess.add(p2)
+                continue
 
-                target.add(filename, node, p1, p2, linknode, copyfrom)
+            if copyfrom:
+                dontprocess.add(p1)
 
-                if node in entries:
-                    entries[node].historyrepacked = True
+            target.add(filename, node, p1, p2, linknode, copyfrom)
 
-            count += 1
-            ui.progress(_("repacking history"), count, unit=self.unit,
-                        total=len(byfile))
+            if node in entries:
+                entries[node].historyrepacked = True
+
+    def repackpartitioned(self, ledger, targetdata, targethistory):
+        """Repacks the ledger in partitions that are processed in parallel by
+        worker processes.
+
+        The ledger is split by filename hash, and each partition is repacked
+        into its own temporary data and history pack. The partial packs are
+        then merged into the targets with a streaming k-way merge on filename,
+        so the result is the same as a serial repack. A worker only holds one
+        partition at a time, and remotefilelog.repackpartitionsize bounds how
+        many entries that is, unless a single file has more revisions than
+        that, since a file is never split across partitions.
+
+        Before forking, the ledger keys are only assigned to their partition.
+        Each worker looks up the entries of its own partitions in the ledger
+        it inherited.
+        """
+        ui = self.repo.ui
+        partitionsize = ui.configint('remotefilelog', 'repackpartitionsize',
+                                     100000)
+        count = max(ui.configint('worker', 'numcpus') or worker.countcpus(),
+                    (len(ledger.entries) + partitionsize - 1) // partitionsize)
+
+        partitions = _partitionkeys(ledger.entries, count, partitionsize)
+        ids = [p for p, keys in enumerate(partitions) if keys]
+
+        tempdir = tempfile.mkdtemp(prefix='repack-',
+                                   dir=targetdata.opener.base)
+        try:
+            # Flush before forking, so the workers don't write buffered output
+            # a second time.
+            ui.flush()
+            results = worker.worker(ui, WORKERCOST, self._repackpartitions,
+                                    (ledger, partitions, tempdir,
+                                     targetdata.VERSION),
+                                    ids)
+            datapacks = []
+            historypacks = []
+            done = 0
+            for i, paths in results:
+                done += 1
+                ui.progress(_("repacking partitions"), done, unit='partitions',
+                            total=len(ids))
+                datapath, historypath = paths.split('\0')
+                if datapath:
+                    datapacks.append((i, datapack.datapack(datapath)))
+                if historypath:
+                    historypacks.append((i,
+                                         historypack.historypack(historypath)))
+            ui.progress(_("repacking partitions"), None)
+
+            self._mergedata(ledger, datapacks, targetdata)
+            self._mergehistory(ledger, historypacks, targethistory)
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+        if self.garbagecollect:
+            # Every data entry of a partition was either written to its
+            # partial pack, or skipped by the garbage collection.
+            for entry in ledger.entries.itervalues():
+                if entry.datasource and not entry.datarepacked:
+                    entry.gced = True
+
+    def _repackpartitions(self, ledger, partitions, tempdir, version, ids):
+        """Repacks the given partitions into partial packs in tempdir. Runs in
+        the worker processes, and yields (partition, paths) for each
+        partition, where paths holds the partial data and history pack paths,
+        separated by a null byte.
+
+        ``partitions`` holds the ledger keys of each partition."""
+        ui = self.repo.ui
+        for i in ids:
+            datafiles = {}
+            historyfiles = {}
+            for key in partitions[i]:
+                entry = ledger.entries[key]
+                if entry.datasource:
+                    datafiles.setdefault(entry.filename, {})[entry.node] = entry
+                if entry.historysource:
+                    historyfiles.setdefault(entry.filename,
+                                            {})[entry.node] = entry
+
+            with datapack.mutabledatapack(ui, tempdir,
+                                          version=version) as dpack:
+                with historypack.mutablehistorypack(ui, tempdir) as hpack:
+                    for filename, entries in sorted(datafiles.iteritems()):
+                        self._repackfiledata(filename, entries, dpack,
+                                             progress=False)
+                    for filename, entries in sorted(historyfiles.iteritems()):
+                        self._repackfilehistory(filename, entries, hpack)
+
+                    datapath = dpack.close()
+                    historypath = hpack.close()
+
+            yield i, '%s\0%s' % (datapath or '', historypath or '')
+
+    def _mergedata(self, ledger, packs, target):
+        """Streams the entries of the partial data packs into target, in
+        filename order. ``packs`` is a list of (partition, datapack)."""
+        def packentries(partition, pack):
+            for seq, (filename, node, deltabase, rawentry) in enumerate(
+                    pack.iterrawentries()):
+                yield filename, partition, seq, node, deltabase, rawentry
+
+        # A file lives in a single partition, so the merge never compares
+        # past the partition, and a file's revisions keep their order.
+        merged = heapq.merge(*[packentries(i, p) for i, p in packs])
+        for filename, partition, seq, node, deltabase, rawentry in merged:
+            target.addraw(node, deltabase, rawentry)
+            ledger.entries[(filename, node)].datarepacked = True
+
+        target.close(ledger=ledger)
+
+    def _mergehistory(self, ledger, packs, target):
+        """Streams the entries of the partial history packs into target, in
+        filename order. ``packs`` is a list of (partition, historypack)."""
+        def packentries(partition, pack):
+            for seq, entry in enumerate(pack.iterentries()):
+                yield (entry[0], partition, seq) + entry[1:]
+
+        merged = heapq.merge(*[packentries(i, p) for i, p in packs])
+        for (filename, partition, seq, node, p1, p2, linknode,
+             copyfrom) in merged:
+            target.add(filename, node, p1, p2, linknode, copyfrom)
+            entry = ledger.entries.get((filename, node))
+            if entry is not None and entry.historysource:
+                entry.historyrepacked = True
 
-        ui.progress(_("repacking history"), None)
         target.close(ledger=ledger)
 
     def _toposort(self, ancestors):
@@ -0,0 +1,106 @@
+# revgraph.py - numbered revision graphs of remotefilelog files
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+from __future__ import absolute_import
+
+import array
+
+from mercurial import ancestor
+from mercurial.node import nullid
+
+# How many file graphs a metadata store keeps
+CACHESIZE = 1000
+
+class revgraph(object):
+    """The revisions of a file known so far, numbered so every revision
+    comes after its parents, like in a revlog.
+
+    The graph is built from ancestor maps as returned by
+    unionmetadatastore.getancestors, and only ever grows: a node is added
+    with all of its ancestors, so the ancestors of any node in the graph are
+    in it too. Renames are not followed, the parent of a renamed revision is
+    left out like remotefilectx.ancestor expects.
+
+    Parents are kept in two arrays indexed by revision, so the common
+    ancestor algorithms of mercurial.ancestor can walk the graph without
+    building a dict of every revision's parents.
+    """
+    def __init__(self):
+        self.nodemap = {}
+        self._nodes = []
+        self._p1s = array.array('i')
+        self._p2s = array.array('i')
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self.nodemap
+
+    def rev(self, node):
+        return self.nodemap[node]
+
+    def node(self, rev):
+        return self._nodes[rev]
+
+    def parentrevs(self, rev):
+        p1 = self._p1s[rev]
+        p2 = self._p2s[rev]
+        if p2 == -1:
+            if p1 == -1:
+                return []
+            return [p1]
+        if p1 == -1:
+            return [p2]
+        return [p1, p2]
+
+    def add(self, node, ancestors):
+        """Adds node and its ancestors to the graph. ancestors has to hold
+        the parents of the ancestors of node that aren't in the graph yet,
+        as {node: (p1, p2, linknode, copyfrom)}."""
+        nodemap = self.nodemap
+        if node in nodemap:
+            return
+
+        def parents(node):
+            p1, p2, linknode, copyfrom = ancestors[node]
+            result = []
+            if p1 != nullid and not copyfrom:
+                result.append(p1)
+            if p2 != nullid:
+                result.append(p2)
+            return result
+
+        # Walk depth first, and number each revision once its parents are
+        stack = [node]
+        while stack:
+            current = stack[-1]
+            if current in nodemap:
+                stack.pop()
+                continue
+            pending = [p for p in parents(current)
+                       if p not in nodemap and p in ancestors]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+
+            prevs = [nodemap.get(p, -1) for p in parents(current)] + [-1, -1]
+            nodemap[current] = len(self._nodes)
+            self._nodes.append(current)
+            self._p1s.append(prevs[0])
+            self._p2s.append(prevs[1])
+
+    def ancestor(self, a, b):
+        """Returns the revisions of the greatest common ancestors of a and
+        b, see mercurial.ancestor.ancestors."""
+        return ancestor.ancestors(self.parentrevs, self.nodemap[a],
+                                  self.nodemap[b])
+
+    def commonancestorsheads(self, a, b):
+        return ancestor.commonancestorsheads(self.parentrevs,
+                                             self.nodemap[a],
+                                             self.nodemap[b])
@@ -10,8 +10,9 @@ from mercurial.i18n import _
 from mercurial.node import hex, nullid, nullrev
 from mercurial import error, localrepo, util, match, scmutil
 from . import remotefilelog, remotefilectx, fileserverclient
+from . import bgprefetch
 import repack as repackmod
-import constants, shallowutil
+import ancestorcache, constants, shallowutil
 from contentstore import remotefilelogcontentstore, unioncontentstore
 from contentstore import remotecontentstore
 from metadatastore import remotefilelogmetadatastore, unionmetadatastore
@@ -92,10 +93,21 @@ def makeunionstores(repo):
                                                      cachemetadata)
 
     # Instantiate union stores
+    textcachesize = repo.ui.configbytes('remotefilelog', 'textcachesize',
+                                        '64MB')
     repo.contentstore = unioncontentstore(packcontentstore, cachecontent,
-            localcontent, remotecontent, writestore=localcontent)
+            localcontent, remotecontent, writestore=localcontent,
+            ui=repo.ui, textcachesize=textcachesize)
+    ancestors = None
+    if repo.ui.configbool('remotefilelog', 'ancestorcache'):
+        ancestors = ancestorcache.ancestorcache(repo.ui, packmetadatastore,
+            minentries=repo.ui.configint('remotefilelog',
+                                         'ancestorcache.minentries', 100),
+            maxentries=repo.ui.configint('remotefilelog',
+                                         'ancestorcache.maxentries', 1000000))
     repo.metadatastore = unionmetadatastore(packmetadatastore, cachemetadata,
-            localmetadata, remotemetadata, writestore=localmetadata)
+            localmetadata, remotemetadata, writestore=localmetadata,
+            ancestorcache=ancestors)
 
     fileservicedatawrite = cachecontent
     fileservicehistorywrite = cachecontent
@@ -175,6 +187,15 @@ def wraprepo(repo):
                                opts=None):
             """Runs prefetch in background with optional repack
             """
+            if self.ui.configbool('remotefilelog', 'prefetchdaemon'):
+                nodes = [self.changelog.node(r)
+                         for r in scmutil.revrange(self, [revs or '.'])]
+                bgprefetch.enqueue(self, nodes, repack=repack)
+                if self.ui.configbool('remotefilelog',
+                                      'prefetchdaemon.autostart', True):
+                    bgprefetch.start(self)
+                return
+
             cmd = util.hgcmd() + ['-R', repo.origroot, 'prefetch']
             if repack:
                 cmd.append('--repack')
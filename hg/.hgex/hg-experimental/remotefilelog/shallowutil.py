@@ -6,7 +6,7 @@
 # GNU General Public License version 2 or any later version.
 from __future__ import absolute_import
 
-import errno, hashlib, os, stat, struct, tempfile
+import errno, hashlib, os, stat, struct, sys, tempfile
 from mercurial import filelog, revlog, util, error
 from mercurial.i18n import _
 
@@ -14,6 +14,7 @@ from . import constants
 
 if os.name != 'nt':
     import grp
+    import resource
 
 def interposeclass(container, classname):
     '''Interpose a class into the hierarchies of all loaded subclasses. This
@@ -72,6 +73,18 @@ def getcachepackpath(repo, category):
 def getlocalpackpath(base, category):
     return os.path.join(base, 'packs', category)
 
+def getprefetchrevset(ui):
+    """Returns the revset prefetched by default: the working copy parent, the
+    draft commits, and the pullprefetch and bgprefetchrevs revsets."""
+    revset = ['.', 'draft()']
+    prefetchrevset = ui.config('remotefilelog', 'pullprefetch', None)
+    if prefetchrevset:
+        revset.append('(%s)' % prefetchrevset)
+    bgprefetchrevs = ui.config('remotefilelog', 'bgprefetchrevs', None)
+    if bgprefetchrevs:
+        revset.append('(%s)' % bgprefetchrevs)
+    return '+'.join(revset)
+
 def createrevlogtext(text, copyfrom=None, copyrev=None):
     """returns a string that matches the revlog contents in a
     traditional revlog
@@ -269,6 +282,34 @@ def ancestormap(raw):
 
     return mapping
 
+def splitdedupblob(raw):
+    """given a remotefilelog blob, return (stub, text) where stub is the blob
+    without its text, as stored for deduplicated blobs."""
+    offset, size, flags = parsesizeflags(raw)
+    return (constants.DEDUPMARKER + raw[:offset] + raw[offset + size:],
+            raw[offset:offset + size])
+
+def joindedupblob(stub, text):
+    """the reverse of splitdedupblob"""
+    stub = stub[len(constants.DEDUPMARKER):]
+    index = stub.index('\0') + 1
+    return stub[:index] + text + stub[index:]
+
+def readfileblob(path):
+    """read the remotefilelog blob at path, putting the text of deduplicated
+    blobs back in"""
+    raw = readfile(path)
+    if raw.startswith(constants.DEDUPMARKER):
+        try:
+            text = readfile(path + constants.DEDUPSUFFIX)
+        except IOError:
+            # a stub is useless without its text, remove it so the blob is
+            # fetched again
+            util.tryunlink(path)
+            raise
+        raw = joindedupblob(raw, text)
+    return raw
+
 def readfile(path):
     f = open(path, 'rb')
     try:
@@ -463,3 +504,15 @@ def mkstickygroupdir(ui, path):
             setstickygroupdir(path, gid, ui.warn)
     finally:
         os.umask(oldumask)
+
+def peakrss(children=False):
+    """Returns the peak resident set size of the process (or of its waited
+    for children) in bytes, or 0 if the platform doesn't report it."""
+    if os.name == 'nt':
+        return 0
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        # darwin reports bytes, everything else kilobytes
+        return maxrss
+    return maxrss * 1024
@@ -6,7 +6,8 @@
 # GNU General Public License version 2 or any later version.
 
 from mercurial.i18n import _
-from mercurial.node import nullid
+from mercurial.node import hex, nullid
+from mercurial import mdiff
 import constants
 import struct
 from collections import defaultdict
@@ -42,9 +43,18 @@ def sendpackpart(filename, history, data):
 def closepart():
     return '\0' * 10
 
-def receivepack(ui, fh, packpath):
+def receivepack(ui, fh, packpath, basestore=None):
+    """Writes the pack parts read from fh to a new data and history pack in
+    packpath, and returns the (filename, node) keys received for each.
+
+    Deltas against revisions outside the new pack, which getpackv2 sends, are
+    applied to their base read from ``basestore``, and the full texts are
+    stored. So the new pack is self-contained: an incremental repack or a gc
+    that removes the pack holding a base can't break it.
+    """
     receiveddata = []
     receivedhistory = []
+    applieddeltas = 0
     mkstickygroupdir(ui, packpath)
     totalcount = 0
     ui.progress(_("receiving pack"), totalcount)
@@ -63,6 +73,18 @@ def receivepack(ui, fh, packpath):
                     count += 1
 
                 for node, deltabase, delta in readdeltas(fh):
+                    if deltabase != nullid:
+                        try:
+                            base = basestore.get(filename, deltabase)
+                        except KeyError:
+                            # The base is gone, so the revision is left out
+                            # and fetched again when it's needed.
+                            ui.debug('missing delta base %s of %s:%s\n' %
+                                     (hex(deltabase), filename, hex(node)))
+                            continue
+                        delta = mdiff.patches(base, [delta])
+                        deltabase = nullid
+                        applieddeltas += 1
                     dpack.add(filename, node, deltabase, delta)
                     receiveddata.append((filename, node))
                     count += 1
@@ -89,6 +111,9 @@ def receivepack(ui, fh, packpath):
                     node, p1, p2, linknode, copyfrom = nodevalues[node]
                     hpack.add(filename, node, p1, p2, linknode, copyfrom)
     ui.progress(_("receiving pack"), None)
+    if applieddeltas:
+        ui.debug('applied %d received deltas to their bases\n' %
+                 applieddeltas)
 
     return receiveddata, receivedhistory
 
@@ -0,0 +1,165 @@
+# workerpool.py - ordered process pool for the file serving commands
+#
+# Copyright 2017 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+from __future__ import absolute_import
+
+import atexit, collections, multiprocessing, Queue, threading
+
+# The state worker processes build responses with. It's set before the pool
+# forks, so it's inherited instead of being pickled.
+_state = {}
+
+# The pools of this process, by repository root. A server process serves many
+# commands, and forking the workers again for each of them would cost more
+# than most of them take.
+_pools = {}
+
+def getpool(repo):
+    """Returns the worker pool serving files from repo in this process, or
+    None if the server is configured to build responses in its own process.
+
+    The workers are only forked once a request needs them, and see the
+    repository as it was then, so the pool is replaced when the changelog
+    changes.
+    """
+    ui = repo.ui
+    workers = ui.configint('remotefilelog', 'serverworkers', 0)
+    if workers <= 0:
+        return None
+    maxpending = ui.configint('remotefilelog', 'serverworkers.maxpending',
+                              workers * 4)
+    cl = repo.unfiltered().changelog
+    key = (workers, maxpending, len(cl), cl.tip())
+    pool = _pools.get(repo.root)
+    if pool is not None and pool.key != key:
+        pool.close()
+        pool = None
+    if pool is None:
+        pool = workerpool(workers, max(1, maxpending), repo=repo)
+        pool.key = key
+        _pools[repo.root] = pool
+    pool.minbatch = ui.configint('remotefilelog', 'serverworkers.minbatch', 16)
+    return pool
+
+@atexit.register
+def _closepools():
+    for pool in _pools.values():
+        pool.close()
+    _pools.clear()
+
+def _initworker(state):
+    _state.update(state)
+
+def _call(func, args):
+    return func(_state, *args)
+
+class done(object):
+    """A result that is already available, which can be put in the pipeline
+    between results still being computed, e.g. for a cache hit."""
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+class workerpool(object):
+    """A pool of worker processes running the expensive part of a request
+    stream, like building and compressing blobs, ahead of the responses being
+    written.
+
+    Results are always produced in the order of the requests, and at most
+    ``maxpending`` requests are being worked on at once, which bounds the
+    memory held by results waiting for the ones before them.
+
+    Functions run in the pool are called with the state the pool was created
+    with, followed by their arguments, and must be defined at the top level
+    of a module, so they can be pickled.
+
+    The worker processes are started by the first submit(), and live until
+    close().
+    """
+    def __init__(self, workers, maxpending, **state):
+        self.workers = workers
+        self.maxpending = maxpending
+        self._state = state
+        self._pool = None
+        # How many requests of a command are worked on in this process
+        # before the workers are used, see getpool
+        self.minbatch = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.close(abort=exctype is not None)
+
+    def close(self, abort=False):
+        pool = self._pool
+        if pool is None:
+            return
+        self._pool = None
+        if abort:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+    def submit(self, func, *args):
+        """Runs func(state, *args) in a worker, and returns an object whose
+        get() method waits for and returns the result."""
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, _initworker,
+                                              (self._state,))
+        return self._pool.apply_async(_call, (func, args))
+
+    def run(self, func, *args):
+        """Runs func(state, *args) in this process, and returns a done()
+        result, for requests too small to be worth sending to a worker."""
+        return done(func(self._state, *args))
+
+    def pipeline(self, requests, submit):
+        """Yields (request, result) for each of the given requests, in order.
+
+        ``submit(request)`` is called for each request and returns either
+        the result of submit() or a done() result. ``requests`` is consumed
+        in a separate thread, so the results of the requests received so far
+        are produced while waiting for more, which is what a client that
+        waits for responses before sending more requests needs.
+        """
+        # The reader stays at most maxpending requests ahead as well
+        queue = Queue.Queue(self.maxpending)
+        def read():
+            try:
+                for request in requests:
+                    queue.put((True, request))
+            except Exception as ex:
+                queue.put((False, ex))
+                return
+            queue.put((False, None))
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+
+        pending = collections.deque()
+        finished = False
+        while not finished or pending:
+            while not finished and len(pending) < self.maxpending:
+                try:
+                    ok, request = queue.get(block=not pending)
+                except Queue.Empty:
+                    break
+                if not ok:
+                    finished = True
+                    if request is not None:
+                        raise request
+                    break
+                pending.append((request, submit(request)))
+
+            if pending:
+                request, result = pending.popleft()
+                yield request, result.get()
+
+        reader.join()
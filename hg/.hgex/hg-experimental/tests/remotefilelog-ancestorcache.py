@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import silenttestrunner
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog import ancestorcache
+from remotefilelog import historypack
+from remotefilelog.historypack import historypackstore, mutablehistorypack
+from remotefilelog.metadatastore import unionmetadatastore
+
+from mercurial.node import nullid
+import mercurial.ui
+
+class countingstore(object):
+    """Wraps a store and counts the getancestors calls made on it."""
+    def __init__(self, store):
+        self.store = store
+        self.calls = 0
+
+        self.path = store.path
+
+    def getancestors(self, name, node, known=None):
+        self.calls += 1
+        return self.store.getancestors(name, node, known=known)
+
+    def getpackancestors(self, name, node, known=None):
+        self.calls += 1
+        return self.store.getpackancestors(name, node, known=known)
+
+class dictstore(object):
+    """A metadata store holding the ancestor maps it is given, like the
+    repo-local stores."""
+    def __init__(self, maps):
+        self.maps = maps
+
+    def getancestors(self, name, node, known=None):
+        return self.maps[(name, node)]
+
+class ancestorcachetests(unittest.TestCase):
+    def setUp(self):
+        self.packdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.packdir)
+
+    def getHash(self, content):
+        return hashlib.sha1(content).digest()
+
+    def createPack(self, filename, count, copyfrom=None, copynode=nullid):
+        """Creates a historypack holding a linear history of ``count``
+        revisions of ``filename`` and returns the nodes, oldest first."""
+        packer = mutablehistorypack(mercurial.ui.ui(), self.packdir)
+        nodes = []
+        p1 = copynode
+        for i in range(count):
+            node = self.getHash('%s%s' % (filename, i))
+            packer.add(filename, node, p1, nullid, self.getHash(str(i)),
+                       copyfrom if i == 0 else None)
+            nodes.append(node)
+            p1 = node
+        self.lastpack = packer.close()
+        return nodes
+
+    def createUnion(self, minentries=1, localstore=None):
+        store = countingstore(historypackstore(mercurial.ui.ui(),
+                                               self.packdir))
+        cache = ancestorcache.ancestorcache(mercurial.ui.ui(), store,
+                                            minentries=minentries)
+        stores = [store]
+        if localstore is not None:
+            stores.append(localstore)
+        return store, unionmetadatastore(*stores, ancestorcache=cache)
+
+    def removePack(self, pack):
+        for suffix in (historypack.PACKSUFFIX, historypack.INDEXSUFFIX):
+            os.remove(os.path.join(self.packdir, pack + suffix))
+
+    def testWriteRead(self):
+        node, p1, p2, link = [self.getHash(str(i)) for i in range(4)]
+        maps = {
+            ('foo', node): {node: (p1, nullid, link, None),
+                            p1: (nullid, nullid, link, None)},
+            ('bar', p2): {p2: (node, p1, link, 'foo'),
+                          link: (nullid, nullid, link, 'foo')},
+        }
+        path = os.path.join(self.packdir, 'test.ancestors')
+        packs = {
+            ('foo', node): frozenset(['\1' * 20]),
+            ('bar', p2): frozenset(['\1' * 20, '\2' * 20]),
+        }
+        entries = [(ancestorcache.keyhash(name, n), packs[(name, n)],
+                    ancestors)
+                   for (name, n), ancestors in maps.iteritems()]
+        ancestorcache.write(path, entries)
+
+        cache = ancestorcache.load(path)
+        self.assertEquals(len(cache), 2)
+        for (name, n), ancestors in maps.iteritems():
+            self.assertEquals(cache.get(name, n),
+                              (packs[(name, n)], ancestors))
+        self.assertEquals(cache.get('foo', p2), None)
+        self.assertEquals(cache.get('bar', node), None)
+        self.assertEquals(sorted(entries), list(cache.iterentries()))
+        cache.close()
+
+    def testCorruptFileIgnored(self):
+        path = os.path.join(self.packdir, 'test.ancestors')
+        with open(path, 'w') as f:
+            f.write('garbage')
+        self.assertEquals(ancestorcache.load(path), None)
+        self.assertEquals(ancestorcache.load(path + '-missing'), None)
+
+    def testUnionStoreUsesCache(self):
+        nodes = self.createPack('foo', 10)
+        store, union = self.createUnion()
+        expected = union.getancestors('foo', nodes[-1])
+        self.assertEquals(len(expected), 10)
+        union.flush()
+        self.assertTrue(os.path.exists(os.path.join(self.packdir,
+                                                    ancestorcache.FILENAME)))
+
+        # A new command reads the map back without touching the packs
+        store, union = self.createUnion()
+        self.assertEquals(union.getancestors('foo', nodes[-1]), expected)
+        self.assertEquals(store.calls, 0)
+        self.assertEquals(union._ancestorcache.hits, 1)
+
+        # Partial maps bypass the cache
+        union.getancestors('foo', nodes[-1], known=set([nodes[3]]))
+        self.assertEquals(store.calls, 1)
+
+    def testCopiesAreCached(self):
+        foonodes = self.createPack('foo', 3)
+        nodes = self.createPack('bar', 3, copyfrom='foo',
+                                copynode=foonodes[-1])
+        store, union = self.createUnion()
+        expected = union.getancestors('bar', nodes[-1])
+        self.assertEquals(len(expected), 6)
+        union.flush()
+
+        store, union = self.createUnion()
+        self.assertEquals(union.getancestors('bar', nodes[-1]), expected)
+        self.assertEquals(store.calls, 0)
+
+    def testNewPackKeepsEntries(self):
+        nodes = self.createPack('foo', 10)
+        store, union = self.createUnion()
+        union.getancestors('foo', nodes[-1])
+        union.flush()
+
+        self.createPack('bar', 2)
+        store, union = self.createUnion()
+        union.getancestors('foo', nodes[-1])
+        self.assertEquals(store.calls, 0)
+        self.assertEquals(union._ancestorcache.hits, 1)
+
+    def testRemovedPackInvalidates(self):
+        foonodes = self.createPack('foo', 4)
+        foopack = self.lastpack
+        barnodes = self.createPack('bar', 4)
+        store, union = self.createUnion()
+        union.getancestors('foo', foonodes[-1])
+        union.getancestors('bar', barnodes[-1])
+        union.flush()
+
+        # Only the map read from the removed pack is dropped
+        self.removePack(foopack)
+        store, union = self.createUnion()
+        cache = union._ancestorcache
+        self.assertEquals(cache.get('foo', foonodes[-1]), None)
+        self.assertEquals(len(cache.get('bar', barnodes[-1])), 4)
+
+    def testPackRemovedBeforeFlush(self):
+        nodes = self.createPack('foo', 10)
+        pack = self.lastpack
+        store, union = self.createUnion()
+        union.getancestors('foo', nodes[-1])
+
+        # The map was read from a pack that's gone, so it isn't written
+        self.removePack(pack)
+        union.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.packdir,
+                                                     ancestorcache.FILENAME)))
+
+    def testLocalStoresNotCached(self):
+        foonodes = self.createPack('foo', 3)
+        local = self.getHash('local')
+        localstore = dictstore({
+            ('foo', local): {local: (foonodes[-1], nullid, local, None)},
+        })
+        store, union = self.createUnion(localstore=localstore)
+        self.assertEquals(len(union.getancestors('foo', local)), 4)
+        union.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.packdir,
+                                                     ancestorcache.FILENAME)))
+
+    def testSmallHistoriesNotCached(self):
+        nodes = self.createPack('foo', 5)
+        store, union = self.createUnion(minentries=10)
+        union.getancestors('foo', nodes[-1])
+        union.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.packdir,
+                                                     ancestorcache.FILENAME)))
+
+    def testFlushKeepsExistingEntries(self):
+        foonodes = self.createPack('foo', 4)
+        barnodes = self.createPack('bar', 4)
+        store, union = self.createUnion()
+        union.getancestors('foo', foonodes[-1])
+        union.flush()
+
+        store, union = self.createUnion()
+        union.getancestors('bar', barnodes[-1])
+        union.flush()
+
+        store, union = self.createUnion()
+        union.getancestors('foo', foonodes[-1])
+        union.getancestors('bar', barnodes[-1])
+        self.assertEquals(store.calls, 0)
+
+    def testSmallFlushesWriteNewFile(self):
+        foonodes = self.createPack('foo', 40)
+        barnodes = self.createPack('bar', 2)
+        baznodes = self.createPack('baz', 4)
+        path = os.path.join(self.packdir, ancestorcache.FILENAME)
+        newpath = os.path.join(self.packdir, ancestorcache.NEWFILENAME)
+        store, union = self.createUnion()
+        union.getancestors('foo', foonodes[-1])
+        union.flush()
+        with open(path) as f:
+            content = f.read()
+
+        # A map much smaller than the cache goes to the new file
+        store, union = self.createUnion()
+        union.getancestors('bar', barnodes[-1])
+        union.flush()
+        with open(path) as f:
+            self.assertEquals(f.read(), content)
+        self.assertEquals(len(ancestorcache.load(newpath)), 1)
+
+        store, union = self.createUnion()
+        union.getancestors('foo', foonodes[-1])
+        union.getancestors('bar', barnodes[-1])
+        self.assertEquals(store.calls, 0)
+
+        # Once the new file is big enough, it's merged into the cache
+        union.getancestors('baz', baznodes[-1])
+        union.flush()
+        self.assertFalse(os.path.exists(newpath))
+        self.assertEquals(len(ancestorcache.load(path)), 3)
+
+    # perf test off by default since it's slow
+    def _testAncestorCachePerf(self):
+        print "Ancestor cache perf test"
+        filecount = 100
+        for revcount in [100, 1000, 10000]:
+            shutil.rmtree(self.packdir)
+            self.packdir = tempfile.mkdtemp()
+            heads = [(('file%s' % i), self.createPack('file%s' % i,
+                                                      revcount)[-1])
+                     for i in xrange(filecount)]
+
+            results = []
+            for enabled in (False, True):
+                store, union = self.createUnion()
+                if not enabled:
+                    union._ancestorcache = None
+                for name, node in heads:
+                    union.getancestors(name, node)
+                union.flush()
+
+                # Time a second command, which would read the cache file
+                store, union = self.createUnion()
+                if not enabled:
+                    union._ancestorcache = None
+                start = time.time()
+                for name, node in heads:
+                    union.getancestors(name, node)
+                results.append(time.time() - start)
+
+            print ("%s revisions: walk = %0.04f  cache = %0.04f" %
+                   (('%s' % revcount).rjust(5), results[0], results[1]))
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import silenttestrunner
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog import blobpack
+
+import mercurial.ui
+
+class blobpacktests(unittest.TestCase):
+    def setUp(self):
+        self.tempdirs = []
+
+    def tearDown(self):
+        for d in self.tempdirs:
+            shutil.rmtree(d)
+
+    def makeTempDir(self):
+        tempdir = tempfile.mkdtemp()
+        self.tempdirs.append(tempdir)
+        return tempdir
+
+    def getFakeHash(self):
+        return ''.join(chr(random.randint(0, 255)) for _ in range(20))
+
+    def createStore(self, path=None, segmentsize=1024 * 1024):
+        if path is None:
+            path = os.path.join(self.makeTempDir(), 'packs')
+        return blobpack.blobpackstore(mercurial.ui.ui(), path, segmentsize)
+
+    def addBlobs(self, store, count):
+        blobs = {}
+        for i in range(count):
+            key = ('foo%d' % (i % 3), self.getFakeHash())
+            blob = os.urandom(random.randint(1, 64))
+            store.add(key[0], key[1], blob)
+            blobs[key] = blob
+        return blobs
+
+    def segmentFiles(self, store, suffix):
+        return [f for f in os.listdir(store.path) if f.endswith(suffix)]
+
+    def testAddGet(self):
+        store = self.createStore()
+        blobs = self.addBlobs(store, 20)
+        for (path, node), blob in blobs.iteritems():
+            self.assertEquals(store.get(path, node), blob)
+            self.assertTrue(store.contains(path, node))
+        self.assertEquals(store.get('foo0', self.getFakeHash()), None)
+        self.assertFalse(store.contains('foo0', self.getFakeHash()))
+
+    def testOtherReader(self):
+        """A blob added by one process is found by the others."""
+        store = self.createStore()
+        other = self.createStore(store.path)
+        self.assertEquals(other.get('foo', self.getFakeHash()), None)
+
+        blobs = self.addBlobs(store, 10)
+        # Look the blobs up after the refresh rate, like a new request would
+        other._lastrefresh = 0
+        for (path, node), blob in blobs.iteritems():
+            self.assertEquals(other.get(path, node), blob)
+
+        more = self.addBlobs(store, 10)
+        other._lastrefresh = 0
+        for (path, node), blob in more.iteritems():
+            self.assertEquals(other.get(path, node), blob)
+
+    def testSealing(self):
+        store = self.createStore(segmentsize=200)
+        blobs = self.addBlobs(store, 50)
+        self.assertTrue(len(self.segmentFiles(store, blobpack.PACKSUFFIX)) > 1)
+
+        # Every process reads the same blobs, whether it saw the segments
+        # being written or only sealed
+        other = self.createStore(store.path)
+        for (path, node), blob in blobs.iteritems():
+            self.assertEquals(store.get(path, node), blob)
+            self.assertEquals(other.get(path, node), blob)
+        sealed = [s for s in other._segments.itervalues() if s.sealed]
+        self.assertTrue(sealed)
+
+        # Sealed indexes are sorted, with a fanout table
+        for seg in sealed:
+            with open(seg.path + blobpack.INDEXSUFFIX, 'rb') as fp:
+                fp.seek(blobpack.SORTEDSTART)
+                raw = fp.read()
+            hashes = [raw[i:i + 20] for i in
+                      range(0, len(raw), blobpack.INDEXENTRYLENGTH)]
+            self.assertEquals(hashes, sorted(hashes))
+
+    def testPartialIndexEntry(self):
+        """A reader never uses an index entry that is still being written."""
+        store = self.createStore()
+        blobs = self.addBlobs(store, 3)
+        indexpath = store._writerpath + blobpack.INDEXSUFFIX
+        with open(indexpath, 'ab') as fp:
+            fp.write('x' * (blobpack.INDEXENTRYLENGTH // 2))
+
+        other = self.createStore(store.path)
+        for (path, node), blob in blobs.iteritems():
+            self.assertEquals(other.get(path, node), blob)
+
+    def testNewSegmentPerProcess(self):
+        store = self.createStore()
+        self.addBlobs(store, 1)
+        firstwriter = store._writerpath
+
+        # A forked worker must not append to its parent's segment, which the
+        # parent still has open
+        parentwriter = store._writer
+        store._writerpid = -1
+        blobs = self.addBlobs(store, 1)
+        self.assertNotEquals(store._writerpath, firstwriter)
+        self.assertEquals(len(self.segmentFiles(store, blobpack.PACKSUFFIX)),
+                          2)
+        for (path, node), blob in blobs.iteritems():
+            self.assertEquals(store.get(path, node), blob)
+        parentwriter[0].close()
+        parentwriter[1].close()
+
+    def testReuseSegment(self):
+        """A segment is appended to by the next process once its writer is
+        done with it."""
+        store = self.createStore()
+        blobs = self.addBlobs(store, 5)
+        firstwriter = store._writerpath
+        store.close()
+
+        other = self.createStore(store.path)
+        blobs.update(self.addBlobs(other, 5))
+        self.assertEquals(other._writerpath, firstwriter)
+
+        # But not while it's in use
+        third = self.createStore(store.path)
+        blobs.update(self.addBlobs(third, 5))
+        self.assertNotEquals(third._writerpath, firstwriter)
+        other.close()
+        third.close()
+
+        reader = self.createStore(store.path)
+        for (path, node), blob in blobs.iteritems():
+            self.assertEquals(reader.get(path, node), blob)
+
+    def testTrim(self):
+        store = self.createStore(segmentsize=200)
+        old = self.addBlobs(store, 60)
+        for name in self.segmentFiles(store, blobpack.PACKSUFFIX):
+            os.utime(os.path.join(store.path, name), (0, 0))
+        new = self.addBlobs(store, 5)
+
+        # The new blobs are in at most two segments of less than 264 bytes
+        packs = len(self.segmentFiles(store, blobpack.PACKSUFFIX))
+        freed = store.trim(600)
+        self.assertTrue(freed > 0)
+        self.assertTrue(len(self.segmentFiles(store, blobpack.PACKSUFFIX)) <
+                        packs)
+        size = sum(os.path.getsize(os.path.join(store.path, name))
+                   for name in self.segmentFiles(store, blobpack.PACKSUFFIX))
+        self.assertTrue(size <= 600)
+
+        # The oldest blobs went first
+        self.assertTrue(any(store.get(path, node) is None
+                            for path, node in old))
+        for (path, node), blob in new.iteritems():
+            self.assertEquals(store.get(path, node), blob)
+
+    def testExpire(self):
+        # Every blob seals its segment
+        store = self.createStore(segmentsize=1)
+        old = self.addBlobs(store, 20)
+        for name in self.segmentFiles(store, blobpack.PACKSUFFIX):
+            os.utime(os.path.join(store.path, name), (0, 0))
+        store.close()
+        new = self.addBlobs(store, 1)
+
+        freed = store.expire(time.time() - 60)
+        self.assertTrue(freed > 0)
+        self.assertEquals(len(self.segmentFiles(store, blobpack.PACKSUFFIX)),
+                          1)
+        self.assertEquals(len(self.segmentFiles(store, blobpack.INDEXSUFFIX)),
+                          1)
+        for (path, node), blob in old.iteritems():
+            self.assertEquals(store.get(path, node), None)
+        for (path, node), blob in new.iteritems():
+            self.assertEquals(store.get(path, node), blob)
+
+    def testRemoveSkipsLockedSegments(self):
+        """Segments another process is still appending to are neither
+        expired nor trimmed."""
+        writer = self.createStore()
+        blobs = self.addBlobs(writer, 10)
+        for name in self.segmentFiles(writer, blobpack.PACKSUFFIX):
+            os.utime(os.path.join(writer.path, name), (0, 0))
+
+        other = self.createStore(writer.path)
+        self.assertEquals(other.expire(time.time() - 60), 0)
+        self.assertEquals(other.trim(0), 0)
+        self.assertEquals(len(self.segmentFiles(writer, blobpack.PACKSUFFIX)),
+                          1)
+        more = self.addBlobs(writer, 5)
+        blobs.update(more)
+        other._lastrefresh = 0
+        for (path, node), blob in blobs.iteritems():
+            self.assertEquals(other.get(path, node), blob)
+
+        # Once its writer is done with it, it can be removed
+        writer.close()
+        self.assertTrue(other.trim(0) > 0)
+        self.assertEquals(self.segmentFiles(writer, blobpack.PACKSUFFIX), [])
+
+    # perf test off by default since it's slow
+    def _testLookupPerf(self):
+        """Compares looking blobs up in a pack store and as loose files, the
+        way the server cache used to keep them."""
+        print "Server blob pack perf test"
+        count = 100000
+        keys = [('dir%d/file%d' % (i % 100, i), hashlib.sha1(str(i)).digest())
+                for i in range(count)]
+        blob = 'x' * 512
+
+        loosedir = self.makeTempDir()
+        start = time.time()
+        for path, node in keys:
+            filepath = os.path.join(loosedir, path, node.encode('hex'))
+            dirname = os.path.dirname(filepath)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(filepath, 'w') as f:
+                f.write(blob)
+        print "loose write:  %0.04f" % (time.time() - start)
+
+        store = self.createStore(segmentsize=16 * 1024 * 1024)
+        start = time.time()
+        for path, node in keys:
+            store.add(path, node, blob)
+        print "pack write:   %0.04f" % (time.time() - start)
+
+        random.shuffle(keys)
+        start = time.time()
+        for path, node in keys:
+            filepath = os.path.join(loosedir, path, node.encode('hex'))
+            with open(filepath) as f:
+                f.read()
+        print "loose read:   %0.04f" % (time.time() - start)
+
+        other = self.createStore(store.path)
+        start = time.time()
+        for path, node in keys:
+            other.get(path, node)
+        print "pack read:    %0.04f" % (time.time() - start)
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import os
+import socket
+import subprocess
+import sys
+import threading
+import unittest
+
+import silenttestrunner
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog import connectionbroker
+
+class relaytests(unittest.TestCase):
+    def setUp(self):
+        # cat stands in for hg serve --stdio, it echoes every request
+        self.proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, bufsize=0)
+        self.client, self.broker = socket.socketpair()
+        self.result = []
+        self.thread = threading.Thread(target=self.relay)
+        self.thread.start()
+
+    def tearDown(self):
+        self.client.close()
+        self.thread.join()
+        self.broker.close()
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def relay(self):
+        self.result.append(connectionbroker._relay(self.broker, self.proc))
+
+    def roundtrip(self, data):
+        self.client.sendall('%d\n%s' % (len(data), data))
+        received = ''
+        while len(received) < len(data):
+            received += self.client.recv(65536)
+        return received
+
+    def testRelease(self):
+        self.assertEquals(self.roundtrip('hello\n'), 'hello\n')
+        # Frames larger than the relay buffers are streamed through
+        data = os.urandom(3 * connectionbroker.CHUNKSIZE + 7)
+        self.assertEquals(self.roundtrip(data), data)
+
+        self.client.sendall('0\n')
+        self.thread.join()
+        self.assertEquals(self.result, [True])
+
+    def testDrop(self):
+        self.assertEquals(self.roundtrip('hello\n'), 'hello\n')
+        self.client.close()
+        self.thread.join()
+        self.assertEquals(self.result, [False])
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import silenttestrunner
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog.contentstore import textcache, unioncontentstore
+from remotefilelog.datapack import datapack, mutabledatapack
+
+from mercurial import mdiff
+from mercurial.node import nullid
+import mercurial.ui
+
+class countingstore(object):
+    """Wraps a store and counts the getdeltachain calls made on it."""
+    def __init__(self, store):
+        self.store = store
+        self.calls = 0
+
+    def getdeltachain(self, name, node):
+        self.calls += 1
+        return self.store.getdeltachain(name, node)
+
+    def getmissing(self, keys):
+        return self.store.getmissing(keys)
+
+class textcachetests(unittest.TestCase):
+    def setUp(self):
+        self.tempdirs = []
+
+    def tearDown(self):
+        for d in self.tempdirs:
+            shutil.rmtree(d)
+
+    def getHash(self, content):
+        return hashlib.sha1(content).digest()
+
+    def createChain(self, filename, count):
+        """Creates a pack holding a delta chain of ``count`` revisions of
+        ``filename`` and returns (pack, [(node, text),...])."""
+        packdir = tempfile.mkdtemp()
+        self.tempdirs.append(packdir)
+        packer = mutabledatapack(mercurial.ui.ui(), packdir)
+
+        revisions = []
+        lastnode = nullid
+        lasttext = ''
+        for i in range(count):
+            text = lasttext + 'line %s\n' % i
+            node = self.getHash(text)
+            if lastnode == nullid:
+                delta = text
+            else:
+                delta = mdiff.textdiff(lasttext, text)
+            packer.add(filename, node, lastnode, delta)
+            revisions.append((node, text))
+            lastnode, lasttext = node, text
+
+        return datapack(packer.close()), revisions
+
+    def testLRUEviction(self):
+        cache = textcache(10)
+        cache.set('a', '1234')
+        cache.set('b', '1234')
+        self.assertEquals(cache.get('a'), '1234')
+        cache.set('c', '1234')
+
+        # 'b' was the least recently used entry
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEquals(cache.size, 8)
+        self.assertEquals(cache.evictions, 1)
+
+        # Entries larger than the whole cache are never stored
+        cache.set('d', '12345678901')
+        self.assertFalse('d' in cache)
+        self.assertEquals(cache.get('d'), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def testGetUsesCache(self):
+        pack, revisions = self.createChain('foo', 20)
+        store = countingstore(pack)
+        union = unioncontentstore(store, textcachesize=1024 * 1024)
+
+        node, text = revisions[-1]
+        self.assertEquals(union.get('foo', node), text)
+        calls = store.calls
+
+        # The second read is served entirely from the cache
+        self.assertEquals(union.get('foo', node), text)
+        self.assertEquals(store.calls, calls)
+        self.assertEquals(union._textcache.hits, 1)
+
+    def testGetStopsAtCachedBase(self):
+        pack, revisions = self.createChain('foo', 20)
+        union = unioncontentstore(countingstore(pack),
+                                  textcachesize=1024 * 1024)
+
+        # Reading a revision caches it, and later revisions built on top of it
+        # only apply the deltas that follow it.
+        middle, middletext = revisions[10]
+        self.assertEquals(union.get('foo', middle), middletext)
+        for node, text in revisions:
+            self.assertEquals(union.get('foo', node), text)
+        self.assertTrue(union._textcache.hits > 0)
+
+    def testDisabledByDefault(self):
+        pack, revisions = self.createChain('foo', 5)
+        union = unioncontentstore(pack)
+        self.assertEquals(union._textcache, None)
+        for node, text in revisions:
+            self.assertEquals(union.get('foo', node), text)
+
+    def testMissingKeyThrows(self):
+        pack, revisions = self.createChain('foo', 5)
+        union = unioncontentstore(pack, textcachesize=1024 * 1024)
+        self.assertRaises(KeyError, union.get, 'foo', self.getHash('missing'))
+
+    def testBytesCopied(self):
+        pack, revisions = self.createChain('foo', 20)
+        union = unioncontentstore(pack, ui=mercurial.ui.ui())
+        node, text = revisions[-1]
+        self.assertEquals(union.get('foo', node), text)
+
+        # The full text base, every delta, and the result are built once
+        chain = pack.getdeltachain('foo', node)
+        expected = sum(len(entry[4]) for entry in chain) + len(text)
+        self.assertEquals(union.gets, 1)
+        self.assertEquals(union.bytescopied, expected)
+
+        union.logstats()
+        self.assertEquals((union.gets, union.bytescopied), (0, 0))
+
+    # perf test off by default since it's slow
+    def _testGetPerf(self):
+        print "Content store get perf test"
+        for count in [100, 1000, 5000]:
+            pack, revisions = self.createChain('foo', count)
+            union = unioncontentstore(pack)
+            node, text = revisions[-1]
+            start = time.time()
+            union.get('foo', node)
+            elapsed = time.time() - start
+            print ("%s revisions: get = %0.04f  copied = %s bytes" %
+                   (('%s' % count).rjust(4), elapsed, union.bytescopied))
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
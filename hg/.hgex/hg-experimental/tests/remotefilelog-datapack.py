@@ -17,6 +17,7 @@ sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
 
 from remotefilelog.datapack import (
     datapack,
+    datapackstore,
     fastdatapack,
     mutabledatapack,
 )
@@ -25,7 +26,7 @@ from remotefilelog.basepack import (
     SMALLFANOUTPREFIX,
     LARGEFANOUTPREFIX,
 )
-from remotefilelog import constants
+from remotefilelog import constants, multipackindex
 
 from mercurial.node import nullid
 import mercurial.ui
@@ -212,6 +213,45 @@ class datapacktestsbase(object):
         missing = pack.getmissing([("foo", revisions[0][1]), ("foo", fakenode)])
         self.assertEquals(missing, [("foo", fakenode)])
 
+    def testGetMissingBatch(self):
+        """Test getmissing() with batches that are both sparse and dense
+        relative to the pack, including duplicate keys.
+        """
+        random.seed(0)
+        revisions = []
+        for i in range(5000):
+            content = "content-%s" % i
+            revisions.append(("filename-%s" % i, self.getHash(content), nullid,
+                              content))
+        pack = self.createPack(revisions)
+
+        keys = [(r[0], r[1]) for r in revisions]
+        for size in (1, 10, 100, 5000):
+            fakekeys = [("fake", self.getFakeHash()) for i in range(size / 2)]
+            batch = random.sample(keys, size) + fakekeys
+            batch.extend(batch[:3])
+            random.shuffle(batch)
+
+            missing = pack.getmissing(batch)
+            self.assertEquals(missing, [k for k in batch if k in fakekeys])
+
+    def testGetMissingGenerator(self):
+        """Test getmissing() with keys passed as a generator, like the tree
+        prefetching does.
+        """
+        revisions = [("foo", self.getHash("content"), nullid, "content")]
+        pack = self.createPack(revisions)
+
+        fakenode = self.getFakeHash()
+        keys = [("foo", revisions[0][1]), ("foo", fakenode)]
+        missing = pack.getmissing(key for key in keys)
+        self.assertEquals(missing, [("foo", fakenode)])
+
+        # Large enough to be answered by scanning the index
+        keys = [("foo", self.getFakeHash()) for i in range(10)]
+        missing = pack.getmissing(key for key in keys)
+        self.assertEquals(missing, keys)
+
     def testAddThrows(self):
         pack = self.createPack()
 
@@ -320,11 +360,187 @@ class datapacktestsbase(object):
         # so the user sees the output.
         raise RuntimeError("perf test always fails")
 
+class multipackindextests(unittest.TestCase):
+    def setUp(self):
+        self.packdir = tempfile.mkdtemp()
+        self.ui = mercurial.ui.ui()
+        self.ui.setconfig('remotefilelog', 'multipackindex', True)
+
+    def tearDown(self):
+        shutil.rmtree(self.packdir)
+
+    def getHash(self, content):
+        return hashlib.sha1(content).digest()
+
+    def createPack(self, revisions):
+        packer = mutabledatapack(mercurial.ui.ui(), self.packdir)
+        for filename, node, base, content in revisions:
+            packer.add(filename, node, base, content)
+        return packer.close()
+
+    def createPacks(self, packcount, revcount):
+        revisions = []
+        for i in xrange(packcount):
+            packrevs = []
+            for j in xrange(revcount):
+                content = "content-%s-%s" % (i, j)
+                packrevs.append(("filename-%s" % j, self.getHash(content),
+                                 nullid, content))
+            self.createPack(packrevs)
+            revisions.extend(packrevs)
+        return revisions
+
+    def midxpath(self):
+        return os.path.join(self.packdir, 'datapack' + multipackindex.SUFFIX)
+
+    def testStoreWritesIndex(self):
+        revisions = self.createPacks(5, 10)
+        store = datapackstore(self.ui, self.packdir)
+
+        midx = multipackindex.multipackindex(self.midxpath())
+        self.assertEquals(len(midx.packnames), 5)
+        self.assertEquals(len(midx), 50)
+        for filename, node, base, content in revisions:
+            self.assertTrue(node in midx)
+            self.assertEquals(len(midx.getpacknames(node)), 1)
+            chain = store.getdeltachain(filename, node)
+            self.assertEquals(content, chain[0][4])
+
+        fakenode = self.getHash('not in any pack')
+        self.assertFalse(fakenode in midx)
+        keys = [(f, n) for f, n, b, c in revisions] + [('foo', fakenode)]
+        self.assertEquals(store.getmissing(keys), [('foo', fakenode)])
+
+    def testDuplicateNodes(self):
+        revisions = [("foo", self.getHash("content"), nullid, "content")]
+        self.createPack(revisions)
+        self.createPack(revisions + [("bar", self.getHash("bar"), nullid,
+                                      "bar")])
+        store = datapackstore(self.ui, self.packdir)
+
+        node = revisions[0][1]
+        self.assertEquals(len(store._midx.getpacknames(node)), 2)
+        self.assertEquals(store.getmissing([("foo", node)]), [])
+        self.assertEquals(store.getdeltachain("foo", node)[0][4], "content")
+
+    def testRefreshUpdatesIndex(self):
+        self.createPacks(2, 10)
+        store = datapackstore(self.ui, self.packdir)
+
+        content = "new content"
+        node = self.getHash(content)
+        self.createPack([("new", node, nullid, content)])
+        self.assertFalse(node in store._midx)
+
+        store.markforrefresh()
+        self.assertEquals(store.getmissing([("new", node)]), [])
+        self.assertTrue(node in store._midx)
+        self.assertEquals(len(store._midx.packnames), 3)
+        self.assertEquals(store._unindexedpacks, [])
+
+        # A new store uses the index written by the refresh as is.
+        store = datapackstore(self.ui, self.packdir)
+        self.assertEquals(len(store._midx.packnames), 3)
+        self.assertEquals(store.getdeltachain("new", node)[0][4], content)
+
+    def testRemovedPacksAreDropped(self):
+        self.createPacks(2, 10)
+        content = "removed content"
+        node = self.getHash(content)
+        path = self.createPack([("removed", node, nullid, content)])
+        datapackstore(self.ui, self.packdir)
+
+        os.unlink(path + '.datapack')
+        os.unlink(path + '.dataidx')
+        store = datapackstore(self.ui, self.packdir)
+        self.assertEquals(len(store._midx.packnames), 2)
+        self.assertFalse(node in store._midx)
+        self.assertEquals(store.getmissing([("removed", node)]),
+                          [("removed", node)])
+
+    def testCorruptIndexIsRebuilt(self):
+        revisions = self.createPacks(2, 10)
+        with open(self.midxpath(), 'w') as f:
+            f.write('garbage')
+
+        store = datapackstore(self.ui, self.packdir)
+        self.assertEquals(len(store._midx), 20)
+        for filename, node, base, content in revisions:
+            self.assertEquals(store.getdeltachain(filename, node)[0][4],
+                              content)
+
+    # perf test off by default since it's slow
+    def _testMultipackIndexPerf(self):
+        random.seed(0)
+        print "Multipack index perf test"
+        revcount = 1000
+        lookupcount = 10000
+        for packcount in [10, 100, 1000]:
+            shutil.rmtree(self.packdir)
+            self.packdir = tempfile.mkdtemp()
+            revisions = self.createPacks(packcount, revcount)
+            keys = [(rev[0], rev[1]) for rev in revisions]
+            random.shuffle(keys)
+            keys = keys[:lookupcount]
+
+            results = []
+            for enabled in (False, True):
+                ui = mercurial.ui.ui()
+                ui.setconfig('remotefilelog', 'multipackindex', enabled)
+                store = datapackstore(ui, self.packdir)
+
+                start = time.time()
+                store.getmissing(keys)
+                for name, node in keys[:lookupcount / 10]:
+                    store.getdeltachain(name, node)
+                results.append(time.time() - start)
+
+            print ("%s packs: per-pack = %0.04f  multipack index = %0.04f" %
+                   (('%s' % packcount).rjust(4), results[0], results[1]))
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
 class datapacktests(datapacktestsbase, unittest.TestCase):
     def __init__(self, *args, **kwargs):
         datapacktestsbase.__init__(self, datapack, True)
         unittest.TestCase.__init__(self, *args, **kwargs)
 
+    # perf test off by default since it's slow
+    def _testBatchLookupPerf(self):
+        random.seed(0)
+        print "Batch lookup perf test"
+        packsize = 1000000
+        revisions = []
+        for i in xrange(packsize):
+            filename = "filename-%s" % i
+            content = "content-%s" % i
+            revisions.append((filename, self.getHash(content), nullid,
+                              content))
+        pack = self.createPack(revisions)
+
+        keys = [(rev[0], rev[1]) for rev in revisions]
+        for lookupsize in [10000, 100000, 1000000]:
+            random.shuffle(keys)
+            batch = keys[:lookupsize]
+
+            start = time.time()
+            for name, node in batch:
+                pack._find(node)
+            single = time.time() - start
+
+            start = time.time()
+            pack.getmissing(batch)
+            batched = time.time() - start
+
+            print ("%s lookups: one by one = %0.04f  batched = %0.04f" %
+                   (('%s' % lookupsize).rjust(7), single, batched))
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
 class fastdatapacktests(datapacktestsbase, unittest.TestCase):
     def __init__(self, *args, **kwargs):
         datapacktestsbase.__init__(self, fastdatapack, False)
@@ -218,6 +218,42 @@ class histpacktests(unittest.TestCase):
         missing = pack.getmissing([("bar", fakenode)])
         self.assertEquals(missing, [("bar", fakenode)])
 
+    def testGetMissingBatch(self):
+        """Test getmissing() with a large batch of keys across many files,
+        including duplicate keys.
+        """
+        random.seed(0)
+        revisions = []
+        for i in range(50):
+            filename = "foo-%s" % i
+            for j in range(random.randint(1, 50)):
+                revisions.append((filename, self.getFakeHash(), nullid, nullid,
+                                  self.getFakeHash(), None))
+
+        pack = self.createPack(revisions)
+
+        keys = [(r[0], r[1]) for r in revisions]
+        fakekeys = [(r[0], self.getFakeHash()) for r in revisions[::3]]
+        fakekeys.append(("bar", revisions[0][1]))
+        allkeys = keys + fakekeys + keys[:10]
+        random.shuffle(allkeys)
+
+        missing = pack.getmissing(allkeys)
+        self.assertEquals(missing, [k for k in allkeys if k in fakekeys])
+
+    def testGetMissingGenerator(self):
+        """Test getmissing() with keys passed as a generator, like the tree
+        prefetching does.
+        """
+        revisions = [("foo", self.getFakeHash(), nullid, nullid,
+                      self.getFakeHash(), None)]
+        pack = self.createPack(revisions)
+
+        fakenode = self.getFakeHash()
+        keys = [("foo", revisions[0][1]), ("foo", fakenode), ("bar", fakenode)]
+        missing = pack.getmissing(key for key in keys)
+        self.assertEquals(missing, [("foo", fakenode), ("bar", fakenode)])
+
     def testAddThrows(self):
         pack = self.createPack()
 
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import random
+import sys
+import time
+import unittest
+
+import silenttestrunner
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog import keepset
+
+from mercurial import manifest
+
+class fakectx(object):
+    def __init__(self, repo, rev, p1, mf):
+        self._repo = repo
+        self._rev = rev
+        self._p1 = p1
+        self._mf = mf
+
+    def manifest(self):
+        self._repo.manifestreads += 1
+        return self._mf
+
+    def p1(self):
+        return self._repo[self._p1]
+
+    def rev(self):
+        return self._rev
+
+class fakerepo(object):
+    """A linear history of manifests, indexed by rev, where each rev changes
+    a few files of its parent."""
+    def __init__(self, filecount, revcount, changes):
+        self.manifestreads = 0
+        self._ctxs = {}
+        mf = manifest.manifestdict()
+        for i in range(filecount):
+            mf['dir%d/file%d' % (i % 10, i)] = self.getFakeHash()
+        for rev in range(revcount):
+            mf = mf.copy()
+            for i in random.sample(range(filecount), changes):
+                mf['dir%d/file%d' % (i % 10, i)] = self.getFakeHash()
+            self._ctxs[rev] = fakectx(self, rev, rev - 1, mf)
+        self._ctxs[-1] = fakectx(self, -1, -1, manifest.manifestdict())
+
+    def getFakeHash(self):
+        return ''.join(chr(random.randint(0, 255)) for _ in range(20))
+
+    def __getitem__(self, rev):
+        return self._ctxs[rev]
+
+def keyfn(path, fnode):
+    return '%s\0%s' % (path, fnode)
+
+class keepsettests(unittest.TestCase):
+    def testContains(self):
+        keys = ['key%d' % i for i in range(1000)]
+        keep = keepset.keepset()
+        for key in keys[:500]:
+            keep.add(key)
+        keep.add(keys[0])
+        self.assertEquals(len(keep), 500)
+        for key in keys[:500]:
+            self.assertTrue(key in keep)
+        for key in keys[500:]:
+            self.assertFalse(key in keep)
+
+        # Keys can still be added after the set was queried
+        keep.add(keys[700])
+        self.assertTrue(keys[700] in keep)
+        self.assertTrue(keys[10] in keep)
+        self.assertEquals(len(keep), 501)
+
+    def testMergeRuns(self):
+        """Keys are merged into sorted runs as they are added, without
+        keeping more than PENDINGLIMIT of them as strings."""
+        oldlimit = keepset.PENDINGLIMIT
+        keepset.PENDINGLIMIT = 10
+        try:
+            keys = ['key%d' % i for i in range(1000)]
+            keep = keepset.keepset()
+            for i, key in enumerate(keys[:500]):
+                keep.add(key)
+                # Duplicates end up in different runs
+                keep.add(keys[i // 2])
+                self.assertTrue(len(keep._pending) < 10)
+            self.assertTrue(len(keep._runs) < 10)
+            for run in keep._runs:
+                hashes = [run[i:i + 20] for i in range(0, len(run), 20)]
+                self.assertEquals(hashes, sorted(set(hashes)))
+
+            self.assertEquals(len(keep), 500)
+            self.assertEquals(len(keep._runs), 1)
+            for key in keys[:500]:
+                self.assertTrue(key in keep)
+            for key in keys[500:]:
+                self.assertFalse(key in keep)
+        finally:
+            keepset.PENDINGLIMIT = oldlimit
+
+    def testEmpty(self):
+        keep = keepset.keepset()
+        self.assertEquals(len(keep), 0)
+        self.assertFalse('key' in keep)
+
+    def testAddRevs(self):
+        repo = fakerepo(200, 30, 3)
+        revs = [0, 3, 4, 5, 12, 25]
+
+        keep = keepset.keepset()
+        keepset.addrevs(keep, repo, revs, keyfn)
+
+        expected = set()
+        for rev in revs:
+            for path, fnode in repo[rev].manifest().iteritems():
+                expected.add(keyfn(path, fnode))
+        for key in expected:
+            self.assertTrue(key in keep)
+        self.assertEquals(len(keep), len(expected))
+
+        # Files that only changed in revisions that aren't kept are not
+        mf = repo[28].manifest()
+        dropped = [keyfn(path, fnode) for path, fnode in mf.iteritems()
+                   if keyfn(path, fnode) not in expected]
+        self.assertTrue(dropped)
+        for key in dropped:
+            self.assertFalse(key in keep)
+
+    # perf test off by default since it's slow
+    def _testAddRevsPerf(self):
+        """Compares the keepset to a set of the cache key strings, the way
+        hg gc used to compute it."""
+        print "Keepset perf test"
+        repo = fakerepo(100000, 50, 20)
+        revs = range(50)
+        def getcachekey(path, fnode):
+            pathhash = hashlib.sha1(path).hexdigest()
+            return os.path.join('repo', pathhash[:2], pathhash[2:],
+                                fnode.encode('hex'))
+
+        start = time.time()
+        keepkeys = set()
+        for rev in revs:
+            for path, fnode in repo[rev].manifest().iteritems():
+                keepkeys.add(getcachekey(path, fnode))
+        print "set of strings: %0.04f (%d keys, %d bytes)" % (
+            time.time() - start, len(keepkeys),
+            sys.getsizeof(keepkeys) + sum(sys.getsizeof(k) for k in keepkeys))
+
+        start = time.time()
+        keep = keepset.keepset()
+        keepset.addrevs(keep, repo, revs, getcachekey)
+        count = len(keep)
+        print "keepset:        %0.04f (%d keys, %d bytes)" % (
+            time.time() - start, count, sys.getsizeof(keep._runs[0]))
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import silenttestrunner
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog import blobpack, localcacheclient
+
+import mercurial.ui
+
+class localcacheclienttests(unittest.TestCase):
+    def setUp(self):
+        self.tempdirs = []
+
+    def tearDown(self):
+        for d in self.tempdirs:
+            shutil.rmtree(d)
+
+    def makeTempDir(self):
+        tempdir = tempfile.mkdtemp()
+        self.tempdirs.append(tempdir)
+        return tempdir
+
+    def getFakeId(self, i):
+        pathhash = hashlib.sha1('file%d' % i).hexdigest()
+        node = hashlib.sha1(str(random.random())).hexdigest()
+        return os.path.join('repo', pathhash[:2], pathhash[2:], node)
+
+    def createStore(self, path=None):
+        if path is None:
+            path = os.path.join(self.makeTempDir(), 'packs')
+        return blobpack.blobpackstore(mercurial.ui.ui(), path,
+                                      localcacheclient.segmentsize)
+
+    def writeBlobs(self, cachepath, ids):
+        blobs = {}
+        for id in ids:
+            blob = 'blob of %s\0' % id + os.urandom(random.randint(1, 64))
+            localcacheclient.cacheclient.writefile(
+                os.path.join(cachepath, id), blob)
+            blobs[id] = blob
+        return blobs
+
+    def request(self, func, ids, *args):
+        localcacheclient.stdin = StringIO('%d\n%s' % (
+            len(ids), ''.join(id + '\n' for id in ids)))
+        localcacheclient.stdout = StringIO()
+        func(*args)
+        return localcacheclient.stdout.getvalue().splitlines()
+
+    def testSetGet(self):
+        store = self.createStore()
+        ids = [self.getFakeId(i) for i in range(10)]
+        cachepath = self.makeTempDir()
+        blobs = self.writeBlobs(cachepath, ids[:5])
+        self.request(localcacheclient.setKeys, ids[:5], store, cachepath, 0)
+
+        # Another process gets the blobs, and reports the misses
+        other = self.createStore(store.path)
+        destpath = self.makeTempDir()
+        output = self.request(localcacheclient.getKeys, ids, other, destpath)
+        self.assertEquals(sorted(output[:-2]), sorted(ids[5:]))
+        self.assertEquals(output[-2:], ['_hits_5_', '0'])
+        for id, blob in blobs.iteritems():
+            with open(os.path.join(destpath, id)) as f:
+                self.assertEquals(f.read(), blob)
+
+    def testIncludePath(self):
+        store = self.createStore()
+        ids = [self.getFakeId(i) for i in range(2)]
+        cachepath = self.makeTempDir()
+        self.writeBlobs(cachepath, ids[:1])
+        self.request(localcacheclient.setKeys, ['file0\0' + ids[0]], store,
+                     cachepath, 0)
+
+        destpath = self.makeTempDir()
+        output = self.request(localcacheclient.getKeys,
+                              ['file%d\0%s' % (i, id)
+                               for i, id in enumerate(ids)],
+                              store, destpath)
+        self.assertEquals(output, [ids[1], '_hits_1_', '0'])
+        self.assertTrue(os.path.exists(os.path.join(destpath, ids[0])))
+
+    def testProgress(self):
+        """Progress is reported after each batch of lookups."""
+        store = self.createStore()
+        ids = [self.getFakeId(i) for i in range(25)]
+        cachepath = self.makeTempDir()
+        self.writeBlobs(cachepath, ids)
+        self.request(localcacheclient.setKeys, ids, store, cachepath, 0)
+
+        oldbatchsize = localcacheclient.batchsize
+        localcacheclient.batchsize = 10
+        try:
+            output = self.request(localcacheclient.getKeys, ids, store,
+                                  self.makeTempDir())
+        finally:
+            localcacheclient.batchsize = oldbatchsize
+        self.assertEquals(output, ['_hits_10_', '_hits_10_', '_hits_5_',
+                                   '0'])
+
+    def testMaxSize(self):
+        store = self.createStore()
+        store.segmentsize = 500
+        cachepath = self.makeTempDir()
+        for i in range(20):
+            ids = [self.getFakeId(i * 10 + j) for j in range(10)]
+            self.writeBlobs(cachepath, ids)
+            self.request(localcacheclient.setKeys, ids, store, cachepath,
+                         2000)
+        size = sum(os.path.getsize(os.path.join(store.path, f))
+                   for f in os.listdir(store.path)
+                   if f.endswith(blobpack.PACKSUFFIX))
+        self.assertTrue(size <= 2000)
+
+    # perf test off by default since it's slow
+    def _testGetPerf(self):
+        """Times get requests of 100k keys served from the store, against
+        copying the files from a loose file cache."""
+        print "Local cache process perf test"
+        count = 100000
+        ids = [self.getFakeId(i) for i in range(count)]
+        cachepath = self.makeTempDir()
+        self.writeBlobs(cachepath, ids)
+
+        store = self.createStore()
+        start = time.time()
+        self.request(localcacheclient.setKeys, ids, store, cachepath, 0)
+        print "set 100k keys:         %0.04f" % (time.time() - start)
+
+        random.shuffle(ids)
+        destpath = self.makeTempDir()
+        start = time.time()
+        for id in ids:
+            localcacheclient.cacheclient.writefile(
+                os.path.join(destpath, id),
+                localcacheclient.cacheclient.readfile(
+                    os.path.join(cachepath, id)))
+        print "copy 100k loose files: %0.04f" % (time.time() - start)
+
+        for i in range(2):
+            other = self.createStore(store.path)
+            destpath = self.makeTempDir()
+            start = time.time()
+            output = self.request(localcacheclient.getKeys, ids, other,
+                                  destpath)
+            elapsed = time.time() - start
+            print "get 100k keys:         %0.04f (%d keys/sec, %s)" % (
+                elapsed, count / elapsed, output[-2])
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
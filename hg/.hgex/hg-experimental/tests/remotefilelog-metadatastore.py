@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import silenttestrunner
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog.historypack import historypackstore, mutablehistorypack
+from remotefilelog.metadatastore import lazyancestormap, unionmetadatastore
+
+from mercurial.node import nullid
+import mercurial.ui
+
+class countingstore(object):
+    """Wraps a store and counts the getnodeinfo calls made on it."""
+    def __init__(self, store):
+        self.store = store
+        self.calls = 0
+
+    def getnodeinfo(self, name, node):
+        self.calls += 1
+        return self.store.getnodeinfo(name, node)
+
+    def getmissing(self, keys):
+        return self.store.getmissing(keys)
+
+    def markforrefresh(self):
+        self.store.markforrefresh()
+
+class lazyancestormaptests(unittest.TestCase):
+    def setUp(self):
+        self.packdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.packdir)
+
+    def getHash(self, content):
+        return hashlib.sha1(content).digest()
+
+    def createHistory(self, filename, count, copyfrom=None, copynode=nullid):
+        """Returns a linear history of ``count`` revisions of ``filename``
+        as (filename, node, p1, p2, linknode, copyfrom) entries, oldest
+        first."""
+        entries = []
+        p1 = copynode
+        for i in range(count):
+            node = self.getHash('%s%s' % (filename, i))
+            entries.append((filename, node, p1, nullid, self.getHash(str(i)),
+                            copyfrom if i == 0 else None))
+            p1 = node
+        return entries
+
+    def createPack(self, entries):
+        packer = mutablehistorypack(mercurial.ui.ui(), self.packdir)
+        for entry in entries:
+            packer.add(*entry)
+        packer.close()
+
+    def createUnion(self):
+        store = countingstore(historypackstore(mercurial.ui.ui(),
+                                               self.packdir))
+        return store, unionmetadatastore(store)
+
+    def testLoadsOnDemand(self):
+        entries = self.createHistory('foo', 100)
+        self.createPack(entries)
+        store, union = self.createUnion()
+        tip = entries[-1][1]
+        ancestormap = lazyancestormap(union, 'foo', tip)
+        self.assertEquals(len(ancestormap), 0)
+
+        node = tip
+        for i in range(10):
+            p1, p2, linknode, copyfrom = ancestormap[node]
+            self.assertEquals(linknode, self.getHash(str(99 - i)))
+            node = p1
+        self.assertEquals(len(ancestormap), 10)
+        self.assertEquals(store.calls, 10)
+
+        # Loaded entries are not read again
+        ancestormap[tip]
+        ancestormap.load([tip, node])
+        self.assertEquals(store.calls, 11)
+
+    def testUnknownNodes(self):
+        entries = self.createHistory('foo', 3)
+        self.createPack(entries)
+        store, union = self.createUnion()
+        ancestormap = lazyancestormap(union, 'foo', entries[-1][1])
+
+        # Nodes are only looked up once a descendant names their file
+        self.assertRaises(KeyError, ancestormap.__getitem__, entries[0][1])
+        self.assertEquals(ancestormap.get(entries[0][1]), None)
+        self.assertEquals(store.calls, 0)
+
+        ancestormap[entries[-1][1]]
+        ancestormap[entries[1][1]]
+        self.assertEquals(ancestormap.get(entries[0][1]), entries[0][2:])
+        self.assertEquals(ancestormap.get(self.getHash('bar')), None)
+
+    def testRenamesAreFollowed(self):
+        fooentries = self.createHistory('foo', 3)
+        entries = self.createHistory('bar', 3, copyfrom='foo',
+                                     copynode=fooentries[-1][1])
+        self.createPack(fooentries + entries)
+        store, union = self.createUnion()
+        ancestormap = lazyancestormap(union, 'bar', entries[-1][1])
+
+        node = entries[-1][1]
+        nodes = []
+        while node != nullid:
+            nodes.append(node)
+            node = ancestormap[node][0]
+        self.assertEquals(nodes, [e[1] for e in reversed(fooentries +
+                                                         entries)])
+
+    def testMissingNodesAreFetchedTogether(self):
+        entries = self.createHistory('foo', 4)
+        merge = ('foo', self.getHash('merge'), entries[1][1], entries[2][1],
+                 self.getHash('4'), None)
+        self.createPack(entries[-2:] + [merge])
+        store, union = self.createUnion()
+
+        fetches = []
+        def prefetch(keys):
+            fetches.append(sorted(keys))
+            self.createPack(entries[:2])
+            store.markforrefresh()
+
+        ancestormap = lazyancestormap(union, 'foo', merge[1],
+                                      prefetch=prefetch)
+        ancestormap.load([merge[1]])
+        self.assertEquals(fetches, [])
+
+        # Only the parent that isn't in the packs is fetched
+        ancestormap.load([merge[2], merge[3]])
+        self.assertEquals(fetches, [[('foo', entries[1][1])]])
+        self.assertEquals(len(ancestormap), 3)
+
+        ancestormap.load([entries[0][1], entries[1][2]])
+        self.assertEquals(len(fetches), 1)
+        self.assertEquals(len(ancestormap), 4)
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import os
+import random
+import sys
+import time
+import unittest
+
+import silenttestrunner
+
+import mercurial.ui
+
+# Load the local remotefilelog, not the system one
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from remotefilelog import workerpool
+from remotefilelog.lz4wrapper import lzcompresshc
+
+def square(state, value):
+    return state['offset'] + value * value
+
+def slowsquare(state, value):
+    # Finish the requests in a different order than they were submitted
+    time.sleep(random.random() / 100)
+    return square(state, value)
+
+def fail(state, value):
+    raise ValueError(value)
+
+def compress(state, index):
+    return len(lzcompresshc(state['blobs'][index % len(state['blobs'])]))
+
+class fakechangelog(list):
+    def tip(self):
+        return self[-1] if self else None
+
+class fakerepo(object):
+    def __init__(self, root, workers):
+        self.root = root
+        self.ui = mercurial.ui.ui()
+        self.ui.setconfig('remotefilelog', 'serverworkers', workers)
+        self.changelog = fakechangelog()
+
+    def unfiltered(self):
+        return self
+
+class workerpooltests(unittest.TestCase):
+    def testResultsAreOrdered(self):
+        with workerpool.workerpool(4, 8, offset=1) as pool:
+            submit = lambda value: pool.submit(slowsquare, value)
+            results = list(pool.pipeline(iter(range(50)), submit))
+        self.assertEquals(results, [(i, 1 + i * i) for i in range(50)])
+
+    def testDoneResults(self):
+        with workerpool.workerpool(2, 2, offset=0) as pool:
+            def submit(value):
+                if value % 2:
+                    return workerpool.done(-value)
+                return pool.submit(square, value)
+            results = [r for v, r in pool.pipeline(iter(range(6)), submit)]
+        self.assertEquals(results, [0, -1, 4, -3, 16, -5])
+
+    def testMaxPending(self):
+        # The requests are only read as fast as the results are consumed
+        read = []
+        def requests():
+            for i in range(20):
+                read.append(i)
+                yield i
+
+        with workerpool.workerpool(2, 3, offset=0) as pool:
+            submit = lambda value: pool.submit(square, value)
+            for value, result in pool.pipeline(requests(), submit):
+                submitted = len(read)
+                # Besides the pending requests, the reader's queue holds at
+                # most as many again, and the reader one more
+                self.assertTrue(submitted <= value + 1 + 3 * 2 + 1)
+
+    def testWorkersStartLazily(self):
+        with workerpool.workerpool(2, 2, offset=0) as pool:
+            self.assertEquals(pool.run(square, 3).get(), 9)
+            self.assertEquals(pool._pool, None)
+            self.assertEquals(pool.submit(square, 4).get(), 16)
+            self.assertNotEquals(pool._pool, None)
+
+    def testPoolIsReused(self):
+        self.assertEquals(workerpool.getpool(fakerepo('/repo', 0)), None)
+
+        repo = fakerepo('/repo', 2)
+        pool = workerpool.getpool(repo)
+        try:
+            self.assertEquals(pool.minbatch, 16)
+            pool.submit(square, 1)
+            self.assertTrue(workerpool.getpool(repo) is pool)
+
+            # Workers forked before a commit don't see it
+            repo.changelog.append('a')
+            newpool = workerpool.getpool(repo)
+            self.assertFalse(newpool is pool)
+            self.assertEquals(pool._pool, None)
+        finally:
+            workerpool._closepools()
+
+    def testWorkerErrorsAreRaised(self):
+        with workerpool.workerpool(2, 2) as pool:
+            submit = lambda value: pool.submit(fail, value)
+            self.assertRaises(ValueError, list,
+                              pool.pipeline(iter(range(3)), submit))
+
+    def testRequestErrorsAreRaised(self):
+        def requests():
+            yield 1
+            raise IOError('connection closed')
+
+        with workerpool.workerpool(2, 2, offset=0) as pool:
+            submit = lambda value: pool.submit(square, value)
+            results = pool.pipeline(requests(), submit)
+            self.assertRaises(IOError, list, results)
+
+    # perf test off by default since it's slow
+    def _testPipelinePerf(self):
+        """Synthetic getfiles load: compresses random blobs the way the server
+        does, serially and with pools of increasing size."""
+        print "Server worker pool perf test"
+        blobs = [os.urandom(64 * 1024) + 'x' * (192 * 1024)
+                 for i in range(16)]
+        requests = range(2000)
+
+        start = time.time()
+        state = {'blobs': blobs}
+        for i in requests:
+            compress(state, i)
+        serial = time.time() - start
+        print "serial:     %0.04f" % serial
+
+        for workers in [1, 2, 4, 8]:
+            with workerpool.workerpool(workers, workers * 4,
+                                       blobs=blobs) as pool:
+                submit = lambda value: pool.submit(compress, value)
+                start = time.time()
+                for x in pool.pipeline(iter(requests), submit):
+                    pass
+                elapsed = time.time() - start
+            print ("%s workers: %0.04f (%0.2fx)" %
+                   (str(workers).rjust(2), elapsed, serial / elapsed))
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
+if __name__ == '__main__':
+    silenttestrunner.main(__name__)
@@ -30,9 +30,13 @@ New errors are not allowed. Warnings are strongly discouraged.
   undocumented: fastmanifest.debugmetrics (bool)
   undocumented: fastmanifest.logfile (str)
   undocumented: fastmanifest.maxinmemoryentries (str) [DEFAULT_MAX_MEMORY_ENTRIES]
+  undocumented: fastmanifest.maxqueuedmisses (int) [10]
+  undocumented: fastmanifest.mmapcache (bool) [True]
+  undocumented: fastmanifest.sharedtreecachemb (int) [DEFAULT_MAX_SHARED_TREE_CACHE_MB]
   undocumented: fastmanifest.silent (bool)
   undocumented: fastmanifest.usecache (bool) [True]
   undocumented: fastmanifest.usetree (bool)
+  undocumented: fastmanifest.workerdelayms (int) [100]
   undocumented: fbconduit.backingrepos (list) [[reponame]]
   undocumented: fbconduit.gitcallsigns (list)
   undocumented: fbconduit.host (str)
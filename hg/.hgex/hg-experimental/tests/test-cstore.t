@@ -16,6 +16,15 @@ Get build path for native extensions
 
   $ $PYTHON $TESTDIR/remotefilelog-datapack.py
   $ $PYTHON $TESTDIR/remotefilelog-histpack.py
+  $ $PYTHON $TESTDIR/remotefilelog-contentstore.py
+  $ $PYTHON $TESTDIR/remotefilelog-ancestorcache.py
+  $ $PYTHON $TESTDIR/remotefilelog-revgraph.py
+  $ $PYTHON $TESTDIR/remotefilelog-metadatastore.py
+  $ $PYTHON $TESTDIR/remotefilelog-blobpack.py
+  $ $PYTHON $TESTDIR/remotefilelog-keepset.py
+  $ $PYTHON $TESTDIR/remotefilelog-localcacheclient.py
+  $ $PYTHON $TESTDIR/remotefilelog-connectionbroker.py
+  $ $PYTHON $TESTDIR/remotefilelog-workerpool.py
   $ $PYTHON $TESTDIR/cstore-datapackstore.py
   $ $PYTHON $TESTDIR/cstore-treemanifest.py
   $ $PYTHON $TESTDIR/cstore-uniondatapackstore.py
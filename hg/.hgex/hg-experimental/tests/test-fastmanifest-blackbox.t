@@ -30,6 +30,7 @@ Check diagnosis, debugging information
   > cacheonchange=True
   > cachecutoffdays=-1
   > randomorder=False
+  > maxqueuedmisses=0
   > EOF
 
   $ mkcommit a
@@ -44,13 +45,12 @@ Check diagnosis, debugging information
    FM: caching trigger: commit
    FM: triggering caching for $TESTTMP/cachetesting
    FM: trying to cache [1, 0]
-   FM: cached(rev,man) 1->a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7
    FM: skip(rev, man) 0->a0c8bcbbb45c63b90b70ad007bf38961f64f2af0
+   FM: cached(rev,man) 1->a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7
    FM: caching trigger: commit
    FM: triggering caching for $TESTTMP/cachetesting
-   FM: trying to cache [2, 1, 0]
-   FM: cached(rev,man) 2->e3738bf5439958f89499a656982023aba57b076e
+   FM: trying to cache [2, 1]
    FM: skip(rev, man) 1->a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7
-   FM: skip(rev, man) 0->a0c8bcbbb45c63b90b70ad007bf38961f64f2af0
+   FM: cached(rev,man) 2->e3738bf5439958f89499a656982023aba57b076e
    FM: caching trigger: commit
    FM: triggering caching for $TESTTMP/cachetesting
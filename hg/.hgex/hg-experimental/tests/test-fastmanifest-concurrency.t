@@ -25,6 +25,7 @@ Check diagnosis, debugging information
   > cachecutoffdays=-1
   > cacheonchange=True
   > cacheonchangebackground=True
+  > workerdelayms=0
   > EOF
   $ mkcommit a
   $ mkcommit b
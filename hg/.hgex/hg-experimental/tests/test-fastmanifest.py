@@ -1,7 +1,10 @@
 import silenttestrunner
 import unittest
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 import time
 
 from mercurial import error
@@ -169,6 +172,332 @@ class HybridManifest(unittest.TestCase):
             self.assertRaises(OSError,
                               lambda: vfs.lstat("lock"))
 
+class CacheIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.vfs = vfsmod.vfs(os.getcwd())
+        self.cachepath = self.vfs.join("manifestcache")
+        if not os.path.exists(self.cachepath):
+            os.makedirs(self.cachepath)
+        for name in os.listdir(self.cachepath):
+            os.unlink(os.path.join(self.cachepath, name))
+
+    def newindex(self):
+        return fastmanifest.cacheindex.cacheindex(self.vfs, self.cachepath,
+                                                  "fast")
+
+    def writeentry(self, hexnode, size, mtime):
+        path = os.path.join(self.cachepath, "fast" + hexnode)
+        with open(path, "wb") as f:
+            f.write("x" * size)
+        os.utime(path, (mtime, mtime))
+
+    def test_accounting(self):
+        index = self.newindex()
+        index.refresh()
+        # Nothing is written until there are entries
+        assert os.listdir(self.cachepath) == []
+
+        index.add("a", 10, 100.0)
+        index.add("b", 20, 300.0)
+        index.add("c", 30, 200.0)
+        assert index.totalsize() == 60
+        assert index.size("b") == 20
+        assert index.sorted() == ["b", "c", "a"]
+
+        index.touch("a", 400.0)
+        index.remove("c")
+        assert "c" not in index
+        assert index.totalsize() == 30
+        assert index.sorted() == ["a", "b"]
+        assert index.leastrelevant() == "b"
+        assert index.leastrelevant(set(["b"])) == "a"
+        assert index.leastrelevant(set(["a", "b"])) is None
+
+        # Other processes read the same index
+        other = self.newindex()
+        assert other.sorted() == ["a", "b"]
+        assert other.totalsize() == 30
+        index.add("d", 5, 500.0)
+        assert other.sorted() == ["d", "a", "b"]
+
+    def test_ties(self):
+        index = self.newindex()
+        for hexnode in ["b", "a", "c"]:
+            index.add(hexnode, 1, 100.0)
+        # like the mtime ordering, ties are broken by name
+        assert index.sorted() == ["a", "b", "c"]
+        assert index.leastrelevant() == "c"
+
+    def test_rebuild(self):
+        self.writeentry("a", 10, 100)
+        self.writeentry("b", 20, 200)
+        index = self.newindex()
+        assert index.sorted() == ["b", "a"]
+        assert index.totalsize() == 30
+        index.touch("a", 300.0)
+
+        # A lost index is rebuilt from the cache directory, keeping the
+        # relevance that is known
+        os.unlink(os.path.join(self.cachepath, "index"))
+        self.writeentry("c", 5, 50)
+        assert index.sorted() == ["a", "b", "c"]
+        assert index.totalsize() == 35
+        assert self.newindex().sorted() == ["a", "b", "c"]
+
+    def test_corruption(self):
+        self.writeentry("a", 10, 100)
+        index = self.newindex()
+        assert index.sorted() == ["a"]
+
+        # An unfinished record is left for later
+        with open(os.path.join(self.cachepath, "index"), "ab") as f:
+            f.write("+b 1")
+        assert self.newindex().sorted() == ["a"]
+
+        # A corrupt one rebuilds the index
+        with open(os.path.join(self.cachepath, "index"), "ab") as f:
+            f.write("\n")
+        self.writeentry("b", 20, 200)
+        assert self.newindex().sorted() == ["b", "a"]
+        assert self.newindex().totalsize() == 30
+
+    def test_compaction(self):
+        cacheindex = fastmanifest.cacheindex
+        index = self.newindex()
+        self.writeentry("a", 10, 100)
+        index.add("a", 10, 100.0)
+        for i in range(cacheindex.COMPACTSLACK + 10):
+            index.touch("a", 100.0 + i)
+        # The index is rewritten once it holds too many records
+        other = self.newindex()
+        assert other._records < cacheindex.COMPACTSLACK
+        assert other.sorted() == ["a"]
+        assert index.totalsize() == 10
+
+class WorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.vfs = vfsmod.vfs(os.getcwd())
+        path = self.vfs.join(fastmanifest.workqueue.QUEUEFILE)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def newqueue(self):
+        queue = fastmanifest.workqueue.workqueue(self.vfs)
+        queue.refresh()
+        return queue
+
+    def test_ordering(self):
+        queue = self.newqueue()
+        assert queue.pending() == []
+        queue.add([("a", 1, 300.0, 1), ("b", 0, 100.0, 2),
+                   ("c", 0, 200.0, 3)])
+        queue.add([("d", 1, 400.0, 4), ("e", 0, 100.0, 5)])
+        # Closest first, then most recent first, then newest revision first
+        assert self.newqueue().pending() == ["c", "e", "b", "d", "a"]
+
+        # A manifest queued again keeps its smallest distance and its
+        # latest time
+        queue.add([("a", 0, 50.0, 1), ("b", 2, 500.0, 2)])
+        assert self.newqueue().pending() == ["b", "a", "c", "e", "d"]
+
+        queue.remove(["b", "c"])
+        assert self.newqueue().pending() == ["a", "e", "d"]
+
+    def test_corruption(self):
+        queue = self.newqueue()
+        queue.add([("a", 0, 100.0, 0)])
+        path = self.vfs.join(fastmanifest.workqueue.QUEUEFILE)
+        with open(path, "ab") as f:
+            f.write("?b\n+c 0 100.0\n+d 0 2")
+        # Unreadable records are skipped, unfinished ones left for later
+        assert self.newqueue().pending() == ["a"]
+        with open(path, "ab") as f:
+            f.write("00.0 1\n")
+        assert self.newqueue().pending() == ["d", "a"]
+
+    def test_compaction(self):
+        workqueue = fastmanifest.workqueue
+        queue = self.newqueue()
+        queue.add([("a", 0, 100.0, 0)])
+        for i in range(workqueue.COMPACTSLACK + 10):
+            queue.add([("b", 0, 100.0 + i, 1)])
+            queue.remove(["b"])
+        queue.compact()
+        other = self.newqueue()
+        assert other._records == 1
+        assert other.pending() == ["a"]
+
+class SharedTreeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.vfs = vfsmod.vfs(os.path.join(os.getcwd(), "shared"))
+        if os.path.exists(self.vfs.base):
+            shutil.rmtree(self.vfs.base)
+        self.cachepath = self.vfs.join("manifestcache")
+        self.texts = dict(("%020d" % i, "text%d" % i) for i in range(10))
+        self.reads = []
+
+    def get(self, name, node):
+        self.reads.append(node)
+        return self.texts[node]
+
+    def newcache(self, maxsize=1000):
+        return fastmanifest.sharedtreecache.sharedtreecache(self.vfs,
+                                                            self.cachepath,
+                                                            maxsize)
+
+    def read(self, cache, nodes):
+        store = cache.store(self)
+        self.reads = []
+        for node in nodes:
+            assert store.get("", node) == self.texts[node]
+        return self.reads
+
+    def test_sharing(self):
+        first = ["%020d" % i for i in (5, 1, 3)]
+        second = ["%020d" % i for i in (0, 3, 9)]
+        cache = self.newcache()
+        assert self.read(cache, first) == first
+        # Until the cache is flushed, only this process can read them
+        assert self.read(self.newcache(), first) == first
+        cache.flush()
+        assert self.read(self.newcache(), first) == []
+
+        other = self.newcache()
+        assert self.read(other, second) == [second[0], second[2]]
+        other.flush()
+        # The index was rewritten, and is mapped again
+        assert self.read(cache, first + second) == []
+        assert cache.generation == 1
+        assert cache._count == 5
+
+    def test_budget(self):
+        cache = self.newcache(maxsize=30)
+        nodes = sorted(self.texts)
+        self.read(cache, nodes[:4])
+        cache.flush()
+        assert cache.generation == 1
+
+        # Past its size, the cache only keeps what was used last
+        other = self.newcache(maxsize=30)
+        self.read(other, nodes[3:6])
+        other.flush()
+        assert other.generation == 2
+        assert self.read(other, nodes[3:6]) == []
+        assert self.read(self.newcache(), nodes[:3]) == nodes[:3]
+
+    def test_generations(self):
+        cache = self.newcache()
+        nodes = sorted(self.texts)
+        self.read(cache, nodes[:2])
+        cache.flush()
+        index = os.path.join(self.cachepath,
+                             fastmanifest.sharedtreecache.INDEXFILE)
+        with open(index, "rb") as f:
+            data = f.read()
+
+        # A generation replaces the data file before the index
+        other = self.newcache(maxsize=20)
+        self.read(other, nodes[2:4])
+        other.flush()
+        assert other.generation == 2
+        assert self.read(other, nodes[2:4]) == []
+        with open(index, "wb") as f:
+            f.write(data)
+        assert self.read(self.newcache(), nodes[:2]) == nodes[:2]
+
+class MappedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.vfs = vfsmod.vfs(os.path.join(os.getcwd(), "mapped"))
+        if os.path.exists(self.vfs.base):
+            shutil.rmtree(self.vfs.base)
+
+    def newcache(self, mmap=True):
+        u = ui.ui()
+        u.setconfig("fastmanifest", "mmapcache", mmap)
+        return fastmanifest.implementation.ondiskcache(lambda msg: None,
+                                                       self.vfs, u)
+
+    def manifesttext(self, count):
+        def path(i):
+            return "dir%d/file%d" % (i % 10, i)
+        return "".join("%s\0%040x%s\n" % (path(i), i, "x" if i % 3 else "")
+                       for i in sorted(range(count), key=path))
+
+    def test_mappedentries(self):
+        text = self.manifesttext(1000)
+        cfastmanifest = fastmanifest.implementation.cfastmanifest
+        cache = self.newcache()
+        cache["a" * 40] = cfastmanifest.fastmanifest(text)
+
+        entry = cache["a" * 40]
+        assert entry.text() == text
+        # Modifying a copy, or the entry, doesn't change the cached one
+        copy = entry.copy()
+        copy["dir0/file0"] = "1" * 20
+        del copy["dir1/file1"]
+        copy["new"] = "2" * 20
+        assert entry.text() == text
+        assert copy.text() != text
+        del entry["dir2/file2"]
+        assert cache["a" * 40].text() == text
+        assert self.newcache(mmap=False)["a" * 40].text() == text
+
+    # perf test off by default since it's slow
+    def _testStatusDiffPerf(self):
+        """Times hg status and hg diff between two cached revisions of a
+        large repository, with the cache entries mapped or read, and
+        reports the peak RSS of each command."""
+        print "Mapped fastmanifest cache perf test"
+        filecount = 200000
+        extpath = os.path.dirname(fastmanifest.__file__)
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.dirname(extpath)
+        devnull = open(os.devnull, "w")
+        repo = tempfile.mkdtemp()
+        try:
+            hg = lambda *args: subprocess.check_call(
+                ["hg", "--cwd", repo] + list(args), stdout=devnull, env=env)
+            hg("init")
+            with open(os.path.join(repo, ".hg", "hgrc"), "a") as f:
+                f.write("[extensions]\nfastmanifest=%s\n" % extpath)
+                f.write("[fastmanifest]\ncachecutoffdays=-1\n")
+            for i in xrange(filecount):
+                path = os.path.join(repo, "dir%d" % (i % 100), "file%d" % i)
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, "w") as f:
+                    f.write("%d\n" % i)
+            hg("commit", "-Aqm", "base", "-u", "test")
+            for i in xrange(0, filecount, filecount / 100):
+                with open(os.path.join(repo, "dir%d" % (i % 100),
+                                       "file%d" % i), "a") as f:
+                    f.write("changed\n")
+            hg("commit", "-qm", "change", "-u", "test")
+            hg("debugcachemanifest", "-r", "all()")
+
+            for mmap in (False, True):
+                for command in (["status", "--rev", "0", "--rev", "1"],
+                                ["diff", "--stat", "-r", "0", "-r", "1"]):
+                    args = ["hg", "--cwd", repo, "--config",
+                            "fastmanifest.mmapcache=%s" % mmap] + command
+                    start = time.time()
+                    proc = subprocess.Popen(args, stdout=devnull, env=env)
+                    pid, status, rusage = os.wait4(proc.pid, 0)
+                    elapsed = time.time() - start
+                    print ("%s mmapcache=%s: %0.04fs, max rss %d KB" %
+                           (command[0].ljust(6), str(mmap).ljust(5), elapsed,
+                            rusage.ru_maxrss))
+        finally:
+            shutil.rmtree(repo)
+
+        # The perf test is meant to produce output, so we always fail the test
+        # so the user sees the output.
+        raise RuntimeError("perf test always fails")
+
 if __name__ == "__main__":
     sys.path.insert(0, os.path.join(os.environ["TESTDIR"], ".."))
     import fastmanifest
@@ -173,24 +173,12 @@ Test the --pruneall command to prune all the cached manifests
   > EOF
   $ mkcommit f
   $ hg book --debug foo
-  [FM] skipped 1853a742c28c3a531336bbb3d677d2e2d8937027, already cached (fast path)
-  [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
   [FM] skipped 7ab5760d084a24168f7595c38c00f4bbc2e308d9, already cached (fast path)
   [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 0
-  [FM] skipped f064a7f8e3e138341587096641d86e9d23cd9778, already cached (fast path)
-  [FM] refreshing f064a7f8e3e138341587096641d86e9d23cd9778 with delay 0
-  [FM] skipped e3738bf5439958f89499a656982023aba57b076e, already cached (fast path)
-  [FM] refreshing e3738bf5439958f89499a656982023aba57b076e with delay 0
-  [FM] skipped a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7, already cached (fast path)
-  [FM] refreshing a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7 with delay 0
-  [FM] skipped a0c8bcbbb45c63b90b70ad007bf38961f64f2af0, already cached (fast path)
-  [FM] refreshing a0c8bcbbb45c63b90b70ad007bf38961f64f2af0 with delay 0
+  [FM] skipped 1853a742c28c3a531336bbb3d677d2e2d8937027, already cached (fast path)
+  [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
   [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
   [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 2
-  [FM] refreshing f064a7f8e3e138341587096641d86e9d23cd9778 with delay 4
-  [FM] refreshing e3738bf5439958f89499a656982023aba57b076e with delay 6
-  [FM] refreshing a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7 with delay 8
-  [FM] refreshing a0c8bcbbb45c63b90b70ad007bf38961f64f2af0 with delay 10
   $ hg diff -c . --debug --nodate
   [FM] performing diff
   [FM] diff: other side is hybrid manifest
@@ -204,18 +192,18 @@ Test the --pruneall command to prune all the cached manifests
 
   $ hg debugcachemanifest --all --debug
   [FM] caching revset: ['fastmanifesttocache()'], pruneall(False), list(False)
-  [FM] skipped 1853a742c28c3a531336bbb3d677d2e2d8937027, already cached (fast path)
-  [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
-  [FM] skipped 7ab5760d084a24168f7595c38c00f4bbc2e308d9, already cached (fast path)
-  [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 0
-  [FM] skipped f064a7f8e3e138341587096641d86e9d23cd9778, already cached (fast path)
-  [FM] refreshing f064a7f8e3e138341587096641d86e9d23cd9778 with delay 0
-  [FM] skipped e3738bf5439958f89499a656982023aba57b076e, already cached (fast path)
-  [FM] refreshing e3738bf5439958f89499a656982023aba57b076e with delay 0
-  [FM] skipped a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7, already cached (fast path)
-  [FM] refreshing a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7 with delay 0
   [FM] skipped a0c8bcbbb45c63b90b70ad007bf38961f64f2af0, already cached (fast path)
   [FM] refreshing a0c8bcbbb45c63b90b70ad007bf38961f64f2af0 with delay 0
+  [FM] skipped a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7, already cached (fast path)
+  [FM] refreshing a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7 with delay 0
+  [FM] skipped e3738bf5439958f89499a656982023aba57b076e, already cached (fast path)
+  [FM] refreshing e3738bf5439958f89499a656982023aba57b076e with delay 0
+  [FM] skipped f064a7f8e3e138341587096641d86e9d23cd9778, already cached (fast path)
+  [FM] refreshing f064a7f8e3e138341587096641d86e9d23cd9778 with delay 0
+  [FM] skipped 7ab5760d084a24168f7595c38c00f4bbc2e308d9, already cached (fast path)
+  [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 0
+  [FM] skipped 1853a742c28c3a531336bbb3d677d2e2d8937027, already cached (fast path)
+  [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
   [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
   [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 2
   [FM] refreshing f064a7f8e3e138341587096641d86e9d23cd9778 with delay 4
@@ -233,18 +221,13 @@ Test the --pruneall command to prune all the cached manifests
   $ hg log -r "fastmanifestcached()" -T '{rev}\n'
   $ hg debugcachemanifest --all --debug
   [FM] caching revset: ['fastmanifesttocache()'], pruneall(False), list(False)
-  [FM] cache miss for fastmanifest 1853a742c28c3a531336bbb3d677d2e2d8937027
-  [FM] caching revision 1853a742c28c3a531336bbb3d677d2e2d8937027
-  [FM] cache miss for fastmanifest 7ab5760d084a24168f7595c38c00f4bbc2e308d9
-  [FM] caching revision 7ab5760d084a24168f7595c38c00f4bbc2e308d9
-  [FM] cache miss for fastmanifest f064a7f8e3e138341587096641d86e9d23cd9778
-  [FM] caching revision f064a7f8e3e138341587096641d86e9d23cd9778
-  [FM] cache miss for fastmanifest e3738bf5439958f89499a656982023aba57b076e
-  [FM] caching revision e3738bf5439958f89499a656982023aba57b076e
-  [FM] cache miss for fastmanifest a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7
-  [FM] caching revision a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7
   [FM] cache miss for fastmanifest a0c8bcbbb45c63b90b70ad007bf38961f64f2af0
   [FM] caching revision a0c8bcbbb45c63b90b70ad007bf38961f64f2af0
+  [FM] caching revision a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7
+  [FM] caching revision e3738bf5439958f89499a656982023aba57b076e
+  [FM] caching revision f064a7f8e3e138341587096641d86e9d23cd9778
+  [FM] caching revision 7ab5760d084a24168f7595c38c00f4bbc2e308d9
+  [FM] caching revision 1853a742c28c3a531336bbb3d677d2e2d8937027
   [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
   [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 2
   [FM] refreshing f064a7f8e3e138341587096641d86e9d23cd9778 with delay 4
@@ -341,6 +324,61 @@ Trim the cache to at most 100 bytes
   cache size is: 0 bytes
   number of entries is: 0
 
+The manifests a command misses are queued to be cached, with their parents.
+As the cache is empty, the revisions of fastmanifesttocache() are queued too.
+  $ hg diff -c . --debug --nodate
+  [FM] performing diff
+  [FM] diff: other side is hybrid manifest
+  [FM] diff: cache and tree miss
+  [FM] cache miss for fastmanifest 1853a742c28c3a531336bbb3d677d2e2d8937027
+  diff -r 9d206ffc875e1bc304590549be293be36821e66c -r bbc3e467917630e7d77cd77298e1027030972893 f
+  --- /dev/null
+  +++ b/f
+  @@ -0,0 +1,1 @@
+  +f
+  [FM] cache miss for fastmanifest a0c8bcbbb45c63b90b70ad007bf38961f64f2af0
+  [FM] caching revision a0c8bcbbb45c63b90b70ad007bf38961f64f2af0
+  [FM] caching revision a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7
+  [FM] caching revision e3738bf5439958f89499a656982023aba57b076e
+  [FM] caching revision f064a7f8e3e138341587096641d86e9d23cd9778
+  [FM] caching revision 7ab5760d084a24168f7595c38c00f4bbc2e308d9
+  [FM] caching revision 1853a742c28c3a531336bbb3d677d2e2d8937027
+  [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
+  [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 2
+  [FM] refreshing f064a7f8e3e138341587096641d86e9d23cd9778 with delay 4
+  [FM] refreshing e3738bf5439958f89499a656982023aba57b076e with delay 6
+  [FM] refreshing a539ce0c1a22b0ecf34498f9f5ce8ea56df9ecb7 with delay 8
+  [FM] refreshing a0c8bcbbb45c63b90b70ad007bf38961f64f2af0 with delay 10
+  $ hg log -r "fastmanifestcached()" -T '{rev}\n'
+  0
+  1
+  2
+  3
+  4
+  5
+
+Only the manifests that become relevant are queued once the cache isn't empty
+  $ hg debugcachemanifest --pruneall
+  $ hg debugcachemanifest -r 3
+  $ hg diff -c . --debug --nodate
+  [FM] performing diff
+  [FM] diff: other side is hybrid manifest
+  [FM] diff: cache and tree miss
+  [FM] cache miss for fastmanifest 1853a742c28c3a531336bbb3d677d2e2d8937027
+  diff -r 9d206ffc875e1bc304590549be293be36821e66c -r bbc3e467917630e7d77cd77298e1027030972893 f
+  --- /dev/null
+  +++ b/f
+  @@ -0,0 +1,1 @@
+  +f
+  [FM] caching revision 7ab5760d084a24168f7595c38c00f4bbc2e308d9
+  [FM] caching revision 1853a742c28c3a531336bbb3d677d2e2d8937027
+  [FM] refreshing 1853a742c28c3a531336bbb3d677d2e2d8937027 with delay 0
+  [FM] refreshing 7ab5760d084a24168f7595c38c00f4bbc2e308d9 with delay 2
+  $ hg log -r "fastmanifestcached()" -T '{rev}\n'
+  3
+  4
+  5
+
 Use the cache in a commit.
   $ hg debugcachemanifest -a
   $ mkcommit g
@@ -385,3 +423,53 @@ Test committing large commits (fastdelta code path)
   $ hg debugcachemanifest -r .
   $ for i in {0..1001} ; do echo a > $i ; done
   $ hg commit -Aqm 'big commit'
+  $ cd ..
+
+Manifests are cached from the cached manifest they are stored as a delta of
+  $ hg init derived
+  $ cd derived
+  $ mkdir d
+  $ echo a > a; echo b > b; echo c > d/c
+  $ hg commit -Aqm 0
+  $ echo a2 > a; hg rm -q b; echo e > d/e; chmod +x d/c
+  $ hg commit -Aqm 1
+  $ ln -s a link; echo b > b; hg rm -q d/e
+  $ hg commit -Aqm 2
+  $ hg up -q 0; echo f > f
+  $ hg commit -Aqm 3
+  $ hg merge -q 2
+  $ hg commit -m merge
+  $ cat >> .hg/hgrc << EOF
+  > [extensions]
+  > fastmanifest=$TESTDIR/../fastmanifest
+  > EOF
+  $ hg debugcachemanifest -r 'all()' --debug
+  [FM] caching revset: ['all()'], pruneall(False), list(False)
+  [FM] cache miss for fastmanifest * (glob)
+  [FM] caching revision * (glob)
+  [FM] caching revision * (glob)
+  [FM] caching revision * (glob)
+  [FM] caching revision * (glob)
+  [FM] caching revision * (glob)
+  [FM] refreshing * with delay 0 (glob)
+  [FM] refreshing * with delay 2 (glob)
+  [FM] refreshing * with delay 4 (glob)
+  [FM] refreshing * with delay 6 (glob)
+  [FM] refreshing * with delay 8 (glob)
+  $ python << EOF
+  > import os, subprocess
+  > import cfastmanifest
+  > cachepath = '.hg/store/manifestcache'
+  > for rev in range(5):
+  >     node = subprocess.check_output(['hg', 'log', '-r', str(rev), '--debug',
+  >                                     '-T', '{manifest}']).split(':')[1]
+  >     path = os.path.join(cachepath, 'fast' + node)
+  >     cached = cfastmanifest.fastmanifest.load(path).text()
+  >     expected = subprocess.check_output(['hg', 'debugdata', '-m', node])
+  >     print rev, cached == expected
+  > EOF
+  0 True
+  1 True
+  2 True
+  3 True
+  4 True
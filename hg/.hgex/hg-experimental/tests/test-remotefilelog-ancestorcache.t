@@ -0,0 +1,81 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > serverexpiration=-1
+  > EOF
+  $ for i in 1 2 3 4 5 6; do echo $i >> x; hg commit -qAm x$i; done
+  $ hg cp x y
+  $ hg commit -qm y
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow
+  $ hg prefetch -r 'all()'
+  5 files fetched over 1 fetches - (5 misses, 0.00% hit ratio) over *s (glob)
+  $ hg repack
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > ancestorcache=True
+  > ancestorcache.minentries=3
+  > EOF
+
+# The first log walks the history and writes the cache
+
+  $ hg log -f y -T '{rev} ' --config extensions.blackbox= \
+  > --config blackbox.track=remotefilelog
+  6 5 4 3 2 1 0  (no-eol)
+  $ ls $CACHEDIR/master/packs | grep ancestors
+  histpack.ancestors
+  $ grep 'ancestor cache' .hg/blackbox.log | sed 's/^.*> //'
+  ancestor cache: 0 hits, 1 misses
+
+# The second one reads it back
+
+  $ rm .hg/blackbox.log
+  $ hg log -f y -T '{rev} ' --config extensions.blackbox= \
+  > --config blackbox.track=remotefilelog
+  6 5 4 3 2 1 0  (no-eol)
+  $ grep 'ancestor cache' .hg/blackbox.log | sed 's/^.*> //'
+  ancestor cache: 1 hits, 0 misses
+
+# Histories that use the loose files of the cache aren't kept
+
+  $ echo 7 >> ../master/y
+  $ hg -R ../master commit -qm y7
+  $ hg pull -q
+  $ hg prefetch -r tip
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ hg up -q tip
+  $ rm .hg/blackbox.log
+  $ hg log -f y -T '{rev} ' --config extensions.blackbox= \
+  > --config blackbox.track=remotefilelog
+  7 6 5 4 3 2 1 0  (no-eol)
+  $ hg log -f y -T '{rev} ' --config extensions.blackbox= \
+  > --config blackbox.track=remotefilelog
+  7 6 5 4 3 2 1 0  (no-eol)
+  $ grep 'ancestor cache' .hg/blackbox.log | sed 's/^.*> //'
+  ancestor cache: 0 hits, 1 misses
+  ancestor cache: 0 hits, 1 misses
+
+# Repacking removes the packs the cached histories were read from
+
+  $ hg repack
+  $ hg up -q 6
+  $ rm .hg/blackbox.log
+  $ hg log -f y -T '{rev} ' --config extensions.blackbox= \
+  > --config blackbox.track=remotefilelog
+  6 5 4 3 2 1 0  (no-eol)
+  $ hg log -f y -T '{rev} ' --config extensions.blackbox= \
+  > --config blackbox.track=remotefilelog
+  6 5 4 3 2 1 0  (no-eol)
+  $ grep 'ancestor cache' .hg/blackbox.log | sed 's/^.*> //'
+  ancestor cache: 0 hits, 1 misses
+  ancestor cache: 1 hits, 0 misses
@@ -0,0 +1,122 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ echo x > x
+  $ echo y > y
+  $ hg commit -qAm x
+  $ echo x2 > x
+  $ echo z > z
+  $ hg commit -qAm z
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow --noupdate -q
+  $ cd shallow
+  $ SOCKET=$TESTTMP/broker.sock
+  $ cat >> $HGRCPATH <<EOF
+  > [remotefilelog]
+  > connectionbroker=True
+  > connectionbroker.autostart=False
+  > connectionbroker.path=$SOCKET
+  > EOF
+  $ waitforsocket() {
+  >   for i in `$TESTDIR/seq.py 1 300`; do
+  >     test -S $SOCKET && return
+  >     sleep 0.1
+  >   done
+  >   echo "no connection broker at $SOCKET"
+  > }
+
+# Without a broker, commands connect to the server themselves
+
+  $ rm $TESTTMP/dummylog
+  $ hg cat -r 0 x y
+  x
+  y
+  2 files fetched over 2 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ cat $TESTTMP/dummylog
+  Got arguments 1:user@dummy 2:hg -R master serve --stdio
+
+# With a broker, every command uses the same connection
+
+  $ hg connectionbroker --idle-timeout 600 --debug > $TESTTMP/broker.log 2>&1 &
+  $ BROKERPID=$!
+  $ waitforsocket
+  $ rm $TESTTMP/dummylog
+  $ clearcache
+  $ hg cat -r 0 x y
+  x
+  y
+  2 files fetched over 2 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ hg cat -r 1 x z
+  x2
+  z
+  2 files fetched over 2 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ clearcache
+  $ hg cat -r 1 x z --debug 2>&1 | grep -e broker -e '^x2' -e '^z'
+  using connection broker for ssh://user@dummy/master
+  x2
+  z
+  $ cat $TESTTMP/dummylog
+  Got arguments 1:user@dummy 2:hg -R master serve --stdio
+
+# A second broker exits right away
+
+  $ hg connectionbroker
+  connection broker already running
+
+# Packs are fetched through the broker too
+
+  $ clearcache
+  $ hg cat -r 1 x --config remotefilelog.fetchpacks=True
+  x2
+  1 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ cat $TESTTMP/dummylog
+  Got arguments 1:user@dummy 2:hg -R master serve --stdio
+
+# The broker reports what it did when it's stopped
+
+  $ kill $BROKERPID
+  $ wait $BROKERPID
+  [255]
+  $ grep '^connection broker:' $TESTTMP/broker.log
+  connection broker: 4 sessions, 1 connections opened, 3 reused
+  $ test -S $SOCKET
+  [1]
+
+# Commands start a broker when none is running
+
+  $ cat >> $HGRCPATH <<EOF
+  > [remotefilelog]
+  > connectionbroker.autostart=True
+  > connectionbroker.idletimeout=10
+  > EOF
+  $ rm $TESTTMP/dummylog
+  $ clearcache
+  $ hg cat -r 0 x
+  x
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ waitforsocket
+  $ clearcache
+  $ hg cat -r 0 x
+  x
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ cat $TESTTMP/dummylog
+  Got arguments 1:user@dummy 2:hg -R master serve --stdio
+  Got arguments 1:user@dummy 2:hg -R master serve --stdio
+
+# It exits once it's idle
+
+  $ for i in `$TESTDIR/seq.py 1 300`; do
+  >   test -S $SOCKET || break
+  >   sleep 0.1
+  > done
+  $ test -S $SOCKET
+  [1]
@@ -0,0 +1,67 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > serverexpiration=-1
+  > EOF
+  $ python -c "print 'x' * 5000" > big
+  $ echo small > small
+  $ hg commit -qAm x
+  $ for i in 1 2 3; do cp big big$i; cp small small$i; done
+  $ hg commit -qAm copies
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow --noupdate -q
+  $ cd shallow
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > dedup=True
+  > EOF
+
+# Identical large files are stored once, small files are left alone
+
+  $ hg up -q tip
+  8 files fetched over 1 fetches - (8 misses, 0.00% hit ratio) over *s (glob)
+  $ find $CACHEDIR/.dedup -type f | wc -l | tr -d ' '
+  1
+  $ find $CACHEDIR/master -type f -name '*.content' | wc -l | tr -d ' '
+  4
+  $ find $CACHEDIR/master -type f -size +4k | wc -l | tr -d ' '
+  4
+  $ cat big3 | wc -c | tr -d ' '
+  5001
+  $ hg cat -r tip big2 small2
+  x* (glob)
+  small
+
+# The debug commands read the stubs
+
+  $ STUB=`find $CACHEDIR/master -type f -name '*.content' | head -n 1 \
+  > | sed 's/\.content$//'`
+  $ head -n 1 $STUB
+  dedup
+  $ hg debugremotefilelog $STUB | grep size
+  size: 5001 bytes
+  $ hg verifyremotefilelog $CACHEDIR/master
+
+# Content that is no longer referenced is removed
+
+  $ find $CACHEDIR/master -type f -name '*.content' | xargs rm
+  $ find $CACHEDIR/.dedup -type f | wc -l | tr -d ' '
+  1
+  $ hg gc
+  finished: removed 0 of 8 files (0.00 GB to 0.00 GB)
+  $ find $CACHEDIR/.dedup -type f | wc -l | tr -d ' '
+  0
+
+# Entries whose content is gone are refetched
+
+  $ hg cat -r tip big1 | wc -c | tr -d ' '
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  5001
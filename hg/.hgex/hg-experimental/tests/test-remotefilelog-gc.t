@@ -75,6 +75,13 @@
   $TESTTMP/hgcache/master/11/f6ad8ec52a2984abaafd7c3b516503785c2072/48023ec064c1d522f0d792a5a912bb1bf7859a4a (glob)
   $TESTTMP/hgcache/repos (glob)
 
+# The keepset only has the file revisions that differ between keep revisions,
+# and the gc reports its duration and peak memory
+
+  $ hg gc --debug | grep -e '^keepset' -e '^gc:'
+  keepset: 2 keys from 2 revisions in *s (glob)
+  gc: *s, peak RSS * (glob)
+
 # Test that if garbage collection on repack and repack on hg gc flags are set then incremental repack with garbage collector is run
 
   $ hg gc --config remotefilelog.gcrepack=True --config remotefilelog.repackonhggc=True
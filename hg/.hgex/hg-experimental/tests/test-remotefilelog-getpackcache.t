@@ -0,0 +1,124 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > getpackcache=True
+  > [extensions]
+  > blackbox=
+  > [blackbox]
+  > track=remotefilelog
+  > EOF
+  $ echo x > x
+  $ echo y > y
+  $ hg commit -qAm x
+  $ echo x2 > x
+  $ hg commit -qAm x2
+
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow --noupdate -q
+  $ cd shallow
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > fetchpacks=True
+  > EOF
+
+# The first fetch fills the cache, and the next one is served from it
+
+  $ hg prefetch -r 1
+  2 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ grep 'getpack cache' ../master/.hg/blackbox.log | sed 's/^.*> //'
+  getpack cache: 0 hits, 2 misses (0.00% hit ratio), 0 bytes served from cache
+  $ find ../master/.hg/getpackcache -mindepth 2 -type f | wc -l | tr -d ' '
+  2
+
+  $ clearcache
+  $ hg prefetch -r 1
+  2 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ grep 'getpack cache' ../master/.hg/blackbox.log | sed 's/^.*> //'
+  getpack cache: 0 hits, 2 misses (0.00% hit ratio), 0 bytes served from cache
+  getpack cache: 2 hits, 0 misses (100.00% hit ratio), * bytes served from cache (glob)
+  $ hg cat -r 1 x y
+  x2
+  y
+
+# Pushes warm the cache with the new file revisions, in the background
+
+  $ hg up -q 1
+  $ echo y2 > y
+  $ echo z > z
+  $ hg commit -qAm y2
+  $ hg push -q
+  $ for i in `$TESTDIR/seq.py 1 50`; do
+  >   n=`find ../master/.hg/getpackcache -mindepth 2 -type f | wc -l | tr -d ' '`
+  >   test $n -eq 4 && break
+  >   sleep 0.2
+  > done
+  $ find ../master/.hg/getpackcache -mindepth 2 -type f | wc -l | tr -d ' '
+  4
+  $ clearcache
+  $ rm ../master/.hg/blackbox.log
+  $ hg prefetch -r 2
+  3 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ grep 'getpack cache' ../master/.hg/blackbox.log | sed 's/^.*> //'
+  getpack cache: 3 hits, 0 misses (100.00% hit ratio), * bytes served from cache (glob)
+
+# Clients that have a parent revision of a file fetch deltas against it,
+# computed from the same cached entries
+
+  $ $TESTDIR/seq.py 1 100 > w
+  $ hg commit -qAm w
+  $ hg push -q
+  $ sed 's/^50$/fifty/' w > w.new
+  $ mv w.new w
+  $ hg commit -qm w2
+  $ hg push -q
+  $ for i in `$TESTDIR/seq.py 1 50`; do
+  >   n=`find ../master/.hg/getpackcache -mindepth 2 -type f | wc -l | tr -d ' '`
+  >   test $n -eq 6 && break
+  >   sleep 0.2
+  > done
+  $ cd ..
+  $ hgcloneshallow ssh://user@dummy/master shallow2 --noupdate -q
+  $ cd shallow2
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > fetchpacks=True
+  > fetchpackdeltas=True
+  > EOF
+  $ hg up -q 3
+  1 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ rm ../master/.hg/blackbox.log
+  $ hg prefetch -r 4 --debug 2>&1 | grep 'received deltas'
+  applied 1 received deltas to their bases
+  $ grep 'getpack cache' ../master/.hg/blackbox.log | sed 's/^.*> //'
+  getpack cache: 1 hits, 0 misses (100.00% hit ratio), * bytes served from cache (glob)
+  $ hg cat -r 4 w | head -50 | tail -1
+  fifty
+  $ cd ../shallow
+
+# A strip changes the linknodes, so the entries cached before it aren't used
+
+  $ hg -R ../master strip -q -r 2 --config extensions.strip=
+  $ clearcache
+  $ rm ../master/.hg/blackbox.log
+  $ hg prefetch -r 1
+  2 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ grep 'getpack cache' ../master/.hg/blackbox.log | sed 's/^.*> //'
+  getpack cache: 0 hits, 2 misses (0.00% hit ratio), 0 bytes served from cache
+
+# gc trims the cache to its size budget, and records the size it's left at
+
+  $ cd ../master
+  $ hg gc --config remotefilelog.getpackcachesize=0
+  no known cache at $TESTTMP/hgcache
+  $ find .hg/getpackcache -mindepth 2 -type f | wc -l | tr -d ' '
+  0
+  $ cat .hg/getpackcache/size
+  0
@@ -0,0 +1,114 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > serverexpiration=-1
+  > EOF
+  $ echo x > x
+  $ hg commit -qAm x
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > linkrevindex=True
+  > [extensions]
+  > blackbox=
+  > [blackbox]
+  > track=remotefilelog
+  > EOF
+
+# A local commit is rebased on the server, so the local blob has a linknode
+# that isn't an ancestor of the main line
+
+  $ echo x >> x
+  $ hg commit -Aqm xx2
+  $ cd ../master
+  $ echo y >> y
+  $ hg commit -Aqm yy2
+  $ echo x >> x
+  $ hg commit -Aqm xx2-fake-rebased
+  $ echo y >> y
+  $ hg commit -Aqm yy3
+  $ cd ../shallow
+  $ hg pull -q
+  $ ls .hg/cache/linkrevindex*
+  .hg/cache/linkrevindex.log
+  .hg/cache/linkrevindex.state
+  $ hg update tip -q
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ echo x > x
+  $ hg commit -qAm xx3
+  $ hg log -G -T '{node|short} {desc} {phase} {files}\n'
+  @  08aa375d990e xx3 draft x
+  |
+  o  d5d19d5d6f58 yy3 public y
+  |
+  o  0110064c9970 xx2-fake-rebased public x
+  |
+  o  6dd7f86616ad yy2 public y
+  |
+  | o  4549721d828f xx2 draft x
+  |/
+  o  b292c1e3311f x public x
+  
+
+# The index finds the right linknode, without refetching the blob or walking
+# the changelog
+
+  $ rm .hg/blackbox.log
+  $ hg log -f x -T '{node|short} {desc} {phase} {files}\n'
+  08aa375d990e xx3 draft x
+  0110064c9970 xx2-fake-rebased public x
+  b292c1e3311f x public x
+  $ grep 'linkrev index' .hg/blackbox.log | sed 's/^.*> //'
+  linkrev index: 1 lookups, 1 resolved by the index, 0 slow walks
+
+# Without a usable index, the changelog is walked as before
+
+  $ rm .hg/cache/linkrevindex*
+  $ rm .hg/blackbox.log
+  $ hg log -f x -T '{desc}\n'
+  xx3
+  xx2-fake-rebased
+  x
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ grep 'linkrev index' .hg/blackbox.log | sed 's/^.*> //'
+  linkrev index: 1 lookups, 0 resolved by the index, 1 slow walks
+
+# The next pull starts a new index from the pulled changesets. Strip re-adds
+# the changesets it kept, which starts the index over from them, since the
+# ones it covered moved.
+
+  $ cd ../master
+  $ echo z > z
+  $ hg commit -qAm z
+  $ cd ../shallow
+  $ hg pull -q
+  $ head -n 2 .hg/cache/linkrevindex.state
+  6
+  7
+  $ hg strip -q -r 'desc("xx3")'
+  $ head -n 2 .hg/cache/linkrevindex.state
+  5
+  6
+  $ cd ../master
+  $ echo z >> z
+  $ hg commit -qm zz
+  $ cd ../shallow
+  $ hg pull -q
+  $ head -n 2 .hg/cache/linkrevindex.state
+  5
+  7
+  $ test "`tail -1 .hg/cache/linkrevindex.state`" = "`hg log -r tip -T '{node}'`"
+  $ hg log -f z -r tip -T '{desc}\n'
+  zz
+  z
@@ -0,0 +1,58 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ echo x > x
+  $ echo y > y
+  $ echo z > z
+  $ hg commit -qAm xyz
+  $ cd ..
+
+  $ cat >> $HGRCPATH <<EOF
+  > [remotefilelog]
+  > cacheprocess = python $TESTDIR/../remotefilelog/localcacheclient.py $TESTTMP/localcache 1MB
+  > EOF
+
+# The first clone misses, and fills the local cache
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  3 files fetched over 1 fetches - (3 misses, 0.00% hit ratio) over *s (glob)
+  $ ls $TESTTMP/localcache
+  *-*-*.blobidx (glob)
+  *-*-*.blobpack (glob)
+
+# Other repos on the machine are then served by the local cache
+
+  $ clearcache
+  $ hgcloneshallow ssh://user@dummy/master shallow2 -q
+  3 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ cat shallow2/x shallow2/y shallow2/z
+  x
+  y
+  z
+
+# Blobs are stored compressed, in a single segment
+
+  $ ls $TESTTMP/localcache | wc -l | tr -d ' '
+  2
+  $ cd master
+  $ for i in `$TESTDIR/seq.py 1 20`; do echo $i >> x; done
+  $ hg commit -qm x2
+  $ cd ../shallow
+  $ hg pull -q
+  $ hg up -q tip
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ clearcache
+  $ hg up -q null
+  1 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg up -q tip
+  2 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ tail -1 x
+  20
@@ -116,3 +116,96 @@ Trace renames
 Verify remotefilelog handles rename metadata stripping when comparing file sizes
   $ hg debugrebuilddirstate
   $ hg status
+
+Follow a history with merges, a limit and followfirst
+  $ echo a >> z
+  $ hg commit -qm a
+  $ hg up -q 2
+  $ echo b > b
+  $ hg commit -qAm b
+  $ echo b >> z
+  $ hg commit -qm b2
+  $ hg merge -q --tool :local 3
+  $ echo ab >> z
+  $ hg commit -qm merge
+  $ hg log -f z -T '{rev} {desc}\n'
+  6 merge
+  5 b2
+  3 a
+  2 move
+  0 x
+  $ hg log -f z -l 2 -T '{rev} {desc}\n'
+  6 merge
+  5 b2
+  $ hg log -r 'reverse(_followfirst(z))' -T '{rev} {desc}\n'
+  6 merge
+  5 b2
+  2 move
+  0 x
+  $ hg log -r 'follow(z)' -T '{rev} {desc}\n'
+  0 x
+  2 move
+  3 a
+  5 b2
+  6 merge
+  $ hg log -r 'reverse(follow(z, 5))' -T '{rev} {desc}\n'
+  5 b2
+  2 move
+  0 x
+
+Follow a file whose history has a linknode outside of the followed ancestry,
+like when the same file revision is introduced again by a rebased commit
+
+  $ cd $TESTTMP
+  $ hginit master2
+  $ cd master2
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ echo 0 > x
+  $ hg commit -qAm x0
+  $ echo 1 > x
+  $ hg commit -qAm x1
+  $ echo 2 > x
+  $ hg commit -qAm x2
+  $ hg up -q 0
+  $ echo 1 > x
+  $ hg commit -qm x1-rebased
+  $ cd ..
+  $ hgcloneshallow ssh://user@dummy/master2 shallow2 -q --noupdate
+  $ cd shallow2
+  $ cat > $TESTTMP/writepack.py <<EOF
+  > import sys
+  > from mercurial import ui as uimod
+  > from mercurial.node import bin, nullid
+  > from remotefilelog import historypack
+  > pack = historypack.mutablehistorypack(uimod.ui(), sys.argv[1])
+  > for line in sys.stdin:
+  >     node, p1, linknode = [bin(n) if n != 'null' else nullid
+  >                           for n in line.split()]
+  >     pack.add(sys.argv[2], node, p1, nullid, linknode, '')
+  > pack.close()
+  > EOF
+  $ fnode() {
+  >   hg manifest --debug -r $1 | grep " $2$" | cut -c 1-40
+  > }
+  $ node() {
+  >   hg log -r $1 -T '{node}'
+  > }
+  $ mkdir -p $CACHEDIR/master2/packs
+  $ $PYTHON $TESTTMP/writepack.py $CACHEDIR/master2/packs x <<EOF
+  > `fnode 2 x` `fnode 1 x` `node 2`
+  > `fnode 1 x` `fnode 0 x` `node 3`
+  > `fnode 0 x` null `node 0`
+  > EOF
+  $ hg up -q 2
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ hg log -f x -T '{rev} {desc}\n'
+  2 x2
+  1 x1
+  0 x0
+  $ hg log -r 'follow(x)' -T '{rev} {desc}\n'
+  0 x0
+  1 x1
+  2 x2
@@ -0,0 +1,131 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ for i in `$TESTDIR/seq.py 1 200`; do echo line $i >> x; done
+  $ echo y > y
+  $ hg commit -qAm x
+  $ echo line 201 >> x
+  $ echo y2 > y
+  $ echo z > z
+  $ hg commit -qAm x2
+
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow --noupdate -q
+  $ cd shallow
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > fetchpacks=True
+  > fetchpackdeltas=True
+  > EOF
+
+# Without anything in the cache, the server sends full texts
+
+  $ hg up -q 0
+  2 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg debugdatapack $CACHEDIR/master/packs/*.datapack
+  
+  x
+  Node          Delta Base    Delta Length
+  * 000000000000  1692 (glob)
+  
+  y
+  Node          Delta Base    Delta Length
+  * 000000000000  2 (glob)
+
+# The next revisions are sent as deltas against the working copy parent's
+
+  $ rm $CACHEDIR/master/packs/*.data*
+  $ hg prefetch -r 0
+  2 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ FIRSTPACK=`ls $CACHEDIR/master/packs/*.datapack`
+  $ hg prefetch -r 1 --debug 2>&1 | grep 'received deltas'
+  applied 1 received deltas to their bases
+
+# They're stored as full texts, so the new pack doesn't depend on the first one
+
+  $ hg debugdatapack `ls $CACHEDIR/master/packs/*.datapack | grep -v $FIRSTPACK`
+  
+  x
+  Node          Delta Base    Delta Length
+  * 000000000000  1701 (glob)
+  
+  y
+  Node          Delta Base    Delta Length
+  * 000000000000  3 (glob)
+  
+  z
+  Node          Delta Base    Delta Length
+  * 000000000000  2 (glob)
+  $ hg cat -r 1 x | tail -2
+  line 200
+  line 201
+  $ hg up -q 1
+  $ cat y z
+  y2
+  z
+
+# An incremental repack can leave out the pack holding the revision a received
+# delta was against
+
+  $ cd ../master
+  $ $TESTDIR/seq.py 1 5000 > big
+  $ echo line 202 >> x
+  $ hg commit -qAm big
+  $ echo line 203 >> x
+  $ hg commit -qm x4
+  $ echo line 204 >> x
+  $ hg commit -qm x5
+  $ cd ../shallow
+  $ hg pull -q
+  $ hg prefetch -r 2
+  2 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg up -q 2
+  $ hg prefetch -r 3 --debug 2>&1 | grep 'received deltas'
+  applied 1 received deltas to their bases
+  $ hg prefetch -r 4 --debug 2>&1 | grep 'received deltas'
+  applied 1 received deltas to their bases
+  $ ls $CACHEDIR/master/packs/*.datapack | wc -l | tr -d ' '
+  5
+  $ hg repack --incremental --config remotefilelog.data.generations=4k \
+  >   --config remotefilelog.data.gencountlimit=1
+  $ ls $CACHEDIR/master/packs/*.datapack | wc -l | tr -d ' '
+  2
+  $ hg cat -r 4 x | tail -1
+  line 204
+
+  $ hg repack
+  $ hg cat -r 1 x | wc -l | tr -d ' '
+  201
+
+# Revisions only in the loose files of the cache aren't offered as bases,
+# since gc can remove them
+
+  $ hg up -q null
+  $ rm -rf $CACHEDIR/master
+  $ hg prefetch -r 0 --config remotefilelog.fetchpacks=False
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ hg up -q 0
+  $ hg prefetch -r 1
+  3 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg debugdatapack $CACHEDIR/master/packs/*.datapack
+  
+  x
+  Node          Delta Base    Delta Length
+  * 000000000000  1701 (glob)
+  
+  y
+  Node          Delta Base    Delta Length
+  * 000000000000  3 (glob)
+  
+  z
+  Node          Delta Base    Delta Length
+  * 000000000000  2 (glob)
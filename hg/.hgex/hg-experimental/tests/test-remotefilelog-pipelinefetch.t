@@ -0,0 +1,95 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ for i in 1 2 3 4 5 6 7; do echo $i > f$i; done
+  $ hg commit -qAm files
+  $ for i in 1 2 3 4 5 6 7; do echo $i$i >> f$i; done
+  $ hg commit -qAm more
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow --noupdate -q
+  $ cd shallow
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > pipelinefetch=True
+  > fetchconnections=3
+  > getfilesstep=2
+  > EOF
+
+# the sequential fetch uses a single connection for the files
+
+  $ rm -f $TESTTMP/dummylog
+  $ hg prefetch -r 0::1 --config remotefilelog.pipelinefetch=False
+  14 files fetched over 1 fetches - (14 misses, 0.00% hit ratio) over *s (glob)
+  $ grep -c "user@dummy" $TESTTMP/dummylog
+  2
+
+# the pipelined fetch spreads them over several connections
+
+  $ clearcache
+  $ rm -f $TESTTMP/dummylog
+  $ hg prefetch -r 0::1
+  14 files fetched over 1 fetches - (14 misses, 0.00% hit ratio) over *s (glob)
+  $ grep -c "user@dummy" $TESTTMP/dummylog
+  4
+
+  $ hg cat -r 0 f1 f7
+  1
+  7
+  $ hg cat -r 1 f3
+  3
+  33
+  $ hg up -q tip
+  $ cat f5
+  5
+  55
+
+# a single connection is used for small fetches
+
+  $ clearcache
+  $ rm -f $TESTTMP/dummylog
+  $ hg cat -r 1 f2
+  2
+  22
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ grep -c "user@dummy" $TESTTMP/dummylog
+  1
+
+# a cache process that reports misses as it goes
+
+  $ cat > $TESTTMP/cacheprocess.py <<EOF
+  > import sys
+  > while True:
+  >     cmd = sys.stdin.readline().strip()
+  >     if cmd == 'exit' or not cmd:
+  >         sys.exit(0)
+  >     count = int(sys.stdin.readline())
+  >     keys = [sys.stdin.readline()[:-1] for _ in xrange(count)]
+  >     if cmd == 'get':
+  >         for key in keys:
+  >             sys.stdout.write(key + '\n')
+  >             sys.stdout.write('_hits_0_\n')
+  >             sys.stdout.flush()
+  >         sys.stdout.write('0\n')
+  >         sys.stdout.flush()
+  > EOF
+  $ clearcache
+  $ rm -f $TESTTMP/dummylog
+  $ hg prefetch -r 0::1 \
+  > --config remotefilelog.cacheprocess="python $TESTTMP/cacheprocess.py"
+  14 files fetched over 1 fetches - (14 misses, 0.00% hit ratio) over *s (glob)
+  $ grep -c "user@dummy" $TESTTMP/dummylog
+  4
+  $ hg cat -r 1 f4 f6
+  4
+  44
+  6
+  66
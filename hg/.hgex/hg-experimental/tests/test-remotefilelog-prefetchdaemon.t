@@ -0,0 +1,115 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ echo x > x
+  $ echo z > z
+  $ hg commit -qAm x
+  $ echo x2 > x
+  $ echo y > y
+  $ hg commit -qAm y
+  $ echo w > w
+  $ rm z
+  $ hg commit -qAm w
+  $ hg bookmark foo
+
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow --noupdate -q
+  $ cd shallow
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > bgprefetchrevs=.
+  > prefetchdaemon=True
+  > prefetchdaemon.autostart=False
+  > prefetchdaemon.revs=
+  > EOF
+
+  $ hg debugprefetchqueue
+  daemon: not running
+  queued: 0
+  in progress: 0
+
+# Background prefetches are queued, and queuing a revision twice is a no-op
+
+  $ hg up -q 0
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ hg up -q 1
+  2 files fetched over 2 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ hg up -q 0
+  $ hg up -q 1
+  $ hg debugprefetchqueue
+  daemon: not running
+  queued: 2
+  in progress: 0
+
+# The daemon drains the queue, and also prefetches what it watches
+
+  $ clearcache
+  $ hg prefetchdaemon --idle-timeout 0 \
+  > --config remotefilelog.prefetchdaemon.revs=foo
+  $ hg debugprefetchqueue
+  daemon: not running
+  queued: 0
+  in progress: 0
+  prefetched: 3 revisions in 1 batches (0 failed)
+  throughput: * revisions/sec (glob)
+  $ hg cat -r 0 z
+  z
+  $ hg cat -r foo x w
+  w
+  x2
+
+# Small batches are spread over the workers
+
+  $ clearcache
+  $ hg prefetchdaemon --idle-timeout 0 \
+  > --config remotefilelog.prefetchdaemon.revs='all()' \
+  > --config remotefilelog.prefetchdaemon.batchsize=1
+  $ hg debugprefetchqueue | grep prefetched
+  prefetched: 3 revisions in 3 batches (0 failed)
+  $ find $CACHEDIR -type f | grep -c master/
+  5
+
+# A stale claim from a daemon that died is served again
+
+  $ clearcache
+  $ mkdir -p .hg/store/prefetchqueue
+  $ touch .hg/store/prefetchqueue/`hg log -r 2 -T '{node}'`.999999
+  $ hg debugprefetchqueue | grep progress
+  in progress: 1
+  $ hg prefetchdaemon --idle-timeout 0 \
+  > --config remotefilelog.prefetchdaemon.revs=
+  $ hg debugprefetchqueue | grep -v throughput
+  daemon: not running
+  queued: 0
+  in progress: 0
+  prefetched: 2 revisions in 1 batches (0 failed)
+
+# Commands start the daemon in the background when it's not running
+
+  $ clearcache
+  $ hg up -q null
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ hg up -q 2 --config remotefilelog.prefetchdaemon.autostart=True \
+  > --config remotefilelog.prefetchdaemon.idletimeout=1
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ for i in `$TESTDIR/seq.py 1 300`; do
+  >   hg debugprefetchqueue > $TESTTMP/queue
+  >   grep 'prefetched: 1 ' $TESTTMP/queue > /dev/null &&
+  >     grep 'in progress: 0' $TESTTMP/queue > /dev/null && break
+  >   sleep 0.1
+  > done
+  $ grep -v throughput $TESTTMP/queue
+  daemon: * (glob)
+  queued: 0
+  in progress: 0
+  prefetched: 1 revisions in 1 batches (0 failed)
+  $ grep -o 'pid [0-9]*' $TESTTMP/queue | cut -d ' ' -f 2 >> $DAEMON_PIDS
@@ -24,10 +24,10 @@ the server supports our custom getfiles method.
   $ cd master
   $ echo 'hello' | hg -R . serve --stdio
   * (glob)
-  capabilities: lookup * remotefilelog getflogheads getfile (glob)
+  capabilities: lookup * remotefilelog getpackv2 getflogheads getfile (glob)
   $ echo 'capabilities' | hg -R . serve --stdio ; echo
   * (glob)
-  * remotefilelog getflogheads getfile (glob)
+  * remotefilelog getpackv2 getflogheads getfile (glob)
 
 # pull to shallow from full
 
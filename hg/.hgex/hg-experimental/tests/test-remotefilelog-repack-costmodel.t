@@ -0,0 +1,63 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > serverexpiration=-1
+  > EOF
+  $ for i in 1 2 3 4 5 6 7 8; do
+  >   $TESTDIR/seq.py 1 20 | sed "${i}s/.*/x/" > x
+  >   hg commit -qAm x$i
+  > done
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow
+  $ hg prefetch -r 'all()'
+  7 files fetched over 1 fetches - (7 misses, 0.00% hit ratio) over *s (glob)
+
+# Chains are capped at maxchainlen, so every fourth revision is a full text
+
+  $ hg repack --config packs.costmodel=True --config packs.chaincost=0 \
+  > --config packs.maxchainlen=3
+  $ hg debugdatapack $CACHEDIR/master/packs/*.datapack
+  
+  x
+  Node          Delta Base    Delta Length
+  971457ef807b  000000000000  51
+  6c73d5d8462f  971457ef807b  26
+  a19b222bed0f  6c73d5d8462f  26
+  91b494b5037e  a19b222bed0f  26
+  0e51268c2739  000000000000  51
+  f77cfacb0d11  0e51268c2739  26
+  be183b015ab8  f77cfacb0d11  26
+  c18687d7515f  be183b015ab8  26
+  $ hg debugdatapack $CACHEDIR/master/packs/*.datapack | grep -c 000000000000
+  2
+
+  $ for r in 0 3 4 7; do echo `hg cat -r $r x`; done
+  x 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20
+  1 2 3 x 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20
+  1 2 3 4 x 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20
+  1 2 3 4 5 6 7 x 9 10 11 12 13 14 15 16 17 18 19 20
+
+# The deltas of such a small file aren't worth the default chain cost, so every
+# revision is a full text
+
+  $ hg repack --config packs.costmodel=True
+  $ hg debugdatapack $CACHEDIR/master/packs/*.datapack | grep -c 000000000000
+  8
+
+# The benchmark reports the size and read latency of the repacked data
+
+  $ hg debugrepackbench --config packs.costmodel=True
+  repacked 8 entries in * seconds (* entries/sec) (glob)
+  peak RSS: *, workers: * (glob)
+  data pack size: * (glob)
+  get latency: p50 * ms, p99 * ms (glob)
@@ -0,0 +1,83 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > serverexpiration=-1
+  > EOF
+  $ for i in 1 2 3 4 5 6; do echo $i > f$i; done
+  $ hg commit -qAm files
+  $ for i in 1 2 3 4 5 6; do echo $i$i >> f$i; done
+  $ hg commit -qAm more
+  $ hg cp f1 copied
+  $ echo 1 >> f2
+  $ hg commit -qAm copy
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  7 files fetched over 1 fetches - (7 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow
+  $ hg prefetch -r 0::2
+  7 files fetched over 1 fetches - (7 misses, 0.00% hit ratio) over *s (glob)
+  $ cp -R $CACHEDIR $TESTTMP/loosecache
+
+# A serial repack, for reference
+
+  $ hg repack
+  $ find $CACHEDIR -type f | sort > $TESTTMP/serial
+  $ cat $TESTTMP/serial
+  $TESTTMP/hgcache/master/packs/*.dataidx (glob)
+  $TESTTMP/hgcache/master/packs/*.datapack (glob)
+  $TESTTMP/hgcache/master/packs/*.histidx (glob)
+  $TESTTMP/hgcache/master/packs/*.histpack (glob)
+  $TESTTMP/hgcache/repos
+
+# A parallel repack over more partitions than files produces the same packs
+
+  $ rm -rf $CACHEDIR
+  $ cp -R $TESTTMP/loosecache $CACHEDIR
+  $ hg repack --config remotefilelog.parallelrepack=True \
+  > --config worker.numcpus=3 --config remotefilelog.repackpartitionsize=2
+  $ find $CACHEDIR -type f | sort > $TESTTMP/parallel
+  $ cmp $TESTTMP/serial $TESTTMP/parallel
+
+  $ hg cat -r 2 f2 copied
+  1
+  11
+  2
+  22
+  1
+  $ hg log -f copied -T '{rev}\n'
+  2
+  1
+  0
+
+# Repacking existing packs together with new loose files
+
+  $ echo 7 > ../master/f7
+  $ hg -R ../master commit -qAm f7
+  $ hg pull -q
+  $ hg prefetch -r tip
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ hg repack --config remotefilelog.parallelrepack=True \
+  > --config worker.numcpus=2
+  $ ls $CACHEDIR/master/packs | grep -c pack
+  2
+  $ hg cat -r tip f7
+  7
+
+# The benchmark doesn't modify the packs
+
+  $ ls $CACHEDIR/master/packs > $TESTTMP/before
+  $ hg debugrepackbench --config remotefilelog.parallelrepack=True \
+  > --config worker.numcpus=2
+  repacked 15 entries in * seconds (* entries/sec) (glob)
+  peak RSS: *, workers: * (glob)
+  data pack size: * (glob)
+  get latency: p50 * ms, p99 * ms (glob)
+  $ ls $CACHEDIR/master/packs | cmp - $TESTTMP/before
@@ -0,0 +1,69 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > serverpackcache=True
+  > serverpackcache.segmentsize=400
+  > EOF
+  $ for i in `$TESTDIR/seq.py 1 10`; do echo $i > file$i; done
+  $ hg commit -qAm files
+  $ for i in `$TESTDIR/seq.py 1 10`; do echo $i >> file$i; done
+  $ hg commit -qAm files2
+
+  $ cd ..
+
+# The blobs the server sends are appended to pack segments, not loose files
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  10 files fetched over 1 fetches - (10 misses, 0.00% hit ratio) over *s (glob)
+  $ test -d master/.hg/remotefilelogcache
+  [1]
+  $ ls master/.hg/remotefilelogpacks/*.blobpack | wc -l | tr -d ' '
+  3
+  $ ls master/.hg/remotefilelogpacks/*.blobidx | wc -l | tr -d ' '
+  3
+
+# and are served from them by the next server processes
+
+  $ cd shallow
+  $ hg up -q null
+  $ clearcache
+  $ hg up -q tip
+  10 files fetched over 1 fetches - (10 misses, 0.00% hit ratio) over *s (glob)
+  $ ls ../master/.hg/remotefilelogpacks/*.blobpack | wc -l | tr -d ' '
+  3
+  $ cat file3 file10
+  3
+  3
+  10
+  10
+
+# The other revisions fill the last segment, then go to new ones
+
+  $ hg up -q 0
+  10 files fetched over 1 fetches - (10 misses, 0.00% hit ratio) over *s (glob)
+  $ ls ../master/.hg/remotefilelogpacks/*.blobpack | wc -l | tr -d ' '
+  4
+  $ cat file5
+  5
+
+# gc expires whole segments, and the blobs still needed are rebuilt
+
+  $ cd ../master
+  $ hg gc --config remotefilelog.serverexpiration=-1
+  finished: removed 0 of 20 files (0.00 GB to 0.00 GB)
+  $ ls .hg/remotefilelogpacks
+  $ cd ../shallow
+  $ hg up -q null
+  $ clearcache
+  $ hg up -q tip
+  10 files fetched over 1 fetches - (10 misses, 0.00% hit ratio) over *s (glob)
+  $ cat file8
+  8
+  8
@@ -0,0 +1,78 @@
+  $ PYTHONPATH=$TESTDIR/..:$PYTHONPATH
+  $ export PYTHONPATH
+
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > serverworkers=2
+  > serverworkers.maxpending=3
+  > serverworkers.minbatch=4
+  > getpackcache=True
+  > EOF
+  $ for i in `$TESTDIR/seq.py 1 10`; do echo $i > file$i; done
+  $ hg commit -qAm files
+  $ for i in `$TESTDIR/seq.py 1 10`; do echo $i >> file$i; done
+  $ hg commit -qAm files2
+
+  $ cd ..
+
+# getfiles responses are built in the server process and then by the workers,
+# in the order requested
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  10 files fetched over 1 fetches - (10 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow
+  $ cat file3 file10
+  3
+  3
+  10
+  10
+
+# and are served from the server cache once it has them
+
+  $ hg up -q null
+  $ clearcache
+  $ hg up -q tip
+  10 files fetched over 1 fetches - (10 misses, 0.00% hit ratio) over *s (glob)
+  $ cat file7
+  7
+  7
+
+# getpack responses too, whether they are in the getpack cache or not
+
+  $ clearcache
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > fetchpacks=True
+  > EOF
+  $ hg prefetch -r 0
+  10 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg prefetch -r 'all()'
+  10 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ find ../master/.hg/getpackcache -mindepth 2 -type f | wc -l | tr -d ' '
+  20
+  $ clearcache
+  $ hg prefetch -r 'all()'
+  20 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg cat -r 0 file5
+  5
+  $ hg cat -r 1 file6
+  6
+  6
+
+# and when the client sends bases, the cached texts are turned into deltas
+# against them by the workers
+
+  $ hg up -q null
+  $ clearcache
+  $ hg up -q 0
+  10 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg prefetch -r 1 --config remotefilelog.fetchpackdeltas=True
+  10 files fetched over 1 fetches - (0 misses, 100.00% hit ratio) over *s (glob)
+  $ hg cat -r 1 file8
+  8
+  8
@@ -55,6 +55,9 @@
   > [fastmanifest]
   > usetree = True
   > usecache = False
+  > # The trees read are shared by the commands in .hg, which would hide
+  > # what is fetched
+  > sharedtreecachemb = 0
   > EOF
 
 Test prefetchtrees